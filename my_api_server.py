@@ -0,0 +1,484 @@
+#!/usr/bin/env python3
+# pip install -U flask waitress
+#
+# HTTP API бота для рисования (/bing, /images).
+# Раньше tb.run_flask запускал отладочный сервер flask (debug=True) в потоке бота,
+# а /images выполнял всю рассылку по провайдерам рисования прямо в потоке запроса.
+# Теперь запросы принимает многопоточный WSGI сервер (waitress, если его нет то werkzeug в threaded режиме),
+# работа идет заданиями в отдельном пуле my_executor 'api' с ограниченной очередью:
+#   POST /jobs {"type": "images"|"bing", "prompt": ...} -> 202 {"job_id"}
+#   GET /jobs/<id> - состояние, GET /jobs/<id>/results - готовые картинки (у images появляются по мере готовности)
+# Старые /bing и /images работают как раньше (создают задание и ждут его), у каждого клиента
+# (ip, заголовок X-Client-Id только подпись внутри ip - его может подменить кто угодно)
+# не больше API_MAX_CLIENT_JOBS незаконченных заданий.
+# GET /stats - задержки и пропускная способность.
+# Можно запустить отдельно от телеграм бота: python my_api_server.py [host] [port]
+
+
+import base64
+import collections
+import functools
+import json
+import re
+import threading
+import time
+import traceback
+import uuid
+from typing import Any, Dict, List, Union
+
+from flask import Flask, Response, jsonify, request
+
+import cfg
+import my_executor
+import my_genimg
+import my_log
+
+
+# сколько потоков принимают http запросы
+API_THREADS = cfg.API_THREADS if hasattr(cfg, 'API_THREADS') else 16
+# сколько незаконченных заданий может быть у одного клиента
+API_MAX_CLIENT_JOBS = cfg.API_MAX_CLIENT_JOBS if hasattr(cfg, 'API_MAX_CLIENT_JOBS') else 4
+# сколько прокси (nginx) перед сервером, их X-Forwarded-For дает настоящий ip клиента, 0 - без прокси
+API_PROXIES = cfg.API_PROXIES if hasattr(cfg, 'API_PROXIES') else 0
+# сколько ждать результата в синхронных /bing и /images, секунд
+API_SYNC_TIMEOUT = 300
+# сколько хранить законченные задания, секунд
+API_JOB_TTL = 600
+
+APP = Flask(__name__)
+if API_PROXIES:
+    from werkzeug.middleware.proxy_fix import ProxyFix
+    APP.wsgi_app = ProxyFix(APP.wsgi_app, x_for=API_PROXIES)
+
+LOCK = threading.Lock()
+# {job_id: _Job}, старые в начале
+JOBS: 'collections.OrderedDict[str, _Job]' = collections.OrderedDict()
+# {ip клиента: сколько незаконченных заданий}
+CLIENT_JOBS = collections.Counter()
+
+# метрики, {endpoint: [запросов, ошибок, сумма времени]}
+REQUESTS = collections.defaultdict(lambda: [0, 0, 0.0])
+# время выполнения последних заданий и моменты их завершения, для p95 и пропускной способности
+LATENCIES = collections.deque(maxlen=1000)
+FINISHED = collections.deque(maxlen=10000)
+REJECTED = 0
+
+
+class _Job:
+    __slots__ = ('id', 'type', 'prompt', 'client', 'client_id', 'status', 'results', 'error',
+                 'created', 'started', 'finished', 'changed')
+
+    def __init__(self, type_: str, prompt: str, client: str, client_id: str = ''):
+        self.id = uuid.uuid4().hex
+        self.type = type_
+        self.prompt = prompt
+        # ip, по нему лимиты и очередь, и X-Client-Id только для журнала
+        self.client = client
+        self.client_id = client_id
+        # queued, running, done, error
+        self.status = 'queued'
+        self.results: List[str] = []
+        self.error = ''
+        self.created = time.time()
+        self.started = 0.0
+        self.finished = 0.0
+        # будится при каждом новом результате и при завершении
+        self.changed = threading.Condition(LOCK)
+
+    def info(self) -> Dict[str, Any]:
+        '''Состояние задания для ответа, вызывать под LOCK'''
+        return {
+            'job_id': self.id,
+            'type': self.type,
+            'status': self.status,
+            'results': len(self.results),
+            'error': self.error,
+            'queued_for': round((self.started or self.finished or time.time()) - self.created, 3),
+            'running_for': round((self.finished or time.time()) - self.started, 3) if self.started else 0,
+        }
+
+
+def _encode(images: List[Union[str, bytes]]) -> List[str]:
+    '''Картинки в base64, ссылки как есть'''
+    return [base64.b64encode(x).decode('utf-8') if isinstance(x, bytes) else x for x in images]
+
+
+def _add_results(job: _Job, results: List[str]):
+    with LOCK:
+        job.results.extend(results)
+        job.changed.notify_all()
+
+
+def _run_job(job: _Job):
+    '''Выполняется в пуле my_executor 'api' '''
+    with LOCK:
+        job.status = 'running'
+        job.started = time.time()
+    try:
+        if job.type == 'bing':
+            _add_results(job, my_genimg.gen_images_bing_only(job.prompt) or [])
+        else:
+            for images in my_genimg.gen_images_iter(job.prompt, user_id='api_images'):
+                _add_results(job, _encode(images))
+            if not job.results:
+                prompt = job.prompt.strip()
+                # remove trailing !
+                prompt = re.sub(r'^!+', '', prompt).strip()
+                # Get English prompt and negative prompt using the function
+                reprompt, negative_prompt, preffered_aspect_ratio = my_genimg.get_reprompt(prompt)
+                if not reprompt.startswith('MODERATION'):
+                    _add_results(job, _encode(my_genimg.flux_nebius_gen1(reprompt, negative_prompt, model = 'black-forest-labs/flux-dev') or []))
+        status, error = 'done', ''
+    except Exception as e:
+        traceback_error = traceback.format_exc()
+        my_log.log_bing_api(f'my_api_server:run_job: {job.client} {job.client_id} {e}\n{traceback_error}')
+        status, error = 'error', str(e)
+    _finish(job, status, error)
+
+
+def _finish(job: _Job, status: str, error: str = ''):
+    now = time.time()
+    with LOCK:
+        job.status = status
+        job.error = error
+        job.finished = now
+        CLIENT_JOBS[job.client] -= 1
+        if CLIENT_JOBS[job.client] <= 0:
+            del CLIENT_JOBS[job.client]
+        if job.started:
+            LATENCIES.append(now - job.started)
+        FINISHED.append(now)
+        job.changed.notify_all()
+
+
+def _cleanup():
+    '''Удалить старые законченные задания, вызывать под LOCK'''
+    now = time.time()
+    expired = []
+    # задания в порядке создания, дальше первого молодого искать нечего
+    for job in JOBS.values():
+        if job.created + API_JOB_TTL > now:
+            break
+        if job.finished and job.finished + API_JOB_TTL < now:
+            expired.append(job.id)
+    for job_id in expired:
+        del JOBS[job_id]
+
+
+def _client() -> str:
+    '''ip клиента, заголовки клиент может подставить любые и обойти лимиты'''
+    return request.remote_addr or 'unknown'
+
+
+def _client_id() -> str:
+    '''X-Client-Id, подпись клиента внутри его ip'''
+    return request.headers.get('X-Client-Id', '')[:100]
+
+
+def submit(type_: str, prompt: str, client: str, client_id: str = '') -> _Job:
+    '''
+    Создать задание и поставить в очередь пула 'api'.
+    Returns:
+        задание или None если у клиента слишком много заданий или очередь полна
+    '''
+    global REJECTED
+    job = _Job(type_, prompt, client, client_id)
+    with LOCK:
+        _cleanup()
+        if CLIENT_JOBS[client] >= API_MAX_CLIENT_JOBS:
+            REJECTED += 1
+            return None
+        CLIENT_JOBS[client] += 1
+        JOBS[job.id] = job
+    if not my_executor.get_pool('api').submit(f'api:{client}', _run_job, (job,), {}):
+        with LOCK:
+            del JOBS[job.id]
+            CLIENT_JOBS[client] -= 1
+            if CLIENT_JOBS[client] <= 0:
+                del CLIENT_JOBS[client]
+            REJECTED += 1
+        return None
+    return job
+
+
+def wait(job: _Job, timeout: float) -> bool:
+    '''Дождаться завершения задания, False если не дождались'''
+    deadline = time.time() + timeout
+    with LOCK:
+        while job.status in ('queued', 'running'):
+            left = deadline - time.time()
+            if left <= 0:
+                return False
+            job.changed.wait(left)
+    return True
+
+
+def _metered(name: str):
+    '''Декоратор для обработчиков, считает запросы, ошибки (5xx) и время'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            status = 500
+            try:
+                response = func(*args, **kwargs)
+                status = response[1] if isinstance(response, tuple) else getattr(response, 'status_code', 200)
+                return response
+            finally:
+                with LOCK:
+                    item = REQUESTS[name]
+                    item[0] += 1
+                    item[1] += status >= 500
+                    item[2] += time.time() - start
+        return wrapper
+    return decorator
+
+
+def _get_prompt():
+    data: Dict[str, Any] = request.get_json(silent=True) or {}
+    return data, data.get('prompt', '')
+
+
+def _too_many():
+    return jsonify({"error": "Too many requests"}), 429
+
+
+@APP.route('/jobs', methods=['POST'])
+@_metered('POST /jobs')
+def jobs_post():
+    """
+    Submit an image generation job.
+
+    Request: {"prompt": "...", "type": "images" (all providers, default) or "bing"}
+    :return: 202 {"job_id": ...}, 429 if the client has too many unfinished jobs or the queue is full
+    """
+    data, prompt = _get_prompt()
+    if not prompt:
+        return jsonify({"error": "Prompt is required"}), 400
+    type_ = data.get('type', 'images')
+    if type_ not in ('images', 'bing'):
+        return jsonify({"error": "Unknown job type"}), 400
+    job = submit(type_, prompt, _client(), _client_id())
+    if not job:
+        return _too_many()
+    return jsonify({"job_id": job.id}), 202
+
+
+def _get_job(job_id: str) -> _Job:
+    with LOCK:
+        return JOBS.get(job_id)
+
+
+@APP.route('/jobs/<job_id>', methods=['GET'])
+@_metered('GET /jobs/<id>')
+def jobs_get(job_id: str):
+    """Job status"""
+    job = _get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    with LOCK:
+        return jsonify(job.info()), 200
+
+
+@APP.route('/jobs/<job_id>/results', methods=['GET'])
+@_metered('GET /jobs/<id>/results')
+def jobs_results(job_id: str):
+    """
+    Job results: URLs (str) or base64 encoded images (str).
+    Results of an 'images' job appear as each provider finishes, "status" tells whether more are coming.
+    """
+    job = _get_job(job_id)
+    if not job:
+        return jsonify({"error": "Job not found"}), 404
+    with LOCK:
+        info = job.info()
+        info['results'] = list(job.results)
+    return jsonify(info), 200
+
+
+@APP.route('/bing', methods=['POST'])
+@_metered('POST /bing')
+def bing_api_post():
+    """
+    API endpoint for generating images using Bing.
+
+    :return: A JSON response containing a list of URLs or an error message.
+    """
+    try:
+        data, prompt = _get_prompt()
+        if not prompt:
+            return jsonify({"error": "Prompt is required"}), 400
+
+        job = submit('bing', prompt, _client(), _client_id())
+        if not job:
+            return _too_many()
+        if not wait(job, API_SYNC_TIMEOUT):
+            return jsonify({"error": "Timeout", "job_id": job.id}), 504
+        if job.status == 'error':
+            return jsonify({"error": job.error}), 500
+        if not job.results:
+            return jsonify({"error": "No images generated"}), 404
+
+        return jsonify({"urls": job.results}), 200
+    except Exception as e:
+        my_log.log_bing_api(f'my_api_server:bing_api_post: {e}')
+        return jsonify({"error": str(e)}), 500
+
+
+def _stream(job: _Job):
+    """
+    Generator for the streaming /images response: one JSON line per finished provider,
+    an {"error": ...} line if nothing was generated.
+    """
+    sent = 0
+    deadline = time.time() + API_SYNC_TIMEOUT
+    while True:
+        with LOCK:
+            while len(job.results) == sent and job.status in ('queued', 'running') and time.time() < deadline:
+                job.changed.wait(deadline - time.time())
+            new = job.results[sent:]
+            status = job.status
+        if new:
+            sent += len(new)
+            yield json.dumps({"results": new}) + '\n'
+        elif status == 'error':
+            yield json.dumps({"error": job.error}) + '\n'
+            return
+        elif status == 'done' or time.time() >= deadline:
+            if not sent:
+                yield json.dumps({"error": "No images generated" if status == 'done' else "Timeout"}) + '\n'
+            return
+
+
+@APP.route('/images', methods=['POST'])
+@_metered('POST /images')
+def images_api_post():
+    """
+    API endpoint for generating images using all providers.
+
+    With {"stream": true} in the request the response is newline delimited JSON,
+    one {"results": [...]} line as soon as each provider finishes.
+
+    :return: A JSON response containing a list of URLs (str) or base64 encoded image data (str) or an error message.
+    """
+    try:
+        data, prompt = _get_prompt()
+        if not prompt:
+            return jsonify({"error": "Prompt is required"}), 400
+
+        job = submit('images', prompt, _client(), _client_id())
+        if not job:
+            return _too_many()
+
+        if data.get('stream'):
+            return Response(_stream(job), mimetype='application/x-ndjson')
+
+        if not wait(job, API_SYNC_TIMEOUT):
+            return jsonify({"error": "Timeout", "job_id": job.id}), 504
+        if job.status == 'error':
+            return jsonify({"error": job.error}), 500
+        if not job.results:
+            return jsonify({"error": "No images generated"}), 404
+
+        return jsonify({"results": job.results}), 200
+    except Exception as e:
+        my_log.log_bing_api(f'my_api_server:images_api_post: {e}')
+        return jsonify({"error": str(e)}), 500
+
+
+def stats() -> Dict[str, Any]:
+    '''Метрики: запросы по адресам, задания, задержка выполнения, пропускная способность'''
+    now = time.time()
+    with LOCK:
+        latencies = sorted(LATENCIES)
+        finished_1m = sum(1 for x in FINISHED if x > now - 60)
+        jobs = collections.Counter(x.status for x in JOBS.values())
+        requests_ = {k: {'count': v[0], 'errors': v[1], 'avg_time': round(v[2] / v[0], 3) if v[0] else 0}
+                     for k, v in REQUESTS.items()}
+        clients = len(CLIENT_JOBS)
+    return {
+        'requests': requests_,
+        'jobs': dict(jobs),
+        'clients_with_jobs': clients,
+        'rejected': REJECTED,
+        'job_time_avg': round(sum(latencies) / len(latencies), 3) if latencies else 0,
+        'job_time_p95': round(latencies[int(len(latencies) * 0.95)], 3) if latencies else 0,
+        'jobs_per_minute': finished_1m,
+        'pool': my_executor.get_pool('api').stats(),
+    }
+
+
+@APP.route('/stats', methods=['GET'])
+def stats_get():
+    return jsonify(stats()), 200
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats бота'''
+    s = stats()
+    return (f"jobs: {s['jobs']}, per minute: {s['jobs_per_minute']}, avg {s['job_time_avg']}s, "
+            f"p95 {s['job_time_p95']}s, rejected: {s['rejected']}")
+
+
+class _WerkzeugServer:
+    '''werkzeug сервер с теми же run() и close() что у waitress'''
+    def __init__(self, addr: str, port: int, app: Flask):
+        from werkzeug.serving import make_server
+        self.server = make_server(addr, port, app, threaded=True)
+
+    def run(self):
+        self.server.serve_forever()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def create_server(addr: str = '127.0.0.1', port: int = 58796, app: Flask = None):
+    '''http сервер для app (по умолчанию APP): run() - работать (блокирует), close() - остановить'''
+    app = app or APP
+    try:
+        import waitress
+        my_log.log_bing_api(f'my_api_server: {app.name} waitress on {addr}:{port}, {API_THREADS} threads')
+        return waitress.create_server(app, host=addr, port=port, threads=API_THREADS, ident='')
+    except ImportError:
+        my_log.log_bing_api(f'my_api_server: {app.name} waitress is not installed, werkzeug threaded server on {addr}:{port}')
+        return _WerkzeugServer(addr, port, app)
+
+
+def serve(addr: str = '127.0.0.1', port: int = 58796, app: Flask = None):
+    '''Запустить http сервер для app (по умолчанию APP), блокирует'''
+    create_server(addr, port, app).run()
+
+
+def start(addr: str = '127.0.0.1', port: int = 58796):
+    '''Запустить http сервер в фоне, для tb'''
+    def run():
+        try:
+            serve(addr, port)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log_bing_api(f'my_api_server:start: {error}\n{traceback_error}')
+
+    threading.Thread(target=run, name='my_api_server', daemon=True).start()
+
+
+if __name__ == '__main__':
+    pass
+
+    import sys
+
+    import my_db
+    import my_gemini_general
+    import my_groq
+    import my_mistral
+
+    my_db.init(backup=False)
+    my_groq.load_users_keys()
+    my_gemini_general.load_users_keys()
+    my_mistral.load_users_keys()
+
+    try:
+        serve(sys.argv[1] if len(sys.argv) > 1 else '127.0.0.1', int(sys.argv[2]) if len(sys.argv) > 2 else 58796)
+    finally:
+        my_db.close()
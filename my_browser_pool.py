@@ -0,0 +1,214 @@
+#!/usr/bin/env python3
+# pip install -U playwright
+# playwright install chromium
+#
+# Пул заранее запущенных headless chromium для рендеринга html, таблиц, анимаций и чтения страниц.
+# Раньше каждый вызов делал sync_playwright() + chromium.launch() и платил 1-3 секунды за запуск браузера.
+# Теперь BROWSER_POOL_SIZE браузеров работают постоянно, каждое задание получает свежий контекст
+# и страницу в уже запущенном браузере. Объекты sync playwright привязаны к своему потоку,
+# поэтому у каждого браузера свой поток, а задания передаются через общую очередь.
+# Браузер перезапускается если он упал или после BROWSER_MAX_USES заданий (утечки памяти chromium),
+# драйвер playwright - если браузер не запускается.
+# У задания абсолютный срок (время в очереди тоже считается), просроченное задание не запускается,
+# а длинные циклы внутри func должны вызывать check_deadline(), иначе браузер занят до их конца.
+
+
+import concurrent.futures
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict
+
+from playwright.sync_api import sync_playwright
+
+import cfg
+import my_log
+
+
+# сколько браузеров держать запущенными
+BROWSER_POOL_SIZE = cfg.BROWSER_POOL_SIZE if hasattr(cfg, 'BROWSER_POOL_SIZE') else 2
+# перезапускать браузер после стольких заданий
+BROWSER_MAX_USES = cfg.BROWSER_MAX_USES if hasattr(cfg, 'BROWSER_MAX_USES') else 100
+# таймаут задания по умолчанию, секунд
+JOB_TIMEOUT = 120
+LAUNCH_ARGS = ['--disable-dev-shm-usage', '--disable-extensions']
+
+# _Job или None - остановить поток
+QUEUE = queue.Queue()
+
+# срок текущего задания в потоке браузера
+_local = threading.local()
+
+LOCK = threading.Lock()
+WORKERS = []
+
+# метрики
+JOBS = 0
+ERRORS = 0
+TIMEOUTS = 0
+RESTARTS = 0
+
+
+class _Job:
+    __slots__ = ('func', 'context_options', 'deadline', 'future')
+
+    def __init__(self, func: Callable, context_options: Dict[str, Any], deadline: float):
+        self.func = func
+        self.context_options = context_options
+        self.deadline = deadline
+        self.future = concurrent.futures.Future()
+
+
+def remaining() -> float:
+    '''Сколько секунд осталось у текущего задания (внутри func), вне пула бесконечность'''
+    deadline = getattr(_local, 'deadline', None)
+    return float('inf') if deadline is None else deadline - time.time()
+
+
+def check_deadline():
+    '''Вызывать внутри func в длинных циклах, TimeoutError если вызывающий уже не ждет'''
+    if remaining() <= 0:
+        raise TimeoutError('my_browser_pool: job deadline passed')
+
+
+def _worker(n: int):
+    '''Поток одного браузера'''
+    global RESTARTS, ERRORS, TIMEOUTS
+    playwright = None
+    browser = None
+    uses = 0
+    while True:
+        job = QUEUE.get()
+        if job is None:
+            break
+        if not job.future.set_running_or_notify_cancel():
+            # вызывающий уже не ждет
+            continue
+        if time.time() >= job.deadline:
+            # простояло в очереди весь свой срок
+            TIMEOUTS += 1
+            job.future.set_exception(TimeoutError('my_browser_pool: job expired in queue'))
+            continue
+
+        try:
+            # проверка здоровья и перезапуск
+            if browser is not None and (not browser.is_connected() or uses >= BROWSER_MAX_USES):
+                try:
+                    browser.close()
+                except Exception:
+                    pass
+                browser = None
+                RESTARTS += 1
+            if playwright is None:
+                playwright = sync_playwright().start()
+            if browser is None:
+                try:
+                    browser = playwright.chromium.launch(headless=True, args=LAUNCH_ARGS)
+                except Exception:
+                    # возможно умер сам драйвер, следующее задание запустит его заново
+                    try:
+                        playwright.stop()
+                    except Exception:
+                        pass
+                    playwright = None
+                    RESTARTS += 1
+                    raise
+                uses = 0
+
+            uses += 1
+            context = browser.new_context(**job.context_options)
+            _local.deadline = job.deadline
+            try:
+                context.set_default_timeout(max(1.0, job.deadline - time.time()) * 1000)
+                page = context.new_page()
+                result = job.func(page)
+            finally:
+                _local.deadline = None
+                try:
+                    context.close()
+                except Exception:
+                    pass
+            job.future.set_result(result)
+        except Exception as error:
+            ERRORS += 1
+            job.future.set_exception(error)
+            if browser is not None and not browser.is_connected():
+                browser = None
+                RESTARTS += 1
+
+    # остановка
+    try:
+        if browser is not None:
+            browser.close()
+        if playwright is not None:
+            playwright.stop()
+    except Exception as error:
+        my_log.log_playwright(f'my_browser_pool:worker {n} stop: {error}')
+
+
+def _start_workers():
+    with LOCK:
+        if WORKERS:
+            return
+        for n in range(max(1, BROWSER_POOL_SIZE)):
+            thread = threading.Thread(target=_worker, args=(n,), name=f'my_browser_pool {n}', daemon=True)
+            thread.start()
+            WORKERS.append(thread)
+
+
+def run(func: Callable, timeout: float = JOB_TIMEOUT, **context_options) -> Any:
+    '''
+    Выполнить func(page) в одном из браузеров пула и вернуть ее результат.
+
+    Args:
+        func: функция от playwright Page, выполняется в потоке браузера,
+              в длинных циклах должна вызывать check_deadline()
+        timeout: сколько ждать результата, секунд (включая очередь), остаток срока - таймаут по умолчанию для операций страницы
+        context_options: параметры browser.new_context, например viewport={'width': 800, 'height': 600}
+
+    Raises:
+        TimeoutError если задание не выполнено за timeout, и исключения из func
+    '''
+    global JOBS, TIMEOUTS
+    _start_workers()
+    job = _Job(func, context_options, time.time() + timeout)
+    QUEUE.put(job)
+    JOBS += 1
+    try:
+        return job.future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        TIMEOUTS += 1
+        # если еще не началось то и не начнется, если выполняется - упадет по таймауту страницы
+        job.future.cancel()
+        raise TimeoutError(f'my_browser_pool: job timed out after {timeout}s')
+
+
+def shutdown():
+    '''Закрыть все браузеры, при выключении бота'''
+    with LOCK:
+        workers = list(WORKERS)
+        WORKERS.clear()
+    for _ in workers:
+        QUEUE.put(None)
+    for thread in workers:
+        thread.join(timeout=10)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    return (f'browsers: {len(WORKERS)}, queue: {QUEUE.qsize()}, jobs: {JOBS}, errors: {ERRORS}, '
+            f'timeouts: {TIMEOUTS}, restarts: {RESTARTS}')
+
+
+if __name__ == '__main__':
+    pass
+
+    def title(page):
+        page.set_content('<html><head><title>test</title></head><body>hello</body></html>')
+        return page.title(), page.inner_text('body')
+
+    for _ in range(3):
+        start = time.time()
+        print(run(title, viewport={'width': 800, 'height': 600}), f'{time.time() - start:.2f}s')
+    print(get_stats())
+    shutdown()
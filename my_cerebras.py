@@ -13,17 +13,20 @@ from typing import Any, Dict, List, Optional, Tuple
 
 
 import langcodes
-from cerebras.cloud.sdk import Cerebras
 from sqlitedict import SqliteDict
 
 import cfg
 import my_cerebras_tools
 import my_db
+import my_hedge
+import my_key_scheduler
+import my_llm_clients
 import my_log
 import my_skills
 import my_skills_general
 import my_skills_storage
 import utils
+import utils_llm
 
 
 MODEL_GPT_OSS_120B = 'gpt-oss-120b'
@@ -61,8 +64,9 @@ MAX_TOOL_OUTPUT_LEN = 30000
 ALL_KEYS = []
 USER_KEYS = SqliteDict('db/cerebras_user_keys.db', autocommit=True)
 USER_KEYS_LOCK = threading.Lock()
-CURRENT_KEYS_SET_LOCK = threading.Lock()
-CURRENT_KEYS_SET = []
+# планировщик ключей из ALL_KEYS, заполняется в load_users_keys()
+KEY_DAILY_QUOTA = cfg.CEREBRAS_KEY_DAILY_QUOTA if hasattr(cfg, 'CEREBRAS_KEY_DAILY_QUOTA') else 0
+KEYS = my_key_scheduler.get_scheduler('cerebras', KEY_DAILY_QUOTA)
 
 
 funcs = [
@@ -284,7 +288,7 @@ def ai(
             return ''
 
         try:
-            client = Cerebras(api_key=api_key)
+            client = my_llm_clients.get_client('cerebras', api_key)
 
             # Base parameters for all API calls
             sdk_params: Dict[str, Any] = {
@@ -323,6 +327,7 @@ def ai(
                     message = response.choices[0].message
 
                     if not message.tool_calls:
+                        KEYS.report_success(api_key)
                         return message.content or ""
 
                     # Append the assistant's response to memory, which contains the tool calls.
@@ -368,6 +373,7 @@ def ai(
                     raise TimeoutError(f"Global timeout of {effective_timeout}s exceeded before final summarization.")
 
                 final_response = client.chat.completions.create(**final_params)
+                KEYS.report_success(api_key)
                 return final_response.choices[0].message.content or ""
 
             # --- 3. Non-tool path, now much simpler ---
@@ -377,7 +383,9 @@ def ai(
 
                 sdk_params['max_completion_tokens'] = max_tokens
 
+                request_start = time.monotonic()
                 chat_completion = client.chat.completions.create(**sdk_params)
+                KEYS.report_success(api_key, time.monotonic() - request_start)
                 result = chat_completion.choices[0].message.content or ''
 
                 if result:
@@ -401,9 +409,12 @@ def ai(
                         continue  # Continue to the next attempt with the shortened mem_
                 # If we cannot trim or it's the last attempt, we will fall through and return empty
 
+            if 'Error code: 429' in error_str:
+                KEYS.report_rate_limit(api_key, my_key_scheduler.retry_after(error))
             if 'Please try again soon.' in error_str:
                 return ''
             if 'Request timed out.' in error_str or 'Global timeout' in error_str:
+                KEYS.report_failure(api_key)
                 return ''
             if 'Wrong API key' in error_str:
                 if not key_:
@@ -497,6 +508,9 @@ def chat(
 
 
     with lock:
+        # запасной вариант в my_hedge.run, основной уже ответил
+        if my_hedge.is_cancelled():
+            return ''
         mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
 
         text = ai(
@@ -511,7 +525,7 @@ def chat(
             available_tools=available_tools
         )
 
-        if text and not do_not_update_history:
+        if text and not do_not_update_history and my_hedge.claim():
             my_db.add_msg(chat_id, model)
             mem += [{'role': 'user', 'content': query}]
             mem += [{'role': 'assistant', 'content': text}]
@@ -787,6 +801,60 @@ TEXT:
         return ''
 
 
+def translate_batch(
+    items: List[Tuple[str, str]],
+    to_lang: str,
+    from_lang: str = '',
+    model: str = MODEL_QWEN_3_235B_A22B_INSTRUCT
+) -> List[str]:
+    """
+    Translates many strings with one request using native JSON Schema enforcement.
+
+    Args:
+        items (List[Tuple[str, str]]): List of tuples (text, help).
+        to_lang (str): The target language code.
+        from_lang (str): The source language code. Autodetects if empty.
+        model (str): The specific AI model to use for the translation.
+
+    Returns:
+        List[str]: Translations in the same order, '' for items that were not translated.
+    """
+    if not items:
+        return []
+
+    batch_schema: Dict[str, Any] = {
+        "type": "object",
+        "properties": {
+            "translations": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {
+                        "id": {"type": "integer"},
+                        "translation": {"type": "string"}
+                    },
+                    "required": ["id", "translation"],
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["translations"],
+        "additionalProperties": False
+    }
+
+    prompt = utils_llm.build_batch_translate_prompt(items, to_lang, from_lang)
+    json_response = ai(
+        mem=[{"role": "user", "content": prompt}],
+        user_id='translate_service',
+        temperature=0.1,
+        model=model,
+        response_format='json',
+        json_schema=batch_schema,
+        timeout=60
+    )
+    return utils_llm.parse_batch_translation(json_response, len(items))
+
+
 def list_models() -> Optional[List[str]]:
     """
     Retrieves a list of available models for a given user.
@@ -804,9 +872,7 @@ def list_models() -> Optional[List[str]]:
         return None
 
     try:
-        client = Cerebras(
-            api_key=key,
-        )
+        client = my_llm_clients.get_client('cerebras', key)
         model_list = client.models.list()
         result: List[str] = [x.id for x in model_list.data]
         return result
@@ -860,18 +926,21 @@ def format_models_for_telegram(models: List[str]) -> str:
 
 def get_next_key() -> str:
     '''
-    Return round robin key from ALL_KEYS
+    Return best key from ALL_KEYS (see my_key_scheduler), '' if there are no keys
     '''
-    with CURRENT_KEYS_SET_LOCK:
-        global CURRENT_KEYS_SET
-        if not CURRENT_KEYS_SET:
-            if ALL_KEYS:
-                CURRENT_KEYS_SET = ALL_KEYS[:]
-
-        if CURRENT_KEYS_SET:
-            return CURRENT_KEYS_SET.pop(0)
-        else:
-            return ''
+    return KEYS.get_key()
+
+
+def add_user_key(user: str, key: str):
+    '''Save user's key and add it to ALL_KEYS'''
+    with USER_KEYS_LOCK:
+        old_key = USER_KEYS.get(user)
+        if old_key and old_key != key:
+            KEYS.remove_owner(old_key, user)
+        USER_KEYS[user] = key
+        if key not in ALL_KEYS:
+            ALL_KEYS.append(key)
+    KEYS.add_key(key, user)
 
 
 def test_key(key: str) -> bool:
@@ -886,6 +955,7 @@ def load_users_keys():
     """
     Load users' keys into memory and update the list of all keys available.
     """
+    owners = {}
     with USER_KEYS_LOCK:
         global USER_KEYS, ALL_KEYS
         ALL_KEYS = cfg.CEREBRAS_KEYS if hasattr(cfg, 'CEREBRAS_KEYS') and cfg.CEREBRAS_KEYS else []
@@ -893,6 +963,8 @@ def load_users_keys():
             key = USER_KEYS[user]
             if key not in ALL_KEYS:
                 ALL_KEYS.append(key)
+            owners.setdefault(key, []).append(user)
+    KEYS.set_keys(ALL_KEYS, owners)
 
 
 def remove_key(key: str):
@@ -910,9 +982,9 @@ def remove_key(key: str):
         keys_to_delete = []
 
         with USER_KEYS_LOCK:
-            # remove key from USER_KEYS
-            for user in USER_KEYS:
-                if USER_KEYS[user] == key:
+            # remove key from USER_KEYS, owners come from the scheduler's reverse index
+            for user in KEYS.remove_key(key):
+                if USER_KEYS.get(user) == key:
                     keys_to_delete.append(user)
 
             for user_key in keys_to_delete:
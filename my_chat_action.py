@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# Общий планировщик статусов "печатает...", "отправляет фото..." для tb.ShowAction.
+# Вместо отдельного потока на каждый запрос - один поток на всех.
+# Для каждого чата (chat_id, thread_id) отправляется не больше одного статуса за INTERVAL,
+# сколько бы запросов в этом чате ни выполнялось одновременно.
+# После ответа 429 (Too Many Requests) все отправки приостанавливаются на retry_after.
+# Сами запросы к телеграму делает небольшой пул потоков с коротким таймаутом, поток
+# планировщика на сеть не ждет, и один зависший запрос не задерживает статусы остальных чатов.
+
+
+import concurrent.futures
+import itertools
+import threading
+import time
+import traceback
+from typing import Dict, Set, Tuple
+
+import cfg
+import my_log
+
+
+# телеграм гасит статус через 5 секунд
+INTERVAL = 5
+# пауза после 429 если телеграм не сказал сколько ждать
+DEFAULT_BACKOFF = 5
+# сколько статусов отправлять одновременно и сколько ждать ответа телеграма, секунд
+CHAT_ACTION_SENDERS = cfg.CHAT_ACTION_SENDERS if hasattr(cfg, 'CHAT_ACTION_SENDERS') else 8
+CHAT_ACTION_TIMEOUT = cfg.CHAT_ACTION_TIMEOUT if hasattr(cfg, 'CHAT_ACTION_TIMEOUT') else 5
+
+# задается в init(), telebot.TeleBot
+BOT = None
+
+LOCK = threading.Lock()
+WAKEUP = threading.Condition(LOCK)
+# {(chat_id, thread_id): {handle: (action, deadline, is_topic)}}
+ACTIVE: Dict[Tuple[int, int], Dict[int, Tuple[str, float, bool]]] = {}
+# {(chat_id, thread_id): когда отправлять следующий статус}
+NEXT_SEND: Dict[Tuple[int, int], float] = {}
+# не отправлять ничего до этого времени (429)
+BACKOFF_UNTIL = 0.0
+# чаты для которых отправка еще выполняется, второй раз в очередь их не ставим
+IN_FLIGHT: Set[Tuple[int, int]] = set()
+
+SENDERS = concurrent.futures.ThreadPoolExecutor(max_workers=CHAT_ACTION_SENDERS, thread_name_prefix='my_chat_action')
+
+_HANDLES = itertools.count(1)
+WORKER_STARTED = False
+
+# метрики
+SENT = 0
+ERRORS = 0
+BACKOFFS = 0
+SKIPPED = 0
+
+
+def init(bot):
+    '''Запомнить бота и запустить поток планировщика'''
+    global BOT, WORKER_STARTED
+    BOT = bot
+    with LOCK:
+        if WORKER_STARTED:
+            return
+        WORKER_STARTED = True
+    threading.Thread(target=worker, name='my_chat_action', daemon=True).start()
+
+
+def add(chat_id: int, thread_id: int, action: str, is_topic: bool, max_timeout: float) -> int:
+    '''
+    Начать показывать статус action в чате, не дольше max_timeout секунд.
+
+    Returns:
+        int: номер для remove()
+    '''
+    handle = next(_HANDLES)
+    key = (chat_id, thread_id)
+    with LOCK:
+        ACTIVE.setdefault(key, {})[handle] = (action, time.time() + max_timeout, is_topic)
+        # последний добавленный статус виден сразу, не ждем следующего интервала
+        NEXT_SEND[key] = 0
+        WAKEUP.notify()
+    return handle
+
+
+def remove(chat_id: int, thread_id: int, handle: int) -> bool:
+    '''Перестать показывать статус, True если в этом чате больше не осталось статусов'''
+    key = (chat_id, thread_id)
+    with LOCK:
+        handles = ACTIVE.get(key)
+        if handles is None:
+            return True
+        handles.pop(handle, None)
+        if handles:
+            return False
+        del ACTIVE[key]
+        NEXT_SEND.pop(key, None)
+        return True
+
+
+def _retry_after(error: Exception) -> float:
+    '''Сколько ждать после 429, из ответа телеграма'''
+    try:
+        return float(error.result_json['parameters']['retry_after'])
+    except Exception:
+        return DEFAULT_BACKOFF
+
+
+def _collect_due(now: float) -> list:
+    '''Убрать просроченные статусы и вернуть те что пора отправить, вызывать под LOCK'''
+    due = []
+    for key in list(ACTIVE.keys()):
+        handles = ACTIVE[key]
+        for handle in [h for h, (_, deadline, _) in handles.items() if deadline < now]:
+            del handles[handle]
+        if not handles:
+            del ACTIVE[key]
+            NEXT_SEND.pop(key, None)
+            continue
+        if NEXT_SEND.get(key, 0) <= now:
+            # в одном чате показываем только самый свежий статус
+            action, _, is_topic = handles[max(handles)]
+            due.append((key, action, is_topic))
+            NEXT_SEND[key] = now + INTERVAL
+    return due
+
+
+def _send(key: Tuple[int, int], action: str, is_topic: bool):
+    '''Выполняется в пуле SENDERS'''
+    global SENT, ERRORS, BACKOFF_UNTIL, BACKOFFS
+    chat_id, thread_id = key
+    try:
+        if is_topic:
+            BOT.send_chat_action(chat_id, action, message_thread_id = thread_id, timeout=CHAT_ACTION_TIMEOUT)
+        else:
+            BOT.send_chat_action(chat_id, action, timeout=CHAT_ACTION_TIMEOUT)
+        SENT += 1
+    except Exception as error:
+        ERRORS += 1
+        if 'Error code: 429' in str(error):
+            with LOCK:
+                BACKOFF_UNTIL = max(BACKOFF_UNTIL, time.time() + _retry_after(error))
+                BACKOFFS += 1
+        elif 'Forbidden: bot was blocked by the user' in str(error):
+            with LOCK:
+                ACTIVE.pop(key, None)
+                NEXT_SEND.pop(key, None)
+        else:
+            my_log.log2(f'my_chat_action:send: {error} | {key}')
+    finally:
+        with LOCK:
+            IN_FLIGHT.discard(key)
+
+
+def worker():
+    '''Поток планировщика, отправки передает в SENDERS'''
+    global SKIPPED
+    while True:
+        try:
+            with LOCK:
+                while True:
+                    now = time.time()
+                    if not ACTIVE:
+                        WAKEUP.wait()
+                        continue
+                    if BACKOFF_UNTIL > now:
+                        WAKEUP.wait(BACKOFF_UNTIL - now)
+                        continue
+                    due = _collect_due(now)
+                    if due:
+                        break
+                    next_time = min(NEXT_SEND.values(), default=now + INTERVAL)
+                    WAKEUP.wait(max(0.05, next_time - now))
+
+            if BOT is None:
+                continue
+            for key, action, is_topic in due:
+                if BACKOFF_UNTIL > time.time():
+                    # не успели отправить, попробуем после паузы
+                    with LOCK:
+                        if key in NEXT_SEND:
+                            NEXT_SEND[key] = 0
+                    continue
+                with LOCK:
+                    if key in IN_FLIGHT:
+                        # прошлый статус этого чата еще отправляется, этот пропускаем
+                        SKIPPED += 1
+                        continue
+                    IN_FLIGHT.add(key)
+                SENDERS.submit(_send, key, action, is_topic)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_chat_action:worker: {error}\n\n{traceback_error}')
+            time.sleep(1)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        backoff = max(0, BACKOFF_UNTIL - time.time())
+        return (f'chats: {len(ACTIVE)}, requests: {sum(len(x) for x in ACTIVE.values())}, '
+                f'sent: {SENT}, errors: {ERRORS}, 429: {BACKOFFS}, in flight: {len(IN_FLIGHT)}, '
+                f'skipped: {SKIPPED}, backoff: {backoff:.1f}s')
+
+
+if __name__ == '__main__':
+    pass
+
+    class _FakeBot:
+        def send_chat_action(self, chat_id, action, **kwargs):
+            print(time.strftime('%H:%M:%S'), chat_id, action, kwargs.get('message_thread_id'))
+
+    init(_FakeBot())
+    h1 = add(1, None, 'typing', False, 60)
+    h2 = add(1, None, 'upload_photo', False, 60)
+    h3 = add(2, 5, 'typing', True, 60)
+    time.sleep(11)
+    remove(1, None, h2)
+    time.sleep(6)
+    print(get_stats())
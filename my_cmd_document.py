@@ -3,6 +3,7 @@
 # Standard library imports
 import io
 import threading
+import time
 import traceback
 from typing import Any, Callable, Dict, List, Type
 
@@ -13,6 +14,7 @@ import telebot
 import cfg
 import my_db
 import my_doc_translate
+import my_imgproc
 import my_init
 import my_log
 import my_mistral
@@ -150,14 +152,28 @@ def handle_document(
                     if caption.startswith('!tr '):
                         target_lang = caption[4:].strip()
                         if target_lang:
-                            bot_reply_tr(message, 'Translating it will take some time...')
+                            progress_text = tr('Translating it will take some time...', lang)
+                            progress_msg = bot.reply_to(message, progress_text)
+                            last_update = [0.0]
+
+                            def progress(done: int, total: int):
+                                # не чаще раза в 3 секунды, телеграм не любит частые правки
+                                if done < total and time.time() - last_update[0] < 3:
+                                    return
+                                last_update[0] = time.time()
+                                try:
+                                    bot.edit_message_text(f'{progress_text} {done}/{total}', chat_id=progress_msg.chat.id, message_id=progress_msg.message_id)
+                                except Exception as error:
+                                    my_log.log2(f'my_cmd_document:handle_document: translate progress: {error}')
+
                             new_fname = message.document.file_name if hasattr(message, 'document') else 'noname.txt'
                             new_data = my_doc_translate.translate_file_in_dialog(
                                 downloaded_file,
                                 lang,
                                 target_lang,
                                 fname = new_fname,
-                                chat_id_full = chat_id_full)
+                                chat_id_full = chat_id_full,
+                                progress = progress)
                             if new_data:
                                 new_fname2 = f'(translated by @{_bot_name}) {new_fname}'
                                 m = send_document(
@@ -211,7 +227,7 @@ def handle_document(
                                 bot_reply_tr(message, f'Unknown image type {message.document.mime_type}')
                                 return
                             image = utils.resize_image_dimention(image)
-                            image = utils.resize_image(image)
+                            image = my_imgproc.process('resize_image', image)
                             #send converted image back
                             m = send_photo(
                                 message,
@@ -181,8 +181,70 @@ def image_gen(
                 with ShowAction(message, 'upload_photo', max_timeout = show_timeout):
                     moderation_flag = False
 
+                    bot_addr = f'https://t.me/{_bot_name}'
+
+                    def make_media(i: Union[str, bytes]):
+                        '''Картинка или ссылка -> InputMediaPhoto с подписью, None если не годится'''
+                        d = None
+                        caption_ = re.sub(r"(\s)\1+", r"\1\1", prompt)[:900]
+                        # caption_ = prompt[:900]
+                        if isinstance(i, str):
+                            d = utils.download_image_as_bytes(i)
+                            if len(d) < 2000: # placeholder?
+                                return None
+                            if GPT_FLAG:
+                                caption_ = f'{bot_addr} bing.com - gpt4o\n\n' + caption_
+                                my_db.add_msg(chat_id_full, 'img ' + 'bing.com_gtp4o')
+                            else:
+                                caption_ = f'{bot_addr} bing.com - dalle\n\n' + caption_
+                                my_db.add_msg(chat_id_full, 'img ' + 'bing.com')
+                        elif isinstance(i, bytes):
+                            if utils.fast_hash(i) in my_genimg.WHO_AUTOR:
+                                nn_ = '\n\n'
+                                author = my_genimg.WHO_AUTOR[utils.fast_hash(i)]
+                                caption_ = f"{bot_addr} {author}{nn_}{caption_}"
+                                my_db.add_msg(chat_id_full, 'img ' + author)
+                                del my_genimg.WHO_AUTOR[utils.fast_hash(i)]
+                            else:
+                                caption_ = f'{bot_addr} error'
+                            d = i
+                        if d:
+                            try:
+                                return telebot.types.InputMediaPhoto(d, caption = caption_[:900])
+                            except Exception as add_media_error:
+                                error_traceback = traceback.format_exc()
+                                my_log.log2(f'my_cmd_img:image:add_media_bytes: {add_media_error}\n\n{error_traceback}')
+                        return None
+
+                    # делим картинки на группы до 10шт в группе, телеграм не пропускает больше за 1 раз
+                    def split_medias(medias: list) -> list:
+                        chunk_size = 10
+                        return [medias[i:i + chunk_size] for i in range(0, len(medias), chunk_size)]
+
+                    # картинки которые уже отправлены юзеру по мере готовности провайдеров
+                    streamed_medias = []
+                    streamed_ids = set()
+
+                    def stream_images(use_bing: bool) -> list:
+                        '''Рисуем всеми провайдерами, готовые картинки сразу отправляем юзеру'''
+                        images = []
+                        for batch in my_genimg.gen_images_iter(prompt, moderation_flag, chat_id_full, conversation_history, use_bing = use_bing):
+                            images += batch
+                            # ссылки и ошибки (строки) разбираются в конце, когда видно все результаты
+                            medias = []
+                            for i in batch:
+                                if isinstance(i, bytes):
+                                    streamed_ids.add(id(i))
+                                    media = make_media(i)
+                                    if media:
+                                        medias.append(media)
+                            if medias:
+                                send_images_to_user(split_medias(medias), message, chat_id_full, medias, batch)
+                                streamed_medias.extend(medias)
+                        return images
+
                     if NSFW_FLAG:
-                        images = my_genimg.gen_images(prompt, moderation_flag, chat_id_full, conversation_history, use_bing = False)
+                        images = stream_images(use_bing = False)
                     else:
                         if BING_FLAG:
                             bf = BING_FAILS[chat_id_full] if chat_id_full in BING_FAILS else [0, 0]
@@ -213,7 +275,7 @@ def image_gen(
                                 images = []
                                 time.sleep(random.randint(20,30))
                         else:
-                            images = my_genimg.gen_images(prompt, moderation_flag, chat_id_full, conversation_history, use_bing = True)
+                            images = stream_images(use_bing = True)
 
                     # try flux if no results
                     if not images and hasattr(cfg, 'USE_FLUX_IF_EMPTY_IMAGES') and cfg.USE_FLUX_IF_EMPTY_IMAGES:
@@ -241,46 +303,19 @@ def image_gen(
                             if not has_good_images and not i.startswith('https://'):
                                 bot_reply_tr(message, i)
                                 return
-                        d = None
-                        bot_addr = f'https://t.me/{_bot_name}'
-                        caption_ = re.sub(r"(\s)\1+", r"\1\1", prompt)[:900]
-                        # caption_ = prompt[:900]
-                        if isinstance(i, str):
-                            d = utils.download_image_as_bytes(i)
-                            if len(d) < 2000: # placeholder?
-                                continue
-                            if GPT_FLAG:
-                                caption_ = f'{bot_addr} bing.com - gpt4o\n\n' + caption_
-                                my_db.add_msg(chat_id_full, 'img ' + 'bing.com_gtp4o')
-                            else:
-                                caption_ = f'{bot_addr} bing.com - dalle\n\n' + caption_
-                                my_db.add_msg(chat_id_full, 'img ' + 'bing.com')
-                        elif isinstance(i, bytes):
-                            if utils.fast_hash(i) in my_genimg.WHO_AUTOR:
-                                nn_ = '\n\n'
-                                author = my_genimg.WHO_AUTOR[utils.fast_hash(i)]
-                                caption_ = f"{bot_addr} {author}{nn_}{caption_}"
-                                my_db.add_msg(chat_id_full, 'img ' + author)
-                                del my_genimg.WHO_AUTOR[utils.fast_hash(i)]
-                            else:
-                                caption_ = f'{bot_addr} error'
-                            d = i
-                        if d:
-                            try:
-                                medias.append(telebot.types.InputMediaPhoto(d, caption = caption_[:900]))
-                            except Exception as add_media_error:
-                                error_traceback = traceback.format_exc()
-                                my_log.log2(f'my_cmd_img:image:add_media_bytes: {add_media_error}\n\n{error_traceback}')
-
-                    if len(medias) > 0:
-                        # делим картинки на группы до 10шт в группе, телеграм не пропускает больше за 1 раз
-                        chunk_size = 10
-                        chunks = [medias[i:i + chunk_size] for i in range(0, len(medias), chunk_size)]
+                        if id(i) in streamed_ids:
+                            continue
+                        media = make_media(i)
+                        if media:
+                            medias.append(media)
 
-                        send_images_to_user(chunks, message, chat_id_full, medias, images)
+                    all_medias = streamed_medias + medias
+                    if len(all_medias) > 0:
+                        if medias:
+                            send_images_to_user(split_medias(medias), message, chat_id_full, medias, images)
 
                         if pics_group and not NSFW_FLAG:
-                            send_images_to_pic_group(chunks, message, chat_id_full, prompt)
+                            send_images_to_pic_group(split_medias(all_medias), message, chat_id_full, prompt)
 
                         add_to_bots_mem(message.text, f'The bot successfully generated images on the external services <service>bing, fusion, flux, nebius, gemini</service> based on the request <prompt>{prompt}</prompt>', chat_id_full)
 
@@ -3,7 +3,6 @@
 # Standard library imports
 import sys
 import threading
-import time
 import traceback
 from typing import Any, Callable, Dict, List, Type
 
@@ -12,7 +11,10 @@ import telebot
 
 # Local application/library specific imports
 import cfg
+import my_coalesce
 import my_db
+import my_executor
+import my_imgproc
 import my_log
 import my_subscription
 import utils
@@ -31,7 +33,7 @@ def handle_photo(
     COMMAND_MODE: Dict[str, str],
     IMG_LOCKS: Dict[str, threading.Lock],
     CHECK_DONATE_LOCKS: Dict[int, threading.Lock],
-    MESSAGE_QUEUE_IMG: Dict[str, List[telebot.types.Message]],
+    MESSAGE_QUEUE_IMG: my_coalesce.Coalescer,
 
     # Helper functions and classes
     get_topic_id: Callable[[telebot.types.Message], str],
@@ -50,44 +52,36 @@ def handle_photo(
     ShowAction: Type,
 
     download_image_from_message: Callable,
+    download_image_from_messages: Callable,
     img2img: Callable,
 
     # Command handler functions
     google: Callable,
     do_task: Callable,
+
+    # части медиагруппы склеенные MESSAGE_QUEUE_IMG, при первом вызове None
+    batch: List[telebot.types.Message] = None,
 ) -> None:
     """Handles photo, sticker, and animation messages."""
+    # для повторного вызова когда придет вся медиагруппа
+    params = dict(locals())
     try:
         chat_id_full = get_topic_id(message)
         lang = get_lang(chat_id_full, message)
 
-        COMMAND_MODE[chat_id_full] = ''
-        # проверка на подписку
-        if not my_subscription.check_donate(message, chat_id_full, lang, COMMAND_MODE, CHECK_DONATE_LOCKS, BOT_ID, tr, bot_reply, get_keyboard):
-            return
+        # catch groups of images, обработка продолжится когда придет вся медиагруппа
+        if batch is None:
+            COMMAND_MODE[chat_id_full] = ''
+            # проверка на подписку
+            if not my_subscription.check_donate(message, chat_id_full, lang, COMMAND_MODE, CHECK_DONATE_LOCKS, BOT_ID, tr, bot_reply, get_keyboard):
+                return
 
-        # catch groups of images
-        if chat_id_full not in MESSAGE_QUEUE_IMG:
-            MESSAGE_QUEUE_IMG[chat_id_full] = [message,]
-            last_state = MESSAGE_QUEUE_IMG[chat_id_full]
-            n = 10
-            while n > 0:
-                n -= 1
-                time.sleep(0.1)
-                new_state = MESSAGE_QUEUE_IMG[chat_id_full]
-                if last_state != new_state:
-                    last_state = new_state
-                    n = 10
-        else:
-            MESSAGE_QUEUE_IMG[chat_id_full].append(message)
+            MESSAGE_QUEUE_IMG.submit(chat_id_full, message,
+                                     lambda parts: handle_photo(**dict(params, message=parts[0], batch=parts)),
+                                     user_key=my_executor.get_user_key(message))
             return
 
-
-        if len(MESSAGE_QUEUE_IMG[chat_id_full]) > 1:
-            MESSAGES = MESSAGE_QUEUE_IMG[chat_id_full]
-        else:
-            MESSAGES = [message,]
-        del MESSAGE_QUEUE_IMG[chat_id_full]
+        MESSAGES = batch
 
         message.caption = my_log.restore_message_text(message.caption, message.caption_entities)
 
@@ -141,7 +135,7 @@ def handle_photo(
                             break
                     caption = caption.strip()
                     with ShowAction(message, 'typing'):
-                        images = [download_image_from_message(msg) for msg in MESSAGES]
+                        images = download_image_from_messages(MESSAGES)
 
                         # Если прислали группу картинок и запрос начинается на ! то перенаправляем запрос в редактирование картинок
                         if caption.startswith('!'):
@@ -177,11 +171,17 @@ def handle_photo(
 
                         if len(images) > 4:
                             big_text = ''
-                            # соединить группы картинок по 4
-                            images_ = utils.create_image_collages(images)
-                            if images_:
-                                source_images = images[:]
-                                images = images_
+                            # соединить группы картинок по 4, коллажи собираются параллельно
+                            groups = [images[i:i + 4] for i in range(0, len(images), 4)]
+                            collages = my_imgproc.process_batch('make_collage', groups, default=b'')
+                            source_images = images[:]
+                            images = []
+                            for group, collage in zip(groups, collages):
+                                if collage:
+                                    images.append(collage)
+                                else:
+                                    # коллаж не собрался, картинки этой группы распознаются по одной
+                                    images.extend(x for x in group if x)
 
                             for image in images:
                                 if image:
@@ -227,13 +227,13 @@ def handle_photo(
                                 bot_reply_tr(message, 'Too big files.')
                                 return
                             try:
-                                result_image_as_bytes = utils.make_collage(images)
+                                result_image_as_bytes = my_imgproc.process('make_collage', images)
                             except Exception as make_collage_error:
                                 # my_log.log2(f'my_cmd_photo:handle_photo1: {make_collage_error}')
                                 bot_reply_tr(message, 'Too big files.')
                                 return
                             if len(result_image_as_bytes) > 10 * 1024 *1024:
-                                result_image_as_bytes = utils.resize_image(result_image_as_bytes, 10 * 1024 *1024)
+                                result_image_as_bytes = my_imgproc.process('resize_image', result_image_as_bytes, 10 * 1024 *1024)
                             try:
                                 m = send_photo(
                                     message,
@@ -323,9 +323,9 @@ def handle_photo(
                             return
 
                         if len(image) > 10 * 1024 *1024:
-                            image = utils.resize_image(image, 10 * 1024 *1024)
+                            image = my_imgproc.process('resize_image', image, 10 * 1024 *1024)
 
-                        image = utils.heic2jpg(image)
+                        image = my_imgproc.process('heic2jpg', image)
                         if not message.caption:
                             proccess_image(chat_id_full, image, message)
                             return
@@ -13,11 +13,14 @@ import telebot
 import cfg
 import my_cerebras
 import my_cerebras_tools
+import my_coalesce
 import my_cohere
 import my_db
+import my_executor
 import my_github
 import my_gemini3
 import my_groq
+import my_hedge
 import my_log
 import my_mistral
 import my_skills
@@ -53,7 +56,7 @@ def do_task(
 
     # Global state dictionaries
     COMMAND_MODE: Dict[str, str],
-    MESSAGE_QUEUE: Dict[str, str],
+    MESSAGE_QUEUE: my_coalesce.Coalescer,
     CHAT_LOCKS: Dict[str, threading.Lock],
     WHO_ANSWERED: Dict[str, str],
     CHECK_DONATE_LOCKS: Dict[int, threading.Lock],
@@ -100,8 +103,14 @@ def do_task(
     calc_gemini: Callable,
 
     custom_prompt: str = '',
+    batch: List[str] = None,
 ):
-    """default handler"""
+    """default handler
+
+    batch - части длинного сообщения склеенные MESSAGE_QUEUE, при первом вызове None
+    """
+    # для повторного вызова когда придут все части сообщения
+    params = dict(locals())
     try:
         chat_id_full = get_topic_id(message)
     except Exception as error:
@@ -109,12 +118,13 @@ def do_task(
         return
 
     try:
-        message.text = my_log.restore_message_text(message.text, message.entities)
-        if message.forward_date:
-            full_name_forwarded_from = message.forward_from.full_name if hasattr(message.forward_from, 'full_name') else 'Noname'
-            username_forwarded_from = message.forward_from.username if hasattr(message.forward_from, 'username') else 'Noname'
-            message.text = f'forward sender name {full_name_forwarded_from} (@{username_forwarded_from}): {message.text}'
-        message.text += '\n\n'
+        if batch is None:
+            message.text = my_log.restore_message_text(message.text, message.entities)
+            if message.forward_date:
+                full_name_forwarded_from = message.forward_from.full_name if hasattr(message.forward_from, 'full_name') else 'Noname'
+                username_forwarded_from = message.forward_from.username if hasattr(message.forward_from, 'username') else 'Noname'
+                message.text = f'forward sender name {full_name_forwarded_from} (@{username_forwarded_from}): {message.text}'
+            message.text += '\n\n'
 
         from_user_id = f'[{message.from_user.id}] [0]'
         if my_db.get_user_property(from_user_id, 'blocked'):
@@ -123,26 +133,16 @@ def do_task(
         # chat_id_full = get_topic_id(message)
         lang = get_lang(chat_id_full, message)
 
-        # catch too long messages
-        if chat_id_full not in MESSAGE_QUEUE:
-            MESSAGE_QUEUE[chat_id_full] = message.text
-            last_state = MESSAGE_QUEUE[chat_id_full]
-            n = 10
-            while n > 0:
-                n -= 1
-                time.sleep(0.1)
-                new_state = MESSAGE_QUEUE[chat_id_full]
-                if last_state != new_state:
-                    last_state = new_state
-                    n = 10
-            message.text = last_state
-            del MESSAGE_QUEUE[chat_id_full]
-        else:
-            MESSAGE_QUEUE[chat_id_full] += message.text + '\n\n'
-            u_id_ = str(message.chat.id)
-            if u_id_ in request_counter.counts:
-                if request_counter.counts[u_id_]:
-                    request_counter.counts[u_id_].pop(0)
+        # catch too long messages, обработка продолжится когда придут все части
+        if batch is None:
+            def on_ready(parts: List[str]):
+                message.text = ''.join(parts)
+                do_task(**dict(params, batch=parts))
+
+            if not MESSAGE_QUEUE.submit(chat_id_full, message.text, on_ready, size=len(message.text),
+                                        user_key=my_executor.get_user_key(message)):
+                # склеенные части одного сообщения не должны тратить лимит
+                request_counter.refund(str(message.chat.id))
             return
 
         message.text = message.text.strip()
@@ -532,43 +532,48 @@ def do_task(
                             if gmodel == cfg.gemini_flash_light_model:
                                 THINKING_BUDGET = 20000
 
-                            answer = my_gemini3.chat(
-                                message.text,
-                                chat_id_full,
-                                temp,
-                                model = gmodel,
-                                system = hidden_text,
-                                use_skills=True,
-                                telegram_user_name=telegram_user_name,
-                                THINKING_BUDGET = THINKING_BUDGET
-                            )
+                            if gmodel == cfg.gemini_pro_model:
+                                gmodel_fallback = cfg.gemini_pro_model_fallback
+                            elif gmodel == cfg.gemini_flash_model:
+                                gmodel_fallback = cfg.gemini_flash_model_fallback
+                            elif gmodel == cfg.gemini25_flash_model:
+                                gmodel_fallback = cfg.gemini25_flash_model_fallback
+                            elif cfg.gemini_flash_light_model == gmodel:
+                                gmodel_fallback = cfg.gemini_flash_light_model_fallback
+                            elif gmodel == cfg.gemini_learn_model:
+                                gmodel_fallback = cfg.gemini_learn_model_fallback
+                            elif gmodel == cfg.gemini_exp_model:
+                                gmodel_fallback = cfg.gemini_exp_model_fallback
+                            elif gmodel == cfg.gemma3_27b_model:
+                                gmodel_fallback = cfg.gemma3_27b_model_fallback
+                            else:
+                                gmodel_fallback = gmodel
 
-                            if not answer:
-                                if gmodel == cfg.gemini_pro_model:
-                                    gmodel = cfg.gemini_pro_model_fallback
-                                elif gmodel == cfg.gemini_flash_model:
-                                    gmodel = cfg.gemini_flash_model_fallback
-                                elif gmodel == cfg.gemini25_flash_model:
-                                    gmodel = cfg.gemini25_flash_model_fallback
-                                elif cfg.gemini_flash_light_model == gmodel:
-                                    gmodel = cfg.gemini_flash_light_model_fallback
-                                elif gmodel == cfg.gemini_learn_model:
-                                    gmodel = cfg.gemini_learn_model_fallback
-                                elif gmodel == cfg.gemini_exp_model:
-                                    gmodel = cfg.gemini_exp_model_fallback
-                                elif gmodel == cfg.gemma3_27b_model:
-                                    gmodel = cfg.gemma3_27b_model_fallback
-
-                                answer = my_gemini3.chat(
+                            # запасная модель стартует если основная не ответила, не параллельно:
+                            # с use_skills обе вызывали бы инструменты (картинки, файлы, отправки) дважды
+                            answer, winner = my_hedge.run([
+                                (gmodel, lambda: my_gemini3.chat(
                                     message.text,
                                     chat_id_full,
                                     temp,
                                     model = gmodel,
                                     system = hidden_text,
+                                    use_skills=True,
+                                    telegram_user_name=telegram_user_name,
+                                    THINKING_BUDGET = THINKING_BUDGET
+                                ), 'skills'),
+                                (gmodel_fallback, lambda: my_gemini3.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temp,
+                                    model = gmodel_fallback,
+                                    system = hidden_text,
                                     telegram_user_name=telegram_user_name,
                                     use_skills=True
-                                )
-                                WHO_ANSWERED[chat_id_full] = gmodel
+                                ), 'skills'),
+                            ])
+                            if winner:
+                                WHO_ANSWERED[chat_id_full] = winner
 
 
                             # если обычное джемини не ответили (перегруз?) то попробовать лайв версию
@@ -1029,58 +1034,49 @@ def do_task(
                             ]
                             TOOLS_SCHEMA_COHERE, AVAILABLE_TOOLS_COHERE = my_cerebras_tools.get_tools(*funcs_cohere)
 
-                            answer = my_cerebras.chat(
-                                message.text,
-                                chat_id_full,
-                                temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
-                                system=hidden_text,
-                                model = my_cerebras.MODEL_QWEN_3_235B_A22B_THINKING,
-                                tools = TOOLS_SCHEMA,
-                                available_tools = AVAILABLE_TOOLS
-                            )
-                            author = 'Qwen 3 thinking'
-                            WHO_ANSWERED[chat_id_full] = author
-
-                            if not answer:
-                                answer = my_cerebras.chat(
+                            temp = my_db.get_user_property(chat_id_full, 'temperature') or 1
+                            # следующий в цепочке стартует только если предыдущий не ответил, не параллельно:
+                            # все кандидаты вызывают инструменты (картинки, файлы, отправки) и сделали бы это дважды
+                            answer, author = my_hedge.run([
+                                ('Qwen 3 thinking', lambda: my_cerebras.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
+                                    system=hidden_text,
+                                    model = my_cerebras.MODEL_QWEN_3_235B_A22B_THINKING,
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Qwen 3 instruct', lambda: my_cerebras.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_cerebras.MODEL_QWEN_3_235B_A22B_INSTRUCT,
                                     tools = TOOLS_SCHEMA,
                                     available_tools = AVAILABLE_TOOLS
-                                )
-                                author = 'Qwen 3 instruct'
-                                WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Mistral
-                            if not answer:
-                                answer = my_mistral.chat(
+                                ), 'skills'),
+                                ('Mistral', lambda: my_mistral.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_mistral.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA, 
-                                    available_tools=AVAILABLE_TOOLS
-                                )
-                                author += ' -> Mistral'
-                                WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Cohere
-                            if not answer:
-                                answer = my_cohere.chat(
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Cohere', lambda: my_cohere.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_cohere.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA_COHERE,
-                                    available_tools=AVAILABLE_TOOLS_COHERE
-                                )
-                                author += ' -> Cohere'
-                                WHO_ANSWERED[chat_id_full] = author
+                                    tools = TOOLS_SCHEMA_COHERE,
+                                    available_tools = AVAILABLE_TOOLS_COHERE
+                                ), 'skills'),
+                            ])
+                            author = author or 'Qwen 3 thinking'
+                            WHO_ANSWERED[chat_id_full] = author
 
 
                             complete_time = time.time() - time_to_answer_start
@@ -1146,46 +1142,40 @@ def do_task(
                             ]
                             TOOLS_SCHEMA_COHERE, AVAILABLE_TOOLS_COHERE = my_cerebras_tools.get_tools(*funcs_cohere)
 
-                            answer = my_cerebras.chat(
-                                message.text,
-                                chat_id_full,
-                                temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
-                                system=hidden_text,
-                                model = my_cerebras.MODEL_QWEN_3_CODER_480B,
-                                tools = TOOLS_SCHEMA,
-                                available_tools = AVAILABLE_TOOLS
-                            )
-
-                            author = 'Qwen 3 Coder 480b'
-                            WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Mistral
-                            if not answer:
-                                answer = my_mistral.chat(
+                            temp = my_db.get_user_property(chat_id_full, 'temperature') or 1
+                            # следующий в цепочке стартует только если предыдущий не ответил, не параллельно:
+                            # все кандидаты вызывают инструменты (картинки, файлы, отправки) и сделали бы это дважды
+                            answer, author = my_hedge.run([
+                                ('Qwen 3 Coder 480b', lambda: my_cerebras.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
+                                    system=hidden_text,
+                                    model = my_cerebras.MODEL_QWEN_3_CODER_480B,
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Mistral', lambda: my_mistral.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_mistral.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA, 
-                                    available_tools=AVAILABLE_TOOLS
-                                )
-                                author += ' -> Mistral'
-                                WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Cohere
-                            if not answer:
-                                answer = my_cohere.chat(
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Cohere', lambda: my_cohere.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_cohere.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA_COHERE,
-                                    available_tools=AVAILABLE_TOOLS_COHERE
-                                )
-                                author += ' -> Cohere'
-                                WHO_ANSWERED[chat_id_full] = author
+                                    tools = TOOLS_SCHEMA_COHERE,
+                                    available_tools = AVAILABLE_TOOLS_COHERE
+                                ), 'skills'),
+                            ])
+                            author = author or 'Qwen 3 Coder 480b'
+                            WHO_ANSWERED[chat_id_full] = author
 
 
                             complete_time = time.time() - time_to_answer_start
@@ -1251,47 +1241,41 @@ def do_task(
                             ]
                             TOOLS_SCHEMA_COHERE, AVAILABLE_TOOLS_COHERE = my_cerebras_tools.get_tools(*funcs_cohere)
 
-                            answer = my_cerebras.chat(
-                                message.text,
-                                chat_id_full,
-                                temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
-                                system=hidden_text,
-                                model = my_cerebras.MODEL_GPT_OSS_120B,
-                                tools = TOOLS_SCHEMA,
-                                available_tools = AVAILABLE_TOOLS
-                            )
-
-                            author = 'GPT OSS 120b'
-                            WHO_ANSWERED[chat_id_full] = author
-
-                            # fallback logic if the primary model fails
-                            if not answer:
-                                # Assuming Mistral can handle the full toolset or its wrapper manages it
-                                answer = my_mistral.chat(
+                            temp = my_db.get_user_property(chat_id_full, 'temperature') or 1
+                            # следующий в цепочке стартует только если предыдущий не ответил, не параллельно:
+                            # все кандидаты вызывают инструменты (картинки, файлы, отправки) и сделали бы это дважды
+                            answer, author = my_hedge.run([
+                                ('GPT OSS 120b', lambda: my_cerebras.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
+                                    system=hidden_text,
+                                    model = my_cerebras.MODEL_GPT_OSS_120B,
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Mistral', lambda: my_mistral.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_mistral.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA, 
-                                    available_tools=AVAILABLE_TOOLS
-                                )
-                                author += ' -> Mistral'
-                                WHO_ANSWERED[chat_id_full] = author
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Cohere', lambda: my_cohere.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temperature=temp,
+                                    system=hidden_text,
+                                    model = my_cohere.DEFAULT_MODEL,
+                                    tools = TOOLS_SCHEMA_COHERE,
+                                    available_tools = AVAILABLE_TOOLS_COHERE
+                                ), 'skills'),
+                            ])
+                            author = author or 'GPT OSS 120b'
+                            WHO_ANSWERED[chat_id_full] = author
 
-                                # second fallback using Cohere's limited toolset
-                                if not answer:
-                                    answer = my_cohere.chat(
-                                        message.text,
-                                        chat_id_full,
-                                        temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
-                                        system=hidden_text,
-                                        model = my_cohere.DEFAULT_MODEL,
-                                        tools=TOOLS_SCHEMA_COHERE,
-                                        available_tools=AVAILABLE_TOOLS_COHERE
-                                    )
-                                    author += ' -> Cohere'
-                                    WHO_ANSWERED[chat_id_full] = author
 
                             complete_time = time.time() - time_to_answer_start
                             my_log.log3(chat_id_full, complete_time)
@@ -1354,58 +1338,49 @@ def do_task(
                             ]
                             TOOLS_SCHEMA_COHERE, AVAILABLE_TOOLS_COHERE = my_cerebras_tools.get_tools(*funcs_cohere)
 
-                            # First attempt with the primary Llama 4 model (no tools, as they might not work)
-                            answer = my_cerebras.chat(
-                                message.text,
-                                chat_id_full,
-                                temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
-                                system=hidden_text,
-                                model = my_cerebras.MODEL_LLAMA_4_MAVERICK_17B_128E_INSTRUCT
-                            )
-                            author = 'Llama 4'
-                            WHO_ANSWERED[chat_id_full] = author
-
-                            # Second attempt with the fallback Llama 4 model
-                            if not answer:
-                                answer = my_cerebras.chat(
+                            temp = my_db.get_user_property(chat_id_full, 'temperature') or 1
+                            # следующий в цепочке стартует только если предыдущий не ответил, не параллельно:
+                            # все кандидаты вызывают инструменты (картинки, файлы, отправки) и сделали бы это дважды
+                            answer, author = my_hedge.run([
+                                # primary Llama 4 model (no tools, as they might not work)
+                                ('Llama 4', lambda: my_cerebras.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
+                                    system=hidden_text,
+                                    model = my_cerebras.MODEL_LLAMA_4_MAVERICK_17B_128E_INSTRUCT
+                                ), 'skills'),
+                                ('Llama 4 Scout', lambda: my_cerebras.chat(
+                                    message.text,
+                                    chat_id_full,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_cerebras.MODEL_LLAMA_4_SCOUT_17B_16E_INSTRUCT,
                                     tools = my_cerebras.TOOLS_SCHEMA,
                                     available_tools = my_cerebras.AVAILABLE_TOOLS
-                                )
-                                author = 'Llama 4 Scout' # Update author if this model is used
-                                WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Mistral if Llama fails
-                            if not answer:
-                                answer = my_mistral.chat(
+                                ), 'skills'),
+                                ('Mistral', lambda: my_mistral.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_mistral.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA, 
-                                    available_tools=AVAILABLE_TOOLS
-                                )
-                                author += ' -> Mistral'
-                                WHO_ANSWERED[chat_id_full] = author
-
-                            # Fallback to Cohere if Mistral also fails
-                            if not answer:
-                                answer = my_cohere.chat(
+                                    tools = TOOLS_SCHEMA,
+                                    available_tools = AVAILABLE_TOOLS
+                                ), 'skills'),
+                                ('Cohere', lambda: my_cohere.chat(
                                     message.text,
                                     chat_id_full,
-                                    temperature=my_db.get_user_property(chat_id_full, 'temperature') or 1,
+                                    temperature=temp,
                                     system=hidden_text,
                                     model = my_cohere.DEFAULT_MODEL,
-                                    tools=TOOLS_SCHEMA_COHERE,
-                                    available_tools=AVAILABLE_TOOLS_COHERE
-                                )
-                                author += ' -> Cohere'
-                                WHO_ANSWERED[chat_id_full] = author
+                                    tools = TOOLS_SCHEMA_COHERE,
+                                    available_tools = AVAILABLE_TOOLS_COHERE
+                                ), 'skills'),
+                            ])
+                            author = author or 'Llama 4'
+                            WHO_ANSWERED[chat_id_full] = author
+
 
                             complete_time = time.time() - time_to_answer_start
                             my_log.log3(chat_id_full, complete_time)
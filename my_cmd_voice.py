@@ -3,7 +3,6 @@
 # Standard library imports
 import concurrent.futures
 import threading
-import time
 import traceback
 from typing import Any, Callable, Dict, List, Type
 
@@ -11,7 +10,9 @@ from typing import Any, Callable, Dict, List, Type
 import telebot
 
 # Local application/library specific imports
+import my_coalesce
 import my_db
+import my_executor
 import my_gemini3
 import my_log
 import my_stt
@@ -31,7 +32,7 @@ def handle_voice(
     # Global state dictionaries
     COMMAND_MODE: Dict[str, str],
     CHECK_DONATE_LOCKS: Dict[int, threading.Lock],
-    MESSAGE_QUEUE_AUDIO_GROUP: Dict[str, List[telebot.types.Message]],
+    MESSAGE_QUEUE_AUDIO_GROUP: my_coalesce.Coalescer,
 
     # Helper functions and classes
     get_topic_id: Callable[[telebot.types.Message], str],
@@ -45,85 +46,80 @@ def handle_voice(
 
     # Command handler functions
     echo_all: Callable,
+
+    # пачка сообщений склеенная MESSAGE_QUEUE_AUDIO_GROUP, при первом вызове None
+    batch: List[telebot.types.Message] = None,
 ) -> None:
     """Handles voice, video, video_note, and audio messages."""
+    # для повторного вызова когда придет вся пачка
+    params = dict(locals())
     chat_id_full = get_topic_id(message)
     lang = get_lang(chat_id_full, message)
 
-    # Проверка на подписку/донат
-    if not my_subscription.check_donate(message, chat_id_full, lang, COMMAND_MODE, CHECK_DONATE_LOCKS, BOT_ID, tr, bot_reply, get_keyboard):
-        return
+    # все проверки уже сделаны для первого сообщения пачки
+    if batch is None:
+        # Проверка на подписку/донат
+        if not my_subscription.check_donate(message, chat_id_full, lang, COMMAND_MODE, CHECK_DONATE_LOCKS, BOT_ID, tr, bot_reply, get_keyboard):
+            return
 
 
-    is_private = message.chat.type == 'private'
-    supch = my_db.get_user_property(chat_id_full, 'superchat') or 0
-    if supch == 1:
-        is_private = True
+        is_private = message.chat.type == 'private'
+        supch = my_db.get_user_property(chat_id_full, 'superchat') or 0
+        if supch == 1:
+            is_private = True
 
 
-    # определяем какое имя у бота в этом чате, на какое слово он отзывается
-    bot_name = my_db.get_user_property(chat_id_full, 'bot_name') or BOT_NAME_DEFAULT
-    if not is_private:
-        if not message.caption or not message.caption.startswith('?') or \
-            not message.caption.startswith(f'@{_bot_name}') or \
-                not message.caption.startswith(bot_name):
-            return
+        # определяем какое имя у бота в этом чате, на какое слово он отзывается
+        bot_name = my_db.get_user_property(chat_id_full, 'bot_name') or BOT_NAME_DEFAULT
+        if not is_private:
+            if not message.caption or not message.caption.startswith('?') or \
+                not message.caption.startswith(f'@{_bot_name}') or \
+                    not message.caption.startswith(bot_name):
+                return
 
 
-    # --- ПРИОРИТЕТНАЯ ОБРАБОТКА ДЛЯ /transcribe ---
-    if chat_id_full in COMMAND_MODE and COMMAND_MODE[chat_id_full] == 'transcribe':
-        try:
-            file_info, file_name = (None, 'unknown')
-            if message.voice:
-                file_info = bot.get_file(message.voice.file_id)
-                file_name = 'telegram voice message'
-            elif message.audio:
-                file_info = bot.get_file(message.audio.file_id)
-                file_name = message.audio.file_name
-            elif message.video:
-                file_info = bot.get_file(message.video.file_id)
-                file_name = message.video.file_name
-            elif message.video_note:
-                file_info = bot.get_file(message.video_note.file_id)
-            elif message.document:
-                file_info = bot.get_file(message.document.file_id)
-                file_name = message.document.file_name
-
-            if file_info:
-                downloaded_file = bot.download_file(file_info.file_path)
-                transcribe_file(downloaded_file, file_name, message)
-            else:
-                 bot_reply_tr(message, 'Could not get file info for transcription.')
-        except telebot.apihelper.ApiTelegramException as e:
-            if 'file is too big' in str(e):
-                bot_reply_tr(message, 'Too big file. Try /transcribe command. (Button - [Too big file])')
-        except Exception as e:
-            my_log.log2(f'my_cmd_voice:handle_voice:transcribe_mode_error: {e}')
-            bot_reply_tr(message, 'Error during transcription.')
-        finally:
-            COMMAND_MODE[chat_id_full] = ''
-        return
+        # --- ПРИОРИТЕТНАЯ ОБРАБОТКА ДЛЯ /transcribe ---
+        if chat_id_full in COMMAND_MODE and COMMAND_MODE[chat_id_full] == 'transcribe':
+            try:
+                file_info, file_name = (None, 'unknown')
+                if message.voice:
+                    file_info = bot.get_file(message.voice.file_id)
+                    file_name = 'telegram voice message'
+                elif message.audio:
+                    file_info = bot.get_file(message.audio.file_id)
+                    file_name = message.audio.file_name
+                elif message.video:
+                    file_info = bot.get_file(message.video.file_id)
+                    file_name = message.video.file_name
+                elif message.video_note:
+                    file_info = bot.get_file(message.video_note.file_id)
+                elif message.document:
+                    file_info = bot.get_file(message.document.file_id)
+                    file_name = message.document.file_name
+
+                if file_info:
+                    downloaded_file = bot.download_file(file_info.file_path)
+                    transcribe_file(downloaded_file, file_name, message)
+                else:
+                     bot_reply_tr(message, 'Could not get file info for transcription.')
+            except telebot.apihelper.ApiTelegramException as e:
+                if 'file is too big' in str(e):
+                    bot_reply_tr(message, 'Too big file. Try /transcribe command. (Button - [Too big file])')
+            except Exception as e:
+                my_log.log2(f'my_cmd_voice:handle_voice:transcribe_mode_error: {e}')
+                bot_reply_tr(message, 'Error during transcription.')
+            finally:
+                COMMAND_MODE[chat_id_full] = ''
+            return
 
 
-    # --- Механизм сбора группы сообщений ---
-    if chat_id_full not in MESSAGE_QUEUE_AUDIO_GROUP:
-        MESSAGE_QUEUE_AUDIO_GROUP[chat_id_full] = [message]
-        last_state = MESSAGE_QUEUE_AUDIO_GROUP[chat_id_full]
-        n = 10
-        while n > 0:
-            n -= 1
-            time.sleep(0.1)
-            new_state = MESSAGE_QUEUE_AUDIO_GROUP.get(chat_id_full, [])
-            if len(last_state) != len(new_state):
-                last_state = new_state
-                n = 10
-    else:
-        MESSAGE_QUEUE_AUDIO_GROUP[chat_id_full].append(message)
+        # --- Механизм сбора группы сообщений, обработка продолжится когда придет вся пачка ---
+        MESSAGE_QUEUE_AUDIO_GROUP.submit(chat_id_full, message,
+                                         lambda parts: handle_voice(**dict(params, message=parts[0], batch=parts)),
+                                         user_key=my_executor.get_user_key(message))
         return
 
-    messages_to_process = MESSAGE_QUEUE_AUDIO_GROUP.pop(chat_id_full, [])
-    if not messages_to_process:
-        return
+    messages_to_process = batch
 
     try:
         COMMAND_MODE[chat_id_full] = ''
@@ -292,6 +288,3 @@ def handle_voice(
     except Exception as e:
         error_traceback = traceback.format_exc()
         my_log.log2(f'my_cmd_voice:handle_voice_main_logic: {e}\n{error_traceback}')
-        # Гарантированно очищаем очередь, если что-то пошло не так
-        if chat_id_full in MESSAGE_QUEUE_AUDIO_GROUP:
-            del MESSAGE_QUEUE_AUDIO_GROUP[chat_id_full]
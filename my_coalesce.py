@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# Склейка сообщений которые телеграм присылает по частям:
+# длинный текст разрезанный клиентом, медиагруппы картинок, картинки + подпись, пачки аудио.
+# Раньше обработчик первой части занимал поток и раз в 0.1 секунды проверял не прилетело ли еще.
+# Теперь части складываются в пачку по ключу (обычно chat_id_full), обработчик сразу возвращается,
+# а один общий поток-таймер отдает готовую пачку в пул my_executor когда пауза между частями
+# превысила window секунд, пачка стала больше max_size или ждет дольше max_wait.
+
+
+import heapq
+import itertools
+import threading
+import time
+import traceback
+from typing import Any, Callable, Dict, List
+
+import cfg
+import my_executor
+import my_log
+
+
+# сколько ждать следующую часть, секунд
+COALESCE_WINDOW = cfg.COALESCE_WINDOW if hasattr(cfg, 'COALESCE_WINDOW') else 1.0
+# дольше этого пачку не держим даже если части продолжают приходить
+COALESCE_MAX_WAIT = cfg.COALESCE_MAX_WAIT if hasattr(cfg, 'COALESCE_MAX_WAIT') else 10.0
+# пачка отдается сразу как только набралось столько символов текста или столько сообщений
+COALESCE_MAX_CHARS = cfg.COALESCE_MAX_CHARS if hasattr(cfg, 'COALESCE_MAX_CHARS') else 100000
+COALESCE_MAX_ITEMS = cfg.COALESCE_MAX_ITEMS if hasattr(cfg, 'COALESCE_MAX_ITEMS') else 20
+
+LOCK = threading.Lock()
+WAKEUP = threading.Condition(LOCK)
+# [(deadline, seq, coalescer, key)]
+HEAP = []
+_SEQ = itertools.count()
+WORKER_STARTED = False
+
+
+class _Batch:
+    __slots__ = ('items', 'size', 'callback', 'user_key', 'first', 'deadline')
+
+    def __init__(self, callback: Callable, user_key: str, now: float):
+        self.items = []
+        self.size = 0
+        self.callback = callback
+        self.user_key = user_key
+        self.first = now
+        self.deadline = 0.0
+
+
+class Coalescer:
+    '''
+    Очередь склейки частей.
+
+    name - для логов и статистики
+    pool - категория my_executor в которой выполнять callback готовой пачки
+    window - пауза после последней части после которой пачка готова
+    max_size - пачка отдается сразу когда сумма size частей достигла этого значения
+    max_wait - и не позже чем через столько секунд после первой части
+    '''
+    def __init__(self, name: str, pool: str = 'chat', window: float = None, max_size: int = 0, max_wait: float = None):
+        self.name = name
+        self.pool = pool
+        self.window = window if window is not None else COALESCE_WINDOW
+        self.max_size = max_size
+        self.max_wait = max_wait if max_wait is not None else COALESCE_MAX_WAIT
+        # {key: _Batch}, под общим LOCK
+        self.batches: Dict[str, _Batch] = {}
+        # метрики
+        self.flushed = 0
+        self.parts = 0
+
+    def submit(self, key: str, item: Any, callback: Callable[[List[Any]], None], size: int = 1, user_key: str = 'system') -> bool:
+        '''
+        Добавить часть в пачку key.
+        callback(items) вызывается один раз для всей пачки, его задает первая часть.
+
+        Returns:
+            True если эта часть начала новую пачку, False если добавлена к уже ждущей
+        '''
+        _start_worker()
+        now = time.time()
+        full = None
+        with LOCK:
+            batch = self.batches.get(key)
+            first = batch is None
+            if first:
+                batch = self.batches[key] = _Batch(callback, user_key, now)
+            batch.items.append(item)
+            batch.size += size
+            self.parts += 1
+
+            if self.max_size and batch.size >= self.max_size:
+                # пачка заполнена, отдаем сразу, следующая часть начнет новую
+                full = self.batches.pop(key)
+                self.flushed += 1
+            else:
+                deadline = min(now + self.window, batch.first + self.max_wait)
+                if first:
+                    heapq.heappush(HEAP, (deadline, next(_SEQ), self, key))
+                    WAKEUP.notify()
+                # срок только сдвигается вперед, таймер увидит это когда дойдет до старой записи в куче
+                batch.deadline = deadline
+        if full is not None:
+            _dispatch(self, full)
+        return first
+
+    def _pop_if_due(self, key: str, now: float):
+        '''Забрать пачку если ее срок прошел, иначе вернуть новый срок. Вызывать под LOCK'''
+        batch = self.batches.get(key)
+        if batch is None:
+            return None, None
+        if batch.deadline > now:
+            return None, batch.deadline
+        del self.batches[key]
+        self.flushed += 1
+        return batch, None
+
+
+def _dispatch(coalescer: Coalescer, batch: _Batch):
+    pool = my_executor.get_pool(coalescer.pool)
+    if not pool.submit(batch.user_key, batch.callback, (batch.items,), {}):
+        my_log.log2(f'my_coalesce:{coalescer.name}: {coalescer.pool} queue is full, dropped {len(batch.items)} parts from {batch.user_key}')
+
+
+def worker():
+    '''Общий поток-таймер всех очередей склейки'''
+    while True:
+        try:
+            ready = []
+            with LOCK:
+                while True:
+                    now = time.time()
+                    while HEAP and HEAP[0][0] <= now:
+                        _, _, coalescer, key = heapq.heappop(HEAP)
+                        batch, later = coalescer._pop_if_due(key, now)
+                        if batch is not None:
+                            ready.append((coalescer, batch))
+                        elif later is not None:
+                            # пришли новые части, срок сдвинулся
+                            heapq.heappush(HEAP, (later, next(_SEQ), coalescer, key))
+                    if ready:
+                        break
+                    WAKEUP.wait(HEAP[0][0] - now if HEAP else None)
+
+            for coalescer, batch in ready:
+                _dispatch(coalescer, batch)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_coalesce:worker: {error}\n\n{traceback_error}')
+            time.sleep(1)
+
+
+def _start_worker():
+    global WORKER_STARTED
+    if WORKER_STARTED:
+        return
+    with LOCK:
+        if WORKER_STARTED:
+            return
+        WORKER_STARTED = True
+    threading.Thread(target=worker, name='my_coalesce', daemon=True).start()
+
+
+def get_stats(*coalescers: Coalescer) -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        return ', '.join(f'{x.name}: waiting {len(x.batches)}, parts {x.parts}, batches {x.flushed}' for x in coalescers)
+
+
+if __name__ == '__main__':
+    pass
+
+    q = Coalescer('test', pool='admin', window=0.5, max_size=5)
+    start = time.time()
+
+    def show(items):
+        print(f'{time.time() - start:.2f}s', items)
+
+    print(q.submit('a', 'part1', show))
+    time.sleep(0.3)
+    print(q.submit('a', 'part2', show))
+    for i in range(6):
+        q.submit('b', i, show)
+    time.sleep(2)
+    print(get_stats(q))
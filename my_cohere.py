@@ -21,6 +21,7 @@ from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_hedge
 import my_log
 import my_skills_storage
 import utils
@@ -318,6 +319,9 @@ def chat(
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
+        # запасной вариант в my_hedge.run, основной уже ответил
+        if my_hedge.is_cancelled():
+            return ''
         mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
 
         mem_ = mem[:]
@@ -332,7 +336,7 @@ def chat(
             available_tools=available_tools
         )
 
-        if text:
+        if text and my_hedge.claim():
             mem += [{'role': 'user', 'content': query}]
             mem += [{'role': 'assistant', 'content': text}]
             mem = clear_mem(mem, chat_id)
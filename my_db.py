@@ -1,11 +1,10 @@
 #!/usr/bin/env python3
 
 import cachetools.func
+import contextlib
 import datetime
-import hashlib
-import lzma
 import os
-import pickle
+import queue
 import re
 import time
 import threading
@@ -20,13 +19,18 @@ from collections import OrderedDict
 from cachetools import LRUCache
 
 import cfg
+import my_db_codec
 import my_init
 import my_log
 from utils import async_run, remove_file
 
 
+# замок только для записи, читатели идут через пул READ_POOL
 LOCK = threading.Lock()
 
+DB_FILE = 'db/main.db'
+
+# соединение (и курсор) единственного писателя, в режиме autocommit
 CON = None
 CUR = None
 DAEMON_RUN = True
@@ -50,8 +54,8 @@ def obj_to_blob(obj) -> bytes:
         return None
     else:
         try:
-            # Serialize the object using pickle and compress it using lzma
-            return lzma.compress(pickle.dumps(obj))
+            # Serialize the object using pickle and compress it with my_db_codec.CODEC
+            return my_db_codec.dumps(obj)
         except Exception as error:
             # Log the error and return None
             my_log.log2(f'my_db:obj_to_blob {error}')
@@ -70,8 +74,8 @@ def blob_to_obj(blob) -> object:
     """
     if blob:
         try:
-            # Decompress the compressed serialized version of the object using lzma and deserialize it using pickle
-            return pickle.loads(lzma.decompress(blob))
+            # Decompress (codec is taken from the header, old lzma blobs have no header) and unpickle
+            return my_db_codec.loads(blob)
         except Exception as error:
             # Log the error and return None
             my_log.log2(f'my_db:blob_to_obj {error}')
@@ -105,10 +109,320 @@ class SmartCache:
                 del self.cache[key]
 
 
-# cache for users table
+# cache for big users table fields (saved_file and dialogs), key is (user_id, property)
 USERS_CACHE = SmartCache()
 
 
+# эти поля не грузятся в USERS_ROWS, они большие и читаются по одному
+USER_BIG_COLUMNS = (
+    'saved_file',
+    'dialog_gemini',
+    'dialog_gemini3',
+    'dialog_groq',
+    'dialog_openrouter',
+)
+# остальные поля таблицы users, заполняется в init()
+USER_ROW_COLUMNS = ()
+
+
+class UserRowCache:
+    '''
+    Кеш строк таблицы users целиком, без больших полей из USER_BIG_COLUMNS.
+    На одно сообщение читается десяток свойств юзера, а из базы строка грузится один раз.
+    При записи поля обновляются в кешированной строке по одному.
+    '''
+    def __init__(self, max_size: int = 10000):
+        self.cache = LRUCache(maxsize=max_size)
+        self.lock = threading.Lock()
+        # {user_id: [token, ...]} строки которые сейчас читаются из базы,
+        # token = [dirty], если во время чтения было изменение то строку не кешируем
+        self.loading = {}
+
+    def get(self, user_id: str, property: str):
+        '''Вернуть (True, value) если строка юзера в кеше, иначе (False, None)'''
+        with self.lock:
+            row = self.cache.get(user_id)
+            if row is None:
+                return False, None
+            return True, row.get(property)
+
+    def begin_load(self, user_id: str) -> list:
+        token = [False]
+        with self.lock:
+            self.loading.setdefault(user_id, []).append(token)
+        return token
+
+    def end_load(self, user_id: str, token: list, row: dict):
+        with self.lock:
+            # сравнение по id, токены разных читателей равны друг другу по значению
+            tokens = [x for x in self.loading.get(user_id, []) if x is not token]
+            if tokens:
+                self.loading[user_id] = tokens
+            else:
+                self.loading.pop(user_id, None)
+            if row is not None and not token[0]:
+                self.cache[user_id] = row
+
+    def set_field(self, user_id: str, property: str, value):
+        with self.lock:
+            for token in self.loading.get(user_id, []):
+                token[0] = True
+            row = self.cache.get(user_id)
+            if row is not None:
+                row[property] = value
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+
+# cache for users table rows
+USERS_ROWS = UserRowCache()
+
+
+class ReadPool:
+    '''
+    Пул соединений только для чтения к базе в режиме WAL.
+    Читатели не берут общий LOCK и не ждут друг друга и писателя,
+    соединения создаются лениво и переиспользуются разными потоками.
+    '''
+    def __init__(self, db_file: str, size: int = 8):
+        self.db_file = db_file
+        self.size = size
+        self.pool = queue.LifoQueue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.db_file, check_same_thread=False, isolation_level=None)
+        con.execute('PRAGMA query_only = ON')
+        return con
+
+    def acquire(self) -> sqlite3.Connection:
+        '''Взять соединение из пула, если пул исчерпан то ждать свободное'''
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            pass
+
+        with self.lock:
+            can_create = self.created < self.size
+            if can_create:
+                self.created += 1
+
+        if can_create:
+            try:
+                return self._connect()
+            except Exception:
+                with self.lock:
+                    self.created -= 1
+                raise
+
+        return self.pool.get()
+
+    def release(self, con: sqlite3.Connection):
+        self.pool.put(con)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        '''with READ_POOL.cursor() as cur: cur.execute(...)'''
+        con = self.acquire()
+        cur = con.cursor()
+        try:
+            yield cur
+        finally:
+            # закрываем курсор что бы не держать снимок базы открытым
+            try:
+                cur.close()
+            except Exception as error:
+                my_log.log2(f'my_db:ReadPool:cursor {error}')
+            self.release(con)
+
+    def close(self):
+        '''Закрыть все свободные соединения'''
+        while True:
+            try:
+                con = self.pool.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                con.close()
+            except Exception as error:
+                my_log.log2(f'my_db:ReadPool:close {error}')
+            with self.lock:
+                self.created -= 1
+
+
+READ_POOL = ReadPool(DB_FILE, cfg.DB_READ_POOL_SIZE if hasattr(cfg, 'DB_READ_POOL_SIZE') else 8)
+
+
+class WriteBehind:
+    '''
+    Очередь отложенной записи для самых частых операций: add_msg и set_user_property.
+    Записи копятся в памяти и сбрасываются одной транзакцией по размеру или по таймеру.
+    Пока значение не записано в базу get_user_property берет его отсюда.
+
+    Порядок замков всегда LOCK -> self.lock, сама постановка в очередь берет только self.lock.
+    '''
+    def __init__(self, max_size: int = 500, interval: float = 1.0):
+        self.max_size = max_size
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        # [(user_id, access_time, model_used), ...]
+        self.msgs = []
+        # {user_id: {property: value}}, последнее значение побеждает
+        self.props = {}
+        # то что сейчас пишется в базу, видно читателям до конца записи
+        self.inflight = {}
+        self.ops = 0
+        # сколько раз подряд не удалось записать, после max_retries пачка выбрасывается
+        self.failures = 0
+        self.max_retries = 5
+
+    def add_msg(self, user_id: str, access_time: float, model_used: str):
+        with self.lock:
+            self.msgs.append((user_id, access_time, model_used))
+            self.ops += 1
+            full = self.ops >= self.max_size
+        if full:
+            self.wakeup.set()
+
+    def set_property(self, user_id: str, property: str, value):
+        with self.lock:
+            self.props.setdefault(user_id, {})[property] = value
+            self.ops += 1
+            full = self.ops >= self.max_size
+        if full:
+            self.wakeup.set()
+
+    def get_property(self, user_id: str, property: str):
+        '''Вернуть (True, value) если значение еще не записано в базу, иначе (False, None)'''
+        with self.lock:
+            for source in (self.props, self.inflight):
+                fields = source.get(user_id)
+                if fields and property in fields:
+                    return True, fields[property]
+        return False, None
+
+    def drop_property(self, user_id: str, property: str):
+        '''Забыть несохраненное значение, вызывать под LOCK'''
+        with self.lock:
+            fields = self.props.get(user_id)
+            if fields and property in fields:
+                del fields[property]
+                if not fields:
+                    del self.props[user_id]
+
+    def flush(self):
+        '''Записать всё накопленное одной транзакцией'''
+        with LOCK:
+            with self.lock:
+                msgs, self.msgs = self.msgs, []
+                props, self.props = self.props, {}
+                self.inflight = props
+                self.ops = 0
+
+            if not msgs and not props:
+                return
+
+            try:
+                CUR.execute('BEGIN')
+
+                if msgs:
+                    # та же проверка на дубль что была в add_msg, но одним запросом на всю пачку
+                    CUR.executemany('''
+                        INSERT INTO msg_counter (user_id, access_time, model_used)
+                        SELECT ?, ?, ?
+                        WHERE NOT EXISTS (
+                            SELECT 1 FROM msg_counter
+                            WHERE user_id = ? AND access_time = ? AND model_used = ?
+                        )
+                    ''', [x + x for x in msgs])
+
+                if props:
+                    user_ids = list(props.keys())
+                    existing = set()
+                    for i in range(0, len(user_ids), 500):
+                        chunk = user_ids[i:i + 500]
+                        CUR.execute(f'''
+                            SELECT id FROM users
+                            WHERE id IN ({','.join('?' * len(chunk))})
+                        ''', chunk)
+                        existing.update(x[0] for x in CUR.fetchall())
+
+                    new_users = [(x, get_first_meet(x) or time.time()) for x in user_ids if x not in existing]
+                    if new_users:
+                        CUR.executemany('''
+                            INSERT INTO users (id, first_meet)
+                            VALUES (?, ?)
+                        ''', new_users)
+
+                    by_property = {}
+                    for user_id, fields in props.items():
+                        for property, value in fields.items():
+                            by_property.setdefault(property, []).append((value, user_id))
+
+                    # ошибка в любом поле отменяет всю пачку, частично ее не записываем
+                    for property, rows in by_property.items():
+                        CUR.executemany(f'''
+                            UPDATE users
+                            SET {property} = ?
+                            WHERE id = ?
+                        ''', rows)
+
+                CUR.execute('COMMIT')
+                self.failures = 0
+            except Exception as error:
+                traceback_error = traceback.format_exc()
+                my_log.log2(f'my_db:WriteBehind:flush {error}\n\n{traceback_error}')
+                if CON.in_transaction:
+                    CON.rollback()
+                self.failures += 1
+                if self.failures <= self.max_retries:
+                    self._restore(msgs, props)
+                else:
+                    # пачка не пишется раз за разом (например неизвестное поле), дальше ее не держим
+                    my_log.log2(f'my_db:WriteBehind:flush: dropped {len(msgs)} messages and {len(props)} users after {self.failures} failures')
+                    self.failures = 0
+            finally:
+                with self.lock:
+                    self.inflight = {}
+
+    def _restore(self, msgs: list, props: dict):
+        '''Вернуть незаписанную пачку в очередь, более новые значения из очереди не затираются'''
+        with self.lock:
+            self.msgs = msgs + self.msgs
+            for user_id, fields in props.items():
+                pending = self.props.setdefault(user_id, {})
+                for property, value in fields.items():
+                    pending.setdefault(property, value)
+            self.ops += len(msgs) + sum(len(x) for x in props.values())
+
+
+WRITE_BEHIND = WriteBehind(
+    cfg.DB_WRITE_BEHIND_SIZE if hasattr(cfg, 'DB_WRITE_BEHIND_SIZE') else 500,
+    cfg.DB_WRITE_BEHIND_INTERVAL if hasattr(cfg, 'DB_WRITE_BEHIND_INTERVAL') else 1.0,
+)
+
+
+def checkpoint_wal(db_file: str = DB_FILE):
+    '''
+    Перенести содержимое db/main.db-wal в основной файл базы.
+    Нужно перед копированием файла базы, иначе в копию не попадут последние записи.
+    '''
+    if not os.path.exists(db_file + '-wal'):
+        return
+    try:
+        con = sqlite3.connect(db_file)
+        try:
+            con.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+        finally:
+            con.close()
+    except Exception as error:
+        my_log.log2(f'my_db:checkpoint_wal {error}')
+
+
 def unpack_db(from_file: str, to_file: str):
     '''
     Unpack db copy (zstd compressed) with chunk reading and writing.
@@ -143,6 +457,8 @@ def check_db():
 
 def backup_db():
     try:
+        checkpoint_wal()
+
         # if exists db/main.db.zst move to db/main.db.zst.1 and copy
         if os.path.exists('db/main.db.zst'):
             if os.path.exists('db/main.db.zst.1'):
@@ -184,6 +500,19 @@ def online_backup(target_file: str = ''):
             CON.backup(target)
 
 
+@async_run
+def write_behind_daemon():
+    '''Сбрасывает очередь WRITE_BEHIND раз в interval секунд или при заполнении'''
+    while DAEMON_RUN:
+        WRITE_BEHIND.wakeup.wait(WRITE_BEHIND.interval)
+        WRITE_BEHIND.wakeup.clear()
+        try:
+            WRITE_BEHIND.flush()
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_db:write_behind_daemon {error}\n\n{traceback_error}')
+
+
 @async_run
 def sync_daemon():
     while DAEMON_RUN:
@@ -197,9 +526,147 @@ def sync_daemon():
             my_log.log2(f'my_db:sync_daemon {error}\n\n{traceback_error}')
 
 
+# сводные таблицы по msg_counter для статистики, обновляются триггерами при каждой вставке,
+# так что /stats и графики читают O(дней) строк а не все сообщения за 10 лет
+# stat_model_day    - сообщений за день по моделям
+# stat_active_day   - активных юзеров за день
+# stat_new_users_day - новых юзеров за день
+# stat_user_day     - кто писал в какой день (последние STAT_USER_DAY_KEEP дней, для уникальности)
+# stat_user_first   - когда юзер написал впервые
+STAT_USER_DAY_KEEP = 40
+STAT_DAY_SQL = "date({}, 'unixepoch', 'localtime')"
+
+
+def _day(timestamp: float) -> str:
+    '''Дата в формате stat_* таблиц'''
+    return datetime.date.fromtimestamp(timestamp).strftime('%Y-%m-%d')
+
+
+def _next_day_start(timestamp: float) -> float:
+    '''Начало следующего дня после timestamp'''
+    date_obj = datetime.date.fromtimestamp(timestamp) + datetime.timedelta(days=1)
+    return time.mktime(date_obj.timetuple())
+
+
+def rebuild_stat_rollups():
+    '''Пересчитать сводные таблицы с нуля по msg_counter, вызывать под LOCK и в транзакции'''
+    day = STAT_DAY_SQL.format('access_time')
+    for table in ('stat_model_day', 'stat_user_day', 'stat_user_first'):
+        CUR.execute(f'DELETE FROM {table}')
+    CUR.execute(f'''
+        INSERT INTO stat_model_day (day, model_used, count)
+        SELECT {day} AS d, IFNULL(model_used, ''), COUNT(*) FROM msg_counter
+        GROUP BY d, IFNULL(model_used, '')
+    ''')
+    CUR.execute(f'''
+        INSERT INTO stat_user_day (day, user_id)
+        SELECT DISTINCT {day}, user_id FROM msg_counter
+        WHERE access_time >= ?
+    ''', (time.time() - STAT_USER_DAY_KEEP * 24 * 60 * 60,))
+    CUR.execute('''
+        INSERT INTO stat_user_first (user_id, first_time)
+        SELECT user_id, MIN(access_time) FROM msg_counter
+        GROUP BY user_id
+    ''')
+    # счетчики по дням считаем последними, вставки выше могли их задеть через триггеры
+    CUR.execute('DELETE FROM stat_active_day')
+    CUR.execute('DELETE FROM stat_new_users_day')
+    CUR.execute(f'''
+        INSERT INTO stat_active_day (day, count)
+        SELECT {day} AS d, COUNT(DISTINCT user_id) FROM msg_counter
+        GROUP BY d
+    ''')
+    CUR.execute(f'''
+        INSERT INTO stat_new_users_day (day, count)
+        SELECT {STAT_DAY_SQL.format('first_time')} AS d, COUNT(*) FROM stat_user_first
+        GROUP BY d
+    ''')
+
+
+def init_stat_rollups():
+    '''Создать сводные таблицы и триггеры, при первом запуске заполнить их по msg_counter'''
+    CUR.execute('''
+        CREATE TABLE IF NOT EXISTS stat_model_day (
+            day TEXT,
+            model_used TEXT,
+            count INTEGER,
+            PRIMARY KEY (day, model_used)
+        )
+    ''')
+    CUR.execute('''
+        CREATE TABLE IF NOT EXISTS stat_active_day (
+            day TEXT PRIMARY KEY,
+            count INTEGER
+        )
+    ''')
+    CUR.execute('''
+        CREATE TABLE IF NOT EXISTS stat_new_users_day (
+            day TEXT PRIMARY KEY,
+            count INTEGER
+        )
+    ''')
+    CUR.execute('''
+        CREATE TABLE IF NOT EXISTS stat_user_day (
+            day TEXT,
+            user_id TEXT,
+            PRIMARY KEY (day, user_id)
+        )
+    ''')
+    CUR.execute('''
+        CREATE TABLE IF NOT EXISTS stat_user_first (
+            user_id TEXT PRIMARY KEY,
+            first_time REAL
+        )
+    ''')
+    CUR.execute('CREATE INDEX IF NOT EXISTS idx_stat_user_first_time ON stat_user_first (first_time)')
+
+    CUR.execute("SELECT name FROM sqlite_master WHERE type='trigger' AND name='trg_msg_counter_rollup'")
+    if CUR.fetchone() is None:
+        # триггеры и начальное заполнение в одной транзакции, что бы ничего не потерять и не посчитать дважды
+        day = STAT_DAY_SQL.format('NEW.access_time')
+        CUR.execute('BEGIN')
+        try:
+            start = time.time()
+            rebuild_stat_rollups()
+            # INSERT OR IGNORE не вызывает триггер на вставку если строка уже есть,
+            # поэтому новые дни/юзеры считаются по вставкам в stat_user_day и stat_user_first
+            CUR.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_msg_counter_rollup AFTER INSERT ON msg_counter
+                BEGIN
+                    INSERT INTO stat_model_day (day, model_used, count)
+                    VALUES ({day}, IFNULL(NEW.model_used, ''), 1)
+                    ON CONFLICT (day, model_used) DO UPDATE SET count = count + 1;
+                    INSERT OR IGNORE INTO stat_user_day (day, user_id) VALUES ({day}, NEW.user_id);
+                    INSERT OR IGNORE INTO stat_user_first (user_id, first_time) VALUES (NEW.user_id, NEW.access_time);
+                END
+            ''')
+            CUR.execute('''
+                CREATE TRIGGER IF NOT EXISTS trg_stat_user_day_rollup AFTER INSERT ON stat_user_day
+                BEGIN
+                    INSERT INTO stat_active_day (day, count) VALUES (NEW.day, 1)
+                    ON CONFLICT (day) DO UPDATE SET count = count + 1;
+                END
+            ''')
+            CUR.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS trg_stat_user_first_rollup AFTER INSERT ON stat_user_first
+                BEGIN
+                    INSERT INTO stat_new_users_day (day, count) VALUES ({STAT_DAY_SQL.format('NEW.first_time')}, 1)
+                    ON CONFLICT (day) DO UPDATE SET count = count + 1;
+                END
+            ''')
+            CUR.execute('COMMIT')
+            my_log.log2(f'my_db:init_stat_rollups: backfilled in {time.time() - start:.1f}s')
+        except Exception as error:
+            CON.rollback()
+            raise error
+
+    # для уникальности по дням нужны только последние дни
+    CUR.execute('DELETE FROM stat_user_day WHERE day < ?', (_day(time.time() - STAT_USER_DAY_KEEP * 24 * 60 * 60),))
+
+
 def init(backup: bool = True, vacuum: bool = False):
     '''init db'''
-    global CON, CUR
+    global CON, CUR, USER_ROW_COLUMNS
     day_seconds = 60 * 60 * 24
     week_seconds = day_seconds * 7
     month_seconds = day_seconds * 30
@@ -213,8 +680,12 @@ def init(backup: bool = True, vacuum: bool = False):
     try:
         if backup:
             backup_db()
-        CON = sqlite3.connect('db/main.db', check_same_thread=False)
+        # autocommit + WAL: каждая запись сразу видна читателям из READ_POOL,
+        # при synchronous=NORMAL коммит это дописывание в WAL без fsync
+        CON = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
         CUR = CON.cursor()
+        CUR.execute('PRAGMA journal_mode=WAL')
+        CUR.execute('PRAGMA synchronous=NORMAL')
 
         # переделать поле saved_file на blob
         alter_saved_file_column()
@@ -231,6 +702,7 @@ def init(backup: bool = True, vacuum: bool = False):
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_access_time ON msg_counter (access_time)')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_user_id ON msg_counter (user_id)')
         CUR.execute('CREATE INDEX IF NOT EXISTS idx_model_used ON msg_counter (model_used)')
+        init_stat_rollups()
 
         CUR.execute('''
             CREATE TABLE IF NOT EXISTS translations (
@@ -348,6 +820,9 @@ def init(backup: bool = True, vacuum: bool = False):
                     WHERE last_time_access < ?
                     """, (time.time() - keep_messages_seconds,))
 
+        CUR.execute("PRAGMA table_info(users)")
+        USER_ROW_COLUMNS = tuple(x[1] for x in CUR.fetchall() if x[1] not in USER_BIG_COLUMNS)
+
         CUR.execute('''
             CREATE TABLE IF NOT EXISTS sum (
                 id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -357,12 +832,22 @@ def init(backup: bool = True, vacuum: bool = False):
             )
         ''')
 
+        CUR.execute('''
+            CREATE TABLE IF NOT EXISTS blob_dicts (
+                dict_id INTEGER PRIMARY KEY,
+                data BLOB,
+                current INTEGER
+            )
+        ''')
+        sync_blob_dicts()
+
 
         if vacuum:
             CON.commit()
             CUR.execute("VACUUM")
         CON.commit()
         sync_daemon()
+        write_behind_daemon()
     except Exception as error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'my_db:init {error}\n\n{traceback_error}')
@@ -371,10 +856,14 @@ def init(backup: bool = True, vacuum: bool = False):
 def close():
     global DAEMON_RUN
     DAEMON_RUN = False
+    WRITE_BEHIND.wakeup.set()
     time.sleep(DAEMON_TIME + 2)
+    WRITE_BEHIND.flush()
     with LOCK:
         try:
             CON.commit()
+            READ_POOL.close()
+            CUR.execute('PRAGMA wal_checkpoint(TRUNCATE)')
             # CON.close()
         except Exception as error:
             my_log.log2(f'my_db:close {error}')
@@ -433,28 +922,13 @@ def alter_saved_file_column():
             CON.rollback()
 
 
-@async_run
 def add_msg(user_id: str, model_used: str, timestamp: float = None):
-    '''add msg counter record to db'''
-    with LOCK:
-        try:
-            access_time = timestamp if timestamp else time.time()
-
-            # Проверка наличия записи
-            CUR.execute('''
-                SELECT COUNT(*) FROM msg_counter
-                WHERE user_id = ? AND access_time = ? AND model_used = ?
-            ''', (user_id, access_time, model_used))
-
-            if CUR.fetchone()[0] == 0:
-                # Если записи нет, добавляем новую
-                CUR.execute('''
-                    INSERT INTO msg_counter (user_id, access_time, model_used)
-                    VALUES (?, ?, ?)
-                ''', (user_id, access_time, model_used))
-
-        except Exception as error:
-            my_log.log2(f'my_db:add {error}')
+    '''add msg counter record to db (через очередь WRITE_BEHIND)'''
+    try:
+        access_time = timestamp if timestamp else time.time()
+        WRITE_BEHIND.add_msg(user_id, access_time, model_used)
+    except Exception as error:
+        my_log.log2(f'my_db:add {error}')
 
 
 def count_msgs(user_id: str, model: str, access_time: float):
@@ -465,19 +939,19 @@ def count_msgs(user_id: str, model: str, access_time: float):
     print(count_msgs('user1', 'all', 60*60*24*30)) - print all messages sent by user1 in the last 30 days
     '''
     access_time = time.time() - access_time
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
             if model == 'all':
-                CUR.execute('''
+                cur.execute('''
                     SELECT COUNT(*) FROM msg_counter
                     WHERE user_id = ? AND access_time > ?
                 ''', (user_id, access_time))
             else:
-                CUR.execute('''
+                cur.execute('''
                     SELECT COUNT(*) FROM msg_counter
                     WHERE user_id = ? AND model_used = ? AND access_time > ?
                 ''', (user_id, model, access_time))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:count {error}')
             return 0
@@ -487,13 +961,13 @@ def count_msgs(user_id: str, model: str, access_time: float):
 def count_msgs_total_user(user_id: str) -> int:
     '''Count the number of all messages sent by a user.
     '''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(*) FROM msg_counter
                 WHERE user_id = ?
             ''', (user_id,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:count {error}')
             return 0
@@ -510,19 +984,19 @@ def count_msgs_last_24h(user_id: str) -> int:
     Returns:
         The number of messages sent by the user in the last 24 hours.
     """
-    with LOCK:  # Assuming you have a lock defined for database access
+    with READ_POOL.cursor() as cur:
         try:
             # Calculate the timestamp 24 hours ago
             time_24h_ago = time.time() - 24 * 60 * 60
 
             # Execute the SQL query to count messages
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(*) FROM msg_counter
                 WHERE user_id = ? AND access_time >= ?
             ''', (user_id, time_24h_ago))
 
             # Fetch and return the result
-            result = CUR.fetchone()[0]
+            result = cur.fetchone()[0]
             return result
 
         except sqlite3.Error as error:
@@ -533,100 +1007,141 @@ def count_msgs_last_24h(user_id: str) -> int:
 
 def count_msgs_all():
     '''count all messages'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(*) FROM msg_counter
             ''')
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:count_all {error}')
             return 0
 
 
 def get_model_usage(days: int):
+    '''Сколько сообщений по моделям за последние days дней,
+    целые дни из stat_model_day, начало окна (неполный день) из msg_counter'''
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    first_full_day_start = _next_day_start(access_time)
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT model_used, COUNT(*) FROM msg_counter
-                WHERE access_time > ?
-                GROUP BY model_used
-            ''', (access_time,))
-            results = CUR.fetchall()
             model_usage = {}
-            for row in results:
-                model = row[0]
-                usage_count = row[1]
+            cur.execute('''
+                SELECT model_used, SUM(count) FROM stat_model_day
+                WHERE day >= ?
+                GROUP BY model_used
+            ''', (_day(first_full_day_start),))
+            for model, usage_count in cur.fetchall():
                 model_usage[model] = usage_count
+            cur.execute('''
+                SELECT IFNULL(model_used, ''), COUNT(*) FROM msg_counter
+                WHERE access_time > ? AND access_time < ?
+                GROUP BY IFNULL(model_used, '')
+            ''', (access_time, first_full_day_start))
+            for model, usage_count in cur.fetchall():
+                model_usage[model] = model_usage.get(model, 0) + usage_count
             return model_usage
         except Exception as error:
             my_log.log2(f'my_db:get_model_usage {error}')
             return {}
 
 
+def get_model_usage_by_days(start_day: str, end_day: str) -> dict:
+    '''
+    Сколько сообщений по моделям в каждый день из stat_model_day.
+
+    Args:
+        start_day, end_day: 'YYYY-MM-DD', включительно
+
+    Returns:
+        {day: {model: count}}
+    '''
+    result = {}
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT day, model_used, count FROM stat_model_day
+                WHERE day >= ? AND day <= ?
+            ''', (start_day, end_day))
+            for day, model, usage_count in cur.fetchall():
+                result.setdefault(day, {})[model] = usage_count
+        except Exception as error:
+            my_log.log2(f'my_db:get_model_usage_by_days {error}')
+    return result
+
+
 def get_total_msg_users() -> int:
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(DISTINCT user_id) FROM msg_counter
             ''')
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_users {error}')
             return 0
 
 
 def get_total_msg_user(user_id) -> int:
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(id) FROM msg_counter WHERE user_id = ?
             ''', (user_id,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_user {error}')
             return 0
 
 
 def get_pics_msg_user(user_id) -> int:
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(id) FROM msg_counter WHERE user_id = ? AND model_used LIKE 'img %'
             ''', (user_id,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_user {error}')
             return 0
 
 
 def get_total_msg_users_in_days(days: int) -> int:
+    '''Сколько разных юзеров писали за последние days дней,
+    целые дни из stat_user_day, начало окна (неполный день) из msg_counter'''
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    first_full_day_start = _next_day_start(access_time)
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(DISTINCT user_id) FROM msg_counter
-                WHERE access_time > ?
-            ''', (access_time,))
-            return CUR.fetchone()[0]
+            if days > STAT_USER_DAY_KEEP - 2:
+                cur.execute('''
+                    SELECT COUNT(DISTINCT user_id) FROM msg_counter
+                    WHERE access_time > ?
+                ''', (access_time,))
+            else:
+                cur.execute('''
+                    SELECT COUNT(*) FROM (
+                        SELECT user_id FROM stat_user_day WHERE day >= ?
+                        UNION
+                        SELECT user_id FROM msg_counter WHERE access_time > ? AND access_time < ?
+                    )
+                ''', (_day(first_full_day_start), access_time, first_full_day_start))
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:get_total_msg_users_in_days {error}')
             return 0
 
 
 def count_new_user_in_days(days: int) -> int:
-    '''Посчитать сколько юзеров впервые написали боту раньше чем за days дней'''
+    '''Посчитать сколько юзеров впервые написали боту за последние days дней'''
     access_time = time.time() - days * 24 * 60 * 60
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
-                SELECT COUNT(DISTINCT T1.user_id)
-                FROM msg_counter AS T1
-                INNER JOIN users AS T2 ON T1.user_id = T2.id
-                WHERE T2.first_meet > ?
+            cur.execute('''
+                SELECT COUNT(*) FROM stat_user_first
+                WHERE first_time > ?
             ''', (access_time,))
-            return CUR.fetchone()[0]
+            return cur.fetchone()[0]
         except Exception as error:
             my_log.log2(f'my_db:count_new_user_in_days {error}')
             return 0
@@ -634,7 +1149,7 @@ def count_new_user_in_days(days: int) -> int:
 
 def get_new_users_for_last_days(days: int) -> OrderedDict:
     """
-    Retrieves the number of new users for each of the past `days` from the database.
+    Retrieves the number of new users for each of the past `days` from the stat_new_users_day rollup.
 
     Args:
         days: The number of past days to retrieve data for.
@@ -644,38 +1159,12 @@ def get_new_users_for_last_days(days: int) -> OrderedDict:
         The keys are date strings in "YYYY-MM-DD" format, and the values are the
         corresponding new user counts. The dates are ordered from oldest to newest.
     """
-
-    result = OrderedDict()
-    today = datetime.date.today()
-    with LOCK:
-        try:
-            for i in range(days - 1, -1, -1):
-                date_obj = today - datetime.timedelta(days=i)
-                date_str = date_obj.strftime("%Y-%m-%d")
-                start_timestamp = time.mktime(date_obj.timetuple())
-                end_timestamp = start_timestamp + 24 * 60 * 60
-
-                CUR.execute('''
-                    SELECT COUNT(DISTINCT T1.user_id)
-                    FROM msg_counter AS T1
-                    INNER JOIN users AS T2 ON T1.user_id = T2.id
-                    WHERE T2.first_meet >= ? AND T2.first_meet < ?
-                ''', (start_timestamp, end_timestamp))
-                new_users_count = CUR.fetchone()[0]
-                result[date_str] = new_users_count
-
-        except Exception as error:
-            my_log.log2(f'my_db:get_new_users_for_last_days {error}')
-
-    if result:  # Проверяем, не пустой ли словарь
-        result.popitem() # Удаляем последний элемент
-
-    return result
+    return _get_daily_rollup('stat_new_users_day', days)
 
 
 def get_users_for_last_days(days: int) -> OrderedDict:
     """
-    Retrieves the number of active users for each of the past `days`, excluding today.
+    Retrieves the number of active users for each of the past `days` from the stat_active_day rollup, excluding today.
 
     Args:
         days: The number of past days to retrieve data for (excluding today).
@@ -686,48 +1175,60 @@ def get_users_for_last_days(days: int) -> OrderedDict:
         corresponding user counts. The dates are ordered from oldest to newest.
         Returns an empty OrderedDict if days is less than or equal to zero.
     """
+    return _get_daily_rollup('stat_active_day', days)
 
-    result = OrderedDict()
-    for i in range(days - 1, -1, -1):  # Итерация в обратном порядке
-        date_obj = datetime.date.today() - datetime.timedelta(days=i)
-        date_str = date_obj.strftime("%Y-%m-%d")
-        try:
-            start_timestamp = time.mktime(date_obj.timetuple())
-            end_timestamp = start_timestamp + 24 * 60 * 60
 
-            with LOCK:
-                CUR.execute('''
-                    SELECT COUNT(DISTINCT user_id) FROM msg_counter
-                    WHERE access_time >= ? AND access_time < ?
-                ''', (start_timestamp, end_timestamp))
-                users_count = CUR.fetchone()[0]
-        except Exception as error:
-            my_log.log2(f'my_db:get_users_for_last_days {error}')
-            users_count = 0
-
-        result[date_str] = users_count
-
-    if result:  # Проверяем, не пустой ли словарь
-        result.popitem() # Удаляем последний элемент
-
-    return result # Возвращаем OrderedDict
+def _get_daily_rollup(table: str, days: int) -> OrderedDict:
+    '''{day: count} из stat_active_day/stat_new_users_day за days дней без сегодняшнего'''
+    result = OrderedDict()
+    if days <= 0:
+        return result
+    today = datetime.date.today()
+    dates = [(today - datetime.timedelta(days=i)).strftime("%Y-%m-%d") for i in range(days - 1, 0, -1)]
+    counts = {}
+    if dates:
+        with READ_POOL.cursor() as cur:
+            try:
+                cur.execute(f'''
+                    SELECT day, count FROM {table}
+                    WHERE day >= ? AND day <= ?
+                ''', (dates[0], dates[-1]))
+                counts = dict(cur.fetchall())
+            except Exception as error:
+                my_log.log2(f'my_db:_get_daily_rollup {table} {error}')
+    for date_str in dates:
+        result[date_str] = counts.get(date_str, 0)
+    return result
 
 
 def get_translation(text: str, lang: str, help: str) -> str:
     '''Get translation from cache if any'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT translation FROM translations
                 WHERE original = ? AND lang = ? AND help = ?
             ''', (text, lang, help))
-            result = CUR.fetchone()
+            result = cur.fetchone()
             return result[0] if result else ''
         except Exception as error:
             my_log.log2(f'my_db:get_translation {error}')
             return ''
 
 
+def get_all_translations() -> List[Tuple[str, str, str, str]]:
+    '''Get all translations, list of tuples (original, lang, help, translation)'''
+    with READ_POOL.cursor() as cur:
+        try:
+            cur.execute('''
+                SELECT original, lang, help, translation FROM translations
+            ''')
+            return cur.fetchall()
+        except Exception as error:
+            my_log.log2(f'my_db:get_all_translations {error}')
+            return []
+
+
 def update_translation(text: str, lang: str, help: str, translation: str):
     '''Update or insert translation in cache'''
     with LOCK:
@@ -752,30 +1253,38 @@ def update_translation(text: str, lang: str, help: str, translation: str):
 
 
 def update_translations(values: list):
-    '''Update many translations in cache
+    '''Update or insert many translations in cache in one transaction
     values - list of tuples (text, lang, help, translation)
     '''
-    drop_all_translations()
+    if not values:
+        return
     with LOCK:
         try:
-            # Выполняем один запрос для вставки данных
+            CUR.execute('BEGIN')
+            CUR.executemany('''
+                DELETE FROM translations
+                WHERE original = ? AND lang = ? AND help = ?
+            ''', [x[:3] for x in values])
             CUR.executemany('''
                 INSERT INTO translations (original, lang, help, translation)
                 VALUES (?, ?, ?, ?)
             ''', values)
+            CUR.execute('COMMIT')
         except Exception as error:
             my_log.log2(f'my_db:update_translations {error}\n\n{values}')
+            if CON.in_transaction:
+                CON.rollback()
 
 
 def get_translations_like(text: str) -> list:
     '''Get translations from cache that are similar to the given text'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT original, lang, help, translation FROM translations
                 WHERE translation LIKE ?
             ''', (f'%{text}%',))
-            results = CUR.fetchall()
+            results = cur.fetchall()
             return results or []
         except Exception as error:
             my_log.log2(f'my_db:get_translations_like {error}')
@@ -784,12 +1293,12 @@ def get_translations_like(text: str) -> list:
 
 def get_translations_count() -> int:
     '''Get count of translations'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(*) FROM translations
             ''')
-            result = CUR.fetchone()
+            result = cur.fetchone()
             return result[0] if result else 0
         except Exception as error:
             my_log.log2(f'my_db:get_translations_count {error}')
@@ -816,13 +1325,13 @@ def _is_bad_original(text: str) -> bool:
 
 def get_unique_originals() -> List[Tuple[str, str]]:
     """Получает уникальные записи и отфильтровывает «плохие» оригиналы."""
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT DISTINCT original, help
                 FROM translations
             ''')
-            rows: List[Tuple[str, str]] = CUR.fetchall()
+            rows: List[Tuple[str, str]] = cur.fetchall()
         except Exception as err:
             my_log.log2(f'my_db:get_unique_originals {err}')
             return []
@@ -884,11 +1393,56 @@ def get_first_meet(user_id):
         return None
 
 
+def load_user_row(user_id: str, token: list = None) -> dict:
+    '''Загрузить строку юзера (без больших полей) в USERS_ROWS
+    token - от USERS_ROWS.begin_load если он взят заранее
+    Return None if user not found
+    '''
+    if token is None:
+        token = USERS_ROWS.begin_load(user_id)
+    row = None
+    try:
+        with READ_POOL.cursor() as cur:
+            cur.execute(f'''
+                SELECT {', '.join(USER_ROW_COLUMNS)} FROM users
+                WHERE id = ?
+            ''', (user_id,))
+            result = cur.fetchone()
+            if result:
+                row = dict(zip(USER_ROW_COLUMNS, result))
+    except Exception as error:
+        my_log.log2(f'my_db:load_user_row {error}')
+    finally:
+        USERS_ROWS.end_load(user_id, token, row)
+    return row
+
+
 def get_user_property(user_id: str, property: str):
     '''Get a value of property in user table
     Return None if user not found
     '''
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
+    # токен загрузки берем до проверки очереди записи, иначе set_user_property между проверкой
+    # и загрузкой не пометит загрузку и в кеш попадет строка из базы со старым значением
+    token = USERS_ROWS.begin_load(user_id) if property in USER_ROW_COLUMNS else None
+
+    # значение еще не записано в базу
+    pending, value = WRITE_BEHIND.get_property(user_id, property)
+    if pending:
+        if token is not None:
+            USERS_ROWS.end_load(user_id, token, None)
+        if property == 'saved_file':
+            return blob_to_obj(value)
+        return value
+
+    if token is not None:
+        found, value = USERS_ROWS.get(user_id, property)
+        if found:
+            USERS_ROWS.end_load(user_id, token, None)
+            return value
+        row = load_user_row(user_id, token)
+        return row.get(property) if row else None
+
+    cache_key = (user_id, property)
     if cache_key in USERS_CACHE.cache:
         # saved_file сжимаем и распаковываем
         if property == 'saved_file':
@@ -896,13 +1450,13 @@ def get_user_property(user_id: str, property: str):
         else:
             return USERS_CACHE.get(cache_key)
     else:
-        with LOCK:
+        with READ_POOL.cursor() as cur:
             try:
-                CUR.execute(f'''
+                cur.execute(f'''
                     SELECT {property} FROM users
                     WHERE id = ?
                 ''', (user_id,))
-                result = CUR.fetchone()
+                result = cur.fetchone()
                 if result:
                     # saved_file сжимаем и распаковываем
                     if property == 'saved_file':
@@ -921,13 +1475,13 @@ def get_user_property(user_id: str, property: str):
 
 def get_user_all_bad_ids():
     '''get users ids if blocked = True'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_ids {error}')
@@ -936,13 +1490,13 @@ def get_user_all_bad_ids():
 
 def get_user_all_bad_bing_ids():
     '''get users ids if blocked_bing = True'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked_bing = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_bing_ids {error}')
@@ -951,13 +1505,13 @@ def get_user_all_bad_bing_ids():
 
 def get_user_all_bad_totally_ids():
     '''get users ids if blocked_totally = True'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
                 WHERE blocked_totally = 1
             ''')
-            result = CUR.fetchall()
+            result = cur.fetchall()
             return [x[0] for x in result]
         except Exception as error:
             my_log.log2(f'my_db:get_user_all_bad_totally_ids {error}')
@@ -966,11 +1520,14 @@ def get_user_all_bad_totally_ids():
 
 def delete_user_property(user_id: str, property: str):
     '''Delete user`s property value'''
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
-    if cache_key in USERS_CACHE.cache:
-        USERS_CACHE.delete(cache_key)
+    if property in USER_ROW_COLUMNS:
+        USERS_ROWS.set_field(user_id, property, None)
+    else:
+        USERS_CACHE.delete((user_id, property))
     with LOCK:
         try:
+            WRITE_BEHIND.drop_property(user_id, property)
+
             # Проверяем, существует ли пользователь
             CUR.execute('''
                 SELECT 1 FROM users
@@ -1004,41 +1561,26 @@ def set_user_property(user_id: str, property: str, value):
         value = value[:max_size]
         value = obj_to_blob(value)
 
-    cache_key = hashlib.md5(f"{user_id}_{property}".encode()).hexdigest()
-    USERS_CACHE.set(cache_key, value)
-    with LOCK:
-        try:
-            # Проверяем, есть ли пользователь в базе
-            CUR.execute('''
-                SELECT 1 FROM users
-                WHERE id = ?
-            ''', (user_id,))
-            if CUR.fetchone():
-                # Обновляем если пользователь уже существует
-                CUR.execute(f'''
-                    UPDATE users
-                    SET {property} = ?
-                    WHERE id = ?
-                ''', (value, user_id))
-            else:
-                # Добавляем нового пользователя, если его нет
-                first_meet = get_first_meet(user_id) or time.time()
-                CUR.execute(f'''
-                    INSERT INTO users (id, {property}, first_meet)
-                    VALUES (?, ?, ?)
-                ''', (user_id, value, first_meet))
-        except Exception as error:
-            my_log.log2(f'my_db:set_user_property {error}')
+    try:
+        # сначала в очередь, потом в кеш, так читатель не закеширует старое значение из базы
+        WRITE_BEHIND.set_property(user_id, property, value)
+    except Exception as error:
+        my_log.log2(f'my_db:set_user_property {error}')
+
+    if property in USER_ROW_COLUMNS:
+        USERS_ROWS.set_field(user_id, property, value)
+    else:
+        USERS_CACHE.set((user_id, property), value)
 
 
 def get_all_users_ids():
     '''Get all users ids'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT id FROM users
             ''')
-            results = CUR.fetchall()
+            results = cur.fetchall()
             return [result[0] for result in results]
         except Exception as error:
             my_log.log2(f'my_db:get_all_users_ids {error}')
@@ -1079,13 +1621,13 @@ def set_sum_cache(url, text):
 
 def get_from_sum(url: str) -> str:
     '''Get from sum'''
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute('''
+            cur.execute('''
                 SELECT text FROM sum
                 WHERE url = ?
             ''', (url,))
-            result = CUR.fetchone()
+            result = cur.fetchone()
             if result is None:
                 return ''
             return result[0]
@@ -1114,15 +1656,15 @@ def find_users_with_many_messages() -> List[str]:
         A list of user IDs (as strings) that match the criteria. 
         Returns an empty list if no users match or an error occurs.
     """
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
-            CUR.execute("""
+            cur.execute("""
                 SELECT id
                 FROM users
                 WHERE id IN (SELECT user_id FROM msg_counter GROUP BY user_id HAVING COUNT(*) > 1000)
                   AND id NOT LIKE '%-10%'  -- Exclude users with '-10' in their ID
             """)
-            results = CUR.fetchall()
+            results = cur.fetchall()
             return [user_id[0] for user_id in results]  
         except Exception as error:
             my_log.log2(f'my_db:find_users_with_many_messages {error}')
@@ -1133,10 +1675,14 @@ def fix_tts_model_used():
     '''Исправить записи в базе с неправильным model_used'''
     with LOCK:
         try:
+            CUR.execute('BEGIN')
             CUR.execute("UPDATE msg_counter SET model_used = REPLACE(model_used, 'TTS ', 'STT ') WHERE model_used LIKE 'TTS %'")
-            CON.commit()
+            rebuild_stat_rollups()
+            CUR.execute('COMMIT')
         except Exception as error:
             my_log.log2(f'my_db:fix_tts_model_used {error}')
+            if CON.in_transaction:
+                CON.rollback()
 
 
 def get_top_users_by_size(top_n: int = 100) -> List[Tuple[str, int]]:
@@ -1149,15 +1695,15 @@ def get_top_users_by_size(top_n: int = 100) -> List[Tuple[str, int]]:
     Returns:
         List[Tuple[str, int]]: A list of tuples containing user IDs and their total sizes.
     """
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
             # Извлекаем данные о пользователях
-            CUR.execute('''
+            cur.execute('''
                 SELECT id, saved_file, dialog_gemini, dialog_groq,
                        dialog_openrouter, persistant_memory
                 FROM users
             ''')
-            users_data = CUR.fetchall()
+            users_data = cur.fetchall()
 
             # Подсчитываем размеры текстов и блобов для каждого пользователя
             user_sizes = []
@@ -1198,16 +1744,16 @@ def get_user_data_sizes(user_id: str) -> dict:
     Returns:
         dict: A dictionary containing the sizes of text and blob fields.
     """
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
             # Извлекаем данные о пользователе
-            CUR.execute('''
+            cur.execute('''
                 SELECT id, saved_file, dialog_gemini, dialog_groq,
                        dialog_openrouter, persistant_memory
                 FROM users
                 WHERE id = ?
             ''', (user_id,))
-            user_data = CUR.fetchone()
+            user_data = cur.fetchone()
 
             if not user_data:
                 return {}
@@ -1245,6 +1791,7 @@ def drop_all_user_files_and_big_dialogs(max_dialog_size: int = 500000, delete_da
     Returns:
         str: A message indicating the result of the operation.
     '''
+    WRITE_BEHIND.flush()
     with LOCK:
         try:
             if delete_data:
@@ -1286,7 +1833,8 @@ def drop_all_user_files_and_big_dialogs(max_dialog_size: int = 500000, delete_da
 
                 # Clear the cache
                 try:
-                    USERS_CACHE.cache.cache_clear()
+                    USERS_CACHE.cache.clear()
+                    USERS_ROWS.clear()
                 except Exception as clear_cache_error:
                     my_log.log2(f'my_db:drop_all_user_files_and_big_dialogs {clear_cache_error}')
 
@@ -1336,6 +1884,115 @@ def drop_all_user_files_and_big_dialogs(max_dialog_size: int = 500000, delete_da
                 return f'my_db:drop_all_user_files_and_big_dialogs: Error deleting data: {error}'
 
 
+# поля которые пишутся через obj_to_blob
+BLOB_COLUMNS = ('dialog_gemini', 'dialog_gemini3', 'dialog_groq', 'dialog_openrouter', 'memos', 'saved_file')
+
+
+def migrate_blobs(columns: tuple = BLOB_COLUMNS, batch_size: int = 200) -> str:
+    '''
+    Пережать старые lzma блобы текущим кодеком my_db_codec.CODEC.
+    Читает пачками через READ_POOL, пишет пачку одной транзакцией,
+    строка обновляется только если её не изменили за это время.
+
+    Returns:
+        str: A message indicating the result of the operation.
+    '''
+    WRITE_BEHIND.flush()
+    converted = 0
+    size_before = 0
+    size_after = 0
+    for column in columns:
+        last_id = 0
+        while True:
+            try:
+                with READ_POOL.cursor() as cur:
+                    cur.execute(f'''
+                        SELECT id_num, {column} FROM users
+                        WHERE id_num > ? AND substr({column}, 1, 6) = ?
+                        ORDER BY id_num
+                        LIMIT ?
+                    ''', (last_id, my_db_codec.LZMA_MAGIC, batch_size))
+                    rows = cur.fetchall()
+            except Exception as error:
+                my_log.log2(f'my_db:migrate_blobs {column} {error}')
+                break
+            if not rows:
+                break
+            last_id = rows[-1][0]
+
+            updates = []
+            for id_num, blob in rows:
+                try:
+                    new_blob = my_db_codec.recode(blob)
+                except Exception as error:
+                    my_log.log2(f'my_db:migrate_blobs {column} {id_num} {error}')
+                    continue
+                updates.append((new_blob, id_num, blob))
+                size_before += len(blob)
+                size_after += len(new_blob)
+
+            with LOCK:
+                try:
+                    CUR.execute('BEGIN')
+                    CUR.executemany(f'''
+                        UPDATE users
+                        SET {column} = ?
+                        WHERE id_num = ? AND {column} = ?
+                    ''', updates)
+                    CUR.execute('COMMIT')
+                    converted += len(updates)
+                except Exception as error:
+                    my_log.log2(f'my_db:migrate_blobs {column} {error}')
+                    if CON.in_transaction:
+                        CON.rollback()
+
+    USERS_CACHE.cache.clear()
+
+    msg = f'my_db:migrate_blobs: converted {converted} blobs to {my_db_codec.CODEC}, {size_before} -> {size_after} bytes'
+    my_log.log2(msg)
+    return msg
+
+
+def sync_blob_dicts():
+    '''
+    Словари сжатия my_db_codec (файлы db/blob_dict_*) сохранить в таблицу blob_dicts,
+    а те что есть только в базе (восстановили бекап на другом сервере) загрузить из нее.
+    Вызывать под LOCK или при init
+    '''
+    my_db_codec.load_dicts()
+    rows = CUR.execute('SELECT dict_id, data, current FROM blob_dicts').fetchall()
+    for _, data, current in rows:
+        # текущий словарь из файла главнее
+        my_db_codec.add_dict(data, current=bool(current) and not my_db_codec.CURRENT_DICT_ID)
+    saved = {row[0] for row in rows}
+    for dict_id, data in my_db_codec.get_dicts():
+        if dict_id not in saved:
+            CUR.execute('INSERT INTO blob_dicts (dict_id, data, current) VALUES (?, ?, 0)', (dict_id, data))
+    CUR.execute('UPDATE blob_dicts SET current = (dict_id = ?)', (my_db_codec.CURRENT_DICT_ID,))
+
+
+def train_blob_dict(limit: int = 1000) -> int:
+    '''Обучить общий словарь zstd на последних диалогах, вернуть dict_id или 0'''
+    WRITE_BEHIND.flush()
+    samples = my_db_codec.read_samples(DB_FILE, limit=limit)
+    if not samples:
+        return 0
+    dict_id = my_db_codec.train_dict(samples)
+    if dict_id:
+        with LOCK:
+            try:
+                sync_blob_dicts()
+            except Exception as error:
+                my_log.log2(f'my_db:train_blob_dict: {error}')
+    return dict_id
+
+
+def benchmark_blobs(limit: int = 200) -> str:
+    '''Сравнить кодеки на образцах реальных диалогов'''
+    samples = my_db_codec.read_samples(DB_FILE, limit=limit)
+    return my_db_codec.benchmark(samples)
+
+
 @cachetools.func.ttl_cache(maxsize=100, ttl=30*60)
 def count_imaged_per24h(chat_id_full: str) -> int:
     """
@@ -1347,19 +2004,19 @@ def count_imaged_per24h(chat_id_full: str) -> int:
     Returns:
         The number of images generated by the user in the last 24 hours.
     """
-    with LOCK:
+    with READ_POOL.cursor() as cur:
         try:
             # Calculate the timestamp 24 hours ago
             time_24h_ago = time.time() - 24 * 60 * 60
 
             # Execute the SQL query to count images
-            CUR.execute('''
+            cur.execute('''
                 SELECT COUNT(*) FROM msg_counter
                 WHERE user_id = ? AND access_time >= ? AND (model_used LIKE 'img %' OR model_used LIKE 'IMG %')
             ''', (chat_id_full, time_24h_ago))
 
             # Fetch and return the result
-            result = CUR.fetchone()[0]
+            result = cur.fetchone()[0]
             return result
 
         except sqlite3.Error as error:
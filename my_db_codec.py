@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+# Кодек для BLOB полей базы (диалоги, сохраненные файлы, мемо).
+# Формат: 1 байт заголовка с версией кодека + сжатые данные pickle.
+# Старые блобы без заголовка (чистый lzma) читаются как раньше.
+
+
+import glob
+import lzma
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+
+import zstandard
+
+import cfg
+import my_log
+
+
+# версии заголовка, байт 0xFD занят - так начинается старый lzma (xz) поток
+CODEC_ZSTD = 0x01
+CODEC_ZSTD_DICT = 0x02
+CODEC_ZLIB = 0x03
+
+LZMA_MAGIC = b'\xfd7zXZ\x00'
+
+# 'zstd', 'zstd_dict', 'zlib' или 'lzma' (старый формат без заголовка)
+CODEC = cfg.DB_BLOB_CODEC if hasattr(cfg, 'DB_BLOB_CODEC') else 'zstd'
+ZSTD_LEVEL = cfg.DB_BLOB_ZSTD_LEVEL if hasattr(cfg, 'DB_BLOB_ZSTD_LEVEL') else 3
+ZLIB_LEVEL = cfg.DB_BLOB_ZLIB_LEVEL if hasattr(cfg, 'DB_BLOB_ZLIB_LEVEL') else 6
+
+# общие словари сжатия, db/blob_dict_<dict_id>.zstd, старые не удаляются
+# пока есть блобы сжатые с ними. Копия хранится в таблице blob_dicts самой базы
+# (my_db.sync_blob_dicts), иначе бекап main.db без этих файлов не прочитать
+DICT_DIR = 'db'
+DICT_CURRENT_FILE = os.path.join(DICT_DIR, 'blob_dict.current')
+
+# {dict_id: zstandard.ZstdCompressionDict}
+DICTS = {}
+CURRENT_DICT_ID = 0
+DICTS_LOADED = False
+DICTS_LOCK = threading.Lock()
+
+# компрессоры zstandard нельзя использовать из разных потоков одновременно
+_LOCAL = threading.local()
+
+
+def _dict_file(dict_id: int) -> str:
+    return os.path.join(DICT_DIR, f'blob_dict_{dict_id}.zstd')
+
+
+def load_dicts():
+    '''Загрузить словари сжатия с диска'''
+    global DICTS_LOADED, CURRENT_DICT_ID
+    with DICTS_LOCK:
+        try:
+            for fname in glob.glob(os.path.join(DICT_DIR, 'blob_dict_*.zstd')):
+                with open(fname, 'rb') as f:
+                    d = zstandard.ZstdCompressionDict(f.read())
+                DICTS[d.dict_id()] = d
+            if os.path.exists(DICT_CURRENT_FILE):
+                with open(DICT_CURRENT_FILE, 'r') as f:
+                    CURRENT_DICT_ID = int(f.read().strip() or 0)
+        except Exception as error:
+            my_log.log2(f'my_db_codec:load_dicts {error}')
+        DICTS_LOADED = True
+
+
+def _get_dict(dict_id: int):
+    if not DICTS_LOADED:
+        load_dicts()
+    return DICTS.get(dict_id)
+
+
+def add_dict(data: bytes, current: bool = False) -> int:
+    '''Добавить словарь сжатия (например из базы), current - сделать его текущим. Возвращает dict_id'''
+    global CURRENT_DICT_ID
+    d = zstandard.ZstdCompressionDict(data)
+    dict_id = d.dict_id()
+    with DICTS_LOCK:
+        DICTS.setdefault(dict_id, d)
+        if current:
+            CURRENT_DICT_ID = dict_id
+    return dict_id
+
+
+def get_dicts() -> list:
+    '''Все загруженные словари, [(dict_id, bytes), ...]'''
+    with DICTS_LOCK:
+        return [(dict_id, d.as_bytes()) for dict_id, d in DICTS.items()]
+
+
+def train_dict(samples: list, dict_size: int = 112640) -> int:
+    '''
+    Обучить общий словарь zstd на образцах (несжатые pickle данные) и сделать его текущим.
+
+    Returns:
+        int: dict_id нового словаря или 0 в случае ошибки.
+    '''
+    global CURRENT_DICT_ID
+    try:
+        d = zstandard.train_dictionary(dict_size, samples)
+        dict_id = d.dict_id()
+        with open(_dict_file(dict_id), 'wb') as f:
+            f.write(d.as_bytes())
+        with open(DICT_CURRENT_FILE, 'w') as f:
+            f.write(str(dict_id))
+        load_dicts()
+        CURRENT_DICT_ID = dict_id
+        return dict_id
+    except Exception as error:
+        my_log.log2(f'my_db_codec:train_dict {error}')
+        return 0
+
+
+def _zstd_compressor(dict_id: int = 0) -> zstandard.ZstdCompressor:
+    key = f'c_{dict_id}'
+    c = getattr(_LOCAL, key, None)
+    if c is None:
+        if dict_id:
+            c = zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=_get_dict(dict_id))
+        else:
+            c = zstandard.ZstdCompressor(level=ZSTD_LEVEL)
+        setattr(_LOCAL, key, c)
+    return c
+
+
+def _zstd_decompressor(dict_id: int = 0) -> zstandard.ZstdDecompressor:
+    key = f'd_{dict_id}'
+    d = getattr(_LOCAL, key, None)
+    if d is None:
+        if dict_id:
+            dict_data = _get_dict(dict_id)
+            if dict_data is None:
+                raise ValueError(f'zstd dictionary {dict_id} not found')
+            d = zstandard.ZstdDecompressor(dict_data=dict_data)
+        else:
+            d = zstandard.ZstdDecompressor()
+        setattr(_LOCAL, key, d)
+    return d
+
+
+def encode(data: bytes, codec: str = '') -> bytes:
+    '''Сжать байты выбранным кодеком (по умолчанию CODEC) и добавить заголовок'''
+    codec = codec or CODEC
+
+    if codec == 'zstd_dict':
+        if not DICTS_LOADED:
+            load_dicts()
+        if CURRENT_DICT_ID and CURRENT_DICT_ID in DICTS:
+            return bytes((CODEC_ZSTD_DICT,)) + _zstd_compressor(CURRENT_DICT_ID).compress(data)
+        codec = 'zstd'
+
+    if codec == 'zstd':
+        return bytes((CODEC_ZSTD,)) + _zstd_compressor().compress(data)
+    elif codec == 'zlib':
+        return bytes((CODEC_ZLIB,)) + zlib.compress(data, ZLIB_LEVEL)
+    elif codec == 'lzma':
+        return lzma.compress(data)
+    else:
+        raise ValueError(f'unknown codec {codec}')
+
+
+def decode(blob: bytes) -> bytes:
+    '''Распаковать байты, формат определяется по заголовку'''
+    if blob[:6] == LZMA_MAGIC:
+        return lzma.decompress(blob)
+
+    header = blob[0]
+    payload = blob[1:]
+    if header == CODEC_ZSTD:
+        return _zstd_decompressor().decompress(payload)
+    elif header == CODEC_ZSTD_DICT:
+        dict_id = zstandard.get_frame_parameters(payload).dict_id
+        return _zstd_decompressor(dict_id).decompress(payload)
+    elif header == CODEC_ZLIB:
+        return zlib.decompress(payload)
+    else:
+        raise ValueError(f'unknown blob header {header}')
+
+
+def dumps(obj) -> bytes:
+    return encode(pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL))
+
+
+def loads(blob: bytes):
+    return pickle.loads(decode(blob))
+
+
+def recode(blob: bytes, codec: str = '') -> bytes:
+    '''Пережать блоб текущим кодеком, без распаковки pickle'''
+    return encode(decode(blob), codec)
+
+
+def benchmark(samples: list, codecs: tuple = ('lzma', 'zlib', 'zstd', 'zstd_dict'), repeat: int = 3) -> str:
+    '''
+    Сравнить кодеки на образцах (несжатые pickle данные).
+    Возвращает текстовую таблицу: размер и время сжатия/распаковки.
+    '''
+    if not samples:
+        return 'no samples'
+
+    raw_size = sum(len(x) for x in samples)
+    lines = [f'samples: {len(samples)}, raw size: {raw_size} bytes', '',
+             f'{"codec":<10} {"size":>12} {"ratio":>7} {"compress ms":>12} {"decompress ms":>14}']
+    for codec in codecs:
+        if codec == 'zstd_dict':
+            if not DICTS_LOADED:
+                load_dicts()
+            if not CURRENT_DICT_ID:
+                lines.append(f'{codec:<10} no dictionary, skipped')
+                continue
+        try:
+            best_c = best_d = float('inf')
+            for _ in range(repeat):
+                start = time.perf_counter()
+                packed = [encode(x, codec) for x in samples]
+                best_c = min(best_c, time.perf_counter() - start)
+
+                start = time.perf_counter()
+                for x in packed:
+                    decode(x)
+                best_d = min(best_d, time.perf_counter() - start)
+
+            size = sum(len(x) for x in packed)
+            lines.append(f'{codec:<10} {size:>12} {raw_size / max(size, 1):>7.2f} {best_c * 1000:>12.1f} {best_d * 1000:>14.1f}')
+        except Exception as error:
+            lines.append(f'{codec:<10} error: {error}')
+
+    return '\n'.join(lines)
+
+
+def read_samples(db_file: str = 'db/main.db',
+                 columns: tuple = ('dialog_gemini3', 'dialog_openrouter', 'dialog_groq'),
+                 limit: int = 200) -> list:
+    '''Взять несжатые образцы диалогов из базы (только чтение)'''
+    samples = []
+    con = sqlite3.connect(f'file:{db_file}?mode=ro', uri=True)
+    try:
+        for column in columns:
+            rows = con.execute(f'''
+                SELECT {column} FROM users
+                WHERE {column} IS NOT NULL
+                ORDER BY last_time_access DESC
+                LIMIT ?
+            ''', (limit,)).fetchall()
+            for row in rows:
+                try:
+                    samples.append(decode(row[0]))
+                except Exception as error:
+                    my_log.log2(f'my_db_codec:read_samples {error}')
+    finally:
+        con.close()
+    return samples
+
+
+if __name__ == '__main__':
+    pass
+
+    # микро бенчмарк на реальных данных
+    samples_ = read_samples(limit=200)
+    print(benchmark(samples_))
+
+    # train_dict(samples_)
+    # print(benchmark(samples_))
@@ -0,0 +1,289 @@
+#!/usr/bin/env python3
+# Векторный индекс сохраненного файла юзера (saved_file) для навыка query_user_file.
+# Раньше на каждый вопрос в промпт вставлялся весь файл (до MAX_SAVE_DOCUMENTS_SIZE).
+# Теперь большой файл один раз режется на фрагменты, их эмбеддинги (my_gemini_embedding)
+# хранятся на диске float32 матрицей (db/doc_index/<id>/vectors.npy + meta.json),
+# а в промпт идут только самые близкие к вопросу фрагменты.
+# Если файл изменился то заново считаются эмбеддинги только новых фрагментов.
+# Индекс строится в фоне (свои DOC_INDEX_WORKERS потоков, эмбеддинги большого файла считаются
+# минутами и не должны занимать пул documents), пока он не готов query() возвращает '' и
+# навык работает как раньше, с полным текстом. После неудачной сборки тот же файл
+# не пересобирается DOC_INDEX_RETRY_AFTER секунд.
+
+
+import collections
+import concurrent.futures
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+import traceback
+from typing import List, Tuple
+
+import numpy as np
+
+import cfg
+import my_gemini_embedding
+import my_log
+
+
+# файлы меньше этого размера (символов) отдаются целиком, индекс для них не нужен
+DOC_INDEX_MIN_SIZE = cfg.DOC_INDEX_MIN_SIZE if hasattr(cfg, 'DOC_INDEX_MIN_SIZE') else 30000
+# сколько символов найденных фрагментов отдавать в промпт
+DOC_INDEX_CONTEXT_CHARS = cfg.DOC_INDEX_CONTEXT_CHARS if hasattr(cfg, 'DOC_INDEX_CONTEXT_CHARS') else 30000
+# сколько индексов строить одновременно (на всех юзеров)
+DOC_INDEX_WORKERS = cfg.DOC_INDEX_WORKERS if hasattr(cfg, 'DOC_INDEX_WORKERS') else 1
+# через сколько секунд можно снова пробовать построить индекс файла после неудачи
+DOC_INDEX_RETRY_AFTER = cfg.DOC_INDEX_RETRY_AFTER if hasattr(cfg, 'DOC_INDEX_RETRY_AFTER') else 3600
+
+INDEX_DIR = 'db/doc_index'
+# сколько загруженных индексов держать в памяти
+MAX_LOADED = 32
+
+LOCK = threading.Lock()
+# {user_id: (meta, vectors)}, последние использованные в конце
+LOADED: 'collections.OrderedDict[str, Tuple[dict, np.ndarray]]' = collections.OrderedDict()
+# юзеры для которых сейчас строится индекс
+BUILDING = set()
+# {(user_id, doc_hash): время неудачной сборки}
+FAILED = {}
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=DOC_INDEX_WORKERS, thread_name_prefix='my_doc_index')
+
+# метрики
+QUERIES = 0
+FALLBACKS = 0
+EMBEDDED = 0
+REUSED = 0
+FAILURES = 0
+
+
+def _hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf-8', errors='replace')).hexdigest()
+
+
+def _dir(user_id: str) -> str:
+    return os.path.join(INDEX_DIR, _hash(user_id))
+
+
+def _load(user_id: str) -> Tuple[dict, np.ndarray]:
+    '''Индекс юзера из памяти или с диска, (None, None) если его нет'''
+    with LOCK:
+        item = LOADED.get(user_id)
+        if item is not None:
+            LOADED.move_to_end(user_id)
+            return item
+    path = _dir(user_id)
+    try:
+        with open(os.path.join(path, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        vectors = np.load(os.path.join(path, 'vectors.npy'), mmap_mode='r')
+    except FileNotFoundError:
+        return None, None
+    except Exception as error:
+        my_log.log2(f'my_doc_index:load: {error} {user_id}')
+        return None, None
+    with LOCK:
+        LOADED[user_id] = (meta, vectors)
+        while len(LOADED) > MAX_LOADED:
+            LOADED.popitem(last=False)
+    return meta, vectors
+
+
+def _save(user_id: str, meta: dict, vectors: np.ndarray):
+    path = _dir(user_id)
+    os.makedirs(path, exist_ok=True)
+    # сначала во временные файлы, что бы читатели не увидели половину
+    np.save(os.path.join(path, 'vectors.tmp.npy'), vectors)
+    with open(os.path.join(path, 'meta.tmp.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False)
+    with LOCK:
+        os.replace(os.path.join(path, 'vectors.tmp.npy'), os.path.join(path, 'vectors.npy'))
+        os.replace(os.path.join(path, 'meta.tmp.json'), os.path.join(path, 'meta.json'))
+        LOADED[user_id] = (meta, vectors)
+        LOADED.move_to_end(user_id)
+        while len(LOADED) > MAX_LOADED:
+            LOADED.popitem(last=False)
+
+
+def _failed(user_id: str, doc_hash: str):
+    '''Запомнить неудачную сборку, query() не будет ее повторять DOC_INDEX_RETRY_AFTER секунд'''
+    global FAILURES
+    now = time.time()
+    with LOCK:
+        FAILURES += 1
+        for key in [k for k, t in FAILED.items() if now - t > DOC_INDEX_RETRY_AFTER]:
+            del FAILED[key]
+        FAILED[(user_id, doc_hash)] = now
+
+
+def build(user_id: str, file_name: str, text: str):
+    '''Построить или обновить индекс файла юзера, считает эмбеддинги только новых фрагментов'''
+    global EMBEDDED, REUSED
+    doc_hash = _hash(file_name + '\n' + text)
+    try:
+        chunks = my_gemini_embedding.split_text_into_chunks(text)
+        if not chunks:
+            _failed(user_id, doc_hash)
+            return
+        hashes = [_hash(x) for x in chunks]
+
+        # уже посчитанные вектора из старого индекса
+        old = {}
+        old_meta, old_vectors = _load(user_id)
+        if old_meta and old_meta.get('model') == my_gemini_embedding.EMBEDDING_MODEL_ID:
+            for i, h in enumerate(old_meta['hashes']):
+                old[h] = old_vectors[i]
+
+        missing = [i for i, h in enumerate(hashes) if h not in old]
+        # заголовок без номера части, что бы сдвиг фрагментов не менял их эмбеддинги
+        new = my_gemini_embedding.embed_documents(file_name, [chunks[i] for i in missing]) if missing else []
+        if len(new) != len(missing):
+            my_log.log2(f'my_doc_index:build: got {len(new)} embeddings for {len(missing)} chunks {user_id}')
+            _failed(user_id, doc_hash)
+            return
+        new = dict(zip(missing, new))
+
+        vectors = np.array([new[i] if i in new else old[h] for i, h in enumerate(hashes)], dtype=np.float32)
+        # нормируем, тогда скалярное произведение = косинусная близость
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors /= np.where(norms == 0, 1, norms)
+
+        meta = {
+            'doc_hash': doc_hash,
+            'file_name': file_name,
+            'model': my_gemini_embedding.EMBEDDING_MODEL_ID,
+            'hashes': hashes,
+            'chunks': chunks,
+        }
+        _save(user_id, meta, vectors)
+        with LOCK:
+            EMBEDDED += len(missing)
+            REUSED += len(chunks) - len(missing)
+            FAILED.pop((user_id, doc_hash), None)
+    except Exception as error:
+        traceback_error = traceback.format_exc()
+        my_log.log2(f'my_doc_index:build: {error} {user_id}\n\n{traceback_error}')
+        _failed(user_id, doc_hash)
+    finally:
+        with LOCK:
+            BUILDING.discard(user_id)
+
+
+def _schedule_build(user_id: str, file_name: str, text: str, doc_hash: str):
+    with LOCK:
+        if user_id in BUILDING:
+            return
+        failed = FAILED.get((user_id, doc_hash))
+        if failed and time.time() - failed < DOC_INDEX_RETRY_AFTER:
+            return
+        BUILDING.add(user_id)
+    try:
+        EXECUTOR.submit(build, user_id, file_name, text)
+    except RuntimeError as error:
+        # бот выключается
+        my_log.log2(f'my_doc_index:schedule_build: {error}')
+        with LOCK:
+            BUILDING.discard(user_id)
+
+
+def _render(query: str, passages: List[Tuple[int, str]], file_name: str) -> str:
+    '''Найденные фрагменты в том же XML-подобном виде что и my_gemini_embedding.find_best_passages'''
+    def esc(x: str) -> str:
+        return x.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+    output_parts = ["<fragments>"]
+    output_parts.append(f"<query>{esc(query)}</query>")
+    output_parts.append(f"<meta>Найдено {len(passages)} фрагментов, общая длина {sum(len(x) for _, x in passages)} символов.</meta>")
+    for i, (part, text) in enumerate(passages, 1):
+        output_parts.append(f"<fragment_source_{i}>{esc(file_name)} - Part {part + 1}</fragment_source_{i}>")
+        output_parts.append(f"<fragment_text_{i}>\n{esc(text)}\n</fragment_text_{i}>")
+    output_parts.append("</fragments>")
+    return "\n".join(output_parts)
+
+
+def query(user_id: str, file_name: str, text: str, query: str, target_size_chars: int = 0) -> str:
+    '''
+    Самые близкие к запросу фрагменты сохраненного файла.
+
+    Args:
+        user_id: chat_id_full
+        file_name: имя файла/URL (saved_file_name)
+        text: текст файла (saved_file)
+        query: вопрос юзера
+        target_size_chars: сколько символов фрагментов вернуть, 0 - DOC_INDEX_CONTEXT_CHARS
+
+    Returns:
+        Фрагменты в XML-подобном виде или '' если файл маленький, индекс еще не готов
+        (тогда он начнет строиться в фоне) или что то сломалось - тогда надо использовать весь текст.
+    '''
+    global QUERIES, FALLBACKS
+    if len(text) < DOC_INDEX_MIN_SIZE:
+        return ''
+    target_size_chars = target_size_chars or DOC_INDEX_CONTEXT_CHARS
+    try:
+        meta, vectors = _load(user_id)
+        doc_hash = _hash(file_name + '\n' + text)
+        if not meta or meta['doc_hash'] != doc_hash or meta['model'] != my_gemini_embedding.EMBEDDING_MODEL_ID:
+            _schedule_build(user_id, file_name, text, doc_hash)
+            with LOCK:
+                FALLBACKS += 1
+            return ''
+
+        query_vector = np.asarray(my_gemini_embedding.embed_query(query), dtype=np.float32)
+        query_vector /= np.linalg.norm(query_vector) or 1
+        scores = vectors @ query_vector
+
+        chunks = meta['chunks']
+        selected = []
+        size = 0
+        for i in np.argsort(-scores):
+            if size + len(chunks[i]) > target_size_chars:
+                if selected:
+                    break
+                continue
+            selected.append(int(i))
+            size += len(chunks[i])
+        # в порядке следования в документе
+        selected.sort()
+        with LOCK:
+            QUERIES += 1
+        return _render(query, [(i, chunks[i]) for i in selected], file_name)
+    except Exception as error:
+        traceback_error = traceback.format_exc()
+        my_log.log2(f'my_doc_index:query: {error} {user_id}\n\n{traceback_error}')
+        with LOCK:
+            FALLBACKS += 1
+        return ''
+
+
+def remove(user_id: str):
+    '''Удалить индекс юзера'''
+    with LOCK:
+        LOADED.pop(user_id, None)
+    shutil.rmtree(_dir(user_id), ignore_errors=True)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        return (f'queries: {QUERIES}, full text fallbacks: {FALLBACKS}, building: {len(BUILDING)}, '
+                f'failed builds: {FAILURES}, loaded: {len(LOADED)}, chunks embedded: {EMBEDDED}, reused: {REUSED}')
+
+
+if __name__ == '__main__':
+    pass
+
+    import my_db
+    import my_gemini_general
+    my_db.init(backup=False)
+    my_gemini_general.load_users_keys()
+
+    text = '\n\n'.join(f'Глава {i}. ' + 'Текст главы про разные вещи. ' * 200 for i in range(20))
+    build('test', 'test.txt', text)
+    print(query('test', 'test.txt', text, 'что в главе 7?')[:500])
+    print(get_stats())
+    remove('test')
+    my_db.close()
@@ -1,8 +1,19 @@
 #!/usr/bin/env python3
+# Перевод документов (pandoc -> html -> куски -> LLM -> html -> pandoc).
+# Раньше translate_file_in_dialog переводил куски строго по одному, а translate_file
+# ждал результатов в цикле с time.sleep(1).
+# Теперь куски переводятся параллельно (не больше DOC_TRANSLATE_WORKERS запросов на весь бот),
+# каждый кусок кешируется в TextCache отдельно (повторный перевод того же файла почти бесплатный),
+# при ошибке пробуются следующие модели и потом еще раз по кругу, результат собирается в исходном
+# порядке, а progress(done, total) сообщает о ходе перевода.
 
 
+import concurrent.futures
+import threading
 import time
+import traceback
 import uuid
+from typing import Callable, List
 
 import my_pandoc
 
@@ -12,11 +23,36 @@ import my_cerebras
 import my_gemini_general
 import my_gemini3
 import my_groq
-from utils import async_run_with_limit
+import my_log
 from my_doc_translate_cache import TextCache
 
 
+# сколько кусков переводить одновременно, на все документы всех юзеров вместе
+DOC_TRANSLATE_WORKERS = cfg.DOC_TRANSLATE_WORKERS if hasattr(cfg, 'DOC_TRANSLATE_WORKERS') else 4
+# сколько раз пройти по списку моделей прежде чем оставить кусок без перевода
+DOC_TRANSLATE_RETRIES = cfg.DOC_TRANSLATE_RETRIES if hasattr(cfg, 'DOC_TRANSLATE_RETRIES') else 2
+# файлы с большим количеством кусков не переводятся
+DOC_TRANSLATE_MAX_CHUNKS = cfg.DOC_TRANSLATE_MAX_CHUNKS if hasattr(cfg, 'DOC_TRANSLATE_MAX_CHUNKS') else 100
+
 TRANSLATE_CACHE = None
+CACHE_LOCK = threading.Lock()
+
+EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=DOC_TRANSLATE_WORKERS, thread_name_prefix='my_doc_translate')
+
+# метрики
+CHUNKS = 0
+CACHE_HITS = 0
+RETRIES = 0
+FAILED = 0
+
+
+def get_cache() -> TextCache:
+    global TRANSLATE_CACHE
+    if not TRANSLATE_CACHE:
+        with CACHE_LOCK:
+            if not TRANSLATE_CACHE:
+                TRANSLATE_CACHE = TextCache('db/translate_cache.db', 1000)
+    return TRANSLATE_CACHE
 
 
 def get_prompt_dialog(dst: str) -> str:
@@ -46,41 +82,30 @@ def get_prompt(dst: str) -> str:
     return help
 
 
-@async_run_with_limit(max_threads=1)
-def translate_text(text: str, src: str, dst: str, results: dict, index: int) -> str:
+def _translate_simple(text: str, src: str, dst: str) -> str:
     '''
-    Translate text with ai
-    results - dict[index] = text (translated or original(fail to translate))
+    Translate text with ai, without dialog prompt
     '''
     help = get_prompt(dst)
     result = my_gemini3.translate(text, src, dst, help = help)
     if not result:
         result = my_groq.translate(text, src, dst, help = help)
+    return result
 
-    results[index] = result or text
 
-
-def translate_text_in_dialog(chunk: str, dst: str, chat_id: str) -> str:
+def _translate_dialog(chunk: str, dst: str, chat_id: str) -> str:
     '''
-    Translate text in dialog mode with gemini
+    Translate text in dialog mode, cerebras then gemini flash then gemini fallback
     '''
-    global TRANSLATE_CACHE
-
-    if not TRANSLATE_CACHE:
-        TRANSLATE_CACHE = TextCache('db/translate_cache.db', 1000)
-
-    if chunk in TRANSLATE_CACHE and TRANSLATE_CACHE[chunk]:
-        return TRANSLATE_CACHE[chunk]
-
-
     help = get_prompt_dialog(dst)
 
-    r = my_cerebras.chat(
-        query=chunk,
-        chat_id = chat_id,
+    # без истории, поэтому ai() а не chat(): chat() держит замок chat_id на весь запрос
+    # и куски одного файла переводились бы по одному
+    r = my_cerebras.ai(
+        chunk,
+        user_id = chat_id,
         system = help,
         temperature=0.3,
-        do_not_update_history=True,
     )
 
     if not r:
@@ -107,10 +132,87 @@ def translate_text_in_dialog(chunk: str, dst: str, chat_id: str) -> str:
             do_not_update_history=True,
         )
 
-    if r:
-        TRANSLATE_CACHE.add(chat_id, chunk, r)
+    return r
 
-    return r or chunk
+
+def translate_chunk(chunk: str, dst: str, owner: str, translate: Callable[[str], str]) -> str:
+    '''
+    Перевести один кусок через кеш, translate(chunk) - перевод моделями (с их фолбеками),
+    при неудаче повторяется DOC_TRANSLATE_RETRIES раз с паузой.
+    Returns:
+        перевод или '' если не получилось
+    '''
+    global CHUNKS, CACHE_HITS, RETRIES, FAILED
+    if not chunk.strip():
+        return chunk
+
+    cache = get_cache()
+    # один и тот же текст на разные языки переводится по разному
+    key = f'[{dst}]\n{chunk}'
+    cached = cache[key]
+    with CACHE_LOCK:
+        CHUNKS += 1
+        if cached:
+            CACHE_HITS += 1
+    if cached:
+        return cached
+
+    for attempt in range(max(1, DOC_TRANSLATE_RETRIES)):
+        if attempt:
+            with CACHE_LOCK:
+                RETRIES += 1
+            time.sleep(2 ** attempt)
+        try:
+            r = translate(chunk)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_doc_translate:translate_chunk: {error}\n\n{traceback_error}')
+            r = ''
+        if r and r.strip():
+            cache.add(owner, key, r)
+            return r
+
+    with CACHE_LOCK:
+        FAILED += 1
+    return ''
+
+
+def translate_chunks(
+    chunks: List[str],
+    dst: str,
+    owner: str,
+    translate: Callable[[str], str],
+    progress: Callable[[int, int], None] = None,
+    ) -> List[str]:
+    '''
+    Перевести куски параллельно (общий пул на DOC_TRANSLATE_WORKERS потоков).
+
+    Args:
+        chunks: куски текста
+        dst: язык перевода
+        owner: chat_id_full, владелец записей в кеше
+        translate: функция перевода одного куска
+        progress: progress(done, total) после каждого готового куска, вызывается в потоке вызывающего
+
+    Returns:
+        переводы в том же порядке что и chunks, не переведенные куски остаются как были
+    '''
+    results = list(chunks)
+    futures = {EXECUTOR.submit(translate_chunk, chunk, dst, owner, translate): i for i, chunk in enumerate(chunks)}
+    done = 0
+    for future in concurrent.futures.as_completed(futures):
+        i = futures[future]
+        try:
+            results[i] = future.result() or chunks[i]
+        except Exception as error:
+            my_log.log2(f'my_doc_translate:translate_chunks: {error}')
+        done += 1
+        if progress:
+            try:
+                progress(done, len(chunks))
+            except Exception as error:
+                my_log.log2(f'my_doc_translate:translate_chunks: progress: {error}')
+    return results
 
 
 def split_text(text: str, chunk_size: int = 5000) -> list[str]:
@@ -155,7 +257,7 @@ def split_text(text: str, chunk_size: int = 5000) -> list[str]:
     return chunks
 
 
-def translate_file(data: bytes, src: str, dst: str, fname: str) -> bytes:
+def translate_file(data: bytes, src: str, dst: str, fname: str, owner: str = '', progress: Callable[[int, int], None] = None) -> bytes:
     '''
     Translate document file.
     1. Convert to markdown with pandoc
@@ -172,22 +274,8 @@ def translate_file(data: bytes, src: str, dst: str, fname: str) -> bytes:
     # Split the HTML into chunks for translation
     chunks = split_text(text)
 
-    # Create a dictionary to store the translated chunks
-    results: dict[int, str] = {}
-    index = 1
-    # Translate each chunk asynchronously
-    for chunk in chunks:
-        translate_text(chunk, src, dst, results=results, index=index)
-        index += 1
-
-    # Wait for all translations to complete
-    while len(results) != len(chunks):
-        time.sleep(1)
-
-    # Concatenate the translated chunks
-    translated_text = ""
-    for i in range(1, len(chunks) + 1):
-        translated_text += results[i] + "\n"
+    translated = translate_chunks(chunks, dst, owner, lambda x: _translate_simple(x, src, dst), progress)
+    translated_text = '\n'.join(translated) + '\n'
 
     # Convert the translated HTML back to the original document format using pandoc
     new_data = my_pandoc.convert_html_to_bytes(translated_text, fname)
@@ -195,7 +283,7 @@ def translate_file(data: bytes, src: str, dst: str, fname: str) -> bytes:
     return new_data
 
 
-def translate_file_in_dialog(data: bytes, src: str, dst: str, fname: str, chat_id_full: str) -> bytes:
+def translate_file_in_dialog(data: bytes, src: str, dst: str, fname: str, chat_id_full: str, progress: Callable[[int, int], None] = None) -> bytes:
     '''
     Translate document file in dialog mode.
     1. Convert to markdown with pandoc
@@ -212,18 +300,21 @@ def translate_file_in_dialog(data: bytes, src: str, dst: str, fname: str, chat_i
 
     # Split the HTML into chunks for translation
     chunks = split_text(text)
-    if len(chunks) > 100:
+    if len(chunks) > DOC_TRANSLATE_MAX_CHUNKS:
         return b'Too big file'
 
-    result = ''
     chat_id = 'translate_doc_' + str(uuid.uuid4())
 
-    for chunk in chunks:
-        result += translate_text_in_dialog(chunk, dst, chat_id)
-        if result and result.strip():
+    def translate(chunk: str) -> str:
+        r = _translate_dialog(chunk, dst, chat_id)
+        if r and r.strip():
             my_db.add_msg(chat_id_full, 'gemini')
+        return r
 
-    my_gemini3.reset(chat_id)
+    try:
+        result = '\n'.join(translate_chunks(chunks, dst, chat_id_full, translate, progress))
+    finally:
+        my_gemini3.reset(chat_id)
 
     # Convert the translated HTML back to the original document format using pandoc
     new_data = my_pandoc.convert_html_to_bytes(result, fname)
@@ -231,6 +322,11 @@ def translate_file_in_dialog(data: bytes, src: str, dst: str, fname: str, chat_i
     return new_data
 
 
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    return f'chunks: {CHUNKS}, cache hits: {CACHE_HITS}, retries: {RETRIES}, failed: {FAILED}'
+
+
 if __name__ == '__main__':
     pass
     my_groq.load_users_keys()
@@ -239,7 +335,7 @@ if __name__ == '__main__':
 
     with open(r'C:\Users\user\Downloads\samples for ai\короткий текст с богатым форматированием.docx', 'rb') as f:
         data = f.read()
-        new_data = translate_file_in_dialog(data, 'ru', 'en', 'короткий текст с богатым форматированием.docx', 'test')
+        new_data = translate_file_in_dialog(data, 'ru', 'en', 'короткий текст с богатым форматированием.docx', 'test', progress=lambda done, total: print(f'{done}/{total}'))
         # new_data = translate_file(data, 'en', 'ru', '1.epub')
         with open('c:/Users/user/Downloads/2.docx', 'wb') as f:
             f.write(new_data)
@@ -104,10 +104,12 @@ class TextCache:
         text_hash: str = self._text_hash(text)
         timestamp: int = time.perf_counter_ns()
         with self.lock:
-            if len(self.db) >= self.max_size:
-                # Remove the oldest entries
-                oldest_keys = sorted(self.db, key=lambda k: self.db[k].get("timestamp", 0))
-                for key in oldest_keys[:len(self.db) - self.max_size + 1]:
+            size = len(self.db)
+            if size >= self.max_size:
+                # Remove the oldest entries, 10% at once - every record has to be
+                # decompressed to find them so don't do it on every add
+                oldest_keys = sorted(self.db.items(), key=lambda kv: kv[1].get("timestamp", 0))
+                for key, _ in oldest_keys[:size - self.max_size + 1 + self.max_size // 10]:
                     del self.db[key]
 
             self.db[text_hash] = {"translation": translation, "owner": owner, "timestamp": timestamp}
@@ -0,0 +1,235 @@
+#!/usr/bin/env python3
+# Ограниченные пулы потоков для обработчиков телеграма вместо нового потока на каждый апдейт.
+# У каждой категории (chat, image, audio, documents, admin, api) свой пул и своя очередь,
+# очередь честная - задачи разных юзеров берутся по кругу, спамер не может занять весь пул.
+
+
+import collections
+import functools
+import threading
+import time
+import traceback
+from typing import Callable, Dict
+
+import cfg
+import my_log
+
+
+# {category: (workers, max queued tasks, max queued tasks per user)}
+POOLS_CONFIG = {
+    'chat': (100, 2000, 20),
+    'image': (20, 200, 5),
+    'audio': (20, 200, 5),
+    'documents': (20, 200, 5),
+    'admin': (10, 100, 50),
+    # задания http api (my_api_server), отдельно от телеграма
+    'api': (10, 100, 10),
+}
+if hasattr(cfg, 'EXECUTOR_POOLS') and cfg.EXECUTOR_POOLS:
+    POOLS_CONFIG.update(cfg.EXECUTOR_POOLS)
+
+# вызывается когда задача не влезла в очередь, (category, args, kwargs)
+REJECT_CALLBACK: Callable = None
+# не чаще чем раз в REJECT_NOTIFY_INTERVAL секунд на юзера
+REJECT_NOTIFY_INTERVAL = 30
+
+
+def get_user_key(*args) -> str:
+    '''Ключ для честной очереди: юзер телеграма из первого аргумента (Message, CallbackQuery)'''
+    if args:
+        obj = args[0]
+        user = getattr(obj, 'from_user', None)
+        if user is not None and getattr(user, 'id', None) is not None:
+            return str(user.id)
+        chat = getattr(obj, 'chat', None)
+        if chat is not None and getattr(chat, 'id', None) is not None:
+            return str(chat.id)
+    return 'system'
+
+
+class FairPool:
+    '''
+    Пул из workers потоков с очередями по юзерам.
+    Потоки создаются по мере надобности и живут до конца работы бота.
+    '''
+    def __init__(self, name: str, workers: int, max_queue: int, max_user_queue: int):
+        self.name = name
+        self.workers = workers
+        self.max_queue = max_queue
+        self.max_user_queue = max_user_queue
+
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        # {user_key: deque([(func, args, kwargs, enqueue_time), ...])}
+        self.queues = {}
+        # юзеры у которых есть задачи, по кругу
+        self.ready = collections.deque()
+        self.queued = 0
+
+        self.threads = 0
+        self.idle = 0
+        self.running = 0
+
+        # метрики
+        self.completed = 0
+        self.rejected = 0
+        self.errors = 0
+        self.max_queued = 0
+        self.max_wait = 0.0
+        self.total_wait = 0.0
+
+        self.last_reject = {}
+
+    def submit(self, user_key: str, func: Callable, args: tuple, kwargs: dict) -> bool:
+        '''Поставить задачу в очередь, False если очередь переполнена'''
+        with self.lock:
+            user_queue = self.queues.get(user_key)
+            if self.queued >= self.max_queue or (user_queue and len(user_queue) >= self.max_user_queue):
+                self.rejected += 1
+                return False
+
+            if user_queue is None:
+                user_queue = self.queues[user_key] = collections.deque()
+            if not user_queue:
+                self.ready.append(user_key)
+            user_queue.append((func, args, kwargs, time.time()))
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+
+            if self.idle:
+                # счетчик уменьшаем тут, иначе следующий submit разбудит тот же поток
+                self.idle -= 1
+                self.not_empty.notify()
+            elif self.threads < self.workers:
+                self.threads += 1
+                threading.Thread(target=self._worker, name=f'pool-{self.name}-{self.threads}', daemon=True).start()
+        return True
+
+    def _next_task(self):
+        '''Взять задачу следующего по кругу юзера, вызывать под self.lock'''
+        user_key = self.ready.popleft()
+        user_queue = self.queues[user_key]
+        task = user_queue.popleft()
+        if user_queue:
+            self.ready.append(user_key)
+        else:
+            del self.queues[user_key]
+        self.queued -= 1
+        return task
+
+    def _worker(self):
+        while True:
+            with self.lock:
+                while not self.ready:
+                    self.idle += 1
+                    self.not_empty.wait()
+                func, args, kwargs, enqueue_time = self._next_task()
+                wait = time.time() - enqueue_time
+                self.total_wait += wait
+                self.max_wait = max(self.max_wait, wait)
+                self.running += 1
+
+            try:
+                func(*args, **kwargs)
+            except Exception as error:
+                traceback_error = traceback.format_exc()
+                my_log.log2(f'my_executor:{self.name}:{getattr(func, "__name__", func)} {error}\n\n{traceback_error}')
+                with self.lock:
+                    self.errors += 1
+            finally:
+                with self.lock:
+                    self.running -= 1
+                    self.completed += 1
+
+    def need_reject_notify(self, user_key: str) -> bool:
+        '''Сообщать юзеру о перегрузке не чаще раза в REJECT_NOTIFY_INTERVAL'''
+        now = time.time()
+        with self.lock:
+            if self.last_reject.get(user_key, 0) + REJECT_NOTIFY_INTERVAL > now:
+                return False
+            # чистим старые записи что бы словарь не рос бесконечно
+            if len(self.last_reject) > 10000:
+                self.last_reject = {k: v for k, v in self.last_reject.items() if v + REJECT_NOTIFY_INTERVAL > now}
+            self.last_reject[user_key] = now
+            return True
+
+    def stats(self) -> Dict:
+        with self.lock:
+            started = self.completed + self.running
+            return {
+                'workers': f'{self.threads}/{self.workers}',
+                'running': self.running,
+                'queued': self.queued,
+                'users_queued': len(self.queues),
+                'max_queued': self.max_queued,
+                'completed': self.completed,
+                'errors': self.errors,
+                'rejected': self.rejected,
+                'avg_wait': round(self.total_wait / started, 3) if started else 0,
+                'max_wait': round(self.max_wait, 3),
+            }
+
+
+POOLS: Dict[str, FairPool] = {}
+POOLS_LOCK = threading.Lock()
+
+
+def get_pool(category: str) -> FairPool:
+    with POOLS_LOCK:
+        pool = POOLS.get(category)
+        if pool is None:
+            workers, max_queue, max_user_queue = POOLS_CONFIG.get(category, POOLS_CONFIG['chat'])
+            pool = POOLS[category] = FairPool(category, workers, max_queue, max_user_queue)
+        return pool
+
+
+def submit(category: str, func: Callable, *args, **kwargs) -> bool:
+    '''Запустить func в пуле category, False если задача отклонена из-за перегрузки'''
+    pool = get_pool(category)
+    user_key = get_user_key(*args)
+    if pool.submit(user_key, func, args, kwargs):
+        return True
+
+    my_log.log2(f'my_executor:submit: {category} queue is full, rejected {getattr(func, "__name__", func)} from {user_key}')
+    if REJECT_CALLBACK and pool.need_reject_notify(user_key):
+        try:
+            REJECT_CALLBACK(category, args, kwargs)
+        except Exception as error:
+            my_log.log2(f'my_executor:submit: reject callback {error}')
+    return False
+
+
+def async_run_pool(category: str = 'chat'):
+    '''Декоратор как utils.async_run, но функция выполняется в ограниченном пуле category'''
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            submit(category, func, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_stats() -> str:
+    '''Текстовая сводка по всем пулам для /stats'''
+    with POOLS_LOCK:
+        pools = list(POOLS.values())
+    lines = []
+    for pool in sorted(pools, key=lambda x: x.name):
+        s = pool.stats()
+        lines.append(f"{pool.name}: workers {s['workers']}, running {s['running']}, "
+                     f"queued {s['queued']} (max {s['max_queued']}, users {s['users_queued']}), "
+                     f"done {s['completed']}, errors {s['errors']}, rejected {s['rejected']}, "
+                     f"wait avg {s['avg_wait']}s max {s['max_wait']}s")
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    pass
+
+    def _job(n):
+        time.sleep(0.1)
+
+    for i_ in range(50):
+        submit('chat', _job, i_)
+    time.sleep(1)
+    print(get_stats())
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# Постоянная очередь FIFO на sqlite, для пересылки сообщений в группу логов (tb.log_group_daemon).
+# Раньше очередь была SqliteDict с ключом perf_counter_ns: добавление проверяло дубликаты через
+# `value not in LOG_GROUP_MESSAGES.values()` (распаковка всех записей), а демон на каждом шаге
+# искал min(keys()) по всей таблице. Когда группа отстает в очереди десятки тысяч записей
+# и каждое сообщение в боте платило за полный проход по диску.
+# Теперь ключ - автоинкремент (порядок добавления), дубликаты отсекает уникальный индекс по хешу,
+# голову очереди читают пачкой по первичному ключу, размер считается в памяти.
+
+
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import traceback
+from typing import Any, List, Tuple
+
+from sqlitedict import SqliteDict
+
+import my_log
+
+
+class PersistentFifo:
+    '''
+    Очередь на диске.
+
+    path - файл базы
+    migrate_from - старая очередь SqliteDict {ключ по порядку: значение}, переносится при первом запуске и удаляется
+    '''
+    def __init__(self, path: str, migrate_from: str = ''):
+        self.path = path
+        self.lock = threading.Lock()
+        # будится при добавлении, что бы читатель не спал зря
+        self.event = threading.Event()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.con = sqlite3.connect(path, check_same_thread=False)
+        self.con.execute('PRAGMA journal_mode=WAL')
+        self.con.execute('PRAGMA synchronous=NORMAL')
+        self.con.execute('''CREATE TABLE IF NOT EXISTS fifo (
+                                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                                hash TEXT NOT NULL UNIQUE,
+                                key TEXT NOT NULL DEFAULT '',
+                                value BLOB NOT NULL)''')
+        self.con.execute('CREATE INDEX IF NOT EXISTS idx_fifo_key ON fifo (key)')
+        self.size = self.con.execute('SELECT COUNT(*) FROM fifo').fetchone()[0]
+        # метрики
+        self.added = 0
+        self.duplicates = 0
+        self.removed = 0
+        if migrate_from and os.path.exists(migrate_from):
+            self._migrate(migrate_from)
+
+    def _migrate(self, old_path: str):
+        try:
+            with SqliteDict(old_path) as old:
+                for k in sorted(old.keys()):
+                    value = old[k]
+                    self.put(value, value[2] if isinstance(value, tuple) and len(value) > 2 else '')
+            os.remove(old_path)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_fifo:migrate: {error} {old_path}\n\n{traceback_error}')
+
+    def __len__(self) -> int:
+        return self.size
+
+    def put(self, value: Any, key: str = '') -> bool:
+        '''
+        Добавить в конец если такого же значения еще нет в очереди.
+        key - для remove_by_key, например chat_id_full
+        Returns:
+            True если добавлено, False если дубликат
+        '''
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        h = hashlib.sha1(data).hexdigest()
+        with self.lock:
+            with self.con:
+                cursor = self.con.execute('INSERT OR IGNORE INTO fifo (hash, key, value) VALUES (?, ?, ?)', (h, key, data))
+            if not cursor.rowcount:
+                self.duplicates += 1
+                return False
+            self.size += 1
+            self.added += 1
+        self.event.set()
+        return True
+
+    def peek(self, n: int = 1) -> List[Tuple[int, Any]]:
+        '''Первые n записей [(seq, value)] от старых к новым, без удаления'''
+        with self.lock:
+            rows = self.con.execute('SELECT seq, value FROM fifo ORDER BY seq LIMIT ?', (n,)).fetchall()
+        return [(seq, pickle.loads(value)) for seq, value in rows]
+
+    def delete(self, seqs: List[int]):
+        '''Удалить записи обработанные после peek'''
+        if not seqs:
+            return
+        with self.lock:
+            with self.con:
+                cursor = self.con.executemany('DELETE FROM fifo WHERE seq = ?', [(x,) for x in seqs])
+            self.size -= cursor.rowcount
+            self.removed += cursor.rowcount
+
+    def remove_by_key(self, key: str) -> int:
+        '''Удалить все записи с этим key, возвращает сколько удалено'''
+        with self.lock:
+            with self.con:
+                cursor = self.con.execute('DELETE FROM fifo WHERE key = ?', (key,))
+            self.size -= cursor.rowcount
+            self.removed += cursor.rowcount
+        return cursor.rowcount
+
+    def wait(self, timeout: float) -> bool:
+        '''Подождать пока очередь не пустая, не дольше timeout секунд'''
+        if self.size:
+            return True
+        self.event.clear()
+        # могли добавить между проверкой и clear
+        if self.size:
+            return True
+        return self.event.wait(timeout)
+
+    def close(self):
+        with self.lock:
+            self.con.close()
+
+    def get_stats(self) -> str:
+        '''Текстовая сводка для /stats'''
+        return f'queued: {self.size}, added: {self.added}, duplicates: {self.duplicates}, removed: {self.removed}'
+
+
+if __name__ == '__main__':
+    pass
+
+    q = PersistentFifo('db/debug_my_fifo.db')
+    print(q.put(('new', 'hello', '[1] [0]')), q.put(('new', 'hello', '[1] [0]')), q.put(('copy', '', '[2] [0]'), '[2] [0]'))
+    items = q.peek(10)
+    print(items, len(q))
+    q.delete([items[0][0]])
+    print(q.remove_by_key('[2] [0]'), len(q), q.get_stats())
+    q.close()
+    os.remove('db/debug_my_fifo.db')
@@ -35,11 +35,14 @@ import my_db
 import my_gemini_general
 import my_gemini_live_text
 import my_github
+import my_hedge
+import my_llm_clients
 import my_log
 import my_skills
 import my_skills_general
 import my_skills_storage
 import utils
+import utils_llm
 
 
 # не принимать запросы больше чем, это ограничение для телеграм бота, в этом модуле оно не используется
@@ -673,6 +676,9 @@ def chat(
 
 
         for _ in range(3):
+            # запасной вариант в my_hedge.run, другой кандидат уже ответил
+            if my_hedge.is_cancelled():
+                break
             # Calculate remaining time for this attempt
             remaining_time = deadline - time.time()
             if remaining_time <= 0:
@@ -680,6 +686,7 @@ def chat(
                 break
 
             response = None
+            request_start = time.time()
 
             try:
                 if key__:
@@ -687,7 +694,7 @@ def chat(
                 else:
                     key = my_gemini_general.get_next_key()
                 # Use the remaining time for the client and config timeout
-                client = genai.Client(api_key=key, http_options={'timeout': int(remaining_time * 1000)})
+                client = my_llm_clients.genai_client(key, remaining_time)
                 if use_skills:
                     if model == 'gemini-2.5-flash-lite': # not support tools except search and code builtin
                         code_execution_tool = Tool(code_execution={})
@@ -767,10 +774,12 @@ def chat(
                         history=mem,
                     )
                 response = chat.send_message(query,)
+                my_gemini_general.KEYS.report_success(key, time.time() - request_start)
             except Exception as error:
 
                 if '429 RESOURCE_EXHAUSTED' in str(error):
                     my_log.log_gemini(f'my_gemini3:chat:1: [{chat_id}] {str(error)} {model} {key}')
+                    my_gemini_general.KEYS.report_rate_limit(key)
                     return ''
                 elif 'API key expired. Please renew the API key.' in str(error) or '429 Quota exceeded for quota metric' in str(error):
                     my_gemini_general.remove_key(key)
@@ -780,6 +789,7 @@ def chat(
                     continue
                 elif 'timeout' in str(error).lower():
                     my_log.log_gemini(f'my_gemini3:chat:2:timeout: {str(error)} {model} {key}')
+                    my_gemini_general.KEYS.report_failure(key, time.time() - request_start)
                     return ''
                 elif """503 UNAVAILABLE. {'error': {'code': 503, 'message': 'The model is overloaded. Please try again later.', 'status': 'UNAVAILABLE'}}""" in str(error):
                     my_log.log_gemini(f'my_gemini3:chat:3: {str(error)} {model} {key}')
@@ -889,7 +899,7 @@ def chat(
             if history:
                 history = history[-max_chat_lines*2:]
                 if chat_id:
-                    if not do_not_update_history:
+                    if not do_not_update_history and my_hedge.claim():
                         my_db.set_user_property(chat_id, 'dialog_gemini3', my_db.obj_to_blob(history))
                         my_db.add_msg(chat_id, model)
 
@@ -1475,6 +1485,26 @@ TEXT:
     return ''
 
 
+def translate_batch(items: list, to_lang: str, from_lang: str = '', model: str = '') -> list:
+    """
+    Translates many strings with one request.
+
+    Args:
+        items (list): List of tuples (text, help).
+        to_lang (str): The language to translate the texts into.
+        from_lang (str, optional): The language of the texts, autodetect if empty.
+        model (str, optional): The model to use for translation.
+
+    Returns:
+        list: Translations in the same order, '' for items that were not translated.
+    """
+    if not items:
+        return []
+    query = utils_llm.build_batch_translate_prompt(items, to_lang, from_lang)
+    translated = chat(query, temperature=0.1, model=model, json_output = True, do_not_update_history = True)
+    return utils_llm.parse_batch_translation(translated, len(items))
+
+
 def detect_lang(text: str, chat_id_full: str) -> str:
     q = f'''Detect language of the text, anwser supershort in 1 word iso_code_639_1 like
 text = The quick brown fox jumps over the lazy dog.
@@ -1562,7 +1592,7 @@ def list_models(include_context: bool = False):
     '''
     Lists all available models.
     '''
-    client = genai.Client(api_key=my_gemini_general.get_next_key(), http_options={'timeout': 20 * 1000})
+    client = my_llm_clients.genai_client(my_gemini_general.get_next_key(), 20)
 
     result = []
     for model in client._models.list():
@@ -1979,7 +2009,7 @@ def video2txt(
 
         try:
             key = my_gemini_general.get_next_key()
-            client = genai.Client(api_key=key, http_options={'timeout': int(remaining_time * 1000)})
+            client = my_llm_clients.genai_client(key, remaining_time)
             contents = None
 
             if is_url:
@@ -2173,7 +2203,7 @@ Your final output is a single block of clean, corrected, and well-formatted Mark
 
         try:
             key = my_gemini_general.get_next_key()
-            client = genai.Client(api_key=key, http_options={'timeout': int(remaining_time * 1000)})
+            client = my_llm_clients.genai_client(key, remaining_time)
             contents = None
 
             MAX_DOC_SIZE_INLINE = 20 * 1024 * 1024
@@ -2,6 +2,7 @@
 
 
 import functools
+import hashlib
 # import io
 # import lzma
 # import random
@@ -13,12 +14,12 @@ from pathlib import Path
 import diskcache
 import numpy as np
 import pandas as pd
-from google import genai
 from google.genai import types
 # import zstandard as zstd
 
-# import cfg
+import cfg
 import my_db
+import my_llm_clients
 import my_log
 import my_gemini_general
 
@@ -32,11 +33,17 @@ import my_gemini_general
 EMBEDDING_MODEL_ID = MODEL_ID = "gemini-embedding-001"
 
 
+# сколько фрагментов и символов отправлять в одном запросе
+BATCH_SIZE = 100
+BATCH_MAX_CHARS = 20000
+
+# размер дискового кеша эмбеддингов, при переполнении удаляются самые давно не используемые
+EMBEDDING_CACHE_SIZE = cfg.EMBEDDING_CACHE_SIZE if hasattr(cfg, 'EMBEDDING_CACHE_SIZE') else 2 * 1024**3
+
 cache_dir = Path("./db/cache-gemini-embedding")
 cache_dir.mkdir(exist_ok=True) # Создаем папку, если ее нет
-# Создаем объект кеша
-# Теперь 'cache.memoize' можно использовать как декоратор
-cache = diskcache.Cache(str(cache_dir))
+# Кеш эмбеддингов по ключу (модель, хеш заголовка и текста)
+cache = diskcache.Cache(str(cache_dir), size_limit=EMBEDDING_CACHE_SIZE, eviction_policy='least-recently-used')
 
 
 def rate_limiter(max_calls, max_tokens, time_window=60):
@@ -58,7 +65,11 @@ def rate_limiter(max_calls, max_tokens, time_window=60):
             nonlocal tokens_in_window
 
             # Приблизительная оценка токенов делается один раз до входа в цикл
-            estimated_tokens = len(kwargs.get('text', '')) + len(kwargs.get('title', ''))
+            # text может быть пачкой фрагментов
+            text = kwargs.get('text', '')
+            if isinstance(text, list):
+                text = ''.join(text)
+            estimated_tokens = len(text) + len(kwargs.get('title', ''))
 
             # "Зал ожидания": поток будет крутиться здесь, пока не получит разрешение
             while True:
@@ -104,20 +115,17 @@ def rate_limiter(max_calls, max_tokens, time_window=60):
 limiter = rate_limiter(max_calls=100, max_tokens=30000)
 
 
-@cache.memoize()
 @limiter
-def embed_fn(title, text):
+def _embed_batch(title: str, text: list[str]) -> list[list[float]]:
     """
-    Вычисляет эмбеддинг для текста, с 5 попытками в случае ошибки сети.
+    Вычисляет эмбеддинги для пачки фрагментов одним запросом, с 5 попытками в случае ошибки сети.
     """
-    # print(f"!!! CACHE MISS: Calling Gemini API for title: '{title[:30]}...'")
-
     retries = 5
     delay = 5  # начальная задержка в секундах, всего получится 5+10+20+40 = 75
 
     for attempt in range(retries):
         try:
-            client = genai.Client(api_key=my_gemini_general.get_next_key())
+            client = my_llm_clients.genai_client(my_gemini_general.get_next_key())
             response = client.models.embed_content(
                 model=EMBEDDING_MODEL_ID,
                 contents=text,
@@ -126,20 +134,88 @@ def embed_fn(title, text):
                     title=title
                 )
             )
-            return response.embeddings[0].values
+            return [x.values for x in response.embeddings]
 
         # Ловим конкретные ошибки API или общие ошибки сети
         except Exception as e:
             if attempt < retries - 1:
-                my_log.log_gemini(f"my_gemini_embedding:emded_fn: API call failed (attempt {attempt + 1}/{retries}): {e}. Retrying in {delay}s...")
+                my_log.log_gemini(f"my_gemini_embedding:embed_batch: API call failed (attempt {attempt + 1}/{retries}): {e}. Retrying in {delay}s...")
                 time.sleep(delay)
                 delay *= 2  # Увеличиваем задержку
             else:
-                my_log.log_gemini(f"my_gemini_embedding:emded_fn: API call failed after {retries} attempts. Giving up.")
+                my_log.log_gemini(f"my_gemini_embedding:embed_batch: API call failed after {retries} attempts. Giving up.")
                 # Если все попытки провалены, пробрасываем последнюю ошибку
                 raise e
 
 
+def _cache_key(title: str, text: str) -> tuple:
+    return (EMBEDDING_MODEL_ID, hashlib.sha256(f'{title}\0{text}'.encode('utf-8', errors='replace')).hexdigest())
+
+
+def _batches(items: list) -> list:
+    """Разбивает [(ключ, текст)] на пачки не больше BATCH_SIZE штук и BATCH_MAX_CHARS символов"""
+    batches = []
+    batch = []
+    size = 0
+    for key, text in items:
+        if batch and (len(batch) >= BATCH_SIZE or size + len(text) > BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((key, text))
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_documents(title: str, texts: list[str]) -> list[list[float]]:
+    """
+    Эмбеддинги для нескольких фрагментов одного документа (retrieval_document).
+    Одинаковые фрагменты считаются один раз, уже посчитанные берутся из кеша,
+    остальные отправляются пачками.
+    """
+    keys = [_cache_key(title, text) for text in texts]
+    result = {}
+    missing = {}
+    for key, text in zip(keys, texts):
+        if key in result or key in missing:
+            continue
+        value = cache.get(key)
+        if value is None:
+            missing[key] = text
+        else:
+            result[key] = value
+
+    for batch in _batches(list(missing.items())):
+        vectors = _embed_batch(title=title, text=[text for _, text in batch])
+        for (key, _), vector in zip(batch, vectors):
+            cache.set(key, vector)
+            result[key] = vector
+
+    return [result[key] for key in keys]
+
+
+def embed_fn(title, text):
+    """
+    Вычисляет эмбеддинг для одного текста, через кеш.
+    """
+    return embed_documents(title, [text])[0]
+
+
+def embed_query(query: str) -> list[float]:
+    """
+    Эмбеддинг поискового запроса (retrieval_query), не кешируется.
+    """
+    client = my_llm_clients.genai_client(my_gemini_general.get_next_key())
+    response = client.models.embed_content(
+        model=EMBEDDING_MODEL_ID,
+        contents=query,
+        config=types.EmbedContentConfig(task_type="retrieval_query")
+    )
+    return response.embeddings[0].values
+
+
 def split_text_into_chunks(text: str, max_length_chars: int = 3000, overlap_chars: int = 400) -> list[str]:
     """
     Разбивает текст на осмысленные фрагменты (чанки), идеально подходящие для
@@ -242,12 +318,19 @@ def create_knowledge_base(raw_documents: list[dict]) -> pd.DataFrame:
     for doc in raw_documents:
         # Разбиваем контент на чанки
         content_chunks = split_text_into_chunks(doc["content"])
+        if not content_chunks:
+            continue
+
+        # Вычисляем эмбеддинги всех чанков документа пачками, с общим заголовком документа,
+        # тогда одинаковые куски в другой редакции документа возьмутся из кеша
+        embeddings = embed_documents(doc["title"], content_chunks)
 
         if len(content_chunks) == 1:
             # Если документ не был разбит, добавляем его как есть
             processed_documents_data.append({
                 "Title": doc["title"],
-                "Text": content_chunks[0] # Используем content_chunks[0], так как он мог быть очищен/обработан
+                "Text": content_chunks[0], # Используем content_chunks[0], так как он мог быть очищен/обработан
+                "Embeddings": embeddings[0]
             })
         else:
             # Если документ был разбит на несколько чанков, создаем записи для каждой части
@@ -255,14 +338,12 @@ def create_knowledge_base(raw_documents: list[dict]) -> pd.DataFrame:
                 chunk_title = f"{doc['title']} - Part {i + 1}"
                 processed_documents_data.append({
                     "Title": chunk_title,
-                    "Text": chunk_text
+                    "Text": chunk_text,
+                    "Embeddings": embeddings[i]
                 })
 
     # Создаем DataFrame из обработанных чанков
-    df = pd.DataFrame(processed_documents_data)
-
-    # Вычисляем эмбеддинги для каждого чанка
-    df['Embeddings'] = df.apply(lambda row: embed_fn(row['Title'], row['Text']), axis=1)
+    df = pd.DataFrame(processed_documents_data, columns=["Title", "Text", "Embeddings"])
 
     return df
 
@@ -343,13 +424,7 @@ def find_best_passages(
         return ""
 
     # 1. Получаем эмбеддинг для запроса
-    client = genai.Client(api_key=my_gemini_general.get_next_key())
-    query_embedding_response = client.models.embed_content(
-        model=EMBEDDING_MODEL_ID,
-        contents=query,
-        config=types.EmbedContentConfig(task_type="retrieval_query")
-    )
-    query_embedding = query_embedding_response.embeddings[0].values
+    query_embedding = embed_query(query)
 
     # 2. Считаем и сортируем все фрагменты по релевантности
     dot_products = np.dot(np.stack(dataframe['Embeddings'].values), query_embedding)
@@ -500,7 +575,7 @@ if __name__ == "__main__":
     # deserialized_df = deserialize_dataframe(serialized_df)
     # assert df.equals(deserialized_df)
 
-    client = genai.Client(api_key=my_gemini_general.get_next_key())
+    client = my_llm_clients.genai_client(my_gemini_general.get_next_key())
 
     query = "Кто такой Данаан?"
 
@@ -1,4 +1,3 @@
-import random
 import threading
 import traceback
 
@@ -7,6 +6,7 @@ from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_key_scheduler
 import my_log
 
 
@@ -42,14 +42,18 @@ USER_KEYS = SqliteDict('db/gemini_user_keys.db', autocommit=True)
 
 
 ALL_KEYS = []
-ROUND_ROBIN_KEYS = []
+
+# планировщик всех ключей (cfg.gemini_keys + ключи юзеров), заполняется в load_users_keys()
+# сколько запросов в день на ключ, 0 - не ограничивать (у разных моделей разные лимиты)
+KEY_DAILY_QUOTA = cfg.GEMINI_KEY_DAILY_QUOTA if hasattr(cfg, 'GEMINI_KEY_DAILY_QUOTA') else 0
+KEYS = my_key_scheduler.get_scheduler('gemini', KEY_DAILY_QUOTA)
 
 USER_KEYS_LOCK = threading.Lock()
 
 
 def remove_key(key: str):
     """
-    Removes a given key from the ALL_KEYS list and from the USER_KEYS dictionary.
+    Removes a given key from the ALL_KEYS list, from the key scheduler and from the USER_KEYS dictionary.
 
     Args:
         key (str): The key to be removed.
@@ -61,64 +65,61 @@ def remove_key(key: str):
         if key in ALL_KEYS:
             try:
                 ALL_KEYS.remove(key) # Использовать remove для более безопасного удаления из списка
-                if key not in REMOVED_KEYS:
-                    REMOVED_KEYS.append(key)
             except ValueError:
                 my_log.log_keys(f'my_gemini_general.remove_key: Invalid key {key} not found in ALL_KEYS list') # Логировать, если ключ не найден в ALL_KEYS
+        if key not in REMOVED_KEYS:
+            REMOVED_KEYS.append(key)
 
-        users_to_update = [] # Список для хранения пользователей, чьи записи нужно обновить
+        # владельцы ключа из обратного индекса, перебирать всех юзеров не нужно
+        users_to_update = KEYS.remove_key(key)
 
         with USER_KEYS_LOCK:
-            for user in USER_KEYS:
-                if key in USER_KEYS[user]:
-                    users_to_update.append(user) # Добавить пользователя в список на обновление
-
-            for user in users_to_update: # Выполнить обновление после основной итерации
-                USER_KEYS[user] = [x for x in USER_KEYS[user] if x != key] # Обновить список ключей для каждого пользователя
-                my_log.log_keys(f'my_gemini_general.remove_key:Invalid key {key} removed from user {user}')
+            for user in users_to_update:
+                if user in USER_KEYS:
+                    USER_KEYS[user] = [x for x in USER_KEYS[user] if x != key] # Обновить список ключей для каждого пользователя
+                    my_log.log_keys(f'my_gemini_general.remove_key:Invalid key {key} removed from user {user}')
 
     except Exception as error:
         error_traceback = traceback.format_exc()
         my_log.log_keys(f'my_gemini_general.remove_key:Failed to remove key {key}: {error}\n\n{error_traceback}')
 
 
-def get_next_key():
+def get_next_key() -> str:
     '''
-    Дает один ключ из всех, последовательно перебирает доступные ключи
+    Дает один ключ из всех, самый здоровый из тех что дольше всех отдыхали (см. my_key_scheduler)
     '''
-    # global ROUND_ROBIN_KEYS, BADKEYS, BADKEYS_MTIME
-    global ROUND_ROBIN_KEYS
-
-    if not ROUND_ROBIN_KEYS:
-        keys = cfg.gemini_keys[:] + ALL_KEYS[:]
-        random.shuffle(keys)
-
-        # if os.path.exists(BADKEYS_PATH):
-        #     if os.path.getmtime(BADKEYS_PATH) > BADKEYS_MTIME:
-        #         with open(BADKEYS_PATH, 'r') as f:
-        #             BADKEYS = f.read().splitlines()
-        #             BADKEYS = [x.strip() for x in BADKEYS if x.strip()]
-        #             BADKEYS = [x for x in BADKEYS if len(x) == 39]
-        #             BADKEYS_MTIME = os.path.getmtime(BADKEYS_PATH)
-
-        for key in keys[:]:
-            if key in BADKEYS:
-                keys.remove(key)
-                remove_key(key)
-        ROUND_ROBIN_KEYS = keys[:]
-
-    return ROUND_ROBIN_KEYS.pop(0)
+    while True:
+        key = KEYS.get_key()
+        if key in BADKEYS:
+            remove_key(key)
+            continue
+        return key
+
+
+def add_user_key(user: str, keys: list):
+    '''Записать ключи юзера и добавить их в общий список, вызывать под USER_KEYS_LOCK'''
+    for key in USER_KEYS.get(user, []):
+        if key not in keys:
+            KEYS.remove_owner(key, user)
+    USER_KEYS[user] = keys
+    for key in keys:
+        if key not in ALL_KEYS:
+            ALL_KEYS.append(key)
+        KEYS.add_key(key, user)
 
 
 def load_users_keys():
     """
     Load users' keys into memory and update the list of all keys available.
     """
+    owners = {}
     with USER_KEYS_LOCK:
         for user in USER_KEYS:
             for key in USER_KEYS[user]:
                 if key not in ALL_KEYS:
                     ALL_KEYS.append(key)
+                owners.setdefault(key, []).append(user)
+    KEYS.set_keys(cfg.gemini_keys[:] + ALL_KEYS[:], owners)
 
 
 def transform_mem2(mem: list) -> list:
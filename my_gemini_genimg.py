@@ -7,11 +7,11 @@ from io import BytesIO
 from PIL import Image
 from typing import Optional
 
-from google import genai
 from google.genai import types
 
 import my_db
 import my_gemini_general
+import my_llm_clients
 import my_log
 import utils
 
@@ -99,7 +99,7 @@ def generate_image(prompt: str, api_key: str = '', user_id: str = '') -> Optiona
         if not api_key:
             api_key = my_gemini_general.get_next_key()
 
-        client = genai.Client(api_key=api_key)
+        client = my_llm_clients.genai_client(api_key)
 
         model = MODEL
         contents = [
@@ -208,7 +208,7 @@ def regenerate_image(
             if not api_key:
                 api_key = my_gemini_general.get_next_key()
 
-            client = genai.Client(api_key=api_key)
+            client = my_llm_clients.genai_client(api_key)
 
             # model = MODEL
 
@@ -20,7 +20,6 @@ import time
 import traceback
 from typing import Tuple
 
-from google import genai
 from google.genai.types import (
     GenerateContentConfig,
     GoogleSearch,
@@ -32,6 +31,7 @@ import cfg
 import my_db
 import my_gemini_general
 import my_gemini3
+import my_llm_clients
 import my_log
 import my_skills_storage
 import utils
@@ -63,7 +63,7 @@ MODEL_ID_FALLBACK = cfg.gemini25_flash_model_fallback # "gemini-1.5-flash"
 
 def get_client():
     api_key = random.choice(cfg.gemini_keys[:] + my_gemini_general.ALL_KEYS[:])
-    return genai.Client(api_key=api_key)
+    return my_llm_clients.genai_client(api_key)
 
 
 def get_config(system_instruction: str = "", max_output_tokens: int = 8000, temperature: float = 1):
@@ -5,10 +5,10 @@ from io import BytesIO
 import traceback
 from typing import List
 
-from google import genai
 from google.genai import types
 from PIL import Image
 
+import my_llm_clients
 from my_gemini_general import get_next_key, load_users_keys
 from my_log import log_gemini
 
@@ -38,7 +38,7 @@ def generate_images_as_bytes(
     """
     image_bytes_list = []
     try:
-        client = genai.Client(api_key=get_next_key())
+        client = my_llm_clients.genai_client(get_next_key())
         response = client.models.generate_images(
             model=model,
             prompt=prompt,
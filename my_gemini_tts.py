@@ -6,14 +6,11 @@ import os
 import time
 import unicodedata
 
-from google import genai
-from google.genai.types import (
-    HttpOptions,
-)
 from pydub import AudioSegment
 
 import my_db
 import my_gemini_general
+import my_llm_clients
 import my_log
 import utils
 
@@ -97,7 +94,7 @@ def generate_tts_wav_bytes(
             my_log.log_gemini("my_gemini_tts:generate_tts_wav_bytes:1: API ключ Gemini не найден")
             return None
 
-        client = genai.Client(api_key=key, http_options=HttpOptions(timeout=180*1000))
+        client = my_llm_clients.genai_client(key, 180)
 
         if voice_name not in POSSIBLE_VOICES:
             my_log.log_gemini(f"my_gemini_tts:generate_tts_wav_bytes:2: Предупреждение: Указанный голос '{voice_name}' отсутствует в списке известных голосов. По умолчанию используется 'Zephyr'")
@@ -1,4 +1,3 @@
-from google import genai
 from google.genai import types
 from io import BytesIO
 import json_repair
@@ -6,6 +5,7 @@ import os
 from PIL import Image, ImageDraw, ImageFont
 
 import my_gemini_general
+import my_llm_clients
 
 
 def draw_annotations(image_path: str, json_data_string: str, output_path: str, save_quality: int = 95):
@@ -193,7 +193,7 @@ def find_objects_in_image(
     thinking_budget=0
     ):
 
-    client = genai.Client(api_key=my_gemini_general.get_next_key())
+    client = my_llm_clients.genai_client(my_gemini_general.get_next_key())
 
     bounding_box_system_instructions = """
     Возвращать ограничивающие рамки в виде массива JSON с метками.
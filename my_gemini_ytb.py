@@ -3,12 +3,12 @@
 
 import time
 
-from google import genai
 from google.genai import types
 
 import cfg
 import my_db
 import my_gemini_general
+import my_llm_clients
 import my_log
 
 
@@ -57,7 +57,7 @@ def get_text(url: str, lang: str, user_id: str) -> str:
             break
         try:
             key = my_gemini_general.get_next_key()
-            client = genai.Client(api_key=key, http_options=types.HttpOptions(timeout=TIMEOUT*1000))
+            client = my_llm_clients.genai_client(key, TIMEOUT)
 
             contents = [
                 types.Content(
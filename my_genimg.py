@@ -2,6 +2,7 @@
 
 
 import base64
+import concurrent.futures
 import json
 import os
 import random
@@ -9,7 +10,7 @@ import re
 import time
 import threading
 import traceback
-from multiprocessing.pool import ThreadPool
+from typing import Iterator
 
 import requests
 
@@ -33,6 +34,20 @@ from my_nebius import txt2img as flux_nebius
 WHO_AUTOR = {}
 
 
+# общий пул потоков для всех провайдеров всех запросов, раньше на каждый запрос создавался новый ThreadPool
+GEN_IMAGES_WORKERS = cfg.GEN_IMAGES_WORKERS if hasattr(cfg, 'GEN_IMAGES_WORKERS') else 30
+# сколько ждать каждого провайдера, секунд, потом его результат не нужен
+GEN_IMAGES_TIMEOUT = cfg.GEN_IMAGES_TIMEOUT if hasattr(cfg, 'GEN_IMAGES_TIMEOUT') else 240
+GEN_EXECUTOR = concurrent.futures.ThreadPoolExecutor(max_workers=GEN_IMAGES_WORKERS, thread_name_prefix='my_genimg')
+
+# метрики gen_images
+GEN_REQUESTS = 0
+GEN_TIMEOUTS = 0
+GEN_ERRORS = 0
+GEN_FIRST_TIME = 0.0 # сумма времени до первой картинки
+GEN_FIRST_COUNT = 0
+
+
 # попробовать заблокировать параллельные вызовы бинга
 BING_LOCK = threading.Lock()
 # 0 - main, 1 - second instance
@@ -475,59 +490,117 @@ def flux_nebius_gen1(prompt: str, negative_prompt: str, model: str = None):
         return []
 
 
-def gen_images(
+def gen_images_iter(
     prompt: str,
     moderation_flag: bool = False,
     user_id: str = '',
     conversation_history: str = '',
-    use_bing: bool = True
-) -> list:
-    """рисует одновременно всеми доступными способами"""
+    use_bing: bool = True,
+    timeout: float = 0,
+    cancel: threading.Event = None,
+) -> Iterator[list]:
+    """
+    Рисует одновременно всеми доступными способами и отдает результат каждого провайдера
+    сразу как он готов, не дожидаясь самого медленного.
+
+    Args:
+        timeout: сколько ждать каждого провайдера, 0 - GEN_IMAGES_TIMEOUT
+        cancel: если установлен то перестать ждать оставшихся провайдеров
+
+    Yields:
+        списки картинок (bytes) или ссылок (str), ['moderation',] если промпт не прошел модерацию
+    """
+    global GEN_REQUESTS, GEN_TIMEOUTS, GEN_ERRORS, GEN_FIRST_TIME, GEN_FIRST_COUNT
+
     if not user_id:
         user_id = 'test'
 
     if prompt.strip() == '':
-        return []
+        return
 
     negative = ''
     original_prompt = prompt
 
     reprompt, negative, preffered_aspect_ratio = get_reprompt(prompt, conversation_history, user_id)
     if reprompt == 'MODERATION':
-        return ['moderation',]
+        yield ['moderation',]
+        return
 
     if reprompt:
         prompt = reprompt
     else:
-        return []
+        return
 
     bing_prompt = original_prompt if original_prompt.startswith('!') else prompt
     bing_prompt = re.sub(r'^!+', '', bing_prompt).strip()
 
-    pool = ThreadPool(processes=10)
-
-    async_result2 = pool.apply_async(kandinski, (prompt, 1024, 1024, 1, negative))
-    async_result3 = pool.apply_async(kandinski, (prompt, 1024, 1024, 1, negative))
-    async_result10 = pool.apply_async(gemini_flash, (prompt, 1024, 1024, 2, negative, user_id))
-    async_result_pollinations = pool.apply_async(pollinations_gen, (prompt,))
-
+    jobs = [
+        ('kandinski', kandinski, (prompt, 1024, 1024, 1, negative)),
+        ('kandinski', kandinski, (prompt, 1024, 1024, 1, negative)),
+        ('gemini_flash', gemini_flash, (prompt, 1024, 1024, 2, negative, user_id)),
+        ('pollinations', pollinations_gen, (prompt,)),
+    ]
     if use_bing:
-        async_result1 = pool.apply_async(bing, (bing_prompt, moderation_flag, user_id, 'dalle', preffered_aspect_ratio))
+        jobs.insert(0, ('bing', bing, (bing_prompt, moderation_flag, user_id, 'dalle', preffered_aspect_ratio)))
+
+    GEN_REQUESTS += 1
+    start = time.time()
+    deadline = start + (timeout or GEN_IMAGES_TIMEOUT)
+    futures = {GEN_EXECUTOR.submit(func, *args): name for name, func, args in jobs}
+    pending = set(futures)
+    first = True
+    try:
+        while pending:
+            if cancel is not None and cancel.is_set():
+                break
+            left = deadline - time.time()
+            if left <= 0:
+                GEN_TIMEOUTS += len(pending)
+                my_log.log_reprompt_moderation(f'gen_images_iter: timeout {[futures[x] for x in pending]} {prompt[:100]}')
+                break
+            # просыпаемся раз в секунду что бы заметить cancel
+            done, pending = concurrent.futures.wait(pending, timeout=min(left, 1), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                try:
+                    result = future.result()
+                except Exception as error:
+                    GEN_ERRORS += 1
+                    traceback_error = traceback.format_exc()
+                    my_log.log_reprompt_moderation(f'gen_images_iter: {futures[future]} {error}\n{traceback_error}')
+                    continue
+                if result:
+                    if first:
+                        first = False
+                        GEN_FIRST_TIME += time.time() - start
+                        GEN_FIRST_COUNT += 1
+                    yield result
+    finally:
+        # те что еще не начались не начнутся, уже работающие доработают в пуле но результат никто не ждет
+        for future in pending:
+            future.cancel()
 
-        result = (async_result1.get() or []) + \
-                 (async_result2.get() or []) + \
-                 (async_result3.get() or []) + \
-                 (async_result10.get() or []) + \
-                 (async_result_pollinations.get() or [])
-    else:
-        result = (async_result2.get() or []) + \
-                 (async_result3.get() or []) + \
-                 (async_result10.get() or []) + \
-                 (async_result_pollinations.get() or [])
 
+def gen_images(
+    prompt: str,
+    moderation_flag: bool = False,
+    user_id: str = '',
+    conversation_history: str = '',
+    use_bing: bool = True
+) -> list:
+    """рисует одновременно всеми доступными способами, возвращает все картинки вместе"""
+    result = []
+    for images in gen_images_iter(prompt, moderation_flag, user_id, conversation_history, use_bing):
+        result += images
     return result
 
 
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    first = GEN_FIRST_TIME / GEN_FIRST_COUNT if GEN_FIRST_COUNT else 0
+    return (f'requests: {GEN_REQUESTS}, first image after {first:.1f}s avg, '
+            f'provider timeouts: {GEN_TIMEOUTS}, errors: {GEN_ERRORS}')
+
+
 if __name__ == '__main__':
     my_db.init(backup=False)
     my_groq.load_users_keys()
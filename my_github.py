@@ -10,11 +10,11 @@ import time
 import threading
 import traceback
 
-from openai import OpenAI
 from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_llm_clients
 import my_log
 import utils
 
@@ -198,10 +198,7 @@ def ai(
 
         try:
             key = key_ or get_next_key()
-            client = OpenAI(
-                api_key = key,
-                base_url = BASE_URL,
-                )
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
             response = client.chat.completions.create(
                 messages = mem_,
                 model = model,
@@ -522,10 +519,7 @@ def img2txt(
     for _ in range(3):
         try:
             key = get_next_key()
-            client = OpenAI(
-                api_key = key,
-                base_url = BASE_URL,
-                )
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
             response = client.chat.completions.create(
                 messages = mem,
                 model = model,
@@ -580,8 +574,6 @@ import io
 import time
 import traceback
 
-from openai import OpenAI
-
 # Предполагаем, что следующие функции и объекты доступны из вашего контекста:
 # get_next_key, remove_key, my_log, my_db, utils
 
@@ -654,10 +646,7 @@ def transcribe_audio_with_model(
 
         try:
             key = get_next_key()
-            client = OpenAI(
-                api_key = key,
-                base_url = BASE_URL,
-            )
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
 
             response = client.chat.completions.create(
                 messages = messages,
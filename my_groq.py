@@ -12,17 +12,19 @@ import threading
 import traceback
 from typing import Union
 
-import httpx
-from groq import Groq, PermissionDeniedError
+from groq import PermissionDeniedError
 from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_key_scheduler
+import my_llm_clients
 import my_log
 import my_skills
 import my_skills_storage
 import my_sum
 import utils
+import utils_llm
 
 
 # каждый юзер дает свои ключи и они используются совместно со всеми
@@ -69,20 +71,29 @@ DEEPSEEK_LLAMA70_MODEL = 'deepseek-r1-distill-llama-70b'
 DEEPSEEK_QWQ32B_MODEL = 'qwen-qwq-32b'
 
 
-CURRENT_KEY_SET = []
+# планировщик ключей из ALL_KEYS, заполняется в load_users_keys()
+KEY_DAILY_QUOTA = cfg.GROQ_KEY_DAILY_QUOTA if hasattr(cfg, 'GROQ_KEY_DAILY_QUOTA') else 0
+KEYS = my_key_scheduler.get_scheduler('groq', KEY_DAILY_QUOTA)
 
 
 def get_next_key() -> str:
-    """Получает следующий ключ из списка ALL_KEYS."""
-    global CURRENT_KEY_SET
+    """Получает следующий ключ из ALL_KEYS через планировщик ключей."""
+    key = KEYS.get_key()
+    if not key:
+        raise Exception('No more keys available')
+    return key
 
+
+def add_user_key(user: str, key: str):
+    '''Записать ключ юзера и добавить его в общий список'''
     with USER_KEYS_LOCK:
-        if not CURRENT_KEY_SET:
-            CURRENT_KEY_SET = ALL_KEYS[:]
-        if CURRENT_KEY_SET:
-            return CURRENT_KEY_SET.pop(0)
-        else:
-            raise Exception('No more keys available')
+        old_key = USER_KEYS.get(user)
+        if old_key and old_key != key:
+            KEYS.remove_owner(old_key, user)
+        USER_KEYS[user] = key
+        if key not in ALL_KEYS:
+            ALL_KEYS.append(key)
+    KEYS.add_key(key, user)
 
 
 def encode_image(image_data: bytes) -> str:
@@ -163,7 +174,7 @@ def img2txt(image_data: Union[str, bytes],
         else:
             key = get_next_key()
         try:
-            client = Groq(api_key=key, timeout = timeout)
+            client = my_llm_clients.get_client('groq', key, timeout = timeout)
 
             chat_completion = client.chat.completions.create(
                 messages=mem,
@@ -273,14 +284,16 @@ def ai(prompt: str = '',
                 return ''
 
             if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
-                client = Groq(
-                    api_key=key,
-                    http_client = httpx.Client(proxy = random.choice(cfg.GROQ_PROXIES)),
+                client = my_llm_clients.get_client(
+                    'groq',
+                    key,
+                    proxy = random.choice(cfg.GROQ_PROXIES),
                     timeout = 5,
                 )
             else:
-                client = Groq(api_key=key, timeout = timeout)
+                client = my_llm_clients.get_client('groq', key, timeout = timeout)
 
+            request_start = time.time()
             try:
                 params = {
                     "messages": mem,
@@ -307,6 +320,7 @@ def ai(prompt: str = '',
                 else:
                     # Standard text request
                     chat_completion = client.chat.completions.create(**params)
+                KEYS.report_success(key, time.time() - request_start)
 
             except PermissionDeniedError:
                 my_log.log_groq(f'GROQ PermissionDeniedError: {key}')
@@ -315,10 +329,12 @@ def ai(prompt: str = '',
                 if 'invalid api key' in str(error).lower() or 'Organization has been restricted' in str(error):
                     remove_key(key)
                     continue
-                if 'Rate limit reached for model' in str(error).lower():
+                if 'rate limit reached for model' in str(error).lower():
+                    KEYS.report_rate_limit(key, my_key_scheduler.retry_after(error))
                     continue
                 if "'message': 'Request Entity Too Large', 'type': 'invalid_request_error', 'code': 'request_too_large'" in str(error):
                     return str(error)
+                KEYS.report_failure(key, time.time() - request_start)
                 my_log.log_groq(f'GROQ {error} {key} {model} {str(mem)[:1000]}')
             try:
                 resp = chat_completion.choices[0].message.content.strip()
@@ -433,9 +449,9 @@ def remove_key(key: str):
 
         keys_to_delete = []
         with USER_KEYS_LOCK:
-            # remove key from USER_KEYS
-            for user in USER_KEYS:
-                if USER_KEYS[user] == key:
+            # remove key from USER_KEYS, владельцы ключа из обратного индекса планировщика
+            for user in KEYS.remove_key(key):
+                if USER_KEYS.get(user) == key:
                     keys_to_delete.append(user)
 
             for user_key in keys_to_delete:
@@ -786,13 +802,12 @@ def stt(
     for attempt in range(retries):
         key = key_ or get_next_key()
         try:
-            client_params = {'api_key': key, 'timeout': timeout}
+            proxy = None
             if hasattr(cfg, 'GROQ_PROXIES') and cfg.GROQ_PROXIES:
                 # Add proxy if configured
-                proxy_client = httpx.Client(proxy=random.choice(cfg.GROQ_PROXIES))
-                client_params['http_client'] = proxy_client
+                proxy = random.choice(cfg.GROQ_PROXIES)
 
-            client = Groq(**client_params)
+            client = my_llm_clients.get_client('groq', key, proxy=proxy, timeout=timeout)
 
             if lang_detect:
                 transcription = client.audio.transcriptions.create(
@@ -838,8 +853,7 @@ def tts(text: str, lang: str = 'en', voice: str = 'Mikail-PlayAI') -> bytes:
     voice: str - voice name
     Returns audio data as ogg bytes
     '''
-    client = Groq(api_key=get_next_key())
-    # client = Groq(api_key=cfg.GROQ_API_KEY[0])
+    client = my_llm_clients.get_client('groq', get_next_key())
 
     speech_file_path = utils.get_tmp_fname() + '.wav'
     model = "playai-tts"
@@ -860,7 +874,6 @@ def tts(text: str, lang: str = 'en', voice: str = 'Mikail-PlayAI') -> bytes:
     except Exception as error:
         my_log.log_groq(f'my_groq:tts: {error}')
     finally:
-        client.close()
         utils.remove_file(speech_file_path)
 
     return b''
@@ -925,6 +938,26 @@ TEXT:
     return ''
 
 
+def translate_batch(items: list, to_lang: str, from_lang: str = '', model: str = '') -> list:
+    """
+    Translates many strings with one request.
+
+    Args:
+        items (list): List of tuples (text, help).
+        to_lang (str): The language to translate the texts into.
+        from_lang (str, optional): The language of the texts, autodetect if empty.
+        model (str, optional): The model to use for translation.
+
+    Returns:
+        list: Translations in the same order, '' for items that were not translated.
+    """
+    if not items:
+        return []
+    query = utils_llm.build_batch_translate_prompt(items, to_lang, from_lang)
+    translated = ai(query, temperature=0.1, model_=model, max_tokens_=8000, json_output = True)
+    return utils_llm.parse_batch_translation(translated, len(items))
+
+
 def sum_big_text(text:str, query: str, temperature: float = 1, model = DEFAULT_MODEL, role: str = '') -> str:
     """
     Generates a response from an AI model based on a given text,
@@ -1031,6 +1064,7 @@ def load_users_keys():
     """
     Load users' keys into memory and update the list of all keys available.
     """
+    owners = {}
     with USER_KEYS_LOCK:
         global USER_KEYS, ALL_KEYS
         ALL_KEYS = cfg.GROQ_API_KEY[:] if hasattr(cfg, 'GROQ_API_KEY') and cfg.GROQ_API_KEY else []
@@ -1038,6 +1072,8 @@ def load_users_keys():
             key = USER_KEYS[user]
             if key not in ALL_KEYS:
                 ALL_KEYS.append(key)
+            owners.setdefault(key, []).append(user)
+    KEYS.set_keys(ALL_KEYS, owners)
 
 
 def test_key(key: str) -> bool:
@@ -1083,7 +1119,7 @@ def get_groq_response_with_image(prompt: str, user_id: str = '') -> tuple[str, l
 
         for _ in range(3):
             try:
-                response = requests.post(url, headers=headers, json=payload, timeout=60)
+                response = my_llm_clients.get_session().post(url, headers=headers, json=payload, timeout=60)
                 # Проверяем, успешен ли запрос
                 response.raise_for_status() 
 
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# Хеджированные запросы к цепочкам нейросетей.
+# Раньше запасной провайдер запускался только после того как основной упал или вышел по таймауту,
+# и сбой основного превращался в ответ через 60-120 секунд.
+# Теперь следующий в цепочке стартует если предыдущий не ответил за HEDGE_PERCENTILE перцентиль
+# своего обычного времени ответа, побеждает первый нормальный ответ, остальные отменяются.
+# В статистику времени идут победители и все кто не уложился в свою задержку (даже проигравшие),
+# иначе перцентиль считался бы только по быстрым ответам и хедж запускался бы все чаще.
+#
+# Поток питона нельзя убить, поэтому отмена мягкая: проигравший дорабатывает свой запрос,
+# но модули проверяют my_hedge.is_cancelled() между попытками и my_hedge.claim()
+# перед записью истории диалога, так что в историю попадает только ответ победителя.
+
+
+import collections
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+import cfg
+import my_log
+
+
+# выключить хеджирование - цепочки работают строго по очереди как раньше
+HEDGE_ENABLED = cfg.HEDGE_ENABLED if hasattr(cfg, 'HEDGE_ENABLED') else True
+# после какого перцентиля времени ответа основного запускать запасной
+HEDGE_PERCENTILE = cfg.HEDGE_PERCENTILE if hasattr(cfg, 'HEDGE_PERCENTILE') else 90
+# задержка пока по провайдеру мало замеров, и пределы задержки
+HEDGE_DEFAULT_DELAY = cfg.HEDGE_DEFAULT_DELAY if hasattr(cfg, 'HEDGE_DEFAULT_DELAY') else 20
+HEDGE_MIN_DELAY = cfg.HEDGE_MIN_DELAY if hasattr(cfg, 'HEDGE_MIN_DELAY') else 3
+HEDGE_MAX_DELAY = cfg.HEDGE_MAX_DELAY if hasattr(cfg, 'HEDGE_MAX_DELAY') else 60
+# сколько нужно замеров что бы верить перцентилю, и сколько последних хранить
+MIN_SAMPLES = 10
+MAX_SAMPLES = 200
+
+LOCK = threading.Lock()
+# {name: deque(время удачных ответов)}
+LATENCIES: Dict[str, collections.deque] = {}
+# метрики
+CALLS = 0
+HEDGED = 0
+FAILED = 0
+WINS = collections.Counter()
+
+# в потоке кандидата: события отмены (свое и всех внешних цепочек) и (группа, номер) для claim()
+_local = threading.local()
+
+
+class _Group:
+    '''Состояние одного вызова run()'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.done = threading.Condition(self.lock)
+        # события отмены запущенных кандидатов, {номер: event}
+        self.events: Dict[int, threading.Event] = {}
+        # [(номер, ответ, время)]
+        self.results = []
+        # номер кандидата который начал записывать результат (claim)
+        self.winner = None
+
+
+def is_cancelled() -> bool:
+    '''True если текущий поток работает на проигравшего кандидата и его результат уже не нужен'''
+    return any(x.is_set() for x in getattr(_local, 'events', ()))
+
+
+def claim() -> bool:
+    '''
+    Вызывать перед побочными эффектами результата (запись истории диалога).
+    Первый вызвавший кандидат становится победителем, остальные отменяются.
+    Вне run() всегда True.
+    '''
+    slot = getattr(_local, 'slot', None)
+    if slot is None:
+        return True
+    group, idx = slot
+    with group.lock:
+        if group.events[idx].is_set() or group.winner not in (None, idx):
+            return False
+        group.winner = idx
+        for i, event in group.events.items():
+            if i != idx:
+                event.set()
+    return not is_cancelled()
+
+
+def get_delay(name: str) -> float:
+    '''Через сколько секунд после старта name запускать следующего кандидата'''
+    if not HEDGE_ENABLED:
+        return float('inf')
+    with LOCK:
+        samples = sorted(LATENCIES.get(name, ()))
+    if len(samples) < MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    delay = samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))]
+    return min(max(delay, HEDGE_MIN_DELAY), HEDGE_MAX_DELAY)
+
+
+def _record(name: str, latency: float):
+    with LOCK:
+        if name not in LATENCIES:
+            LATENCIES[name] = collections.deque(maxlen=MAX_SAMPLES)
+        LATENCIES[name].append(latency)
+
+
+def _worker(group: _Group, idx: int, func: Callable, parent_events: tuple):
+    _local.events = parent_events + (group.events[idx],)
+    _local.slot = (group, idx)
+    start = time.time()
+    answer = ''
+    try:
+        answer = func()
+    except Exception as error:
+        traceback_error = traceback.format_exc()
+        my_log.log2(f'my_hedge:worker: {error}\n\n{traceback_error}')
+    finally:
+        _local.events = ()
+        _local.slot = None
+    with group.lock:
+        group.results.append((idx, answer, time.time() - start))
+        group.done.notify_all()
+
+
+def run(candidates: List[Tuple], valid: Callable[[str], bool] = bool) -> Tuple[str, str]:
+    '''
+    Выполнить цепочку запасных вариантов с хеджированием.
+
+    Args:
+        candidates: [(имя для статистики, функция без аргументов которая возвращает ответ[, ключ замка]), ...]
+                    в порядке предпочтения. Кандидаты с одинаковым ключом замка (например chat() одного
+                    модуля, он держит замок чата на весь запрос, или chat() с инструментами, иначе
+                    картинки и файлы делались бы дважды) параллельно не запускаются,
+                    следующий из них стартует только когда предыдущий закончил
+        valid: годится ли ответ, по умолчанию любой непустой
+
+    Returns:
+        (ответ, имя победителя) или ('', '') если никто не ответил
+    '''
+    global CALLS, HEDGED, FAILED
+    with LOCK:
+        CALLS += 1
+
+    group = _Group()
+    parent_events = getattr(_local, 'events', ())
+    names = [x[0] for x in candidates]
+    keys = [x[2] if len(x) > 2 else '' for x in candidates]
+    # еще не запущенные, по порядку
+    pending = list(range(len(candidates)))
+    # {номер: (время старта, задержка хеджа)} запущенных и еще не ответивших
+    started = {}
+    busy = collections.Counter()
+    next_start = 0.0
+
+    def record_slow(now: float):
+        '''Не дождались ответа, время тех кто не уложился в свою задержку тоже идет в статистику'''
+        for i, (start, delay) in started.items():
+            if now - start >= delay:
+                _record(names[i], now - start)
+
+    with group.lock:
+        while True:
+            now = time.time()
+
+            while group.results:
+                idx, answer, latency = group.results.pop(0)
+                _, delay = started.pop(idx)
+                busy[keys[idx]] -= 1
+                if answer and not group.events[idx].is_set() and valid(answer):
+                    group.winner = idx
+                    for i, event in group.events.items():
+                        if i != idx:
+                            event.set()
+                    _record(names[idx], latency)
+                    record_slow(now)
+                    with LOCK:
+                        WINS[names[idx]] += 1
+                    return answer, names[idx]
+                if latency >= delay:
+                    # долго думал и ничего не дал, это тоже его обычное время
+                    _record(names[idx], latency)
+                if group.winner == idx:
+                    # записал историю но ответ не подошел, пробуем остальных
+                    group.winner = None
+
+            # запустить следующего кандидата если все упали или текущий слишком долго думает,
+            # кандидата с занятым замком пропускаем до освобождения замка
+            ready = [i for i in pending if not keys[i] or not busy[keys[i]]]
+            if ready and group.winner is None and (not started or now >= next_start):
+                idx = ready[0]
+                pending.remove(idx)
+                name, func = candidates[idx][:2]
+                group.events[idx] = threading.Event()
+                if started:
+                    with LOCK:
+                        HEDGED += 1
+                delay = get_delay(name)
+                started[idx] = (now, delay)
+                busy[keys[idx]] += 1
+                threading.Thread(target=_worker, args=(group, idx, func, parent_events),
+                                 name=f'my_hedge {name}', daemon=True).start()
+                next_start = now + delay
+                continue
+
+            if (not started and not pending) or any(x.is_set() for x in parent_events):
+                for event in group.events.values():
+                    event.set()
+                record_slow(now)
+                with LOCK:
+                    FAILED += 1
+                return '', ''
+
+            if ready and group.winner is None:
+                group.done.wait(max(0.01, next_start - now))
+            else:
+                group.done.wait()
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        wins = ', '.join(f'{k}: {v}' for k, v in WINS.most_common(10))
+        return f'calls: {CALLS}, hedged: {HEDGED}, failed: {FAILED}\nwins: {wins}'
+
+
+if __name__ == '__main__':
+    pass
+
+    def slow():
+        time.sleep(5)
+        return 'slow'
+
+    def fast():
+        time.sleep(1)
+        return 'fast' if claim() else ''
+
+    HEDGE_DEFAULT_DELAY = 2
+    start = time.time()
+    print(run([('slow', slow), ('fast', fast)]), f'{time.time() - start:.1f}s')
+    print(run([('empty', lambda: ''), ('fast', fast)]), f'{time.time() - start:.1f}s')
+    print(get_stats())
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+# Обработка картинок (Pillow/imagecodecs/ffmpeg из utils) в отдельных процессах.
+# Раньше resize_and_convert_to_jpg, make_collage, heic2jpg и т.п. выполнялись прямо в потоках
+# обработчиков, при альбомах (download_image_from_messages качает в 8 потоков) эта работа
+# упиралась в GIL и тормозила все остальные обработчики, даже текстовые.
+# Теперь функции utils выполняются в пуле из IMAGE_PROCESSES процессов, большие буферы
+# передаются через shared memory (а не pickle через pipe), а process_batch обрабатывает
+# сразу много картинок параллельно.
+# Процессы создаются через fork: при spawn/forkserver каждый процесс заново выполнял бы
+# верхний уровень tb.py (подключение к телеграму, базы), поэтому пул надо запустить
+# пораньше через start(), пока в боте мало работы.
+#
+# Замер на папке с картинками:
+#   python my_imgproc.py bench folder [processes]
+
+
+import concurrent.futures
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+from typing import Any, List
+
+import cfg
+import my_log
+import utils
+
+
+# сколько процессов, 0 - выполнять в потоке вызывающего как раньше
+IMAGE_PROCESSES = cfg.IMAGE_PROCESSES if hasattr(cfg, 'IMAGE_PROCESSES') else min(4, os.cpu_count() or 1)
+# сколько ждать результата по умолчанию, секунд (extract_frames_as_bytes запускает ffmpeg)
+IMAGE_TIMEOUT = cfg.IMAGE_TIMEOUT if hasattr(cfg, 'IMAGE_TIMEOUT') else 120
+# буферы меньше этого передаются обычным pickle
+SHM_MIN_SIZE = 64 * 1024
+
+# какие функции utils можно вызывать
+FUNCTIONS = {
+    'resize_and_convert_to_jpg',
+    'make_collage',
+    'create_image_collages',
+    'heic2jpg',
+    'compress_png_bytes',
+    'resize_image',
+    'extract_frames_as_bytes',
+}
+
+LOCK = threading.Lock()
+POOL: concurrent.futures.ProcessPoolExecutor = None
+
+# метрики
+CALLS = 0
+TOTAL_TIME = 0.0
+INLINE = 0
+ERRORS = 0
+TIMEOUTS = 0
+RESTARTS = 0
+SHM_BYTES = 0
+
+
+class _Shm:
+    '''Ссылка на буфер в shared memory вместо самих байтов'''
+    __slots__ = ('name', 'size')
+
+    def __init__(self, name: str, size: int):
+        self.name = name
+        self.size = size
+
+
+def _to_shm(data: bytes) -> _Shm:
+    global SHM_BYTES
+    shm = shared_memory.SharedMemory(create=True, size=len(data))
+    try:
+        shm.buf[:len(data)] = data
+    finally:
+        shm.close()
+    SHM_BYTES += len(data)
+    return _Shm(shm.name, len(data))
+
+
+def _from_shm(ref: _Shm, unlink: bool) -> bytes:
+    global SHM_BYTES
+    shm = shared_memory.SharedMemory(name=ref.name)
+    try:
+        return bytes(shm.buf[:ref.size])
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+            SHM_BYTES += ref.size
+
+
+def _pack(value: Any) -> Any:
+    '''Большие bytes (и они же внутри списков и кортежей) заменить на _Shm'''
+    if isinstance(value, (bytes, bytearray)) and len(value) >= SHM_MIN_SIZE:
+        return _to_shm(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_pack(x) for x in value)
+    return value
+
+
+def _unpack(value: Any, unlink: bool) -> Any:
+    '''Обратно к bytes, unlink - удалить shared memory после чтения (ее владелец теперь мы)'''
+    if isinstance(value, _Shm):
+        return _from_shm(value, unlink)
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unpack(x, unlink) for x in value)
+    return value
+
+
+def _release(value: Any):
+    '''Удалить shared memory созданную для аргументов'''
+    if isinstance(value, _Shm):
+        try:
+            shm = shared_memory.SharedMemory(name=value.name)
+            shm.close()
+            shm.unlink()
+        except FileNotFoundError:
+            pass
+    elif isinstance(value, (list, tuple)):
+        for x in value:
+            _release(x)
+
+
+def _free_result(future: concurrent.futures.Future):
+    '''Результат который уже никто не ждет (таймаут), освободить его shared memory'''
+    if not future.cancelled() and future.exception() is None:
+        _release(future.result())
+
+
+def _call(name: str, args: tuple, kwargs: dict) -> Any:
+    '''Выполняется в процессе пула'''
+    result = getattr(utils, name)(*_unpack(args, unlink=False), **kwargs)
+    return _pack(result)
+
+
+def _get_pool() -> concurrent.futures.ProcessPoolExecutor:
+    global POOL
+    with LOCK:
+        if POOL is None and IMAGE_PROCESSES > 0:
+            # процессы должны получить общий resource tracker от нас, иначе каждый запустит свой
+            # и будет ругаться на shared memory результатов которые удалили мы
+            resource_tracker.ensure_running()
+            POOL = concurrent.futures.ProcessPoolExecutor(
+                max_workers=IMAGE_PROCESSES,
+                mp_context=multiprocessing.get_context('fork'),
+            )
+        return POOL
+
+
+def _reset(pool: concurrent.futures.ProcessPoolExecutor):
+    '''Процесс пула умер (например не хватило памяти), следующий вызов создаст новый пул'''
+    global POOL, RESTARTS
+    with LOCK:
+        if POOL is pool:
+            POOL = None
+            RESTARTS += 1
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _run(name: str, args: tuple, kwargs: dict) -> Any:
+    '''Выполнить в этом потоке (пул выключен или недоступен)'''
+    global INLINE
+    INLINE += 1
+    return getattr(utils, name)(*args, **kwargs)
+
+
+def _submit(name: str, args: tuple, kwargs: dict):
+    '''
+    Returns:
+        (future, аргументы в shared memory, пул) или (None, None, None) если выполнять в этом потоке
+    '''
+    if name not in FUNCTIONS:
+        raise ValueError(f'my_imgproc: unknown function {name}')
+    pool = _get_pool()
+    if pool is None:
+        return None, None, None
+    packed = _pack(args)
+    try:
+        return pool.submit(_call, name, packed, kwargs), packed, pool
+    except (BrokenProcessPool, RuntimeError) as error:
+        my_log.log2(f'my_imgproc:submit: {error}')
+        _release(packed)
+        _reset(pool)
+        return None, None, None
+
+
+def _wait(future: concurrent.futures.Future, packed: tuple, pool: concurrent.futures.ProcessPoolExecutor, name: str, timeout: float) -> Any:
+    '''Результат задания, исключения функции пробрасываются'''
+    global TIMEOUTS
+    try:
+        return _unpack(future.result(timeout=timeout), unlink=True)
+    except concurrent.futures.TimeoutError:
+        TIMEOUTS += 1
+        if not future.cancel():
+            future.add_done_callback(_free_result)
+        raise TimeoutError(f'my_imgproc: {name} timed out after {timeout:.0f}s')
+    except BrokenProcessPool:
+        _reset(pool)
+        raise
+    finally:
+        _release(packed)
+
+
+def process(name: str, *args, timeout: float = None, **kwargs) -> Any:
+    '''
+    Вызвать utils.<name>(*args, **kwargs) в процессе пула и вернуть результат.
+    Исключения функции пробрасываются, при таймауте TimeoutError.
+
+    process('resize_and_convert_to_jpg', image, 2000, 60)
+    '''
+    global CALLS, TOTAL_TIME
+    t = time.time()
+    future, packed, pool = _submit(name, args, kwargs)
+    try:
+        if future is None:
+            return _run(name, args, kwargs)
+        return _wait(future, packed, pool, name, timeout or IMAGE_TIMEOUT)
+    finally:
+        CALLS += 1
+        TOTAL_TIME += time.time() - t
+
+
+def process_batch(name: str, items: List[Any], *args, timeout: float = None, default: Any = None, **kwargs) -> List[Any]:
+    '''
+    Вызвать utils.<name>(item, *args, **kwargs) для каждого item параллельно.
+    timeout - на всю пачку, при ошибке или таймауте вместо результата default.
+
+    process_batch('resize_and_convert_to_jpg', images, 2000, 60, default=b'')
+    Returns:
+        результаты в том же порядке что и items
+    '''
+    global CALLS, TOTAL_TIME, ERRORS
+    t = time.time()
+    deadline = t + (timeout or IMAGE_TIMEOUT)
+    jobs = [_submit(name, (item,) + args, kwargs) for item in items]
+    results = []
+    for item, (future, packed, pool) in zip(items, jobs):
+        try:
+            if future is None:
+                results.append(_run(name, (item,) + args, kwargs))
+            else:
+                results.append(_wait(future, packed, pool, name, max(0, deadline - time.time())))
+        except Exception as error:
+            ERRORS += 1
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_imgproc:process_batch: {name} {error}\n\n{traceback_error}')
+            results.append(default)
+    CALLS += len(items)
+    TOTAL_TIME += time.time() - t
+    return results
+
+
+def start():
+    '''Запустить процессы заранее, при старте бота'''
+    pool = _get_pool()
+    if pool is not None:
+        # при fork все процессы запускаются на первом задании
+        pool.submit(os.getpid).result()
+
+
+def shutdown():
+    '''Остановить процессы, при выключении бота'''
+    global POOL
+    with LOCK:
+        pool, POOL = POOL, None
+    if pool is not None:
+        pool.shutdown(wait=False, cancel_futures=True)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    avg = TOTAL_TIME / CALLS * 1000 if CALLS else 0
+    return (f'processes: {IMAGE_PROCESSES if POOL else 0}, calls: {CALLS}, avg: {avg:.0f}ms, inline: {INLINE}, '
+            f'errors: {ERRORS}, timeouts: {TIMEOUTS}, restarts: {RESTARTS}, shared memory: {SHM_BYTES // 1024 // 1024}MB')
+
+
+def bench(folder: str, processes: int = None) -> str:
+    '''
+    Сравнить обработку всех картинок из папки как раньше (8 потоков) и через пул процессов.
+    Returns:
+        сводка
+    '''
+    global IMAGE_PROCESSES
+    images = []
+    for fname in sorted(os.listdir(folder)):
+        if fname.lower().endswith(('.jpg', '.jpeg', '.png', '.webp', '.heic', '.bmp', '.gif', '.tif', '.tiff')):
+            with open(os.path.join(folder, fname), 'rb') as f:
+                images.append(f.read())
+    if not images:
+        return f'no images in {folder}'
+    size = sum(len(x) for x in images) // 1024 // 1024
+
+    t = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+        threads = list(executor.map(lambda x: utils.resize_and_convert_to_jpg(x, 2000, 60), images))
+    threads_time = time.time() - t
+
+    if processes is not None:
+        IMAGE_PROCESSES = processes
+    start()
+    t = time.time()
+    pool = process_batch('resize_and_convert_to_jpg', images, 2000, 60, default=b'')
+    pool_time = time.time() - t
+    shutdown()
+
+    same = sum(1 for a, b in zip(threads, pool) if a == b)
+    return (f'{len(images)} images ({size}MB): threads {threads_time:.2f}s, '
+            f'{IMAGE_PROCESSES} processes {pool_time:.2f}s, same results: {same}/{len(images)}\n{get_stats()}')
+
+
+if __name__ == '__main__':
+    pass
+
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'bench':
+        print(bench(sys.argv[2], int(sys.argv[3]) if len(sys.argv) > 3 else None))
+    else:
+        print('usage: python my_imgproc.py bench folder [processes]')
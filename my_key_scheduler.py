@@ -0,0 +1,366 @@
+#!/usr/bin/env python3
+# Общий планировщик API ключей для провайдеров (gemini, groq, cerebras, openrouter free).
+# Для каждого ключа считается доля ошибок, средняя задержка, пауза после 429 и дневная квота.
+# Следующий ключ берется из кучи по времени когда он снова может работать:
+# после использования ключ уходит в конец очереди, плохие и медленные ключи уходят дальше,
+# ключи на паузе (429, кончилась квота) не выдаются пока пауза не пройдет.
+# Обратный индекс ключ -> юзеры позволяет удалять ключ не перебирая всех юзеров.
+# Состояние (паузы, квоты, статистика) сохраняется в json не чаще раза в SAVE_INTERVAL секунд.
+
+
+import datetime
+import heapq
+import itertools
+import json
+import os
+import threading
+import time
+import traceback
+from typing import Dict, Iterable, List, Set
+
+import my_log
+
+
+# сохранять состояние не чаще чем раз в столько секунд
+SAVE_INTERVAL = 30
+STATE_DIR = 'db'
+
+# базовый интервал между использованиями одного ключа, только для порядка в очереди
+BASE_SPACING = 1.0
+# пауза после 429 если провайдер не сказал сколько ждать
+DEFAULT_COOLDOWN = 60
+# вес свежих замеров в скользящем среднем
+EWMA_ALPHA = 0.2
+
+
+class KeyState:
+    '''Статистика одного ключа'''
+    __slots__ = ('key', 'ok', 'errors', 'error_rate', 'latency', 'cooldown_until',
+                 'day', 'used_today', 'last_used', 'version')
+
+    def __init__(self, key: str):
+        self.key = key
+        self.ok = 0
+        self.errors = 0
+        # скользящие средние, 0..1 и секунды
+        self.error_rate = 0.0
+        self.latency = 0.0
+        self.cooldown_until = 0.0
+        self.day = ''
+        self.used_today = 0
+        self.last_used = 0.0
+        # номер актуальной записи в куче, старые записи пропускаются
+        self.version = 0
+
+    def penalty(self) -> float:
+        '''Во сколько раз дольше ждать своей очереди чем идеальному ключу'''
+        return (1 + 4 * self.error_rate) * (1 + self.latency / 10)
+
+    def to_dict(self) -> dict:
+        return {x: getattr(self, x) for x in self.__slots__ if x not in ('key', 'version')}
+
+    def load_dict(self, data: dict):
+        for x in self.__slots__:
+            if x in data and x not in ('key', 'version'):
+                setattr(self, x, data[x])
+
+
+class KeyScheduler:
+    '''
+    Планировщик ключей одного провайдера.
+
+    name - имя для логов и файла состояния db/keys_<name>.json
+    daily_quota - сколько запросов в день на ключ, 0 - без ограничения
+    '''
+    def __init__(self, name: str, daily_quota: int = 0):
+        self.name = name
+        self.daily_quota = daily_quota
+        self.state_file = os.path.join(STATE_DIR, f'keys_{name}.json')
+        self.lock = threading.Lock()
+        # {key: KeyState}
+        self.keys: Dict[str, KeyState] = {}
+        # {key: {user_id, ...}}
+        self.owners: Dict[str, Set[str]] = {}
+        # [(ready_time, seq, version, key)]
+        self.heap = []
+        self._seq = itertools.count()
+        # состояние ключей которых сейчас нет в списке (еще не загружены или удалены)
+        self.saved = {}
+        self.last_save = 0.0
+        self.dirty = False
+        self._load_state()
+
+    # ---------- внутреннее, все под self.lock ----------
+
+    def _ready_time(self, st: KeyState) -> float:
+        return max(st.cooldown_until, st.last_used + BASE_SPACING * st.penalty())
+
+    def _push(self, st: KeyState):
+        st.version += 1
+        heapq.heappush(self.heap, (self._ready_time(st), next(self._seq), st.version, st.key))
+        # старых записей стало слишком много - пересобрать кучу
+        if len(self.heap) > 4 * len(self.keys) + 16:
+            self.heap = [(self._ready_time(x), next(self._seq), x.version, x.key) for x in self.keys.values()]
+            heapq.heapify(self.heap)
+
+    def _add(self, key: str):
+        if key in self.keys:
+            return
+        st = KeyState(key)
+        if key in self.saved:
+            st.load_dict(self.saved.pop(key))
+        self.keys[key] = st
+        self._push(st)
+
+    def _check_day(self, st: KeyState, now: float):
+        today = datetime.date.fromtimestamp(now).isoformat()
+        if st.day != today:
+            st.day = today
+            st.used_today = 0
+
+    def _next_day(self, now: float) -> float:
+        tomorrow = datetime.date.fromtimestamp(now) + datetime.timedelta(days=1)
+        return time.mktime(tomorrow.timetuple())
+
+    # ---------- список ключей ----------
+
+    def set_keys(self, keys: Iterable[str], owners: Dict[str, Iterable[str]] = None):
+        '''Задать полный список ключей и их владельцев, статистика известных ключей сохраняется'''
+        keys = [x for x in dict.fromkeys(keys) if x]
+        with self.lock:
+            for key in list(self.keys):
+                if key not in keys:
+                    self.saved[key] = self.keys.pop(key).to_dict()
+            for key in keys:
+                self._add(key)
+            self.owners = {}
+            for key, users in (owners or {}).items():
+                self.owners[key] = set(users)
+            self.heap = [(self._ready_time(x), next(self._seq), x.version, x.key) for x in self.keys.values()]
+            heapq.heapify(self.heap)
+
+    def add_key(self, key: str, user_id: str = ''):
+        '''Добавить ключ (и его владельца)'''
+        if not key:
+            return
+        with self.lock:
+            self._add(key)
+            if user_id:
+                self.owners.setdefault(key, set()).add(user_id)
+
+    def remove_key(self, key: str) -> Set[str]:
+        '''Убрать ключ, вернуть юзеров которым он принадлежал'''
+        with self.lock:
+            st = self.keys.pop(key, None)
+            if st:
+                # запись в куче станет неактуальной и будет пропущена
+                st.version += 1
+                self.dirty = True
+            return self.owners.pop(key, set())
+
+    def remove_owner(self, key: str, user_id: str):
+        with self.lock:
+            users = self.owners.get(key)
+            if users:
+                users.discard(user_id)
+                if not users:
+                    del self.owners[key]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    # ---------- выдача ключа ----------
+
+    def get_key(self, allow_cooldown: bool = True) -> str:
+        '''
+        Самый подходящий ключ, O(log n).
+
+        Args:
+            allow_cooldown: если все ключи на паузе - отдать тот что освободится раньше всех,
+                            иначе вернуть ''
+        '''
+        now = time.time()
+        with self.lock:
+            while self.heap:
+                ready_time, _, version, key = self.heap[0]
+                st = self.keys.get(key)
+                if st is None or st.version != version:
+                    heapq.heappop(self.heap)
+                    continue
+
+                self._check_day(st, now)
+                if self.daily_quota:
+                    if st.used_today >= self.daily_quota and st.cooldown_until < now:
+                        # квота кончилась, ждать до завтра
+                        heapq.heappop(self.heap)
+                        st.cooldown_until = self._next_day(now)
+                        self._push(st)
+                        continue
+
+                if st.cooldown_until > now and not allow_cooldown:
+                    return ''
+
+                heapq.heappop(self.heap)
+                st.last_used = now
+                st.used_today += 1
+                self._push(st)
+                self.dirty = True
+                return key
+        return ''
+
+    # ---------- результаты запросов ----------
+
+    def report_success(self, key: str, latency: float = 0.0):
+        with self.lock:
+            st = self.keys.get(key)
+            if not st:
+                return
+            st.ok += 1
+            st.error_rate *= (1 - EWMA_ALPHA)
+            if latency:
+                st.latency = latency if not st.latency else st.latency * (1 - EWMA_ALPHA) + latency * EWMA_ALPHA
+            self._push(st)
+            self.dirty = True
+        self.maybe_save()
+
+    def report_failure(self, key: str, latency: float = 0.0):
+        '''Ошибка не связанная с лимитами (таймаут, 5xx)'''
+        with self.lock:
+            st = self.keys.get(key)
+            if not st:
+                return
+            st.errors += 1
+            st.error_rate = st.error_rate * (1 - EWMA_ALPHA) + EWMA_ALPHA
+            if latency:
+                st.latency = latency if not st.latency else st.latency * (1 - EWMA_ALPHA) + latency * EWMA_ALPHA
+            self._push(st)
+            self.dirty = True
+        self.maybe_save()
+
+    def report_rate_limit(self, key: str, retry_after: float = 0):
+        '''Ключ получил 429, не выдавать его retry_after секунд'''
+        with self.lock:
+            st = self.keys.get(key)
+            if st:
+                st.errors += 1
+        self.freeze(key, retry_after or DEFAULT_COOLDOWN)
+
+    def freeze(self, key: str, seconds: float):
+        '''Не выдавать ключ seconds секунд'''
+        with self.lock:
+            st = self.keys.get(key)
+            if not st:
+                return
+            st.cooldown_until = max(st.cooldown_until, time.time() + seconds)
+            self._push(st)
+            self.dirty = True
+        self.maybe_save(force=True)
+
+    def get_frozen(self) -> Dict[str, float]:
+        '''{key: до какого времени на паузе}'''
+        now = time.time()
+        with self.lock:
+            return {k: v.cooldown_until for k, v in self.keys.items() if v.cooldown_until > now}
+
+    # ---------- сохранение ----------
+
+    def _load_state(self):
+        try:
+            if os.path.exists(self.state_file):
+                with open(self.state_file, 'r', encoding='utf-8') as f:
+                    self.saved = json.load(f)
+        except Exception as error:
+            my_log.log_keys(f'my_key_scheduler:{self.name}:load_state: {error}')
+            self.saved = {}
+
+    def maybe_save(self, force: bool = False):
+        '''Сохранить состояние если оно менялось и давно не сохранялось'''
+        now = time.time()
+        with self.lock:
+            if not self.dirty or (not force and now - self.last_save < SAVE_INTERVAL):
+                return
+            data = dict(self.saved)
+            data.update({k: v.to_dict() for k, v in self.keys.items()})
+            self.dirty = False
+            self.last_save = now
+        try:
+            tmp = self.state_file + '.tmp'
+            with open(tmp, 'w', encoding='utf-8') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.state_file)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log_keys(f'my_key_scheduler:{self.name}:save: {error}\n\n{traceback_error}')
+
+    # ---------- статистика ----------
+
+    def stats(self) -> str:
+        now = time.time()
+        with self.lock:
+            total = len(self.keys)
+            frozen = sum(1 for x in self.keys.values() if x.cooldown_until > now)
+            ok = sum(x.ok for x in self.keys.values())
+            errors = sum(x.errors for x in self.keys.values())
+            latencies = [x.latency for x in self.keys.values() if x.latency]
+        avg_latency = sum(latencies) / len(latencies) if latencies else 0
+        return (f'{self.name}: keys {total}, on pause {frozen}, ok {ok}, errors {errors}, '
+                f'avg latency {avg_latency:.1f}s')
+
+    def top(self, n: int = 10) -> List[str]:
+        '''Худшие ключи для отладки'''
+        with self.lock:
+            items = sorted(self.keys.values(), key=lambda x: -x.penalty())[:n]
+            return [f'...{x.key[-4:]} err {x.error_rate:.2f} lat {x.latency:.1f}s today {x.used_today}' for x in items]
+
+
+def retry_after(error: Exception) -> float:
+    '''Сколько ждать после 429, из заголовка retry-after ответа SDK (openai, groq, cerebras), 0 - неизвестно'''
+    try:
+        return float(error.response.headers.get('retry-after', 0))
+    except Exception:
+        return 0
+
+
+SCHEDULERS: Dict[str, KeyScheduler] = {}
+SCHEDULERS_LOCK = threading.Lock()
+
+
+def get_scheduler(name: str, daily_quota: int = 0) -> KeyScheduler:
+    '''Планировщик провайдера name, создается при первом обращении'''
+    with SCHEDULERS_LOCK:
+        scheduler = SCHEDULERS.get(name)
+        if scheduler is None:
+            scheduler = SCHEDULERS[name] = KeyScheduler(name, daily_quota)
+        return scheduler
+
+
+def save_all():
+    with SCHEDULERS_LOCK:
+        schedulers = list(SCHEDULERS.values())
+    for scheduler in schedulers:
+        scheduler.maybe_save(force=True)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with SCHEDULERS_LOCK:
+        schedulers = sorted(SCHEDULERS.values(), key=lambda x: x.name)
+    return '\n'.join(x.stats() for x in schedulers)
+
+
+if __name__ == '__main__':
+    pass
+    STATE_DIR = '/tmp'
+
+    s = KeyScheduler('test', daily_quota=3)
+    s.set_keys(['a', 'b', 'c'], {'a': ['u1'], 'b': ['u1', 'u2']})
+    print([s.get_key() for _ in range(6)])
+    s.report_rate_limit('a', 100)
+    s.report_failure('b', 5)
+    print([s.get_key() for _ in range(4)])
+    print(s.remove_key('b'))
+    print(s.stats())
+    print(s.top())
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# Общий реестр клиентов для всех LLM провайдеров.
+# Раньше каждый запрос создавал новый OpenAI/Groq/genai.Client со своим httpx пулом,
+# и каждый ход диалога платил за новое TLS соединение.
+# Теперь на каждый хост (и прокси) один httpx.Client с keep-alive и HTTP/2 (если установлен h2),
+# а клиенты SDK кешируются по (provider, api_key, base_url, proxy) и используют этот пул.
+
+
+import threading
+import time
+import traceback
+from typing import Dict, Tuple
+from urllib.parse import urlparse
+
+import httpx
+import requests
+from requests.adapters import HTTPAdapter
+
+import cfg
+import my_log
+
+
+try:
+    import h2  # noqa: F401 нужен httpx для http2
+    HTTP2 = True
+except ImportError:
+    HTTP2 = False
+
+
+# лимит соединений на один хост и сколько из них держать открытыми
+MAX_CONNECTIONS_PER_HOST = cfg.LLM_MAX_CONNECTIONS_PER_HOST if hasattr(cfg, 'LLM_MAX_CONNECTIONS_PER_HOST') else 50
+MAX_KEEPALIVE_PER_HOST = cfg.LLM_MAX_KEEPALIVE_PER_HOST if hasattr(cfg, 'LLM_MAX_KEEPALIVE_PER_HOST') else 20
+# через сколько секунд закрывать простаивающее соединение
+KEEPALIVE_EXPIRY = 60
+# через сколько секунд без использования удалять клиентов и пулы из реестра,
+# должно быть больше самого долгого запроса
+IDLE_TIMEOUT = 30 * 60
+CLEANUP_INTERVAL = 60
+
+# таймаут по умолчанию, у SDK он переопределяется при каждом запросе
+DEFAULT_TIMEOUT = 120
+
+LOCK = threading.Lock()
+# {(host, proxy): [httpx.Client, last_used]}
+HTTP_POOLS: Dict[Tuple[str, str], list] = {}
+# {(provider, api_key, base_url, proxy, extra): [client, last_used, pool_key]}
+CLIENTS: Dict[tuple, list] = {}
+# {proxy: [requests.Session, last_used]}
+SESSIONS: Dict[str, list] = {}
+LAST_CLEANUP = time.time()
+
+# метрики
+HITS = 0
+MISSES = 0
+
+# хосты по умолчанию, если base_url не указан
+DEFAULT_HOSTS = {
+    'openai': 'api.openai.com',
+    'groq': 'api.groq.com',
+    'cerebras': 'api.cerebras.ai',
+    'mistral': 'api.mistral.ai',
+    'gemini': 'generativelanguage.googleapis.com',
+}
+
+
+def _host(base_url: str) -> str:
+    if not base_url:
+        return ''
+    return urlparse(base_url).netloc or base_url
+
+
+def _cleanup(now: float):
+    '''Удалить давно не используемых клиентов и закрыть их пулы, вызывать под LOCK'''
+    global LAST_CLEANUP
+    LAST_CLEANUP = now
+    for key in [k for k, v in CLIENTS.items() if now - v[1] > IDLE_TIMEOUT]:
+        del CLIENTS[key]
+    used_pools = {v[2] for v in CLIENTS.values()}
+    for key in [k for k, v in HTTP_POOLS.items() if now - v[1] > IDLE_TIMEOUT and k not in used_pools]:
+        client, _ = HTTP_POOLS.pop(key)
+        try:
+            client.close()
+        except Exception as error:
+            my_log.log2(f'my_llm_clients:cleanup: {error}')
+    for key in [k for k, v in SESSIONS.items() if now - v[1] > IDLE_TIMEOUT]:
+        session, _ = SESSIONS.pop(key)
+        session.close()
+
+
+def _get_pool(host: str, proxy: str = None) -> Tuple[httpx.Client, tuple]:
+    '''httpx.Client с пулом соединений для хоста, вызывать под LOCK'''
+    key = (host, proxy or '')
+    now = time.time()
+    item = HTTP_POOLS.get(key)
+    if item is None:
+        limits = httpx.Limits(
+            max_connections=MAX_CONNECTIONS_PER_HOST,
+            max_keepalive_connections=MAX_KEEPALIVE_PER_HOST,
+            keepalive_expiry=KEEPALIVE_EXPIRY,
+        )
+        client = httpx.Client(
+            http2=HTTP2,
+            limits=limits,
+            proxy=proxy or None,
+            timeout=DEFAULT_TIMEOUT,
+            follow_redirects=True,
+        )
+        item = HTTP_POOLS[key] = [client, now]
+    item[1] = now
+    return item[0], key
+
+
+def get_http_client(base_url: str = '', proxy: str = None) -> httpx.Client:
+    '''Общий httpx.Client для хоста из base_url (и прокси), не закрывать'''
+    with LOCK:
+        return _get_pool(_host(base_url), proxy)[0]
+
+
+def _create_client(provider: str, api_key: str, base_url: str, http_client: httpx.Client, extra: dict):
+    if provider == 'openai':
+        import openai
+        return openai.OpenAI(api_key=api_key, base_url=base_url or None, http_client=http_client,
+                             timeout=DEFAULT_TIMEOUT, **extra)
+    elif provider == 'groq':
+        import groq
+        return groq.Groq(api_key=api_key, base_url=base_url or None, http_client=http_client,
+                         timeout=DEFAULT_TIMEOUT, **extra)
+    elif provider == 'cerebras':
+        from cerebras.cloud.sdk import Cerebras
+        return Cerebras(api_key=api_key, base_url=base_url or None, http_client=http_client,
+                        timeout=DEFAULT_TIMEOUT, **extra)
+    elif provider == 'mistral':
+        from mistralai import Mistral
+        return Mistral(api_key=api_key, server_url=base_url or None, client=http_client, **extra)
+    else:
+        raise ValueError(f'unknown provider {provider}')
+
+
+def get_client(provider: str, api_key: str, base_url: str = '', proxy: str = None, timeout: float = None, **extra):
+    '''
+    Клиент SDK провайдера из реестра.
+
+    Args:
+        provider: 'openai' (и все openai совместимые), 'groq', 'cerebras', 'mistral'
+        api_key: ключ
+        base_url: адрес API, '' - по умолчанию для провайдера
+        proxy: прокси для этого клиента
+        timeout: таймаут для запросов через возвращенного клиента (кроме mistral)
+        extra: остальные параметры конструктора, например default_headers
+
+    Returns:
+        Клиент SDK, его нельзя закрывать, у него общий пул соединений.
+    '''
+    global HITS, MISSES
+    key = (provider, api_key, base_url or '', proxy or '', tuple(sorted((k, repr(v)) for k, v in extra.items())))
+    now = time.time()
+    with LOCK:
+        if now - LAST_CLEANUP > CLEANUP_INTERVAL:
+            _cleanup(now)
+        item = CLIENTS.get(key)
+        if item is None:
+            MISSES += 1
+            http_client, pool_key = _get_pool(_host(base_url) or DEFAULT_HOSTS.get(provider, provider), proxy)
+            client = _create_client(provider, api_key, base_url, http_client, extra)
+            item = CLIENTS[key] = [client, now, pool_key]
+        else:
+            HITS += 1
+            HTTP_POOLS[item[2]][1] = now
+        item[1] = now
+        client = item[0]
+
+    if timeout and provider != 'mistral':
+        # копия клиента с другим таймаутом, пул соединений у них общий
+        return client.with_options(timeout=timeout)
+    return client
+
+
+def genai_client(api_key: str, timeout: float = None):
+    '''
+    genai.Client поверх общего пула соединений.
+    Сам клиент дешевый и создается каждый раз что бы задать таймаут, соединения переиспользуются.
+    timeout - секунды, None - без таймаута как у genai по умолчанию
+    '''
+    from google import genai
+    with LOCK:
+        http_client, _ = _get_pool(DEFAULT_HOSTS['gemini'])
+    http_options = {'httpx_client': http_client}
+    if timeout:
+        http_options['timeout'] = int(timeout * 1000)
+    return genai.Client(api_key=api_key, http_options=http_options)
+
+
+def get_session(proxy: str = None) -> requests.Session:
+    '''
+    Общая requests.Session с keep-alive для модулей которые ходят в API через requests.
+    proxy - если задан то для этой сессии.
+    '''
+    key = proxy or ''
+    now = time.time()
+    with LOCK:
+        item = SESSIONS.get(key)
+        if item is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=20, pool_maxsize=MAX_CONNECTIONS_PER_HOST)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if proxy:
+                session.proxies = {'http': proxy, 'https': proxy}
+            item = SESSIONS[key] = [session, now]
+        item[1] = now
+        return item[0]
+
+
+def close():
+    '''Закрыть все пулы, при выключении бота'''
+    with LOCK:
+        CLIENTS.clear()
+        for client, _ in HTTP_POOLS.values():
+            try:
+                client.close()
+            except Exception as error:
+                traceback_error = traceback.format_exc()
+                my_log.log2(f'my_llm_clients:close: {error}\n\n{traceback_error}')
+        HTTP_POOLS.clear()
+        for session, _ in SESSIONS.values():
+            session.close()
+        SESSIONS.clear()
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        return (f'clients: {len(CLIENTS)}, pools: {len(HTTP_POOLS)}, sessions: {len(SESSIONS)}, '
+                f'hits: {HITS}, misses: {MISSES}, http2: {HTTP2}')
+
+
+if __name__ == '__main__':
+    pass
+
+    c1 = get_client('openai', 'xxx', 'https://openrouter.ai/api/v1', timeout=10)
+    c2 = get_client('openai', 'xxx', 'https://openrouter.ai/api/v1', timeout=20)
+    print(c1._client is c2._client, c1.timeout, c2.timeout)
+    print(get_stats())
+    close()
@@ -7,17 +7,15 @@ import datetime
 import html
 import re
 import telebot
-import threading
 from collections import defaultdict
 from unidecode import unidecode
 
 import cfg
+import my_log_index
+import my_log_writer
 import utils
 
 
-lock = threading.Lock()
-
-
 if not os.path.exists('logs'):
     os.mkdir('logs')
 if not os.path.exists('logs2'):
@@ -37,38 +35,16 @@ def transliterate(text):
     return text
 
 
-def trancate_log_file(log_file_path: str):
+def write(log_file_path: str, text: str, chat_key: str = '') -> None:
     """
-    Truncates the log file at the given file path if it exceeds the maximum file size.
-
-    Parameters:
-        log_file_path (str): The path to the log file.
-
-    Returns:
-        None
-
-    This function checks if the log file exists and if its size exceeds the maximum file size.
-    If it does, it opens the file in read and write mode and truncates it by keeping only the
-    last half of the data. The function uses the os module to check the file path and the cfg
-    module to get the maximum file size if it is defined.
-
-    Note:
-        The function assumes that the log file is in UTF-8 encoding.
+    Дописывает text в лог logs/... и/или logs2/... в зависимости от LOG_MODE.
+    Запись происходит в фоне (my_log_writer), ротация по размеру тоже там.
+    chat_key - chat_id_full для логов чатов, по нему get_user_logs находит файлы в logs2/
     """
-    try:
-        if not os.path.exists(log_file_path):
-            return
-        fsize = os.path.getsize(log_file_path)
-        max_fsize = cfg.MAX_LOG_FILE_SIZE if hasattr(cfg, 'MAX_LOG_FILE_SIZE') else 20*1024*1024
-        if fsize > max_fsize:
-            with open(log_file_path, 'r+') as f:
-                f.seek(fsize - max_fsize // 2) # Переходим к середине от превышения размера
-                data = f.read() # Читаем оставшиеся данные
-                f.seek(0) # Переходим в начало файла
-                f.write(data) # Записываем последние данные
-                f.truncate(len(data)) # Обрезаем файл        
-    except Exception as unknown:
-        print(f'my_log:trancate_log_file: {unknown}')
+    if LOG_MODE in (1,):
+        my_log_writer.write(log_file_path, text)
+    if LOG_MODE in (0,1):
+        my_log_writer.write(log_file_path.replace('logs/', 'logs2/', 1), text, chat_key)
 
 
 def log2(text: str, fname: str = '') -> None:
@@ -87,8 +63,8 @@ def log2(text: str, fname: str = '') -> None:
     The function checks the value of the `LOG_MODE` variable and writes the text to the log
     file accordingly. If `LOG_MODE` is 1, the text is appended to the log file located at
     `logs/debug-{fname}.log`. If `LOG_MODE` is 0, the text is appended to both the log
-    files located at `logs/debug-{fname}.log` and `logs2/debug-{fname}.log`. After writing
-    the text, the function calls the `truncate_log_file` function to truncate the log file
+    files located at `logs/debug-{fname}.log` and `logs2/debug-{fname}.log`. The text is
+    queued and written by the background writer, which also rotates the log file
     if it exceeds the maximum size defined in the `cfg` module.
 
     Note:
@@ -97,18 +73,12 @@ def log2(text: str, fname: str = '') -> None:
     if LOG_MODE == -1:
         return
 
-    global lock
-    with lock:
-        time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
-        if fname:
-            log_file_path = f'logs/debug_{fname}.log'
-        else:
-            log_file_path = 'logs/debug.log'
-        if LOG_MODE in (1,):
-            open(log_file_path, 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
-        if LOG_MODE in (0,1):
-            open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8").write(f'{time_now}\n\n{text}\n{"=" * 80}\n')
-        trancate_log_file(log_file_path)
+    time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
+    if fname:
+        log_file_path = f'logs/debug_{fname}.log'
+    else:
+        log_file_path = 'logs/debug.log'
+    write(log_file_path, f'{time_now}\n\n{text}\n{"=" * 80}\n')
 
 
 def log3(chat_id_full: str, complete_time: float) -> None:
@@ -427,8 +397,6 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     if LOG_MODE == -1:
         return
 
-    global lock
-
     # original_message_text = message.text
     # message.text = restore_message_text(message.text, message.entities)
 
@@ -450,6 +418,8 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     elif message.is_topic_message:
         topic_id = message.message_thread_id
 
+    chat_key = f'[{message.chat.id}] [{topic_id or 0}]'
+
     log_file_path = logname
 
     if debug:
@@ -461,22 +431,13 @@ def log_echo(message: telebot.types.Message, reply_from_bot: str = '', debug: bo
     if reply_from_bot:
         reply_from_bot = utils.html_to_markdown(reply_from_bot)
 
-    with lock:
-        if not message.text:
-            message.text = ''
+    if not message.text:
+        message.text = ''
 
-        if LOG_MODE in (1,):
-            with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                if reply_from_bot:
-                    log_file.write(f"[{time_now}] [BOT]: {reply_from_bot}\n")
-                else:
-                    log_file.write(f"[{time_now}] [{user_name}]: {html.unescape(message.text) or html.unescape(message.caption or '')}\n")
-        if LOG_MODE in (0,1):
-            with open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8") as log_file:
-                if reply_from_bot:
-                    log_file.write(f"[{time_now}] [BOT]: {reply_from_bot}\n")
-                else:
-                    log_file.write(f"[{time_now}] [{user_name}]: {html.unescape(message.text) or html.unescape(message.caption or '')}\n")
+    if reply_from_bot:
+        write(log_file_path, f"[{time_now}] [BOT]: {reply_from_bot}\n", chat_key)
+    else:
+        write(log_file_path, f"[{time_now}] [{user_name}]: {html.unescape(message.text) or html.unescape(message.caption or '')}\n", chat_key)
 
 
 def log_media(message: telebot.types.Message) -> None:
@@ -487,7 +448,6 @@ def log_media(message: telebot.types.Message) -> None:
     if LOG_MODE == -1:
         return
 
-    global lock
     time_now = datetime.datetime.now().strftime('%d-%m-%Y %H:%M:%S')
     private_or_chat = 'private' if message.chat.type == 'private' else 'chat'
     chat_name = message.chat.username or message.chat.first_name or message.chat.title or ''
@@ -508,6 +468,8 @@ def log_media(message: telebot.types.Message) -> None:
     elif message.is_topic_message:
         topic_id = message.message_thread_id
 
+    chat_key = f'[{message.chat.id}] [{topic_id or 0}]'
+
     log_file_path = logname
 
     if topic_id:
@@ -519,52 +481,24 @@ def log_media(message: telebot.types.Message) -> None:
         file_duration = message.audio.duration
         file_title = message.audio.title
         file_mime_type = message.audio.mime_type
-        with lock:
-            if LOG_MODE in (1,):
-                with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
-    [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n")
-            if LOG_MODE in (0,1):
-                with open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
-    [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n")
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил аудио файл] [caption: {caption}] [title: {file_title}] \
+    [filename: {file_name}] [filesize: {file_size}] [duration: {file_duration}] [mime type: {file_mime_type}]\n", chat_key)
 
     if message.voice:
         file_size = message.voice.file_size
         file_duration = message.voice.duration
-        with lock:
-            if LOG_MODE in (1,):
-                with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
-    {file_size}] [duration: {file_duration}]\n")
-            if LOG_MODE in (0,1):
-                with open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
-    {file_size}] [duration: {file_duration}]\n")
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил голосовое сообщение] [filesize: \
+    {file_size}] [duration: {file_duration}]\n", chat_key)
 
     if message.document:
         file_name = message.document.file_name
         file_size = message.document.file_size
         file_mime_type = message.document.mime_type
-        with lock:
-            if LOG_MODE in (1,):
-                with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
-    [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n")
-            if LOG_MODE in (0,1):
-                with open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
-    [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n")
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил документ] [caption: {caption}] \
+    [filename: {file_name}] [filesize: {file_size}] [mime type: {file_mime_type}]\n", chat_key)
 
     if message.photo or message.video:
-        if LOG_MODE in (1,):
-            with lock:
-                with open(log_file_path, 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
-        if LOG_MODE in (0,1):
-            with lock:
-                with open(log_file_path.replace('logs/', 'logs2/', 1), 'a', encoding="utf-8") as log_file:
-                    log_file.write(f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n")
+        write(log_file_path, f"[{time_now}] [{user_name}]: [Отправил фото] [caption]: {caption}\n", chat_key)
 
 
 def purge(chat_id: int) -> bool:
@@ -573,11 +507,16 @@ def purge(chat_id: int) -> bool:
     :param chat_id: An integer representing the chat ID
     :return: A boolean indicating the success of the purge operation
     """
-    f1 = glob.glob('logs/*.log')
-    f2 = glob.glob('logs2/*.log')
+    f1 = glob.glob('logs/*.log*')
+    f2 = glob.glob('logs2/*.log*')
     f3 = f1 + f2
-    f4 = [x for x in f3 if x.endswith(f'[{chat_id}].log') or x.endswith(f'[{chat_id}].log.debug.log')]
+    # .1 - старая часть после ротации
+    f4 = [x for x in f3 if x.removesuffix('.1').endswith((f'[{chat_id}].log', f'[{chat_id}].log.debug.log'))]
     try:
+        # дописать очередь и закрыть файлы, иначе писатель создаст их заново
+        my_log_writer.flush()
+        my_log_writer.close_files(f4)
+        my_log_index.forget(f4)
         for f in f4:
             os.remove(f)
     except Exception as unknown:
@@ -586,100 +525,40 @@ def purge(chat_id: int) -> bool:
     return True
 
 
-def get_user_logs(user_id: str) -> str:
+def get_user_logs(user_id: str, max_bytes: int = 0, since: float = 0, until: float = 0) -> str:
     """
-    Searches for all log files associated with a user in the 'logs2' directory,
-    concatenates them in chronological order (by modification time), and returns
-    their combined text content.
-
-    Log file naming conventions:
-    - For user IDs ending in '[0]' (e.g., '[12345] [0]'), the function looks for
-      files matching the pattern `* [private] [main_id].log`.
-      Example: `[Kati134949] [private] [36857347865].log`
-    - For user IDs ending in '[non-zero]' (e.g., '[12345] [2355]'), the function
-      looks for files matching the pattern `* [chat] [main_id] [topic_id].log`.
-      Example: `[KeRlly] [chat] [36857347865] [2355].log`
+    Returns the combined text of all log files of a chat from the 'logs2' directory,
+    in chronological order.
+
+    Files are found through my_log_index (chat_id_full -> log files), without
+    scanning the directory. Only the requested part of the files is read.
 
     Args:
         user_id (str): The user identifier string in the format '[main_id] [topic_id]'.
-                       - main_id: The primary user or chat ID (digits).
-                       - topic_id: The topic ID (digits).
+        max_bytes (int): Return only the last max_bytes of the logs, 0 - everything.
+        since (float): Only records written at or after this unix time, 0 - no limit.
+        until (float): Only records written at or before this unix time, 0 - no limit.
 
     Returns:
-        str: The concatenated content of all found log files, sorted by modification
-             time (oldest first), separated by a 'Next file' delimiter. Returns an
-             empty string if the 'logs2' directory does not exist, the `user_id`
-             format is invalid, or no matching log files are found.
-
-    Note:
-        - Errors encountered during file reading (e.g., permissions) are logged
-          using the `log2` function and an error message is included in the
-          returned string for that specific file.
-        - Only files directly matching the naming convention for the given `user_id`
-          are considered.
-        - The function relies on file modification times (`os.path.getmtime`) for
-          sorting, assuming this reflects the chronological order of log creation.
+        str: The concatenated content of the found log files, separated by a
+             'Next file' delimiter. Returns an empty string if the `user_id`
+             format is invalid or no log files are found.
     """
-    logs_dir = 'logs2'
-    if not os.path.exists(logs_dir):
-        log2(f"get_user_logs: Log directory '{logs_dir}' does not exist.")
-        return ""
-
     id_match = re.match(r'^\[(-?\d+)\] \[(\d+)\]$', user_id.strip())
     if not id_match:
         log2(f"get_user_logs: Invalid user ID format: {user_id}. Expected format: '[12345] [0]'.")
         return ""
 
-    main_id = id_match.group(1)
-    topic_id = id_match.group(2)
-
-    user_files = []
-
-    # Составляем шаблон регулярного выражения
-    if topic_id == '0':
-        # Для ID, оканчивающихся на [0], ищем файлы вида * [private] [main_id].log
-        # re.escape гарантирует, что все спецсимволы будут обработаны как обычный текст
-        regex_pattern = re.compile(r".* \[private\] \[" + re.escape(main_id) + r"\]\.log")
-    else:
-        # Для ID, оканчивающихся на [не 0], ищем файлы вида * [chat] [main_id] [topic_id].log
-        regex_pattern = re.compile(r".* \[chat\] \[" + re.escape(main_id) + r"\] \[" + re.escape(topic_id) + r"\]\.log")
-
-    # Ищем файлы вручную, проверяя каждый с помощью регулярного выражения
-    for filename in os.listdir(logs_dir):
-        if regex_pattern.match(filename):
-            user_files.append(os.path.join(logs_dir, filename))
-
+    # в файлах должно быть все что уже залогировано
+    my_log_writer.flush()
 
-    if not user_files:
-        return ""
-
-    try:
-        user_files.sort(key=lambda f: os.path.getmtime(f))
-    except OSError as e:
-        log2(f"get_user_logs: Error sorting log files by modification time: {e}")
+    parts = my_log_index.read(f'[{id_match.group(1)}] [{id_match.group(2)}]', max_bytes, since, until)
+    if not parts:
         return ""
 
-    combined_log_content = ""
     separator = "\n" + "="*20 + " Next file " + "="*20 + "\n"
-
-    # Пропускаем первый сепаратор
-    first_file = True
-    for file_path in user_files:
-        try:
-            if not first_file:
-                combined_log_content += separator
-            else:
-                first_file = False
-
-            with open(file_path, 'r', encoding='utf-8', errors='replace') as f:
-                combined_log_content += f.read()
-        except Exception as e:
-            error_msg = f"get_user_logs: Error reading file '{file_path}': {e}"
-            log2(error_msg)
-            combined_log_content += f"\n[{error_msg}]\n"
-
-    if user_files:
-        combined_log_content += "\n" + "="*20 + " End of logs " + "="*20 + "\n"
+    combined_log_content = separator.join(text for _, text in parts)
+    combined_log_content += "\n" + "="*20 + " End of logs " + "="*20 + "\n"
 
     return combined_log_content
 
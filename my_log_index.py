@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# Индекс логов юзеров в logs2/ для my_log.get_user_logs и навыка query_user_logs.
+# Раньше поиск логов одного чата перебирал весь каталог logs2 (десятки тысяч файлов)
+# и читал найденные файлы целиком.
+# Теперь my_log_writer после каждой записи отмечает в sqlite к какому чату (chat_id_full)
+# относится файл, его размер и время первой и последней записи, ротацию в .1 тоже.
+# Чтение берет только нужный хвост (max_bytes) или интервал времени, через seek и mmap
+# с бинарным поиском по меткам времени строк, не читая файлы целиком.
+# Тут нельзя использовать my_log, ошибки печатаются в консоль.
+
+
+import datetime
+import mmap
+import os
+import re
+import sqlite3
+import threading
+import traceback
+from typing import List, Tuple
+
+import cfg
+
+
+DB_FILE = cfg.LOG_INDEX_DB if hasattr(cfg, 'LOG_INDEX_DB') else 'db/log_index.db'
+LOGS_DIR = 'logs2'
+
+LOCK = threading.Lock()
+CON = None
+
+# chat_id_full из имени файла лога (для первой индексации уже существующих логов)
+# [name] [private] [123].log, [name] [chat] [-100123] [55].log, ... [123].log.debug.log, + .1 после ротации
+NAME_RE = re.compile(r'\[(-?\d+)\](?: \[(\d+)\])?\.log(?:\.debug\.log|\.debug \[(\d+)\]\.log)?(?:\.1)?$')
+# метка времени в начале строки лога log_echo/log_media
+TS_RE = re.compile(rb'^\[(\d\d-\d\d-\d{4} \d\d:\d\d:\d\d)\] ', re.M)
+TS_FORMAT = '%d-%m-%Y %H:%M:%S'
+
+
+def _connect():
+    '''Подключение к базе индекса, при первом запуске индексирует существующие логи. Вызывать под LOCK'''
+    global CON
+    if CON is not None:
+        return CON
+    os.makedirs(os.path.dirname(DB_FILE) or '.', exist_ok=True)
+    con = sqlite3.connect(DB_FILE, check_same_thread=False)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute('''CREATE TABLE IF NOT EXISTS segments (
+                       path TEXT PRIMARY KEY,
+                       key TEXT NOT NULL,
+                       size INTEGER NOT NULL DEFAULT 0,
+                       first_ts REAL NOT NULL DEFAULT 0,
+                       last_ts REAL NOT NULL DEFAULT 0)''')
+    con.execute('CREATE INDEX IF NOT EXISTS idx_segments_key ON segments (key, first_ts)')
+    con.execute('CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)')
+    if not con.execute("SELECT 1 FROM meta WHERE name = 'bootstrapped'").fetchone():
+        _bootstrap(con)
+    CON = con
+    return CON
+
+
+def parse_key(file_name: str) -> str:
+    '''chat_id_full ('[123] [0]') по имени файла лога, '' если не похоже на лог чата'''
+    match = NAME_RE.search(file_name)
+    if not match:
+        return ''
+    return f'[{match.group(1)}] [{match.group(2) or match.group(3) or 0}]'
+
+
+def _bootstrap(con: sqlite3.Connection):
+    '''Один раз проиндексировать уже существующие логи'''
+    rows = []
+    if os.path.isdir(LOGS_DIR):
+        for entry in os.scandir(LOGS_DIR):
+            key = parse_key(entry.name)
+            if not key or not entry.is_file():
+                continue
+            stat = entry.stat()
+            # время первой записи неизвестно
+            rows.append((entry.path, key, stat.st_size, 0, stat.st_mtime))
+    with con:
+        con.executemany('INSERT OR REPLACE INTO segments (path, key, size, first_ts, last_ts) VALUES (?, ?, ?, ?, ?)', rows)
+        con.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('bootstrapped', ?)", (str(len(rows)),))
+
+
+def update(rows: List[Tuple[str, str, int, float]]):
+    '''
+    Отметить запись в файлы, вызывается писателем логов после каждой пачки.
+    rows - [(path, key, размер файла после записи, время записи)]
+    '''
+    if not rows:
+        return
+    try:
+        with LOCK:
+            con = _connect()
+            with con:
+                con.executemany('''INSERT INTO segments (path, key, size, first_ts, last_ts) VALUES (?, ?, ?, ?, ?)
+                                   ON CONFLICT(path) DO UPDATE SET size = excluded.size, last_ts = excluded.last_ts''',
+                                [(path, key, size, ts, ts) for path, key, size, ts in rows])
+    except Exception as error:
+        traceback_error = traceback.format_exc()
+        print(f'my_log_index:update: {error}\n\n{traceback_error}')
+
+
+def rotate(path: str, new_path: str):
+    '''Файл path переименован в new_path (старый new_path перезаписан)'''
+    try:
+        with LOCK:
+            con = _connect()
+            with con:
+                con.execute('DELETE FROM segments WHERE path = ?', (new_path,))
+                con.execute('UPDATE segments SET path = ? WHERE path = ?', (new_path, path))
+    except Exception as error:
+        print(f'my_log_index:rotate: {error}')
+
+
+def forget(paths: List[str]):
+    '''Убрать удаленные файлы из индекса'''
+    try:
+        with LOCK:
+            con = _connect()
+            with con:
+                con.executemany('DELETE FROM segments WHERE path = ?', [(x,) for x in paths])
+    except Exception as error:
+        print(f'my_log_index:forget: {error}')
+
+
+def get_segments(key: str) -> List[Tuple[str, int, float, float]]:
+    '''Файлы логов чата key (chat_id_full) от старых к новым, [(path, size, first_ts, last_ts)]'''
+    with LOCK:
+        con = _connect()
+        rows = con.execute('SELECT path, size, first_ts, last_ts FROM segments WHERE key = ?', (key,)).fetchall()
+    # .1 всегда старше текущего файла, остальное по времени
+    return sorted(rows, key=lambda x: (x[2] or x[3], not x[0].endswith('.1')))
+
+
+def _line_time(buf, pos: int) -> Tuple[float, int]:
+    '''(время, смещение) первой строки с меткой времени начиная с pos, (inf, len) если таких нет'''
+    match = TS_RE.search(buf, pos)
+    if not match:
+        return float('inf'), len(buf)
+    try:
+        ts = datetime.datetime.strptime(match.group(1).decode(), TS_FORMAT).timestamp()
+    except ValueError:
+        ts = 0.0
+    return ts, match.start()
+
+
+def _find_offset(buf, ts: float) -> int:
+    '''Смещение первой строки записанной не раньше ts, бинарный поиск'''
+    lo, hi = 0, len(buf)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _line_time(buf, mid)[0] < ts:
+            lo = mid + 1
+        else:
+            hi = mid
+    return _line_time(buf, lo)[1]
+
+
+def _read_segment(path: str, max_bytes: int, since: float, until: float) -> str:
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if not size:
+            return ''
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            start = _find_offset(buf, since) if since else 0
+            end = _find_offset(buf, until + 1) if until else size
+            if max_bytes and end - start > max_bytes:
+                start = end - max_bytes
+                # не начинать с середины строки
+                nl = buf.find(b'\n', start, end)
+                if nl != -1:
+                    start = nl + 1
+            return buf[start:end].decode('utf-8', errors='replace')
+
+
+def read(key: str, max_bytes: int = 0, since: float = 0, until: float = 0) -> List[Tuple[str, str]]:
+    '''
+    Прочитать логи чата.
+
+    Args:
+        key: chat_id_full, '[123] [0]'
+        max_bytes: только последние столько байт (по всем файлам вместе), 0 - все
+        since, until: только записи в этом интервале времени (unix time), 0 - без ограничения
+
+    Returns:
+        [(path, text)] от старых к новым
+    '''
+    result = []
+    budget = max_bytes
+    for path, size, first_ts, last_ts in reversed(get_segments(key)):
+        if since and last_ts and last_ts < since:
+            continue
+        if until and first_ts and first_ts > until:
+            continue
+        try:
+            text = _read_segment(path, budget, since, until)
+        except FileNotFoundError:
+            forget([path])
+            continue
+        except Exception as error:
+            text = f'\n[my_log_index:read: Error reading file \'{path}\': {error}]\n'
+        if not text:
+            continue
+        result.append((path, text))
+        if max_bytes:
+            budget -= len(text.encode('utf-8', errors='replace'))
+            if budget <= 0:
+                break
+    result.reverse()
+    return result
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    with LOCK:
+        con = _connect()
+        chats, files, size = con.execute('SELECT COUNT(DISTINCT key), COUNT(*), COALESCE(SUM(size), 0) FROM segments').fetchone()
+    return f'chats: {chats}, files: {files}, size: {size // 1024 // 1024} MB'
+
+
+if __name__ == '__main__':
+    pass
+
+    print(parse_key('[Kati134949] [private] [36857347865].log'))
+    print(parse_key('[KeRlly] [chat] [-1001234] [2355].log.1'))
+    print(get_stats())
+    for p, t in read('[36857347865] [0]', max_bytes=2000):
+        print(p, len(t))
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# Асинхронная запись логов для my_log.
+# Раньше каждая запись в лог брала общий lock, открывала файл, дописывала, закрывала
+# и проверяла размер, а при переполнении переписывала половину 20мб файла, и все это в потоке обработчика.
+# Теперь обработчик только кладет строку в очередь, один поток-писатель забирает сразу пачку,
+# группирует по файлам и пишет через закешированные открытые файлы (не больше MAX_OPEN_FILES),
+# а слишком большой файл переименовывается в <имя>.1 (старый .1 удаляется) и начинается заново.
+# Файлы логов чатов (с key) отмечаются в my_log_index.
+# Тут нельзя использовать my_log, ошибки печатаются в консоль.
+
+
+import atexit
+import collections
+import os
+import queue
+import threading
+import time
+import traceback
+from typing import Dict, List
+
+import cfg
+import my_log_index
+
+
+# максимальный размер файла лога, потом ротация
+MAX_LOG_FILE_SIZE = cfg.MAX_LOG_FILE_SIZE if hasattr(cfg, 'MAX_LOG_FILE_SIZE') else 20*1024*1024
+# сколько файлов держать открытыми, самые старые по использованию закрываются
+MAX_OPEN_FILES = cfg.LOG_MAX_OPEN_FILES if hasattr(cfg, 'LOG_MAX_OPEN_FILES') else 256
+# больше этого записей в очереди не держим, новые теряются (диск не успевает)
+MAX_QUEUE = cfg.LOG_MAX_QUEUE if hasattr(cfg, 'LOG_MAX_QUEUE') else 100000
+# сколько записей забирать из очереди за раз
+BATCH_SIZE = 1000
+
+# (path, text, key) или (None, threading.Event, '') - метка для flush()
+QUEUE = queue.Queue(maxsize=MAX_QUEUE)
+
+# открытые файлы, владеет поток-писатель, {path: file}
+FILES_LOCK = threading.Lock()
+FILES: 'collections.OrderedDict[str, object]' = collections.OrderedDict()
+
+WORKER_LOCK = threading.Lock()
+WORKER_STARTED = False
+STOPPED = False
+
+# метрики
+WRITTEN = 0
+BATCHES = 0
+DROPPED = 0
+ROTATED = 0
+
+
+def write(path: str, text: str, key: str = ''):
+    '''
+    Дописать text в файл path, в фоне.
+    key - chat_id_full если это лог чата, для my_log_index
+    '''
+    global DROPPED
+    if STOPPED:
+        # после shutdown пишем напрямую, поток-писатель уже остановлен
+        _write_batch({path: [text]}, {path: key} if key else {})
+        _close_all()
+        return
+    _start_worker()
+    try:
+        QUEUE.put_nowait((path, text, key))
+    except queue.Full:
+        DROPPED += 1
+
+
+def _get_file(path: str):
+    '''Открытый файл из кеша, вызывать под FILES_LOCK'''
+    f = FILES.get(path)
+    if f is not None:
+        FILES.move_to_end(path)
+        return f
+    while len(FILES) >= MAX_OPEN_FILES:
+        _, old = FILES.popitem(last=False)
+        old.close()
+    f = FILES[path] = open(path, 'ab')
+    return f
+
+
+def _rotate(path: str, key: str):
+    '''Переименовать переполненный файл в .1, вызывать под FILES_LOCK'''
+    global ROTATED
+    f = FILES.pop(path, None)
+    if f is not None:
+        f.close()
+    os.replace(path, path + '.1')
+    if key:
+        my_log_index.rotate(path, path + '.1')
+    ROTATED += 1
+
+
+def _write_batch(batch: Dict[str, List[str]], keys: Dict[str, str]):
+    global WRITTEN, BATCHES
+    now = time.time()
+    indexed = []
+    with FILES_LOCK:
+        for path, texts in batch.items():
+            try:
+                f = _get_file(path)
+                f.write(''.join(texts).encode('utf-8', errors='replace'))
+                f.flush()
+                WRITTEN += len(texts)
+                key = keys.get(path)
+                if key:
+                    indexed.append((path, key, f.tell(), now))
+                if f.tell() > MAX_LOG_FILE_SIZE:
+                    if key:
+                        my_log_index.update(indexed)
+                        indexed = []
+                    _rotate(path, key)
+            except Exception as error:
+                # например файл удалили (purge) или папки нет, начнем заново при следующей записи
+                bad = FILES.pop(path, None)
+                if bad is not None:
+                    try:
+                        bad.close()
+                    except Exception:
+                        pass
+                print(f'my_log_writer:write_batch: {error} {path}')
+        BATCHES += 1
+    my_log_index.update(indexed)
+
+
+def worker():
+    '''Поток-писатель'''
+    while True:
+        try:
+            items = [QUEUE.get()]
+            while len(items) < BATCH_SIZE:
+                try:
+                    items.append(QUEUE.get_nowait())
+                except queue.Empty:
+                    break
+
+            batch = {}
+            keys = {}
+            events = []
+            for path, text, key in items:
+                if path is None:
+                    events.append(text)
+                else:
+                    batch.setdefault(path, []).append(text)
+                    if key:
+                        keys[path] = key
+            if batch:
+                _write_batch(batch, keys)
+            for event in events:
+                event.set()
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            print(f'my_log_writer:worker: {error}\n\n{traceback_error}')
+            time.sleep(1)
+
+
+def _start_worker():
+    global WORKER_STARTED
+    if WORKER_STARTED:
+        return
+    with WORKER_LOCK:
+        if WORKER_STARTED:
+            return
+        WORKER_STARTED = True
+    threading.Thread(target=worker, name='my_log_writer', daemon=True).start()
+
+
+def flush(timeout: float = 10) -> bool:
+    '''Дождаться пока все что уже в очереди записано на диск'''
+    if not WORKER_STARTED or STOPPED:
+        return True
+    event = threading.Event()
+    try:
+        QUEUE.put((None, event, ''), timeout=timeout)
+    except queue.Full:
+        return False
+    return event.wait(timeout)
+
+
+def close_files(paths: List[str]):
+    '''Закрыть файлы перед их удалением'''
+    with FILES_LOCK:
+        for path in paths:
+            f = FILES.pop(path, None)
+            if f is not None:
+                f.close()
+
+
+def _close_all():
+    with FILES_LOCK:
+        for f in FILES.values():
+            try:
+                f.close()
+            except Exception as error:
+                print(f'my_log_writer:close_all: {error}')
+        FILES.clear()
+
+
+def shutdown(timeout: float = 10):
+    '''Дописать очередь и закрыть файлы, при выключении бота'''
+    global STOPPED
+    if STOPPED:
+        return
+    flush(timeout)
+    STOPPED = True
+    _close_all()
+
+
+atexit.register(shutdown)
+
+
+# открытые файлы родителя в процессе после fork, закрывать их нельзя (допишет буфер родителя еще раз)
+_FORKED_FILES = []
+
+
+def _after_fork_in_child():
+    '''В процессе созданном через fork (пул my_imgproc) потока-писателя нет, пишем сразу'''
+    global FILES_LOCK, FILES, STOPPED
+    _FORKED_FILES.extend(FILES.values())
+    FILES_LOCK = threading.Lock()
+    FILES = collections.OrderedDict()
+    STOPPED = True
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    return (f'queue: {QUEUE.qsize()}, open files: {len(FILES)}, written: {WRITTEN}, '
+            f'batches: {BATCHES}, rotated: {ROTATED}, dropped: {DROPPED}')
+
+
+if __name__ == '__main__':
+    pass
+
+    os.makedirs('logs2', exist_ok=True)
+    start = time.time()
+    for i in range(10000):
+        write('logs2/debug_my_log_writer_test.log', f'line {i}\n')
+    print(f'queued in {time.time() - start:.3f}s')
+    flush()
+    print(f'written in {time.time() - start:.3f}s', get_stats())
+    shutdown()
+    os.remove('logs2/debug_my_log_writer_test.log')
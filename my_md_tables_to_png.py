@@ -17,8 +17,8 @@ from typing import List, Optional
 import imgkit
 import markdown
 from PIL import Image
-from playwright.sync_api import sync_playwright
 
+import my_browser_pool
 import my_log
 
 
@@ -446,59 +446,35 @@ def html_to_image_bytes_playwright(
     Raises:
         Exception: In case of an error during conversion.
     '''
-    with LOCK:
-        # Inject CSS into the head if provided
-        if css_style:
-            style_block = f'<style>{css_style}</style>'
-            # Простая замена </head> может быть не совсем надежной для всех HTML-структур,
-            # но для большинства случаев она работает.
-            html = html.replace('</head>', f'{style_block}</head>', 1)
-
-        browser = None
-        try:
-            with sync_playwright() as p:
-                # Запускаем браузер в безголовом режиме (без графического интерфейса)
-                browser = p.chromium.launch(headless=True)
-                page = browser.new_page()
-                page.set_viewport_size({"width": width, "height": height})
-
-                # Устанавливаем содержимое страницы напрямую из HTML строки
-                page.set_content(html)
-
-                # Ждем, пока сетевая активность не утихнет. Это часто помогает
-                # убедиться, что все ресурсы загружены и начальный JS выполнен.
-                page.wait_for_load_state('networkidle')
-
-                # Добавляем явную задержку для выполнения JavaScript,
-                # особенно полезно для сложных вычислений или анимаций на Canvas.
-                if javascript_delay_ms > 0:
-                    page.wait_for_timeout(javascript_delay_ms)
-
-                # Делаем скриншот страницы в формате PNG
-                raw_png_bytes = page.screenshot(type='png')
-
-
-                return raw_png_bytes
-
-                # # Оптимизируем изображение с помощью Pillow, как в исходном коде
-                # # Убедитесь, что 'PIL' (Pillow) установлена: pip install Pillow
-                # # from PIL import Image # Если не импортирована выше
-                # with Image.open(io.BytesIO(raw_png_bytes)) as img:
-                #     output_buffer = io.BytesIO()
-                #     img.save(output_buffer, format='PNG')
-                #     return output_buffer.getvalue()
-
-        except Exception as e:
-            my_log.log_gemini(f"Error converting HTML to image: {e}")
-            raise Exception(f"Failed to convert HTML to image: {e}") from e
-        finally:
-            # Убеждаемся, что браузер всегда закрывается
-            if browser:
-                try:
-                    browser.close()
-                except Exception as e:
-                    if 'Event loop is closed! Is Playwright already stopped?' not in str(e):
-                        my_log.log_gemini(f"Error closing browser: {e}")
+    # Inject CSS into the head if provided
+    if css_style:
+        style_block = f'<style>{css_style}</style>'
+        # Простая замена </head> может быть не совсем надежной для всех HTML-структур,
+        # но для большинства случаев она работает.
+        html = html.replace('</head>', f'{style_block}</head>', 1)
+
+    def _render(page) -> bytes:
+        # Устанавливаем содержимое страницы напрямую из HTML строки
+        page.set_content(html)
+
+        # Ждем, пока сетевая активность не утихнет. Это часто помогает
+        # убедиться, что все ресурсы загружены и начальный JS выполнен.
+        page.wait_for_load_state('networkidle')
+
+        # Добавляем явную задержку для выполнения JavaScript,
+        # особенно полезно для сложных вычислений или анимаций на Canvas.
+        if javascript_delay_ms > 0:
+            page.wait_for_timeout(javascript_delay_ms)
+
+        # Делаем скриншот страницы в формате PNG
+        return page.screenshot(type='png')
+
+    try:
+        # браузер уже запущен в пуле my_browser_pool, тут только новая страница нужного размера
+        return my_browser_pool.run(_render, viewport={"width": width, "height": height})
+    except Exception as e:
+        my_log.log_gemini(f"Error converting HTML to image: {e}")
+        raise Exception(f"Failed to convert HTML to image: {e}") from e
 
 
 if __name__ == "__main__":
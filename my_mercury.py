@@ -7,10 +7,9 @@ import threading
 
 import traceback
 
-import openai
-
 import cfg
 import my_db
+import my_llm_clients
 import my_log
 # import my_skills_general
 import utils
@@ -126,7 +125,7 @@ def ai(
 
         try:
             key = get_next_key() if not key_ else key_
-            client = openai.OpenAI(api_key=key, base_url=BASE_URL)
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
 
             for _ in range(3):
 
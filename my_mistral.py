@@ -12,9 +12,7 @@ import tempfile
 import traceback
 from typing import Any, Callable, Dict, List, Optional, Union
 
-import openai
 import pysrt
-from mistralai import Mistral
 from mistralai.models import SDKError, TimestampGranularity
 from mistralai.extra.exceptions import MistralClientException
 from mistralai.types import UNSET
@@ -22,6 +20,8 @@ from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_hedge
+import my_llm_clients
 import my_log
 import my_cerebras_tools
 import my_split_audio
@@ -187,7 +187,7 @@ def ai(
 
         try:
             api_key = key_ if key_ else get_next_key()
-            client = openai.OpenAI(api_key=api_key, base_url=BASE_URL)
+            client = my_llm_clients.get_client('openai', api_key, BASE_URL)
 
             # Inner loop for multi-step tool calls
             MAX_TOOL_CALL_STEPS = 5  # Safety break to prevent infinite loops
@@ -353,10 +353,7 @@ def img2txt(
     for _ in range(3):
         try:
             key = get_next_key()
-            client = openai.OpenAI(
-                api_key = key,
-                base_url = BASE_URL,
-            )
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
             response = client.chat.completions.create(
                 model = model,
                 temperature=temperature,
@@ -410,7 +407,7 @@ def ocr_image(
         base64_image = base64.b64encode(image_data).decode('utf-8')
 
         api_key = get_next_key()
-        client = Mistral(api_key=api_key)
+        client = my_llm_clients.get_client('mistral', api_key)
 
         ocr_response = client.ocr.process(
             timeout_ms=timeout * 1000,
@@ -468,7 +465,7 @@ def ocr_pdf(
             f.write(image_data)
 
         api_key = get_next_key()
-        client = Mistral(api_key=api_key)
+        client = my_llm_clients.get_client('mistral', api_key)
 
         uploaded_pdf = client.files.upload(
             timeout_ms = 60 * 1000, # минуту на загрузку
@@ -578,7 +575,7 @@ def _call_mistral_api(
                 return None
 
             try:
-                client = Mistral(api_key=api_key)
+                client = my_llm_clients.get_client('mistral', api_key)
 
                 file_data = {
                     "content": audio_bytes,
@@ -827,6 +824,9 @@ def chat(
         lock = threading.Lock()
         LOCKS[chat_id] = lock
     with lock:
+        # запасной вариант в my_hedge.run, основной уже ответил
+        if my_hedge.is_cancelled():
+            return ''
         mem = my_db.blob_to_obj(my_db.get_user_property(chat_id, 'dialog_openrouter')) or []
         mem_ = mem[:]
 
@@ -843,7 +843,7 @@ def chat(
             tool_choice=tool_choice,
         )
 
-        if text and not do_not_update_history:
+        if text and not do_not_update_history and my_hedge.claim():
             mem += [{'role': 'user', 'content': query}]
             mem += [{'role': 'assistant', 'content': text}]
             mem = clear_mem(mem, chat_id)
@@ -1,6 +1,7 @@
 # pip install diskcache mistralai
 
 import functools
+import hashlib
 import re
 import time
 import threading
@@ -9,9 +10,10 @@ from pathlib import Path
 import diskcache
 import numpy as np
 import pandas as pd
-from mistralai import Mistral
 
+import cfg
 import my_db
+import my_llm_clients
 import my_log
 import my_mistral
 
@@ -19,9 +21,17 @@ import my_mistral
 EMBEDDING_MODEL_ID = "mistral-embed"
 
 
+# How many inputs and characters to send in one request
+BATCH_SIZE = 64
+BATCH_MAX_CHARS = 30000
+
+# Disk cache size, least recently used embeddings are evicted when it is full
+EMBEDDING_CACHE_SIZE = cfg.EMBEDDING_CACHE_SIZE if hasattr(cfg, 'EMBEDDING_CACHE_SIZE') else 2 * 1024**3
+
 cache_dir = Path("./db/cache-mistral-embedding")
 cache_dir.mkdir(exist_ok=True, parents=True)
-cache = diskcache.Cache(str(cache_dir))
+# Embeddings keyed by (model, hash of the input)
+cache = diskcache.Cache(str(cache_dir), size_limit=EMBEDDING_CACHE_SIZE, eviction_policy='least-recently-used')
 
 
 def rate_limiter(max_calls: int, time_window: int = 60):
@@ -65,17 +75,12 @@ def rate_limiter(max_calls: int, time_window: int = 60):
 limiter = rate_limiter(max_calls=200)
 
 
-@cache.memoize()
 @limiter
-def embed_fn(title: str, text: str) -> list[float]:
+def _embed_batch(inputs: list[str]) -> list[list[float]]:
     """
-    Computes an embedding for the text using the Mistral API,
+    Computes embeddings for a batch of inputs in one Mistral API request,
     with 5 retry attempts in case of network errors.
-    The title and text are concatenated as Mistral's API takes a single input string.
     """
-    # Combine title and text for Mistral's embedding model
-    combined_input = f"{title}\n\n{text}" if title else text
-
     retries = 5
     delay = 5  # Initial delay in seconds
     api_key = "" # Define api_key here to be accessible in the except block
@@ -87,31 +92,93 @@ def embed_fn(title: str, text: str) -> list[float]:
             if not api_key:
                 raise ValueError("No Mistral API key available.")
 
-            client = Mistral(api_key=api_key)
+            client = my_llm_clients.get_client('mistral', api_key)
 
             response = client.embeddings.create(
                 model=EMBEDDING_MODEL_ID,
-                inputs=[combined_input]
+                inputs=inputs
             )
-            # Return the embedding vector for the first input
-            return response.data[0].embedding
+            return [x.embedding for x in response.data]
 
         except Exception as e:
             if "Unauthorized" in str(e) and my_mistral:
                 my_mistral.remove_key(api_key)
-                my_log.log_mistral(f"my_mistral_embedding:embed_fn: Unauthorized key removed. Retrying immediately.")
+                my_log.log_mistral(f"my_mistral_embedding:embed_batch: Unauthorized key removed. Retrying immediately.")
                 continue # Try next key immediately
 
             if attempt < retries - 1:
-                my_log.log_mistral(f"my_mistral_embedding:embed_fn: API call failed (attempt {attempt + 1}/{retries}): {e}. Retrying in {delay}s...")
+                my_log.log_mistral(f"my_mistral_embedding:embed_batch: API call failed (attempt {attempt + 1}/{retries}): {e}. Retrying in {delay}s...")
                 time.sleep(delay)
                 delay *= 2  # Exponential backoff
             else:
-                my_log.log_mistral(f"my_mistral_embedding:embed_fn: API call failed after {retries} attempts. Giving up.")
+                my_log.log_mistral(f"my_mistral_embedding:embed_batch: API call failed after {retries} attempts. Giving up.")
                 raise e # Re-raise the last exception if all retries fail
     return [] # Should not be reached if an exception is raised, but here for safety
 
 
+def _batches(items: list) -> list:
+    """Splits [(key, text)] into batches of at most BATCH_SIZE items and BATCH_MAX_CHARS characters"""
+    batches = []
+    batch = []
+    size = 0
+    for key, text in items:
+        if batch and (len(batch) >= BATCH_SIZE or size + len(text) > BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append((key, text))
+        size += len(text)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def embed_inputs(inputs: list[str]) -> list[list[float]]:
+    """
+    Embeddings for many inputs: duplicates are embedded once, cached ones
+    are taken from the disk cache, the rest are sent in batches.
+    """
+    keys = [(EMBEDDING_MODEL_ID, hashlib.sha256(x.encode('utf-8', errors='replace')).hexdigest()) for x in inputs]
+    result = {}
+    missing = {}
+    for key, text in zip(keys, inputs):
+        if key in result or key in missing:
+            continue
+        value = cache.get(key)
+        if value is None:
+            missing[key] = text
+        else:
+            result[key] = value
+
+    for batch in _batches(list(missing.items())):
+        vectors = _embed_batch([text for _, text in batch])
+        for (key, _), vector in zip(batch, vectors):
+            cache.set(key, vector)
+            result[key] = vector
+
+    return [result[key] for key in keys]
+
+
+def _combine(title: str, text: str) -> str:
+    # Combine title and text for Mistral's embedding model
+    return f"{title}\n\n{text}" if title else text
+
+
+def embed_documents(title: str, texts: list[str]) -> list[list[float]]:
+    """
+    Embeddings for several chunks of one document, batched and cached.
+    """
+    return embed_inputs([_combine(title, text) for text in texts])
+
+
+def embed_fn(title: str, text: str) -> list[float]:
+    """
+    Computes an embedding for the text using the Mistral API, through the cache.
+    The title and text are concatenated as Mistral's API takes a single input string.
+    """
+    return embed_inputs([_combine(title, text)])[0]
+
+
 def split_text_into_chunks(text: str, max_length_chars: int = 3000, overlap_chars: int = 400) -> list[str]:
     """
     Splits text into meaningful chunks, ideal for language model processing.
@@ -188,7 +255,8 @@ def create_knowledge_base(raw_documents: list[dict]) -> pd.DataFrame:
         return pd.DataFrame(columns=["Title", "Text", "Embeddings"])
 
     df = pd.DataFrame(processed_documents_data)
-    df['Embeddings'] = df.apply(lambda row: embed_fn(row['Title'], row['Text']), axis=1)
+    # All chunks of all documents in as few requests as possible
+    df['Embeddings'] = embed_inputs([_combine(title, text) for title, text in zip(df['Title'], df['Text'])])
 
     return df
 
@@ -9,12 +9,12 @@ import threading
 import traceback
 from typing import Any, Callable, Dict, List, Optional, Tuple
 
-from openai import OpenAI
 from sqlitedict import SqliteDict
 
 import cfg
 import my_cerebras_tools
 import my_db
+import my_llm_clients
 import my_log
 import my_skills_storage
 import utils
@@ -157,7 +157,7 @@ def ai(
             return ''
 
         try:
-            client = OpenAI(api_key=api_key, base_url=BASE_URL)
+            client = my_llm_clients.get_client('openai', api_key, BASE_URL)
 
             sdk_params: Dict[str, Any] = {
                 'model': model,
@@ -513,10 +513,7 @@ def img2txt(
     for _ in range(3):
         try:
             key = get_next_key()
-            client = OpenAI(
-                api_key = key,
-                base_url = BASE_URL,
-                )
+            client = my_llm_clients.get_client('openai', key, BASE_URL)
             response = client.chat.completions.create(
                 messages = mem,
                 model = model,
@@ -591,10 +588,7 @@ def txt2img(
             num_interence_steps = 16
 
         key = get_next_key()
-        client = OpenAI(
-            base_url=BASE_URL,
-            api_key=key,
-        )
+        client = my_llm_clients.get_client('openai', key, BASE_URL)
 
         response = client.images.generate(
             model=model,
@@ -3,18 +3,18 @@
 import base64
 import json
 import re
-import requests
 import time
 import threading
 import traceback
 from typing import Any, Dict, List, Optional
 
 import langcodes
-from openai import OpenAI, APIStatusError
+from openai import APIStatusError
 from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_llm_clients
 import my_log
 import my_skills_storage
 import utils
@@ -357,7 +357,7 @@ def _execute_chat_completion(
             # --- API Call ---
             is_openai_compatible = not ('openrouter' in url or 'cerebras' in url)
             if is_openai_compatible:
-                client = OpenAI(api_key=key, base_url=url, default_headers=app_headers)
+                client = my_llm_clients.get_client('openai', key, url, default_headers=app_headers)
                 response = client.chat.completions.create(**current_params, timeout=timeout)
                 if response.usage:
                     in_t, out_t = PRICE.get(user_id, (0, 0))
@@ -368,7 +368,7 @@ def _execute_chat_completion(
                 post_url = url if url.endswith('/chat/completions') else url + '/chat/completions'
                 post_url = re.sub(r'(?<!:)//', '/', post_url)
                 request_headers = {"Authorization": f"Bearer {key}", **app_headers}
-                http_response = requests.post(
+                http_response = my_llm_clients.get_session().post(
                     url=post_url, headers=request_headers, json=current_params, timeout=timeout
                 )
 
@@ -856,10 +856,7 @@ def list_models(user_id: str = "") -> Optional[List[str]]:
         url = url[:-17]
 
     try:
-        client = OpenAI(
-            api_key=key,
-            base_url=url,
-        )
+        client = my_llm_clients.get_client('openai', key, url)
         model_list = client.models.list()
         result: List[str] = [x.id for x in model_list]  # Type hint for clarity
         return result
@@ -1003,10 +1000,7 @@ def txt2img(
 
     URL = my_db.get_user_property(chat_id, 'base_api_url') or BASE_URL
 
-    client = OpenAI(
-    api_key=key,
-    base_url=URL
-    )
+    client = my_llm_clients.get_client('openai', key, URL)
 
     params = {
         'model': model,
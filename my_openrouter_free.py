@@ -3,6 +3,7 @@
 import base64
 import binascii
 import json
+import os
 import random
 import requests
 import time
@@ -14,6 +15,8 @@ from sqlitedict import SqliteDict
 
 import cfg
 import my_db
+import my_key_scheduler
+import my_llm_clients
 import my_log
 import my_skills_storage
 import utils
@@ -47,11 +50,47 @@ CLOACKED_MODEL_FALLBACK = 'qwen/qwen3-235b-a22b:free'
 CLOACKED_MODEL_FALLBACK2 = 'deepseek/deepseek-chat-v3.1:free'
 CLOACKED_MODEL_FALLBACK3 = 'qwen/qwen3-235b-a22b:free'
 
-# хранилище временно замороженных ключей {key: unfreeze_timestamp}
-FROZEN_KEYS = SqliteDict('db/openrouter_frozen_keys.db', autocommit=True)
-FROZEN_KEYS_LOCK = threading.Lock()
-CURRENT_KEY_INDEX = 0
-KEY_INDEX_LOCK = threading.Lock()
+# планировщик ключей, заморозка после 429 хранится в нем (db/keys_openrouter_free.json)
+KEY_DAILY_QUOTA = cfg.OPEN_ROUTER_FREE_KEY_DAILY_QUOTA if hasattr(cfg, 'OPEN_ROUTER_FREE_KEY_DAILY_QUOTA') else 0
+KEYS = my_key_scheduler.get_scheduler('openrouter_free', KEY_DAILY_QUOTA)
+KEYS.set_keys(cfg.OPEN_ROUTER_FREE_KEYS if hasattr(cfg, 'OPEN_ROUTER_FREE_KEYS') else [])
+
+
+def _duration_str(duration_seconds: float) -> str:
+    """Human-readable duration like '1d 2h 3m'"""
+    days, rem = divmod(duration_seconds, 86400)
+    hours, rem = divmod(rem, 3600)
+    minutes, _ = divmod(rem, 60)
+
+    duration_parts = []
+    if days > 0:
+        duration_parts.append(f"{int(days)}d")
+    if hours > 0:
+        duration_parts.append(f"{int(hours)}h")
+    if minutes > 0:
+        duration_parts.append(f"{int(minutes)}m")
+
+    return " ".join(duration_parts) if duration_parts else f"{int(duration_seconds)}s"
+
+
+def import_frozen_keys() -> None:
+    """
+    One-time import of frozen keys from the old storage db/openrouter_frozen_keys.db into the key scheduler.
+    """
+    path = 'db/openrouter_frozen_keys.db'
+    if os.path.exists(KEYS.state_file) or not os.path.exists(path):
+        return
+    try:
+        with SqliteDict(path) as frozen_keys:
+            now = time.time()
+            for key, unfreeze_time in frozen_keys.items():
+                if unfreeze_time > now:
+                    KEYS.freeze(key, unfreeze_time - now)
+    except Exception as error:
+        my_log.log_openrouter_free(f'import_frozen_keys: {error}')
+
+
+import_frozen_keys()
 
 
 def freeze_key(key: str, duration_seconds: int = 86400) -> None:
@@ -62,28 +101,10 @@ def freeze_key(key: str, duration_seconds: int = 86400) -> None:
         key (str): The API key to freeze.
         duration_seconds (int): The duration in seconds for which the key will be frozen.
     """
-    with FROZEN_KEYS_LOCK:
-        unfreeze_time = time.time() + duration_seconds
-        FROZEN_KEYS[key] = unfreeze_time
-
-        # Create a human-readable duration string
-        days, rem = divmod(duration_seconds, 86400)
-        hours, rem = divmod(rem, 3600)
-        minutes, _ = divmod(rem, 60)
-
-        duration_parts = []
-        if days > 0:
-            duration_parts.append(f"{int(days)}d")
-        if hours > 0:
-            duration_parts.append(f"{int(hours)}h")
-        if minutes > 0:
-            duration_parts.append(f"{int(minutes)}m")
-
-        duration_str = " ".join(duration_parts) if duration_parts else f"{duration_seconds}s"
-
-        my_log.log_openrouter_free(
-            f'Key ...{key[-4:]} frozen for {duration_str} until {time.ctime(unfreeze_time)}'
-        )
+    KEYS.report_rate_limit(key, duration_seconds)
+    my_log.log_openrouter_free(
+        f'Key ...{key[-4:]} frozen for {_duration_str(duration_seconds)} until {time.ctime(time.time() + duration_seconds)}'
+    )
 
 
 def handle_rate_limit(key: str, response: Any) -> None:
@@ -127,65 +148,27 @@ def handle_rate_limit(key: str, response: Any) -> None:
 
 def get_available_key() -> Optional[str]:
     """
-    Retrieves the next available, non-frozen API key using a round-robin strategy
-    and cleans up expired frozen keys.
+    Retrieves the best available, non-frozen API key from the key scheduler.
 
     Returns:
         Optional[str]: An available API key, or None if no keys are available.
     """
-    global CURRENT_KEY_INDEX
-    with FROZEN_KEYS_LOCK:
-        # Clean up expired keys from the frozen list
-        current_time = time.time()
-        expired_keys = [key for key, unfreeze_time in FROZEN_KEYS.items() if current_time > unfreeze_time]
-        for key in expired_keys:
-            del FROZEN_KEYS[key]
-            my_log.log_openrouter_free(f'Key unfrozen: ...{key[-4:]}')
-
-        # Get the list of all keys and filter out the currently frozen ones
-        all_keys = cfg.OPEN_ROUTER_FREE_KEYS if hasattr(cfg, 'OPEN_ROUTER_FREE_KEYS') else []
-        frozen_keys_set = set(FROZEN_KEYS.keys())
-        available_keys = [key for key in all_keys if key not in frozen_keys_set]
-
-    if not available_keys:
-        # If no keys are available, check if any are frozen and report when the next one is free
-        if FROZEN_KEYS:
-            next_unfreeze_time = min(FROZEN_KEYS.values())
-            remaining_seconds = max(0, next_unfreeze_time - current_time)
-
-            # Human-readable duration
-            days, rem = divmod(remaining_seconds, 86400)
-            hours, rem = divmod(rem, 3600)
-            minutes, _ = divmod(rem, 60)
-
-            duration_parts = []
-            if days > 0:
-                duration_parts.append(f"{int(days)}d")
-            if hours > 0:
-                duration_parts.append(f"{int(hours)}h")
-            # Show minutes if it's the largest unit or there's a remainder
-            if minutes > 0 or not duration_parts:
-                duration_parts.append(f"{int(minutes)}m")
-
-            duration_str = " ".join(duration_parts) if duration_parts else "0m"
-
-            my_log.log_openrouter_free(
-                f'No available keys. Next unfreezes in ~{duration_str} at {time.ctime(next_unfreeze_time)}'
-            )
-        else:
-            # This case means no keys are defined in the config at all
-            my_log.log_openrouter_free('No available (non-frozen) API keys.')
-        return None
-
-    # Select the next key using round-robin logic in a thread-safe manner
-    with KEY_INDEX_LOCK:
-        # Ensure the index wraps around the current list of available keys
-        index = CURRENT_KEY_INDEX % len(available_keys)
-        key_to_return = available_keys[index]
-        # Move to the next index for the subsequent call
-        CURRENT_KEY_INDEX += 1
-
-    return key_to_return
+    key = KEYS.get_key(allow_cooldown=False)
+    if key:
+        return key
+
+    frozen = KEYS.get_frozen()
+    if frozen:
+        # If no keys are available, report when the next one is free
+        next_unfreeze_time = min(frozen.values())
+        remaining_seconds = max(0, next_unfreeze_time - time.time())
+        my_log.log_openrouter_free(
+            f'No available keys. Next unfreezes in ~{_duration_str(remaining_seconds)} at {time.ctime(next_unfreeze_time)}'
+        )
+    else:
+        # This case means no keys are defined in the config at all
+        my_log.log_openrouter_free('No available (non-frozen) API keys.')
+    return None
 
 
 def clear_mem(mem, user_id: str):
@@ -324,7 +307,8 @@ def ai(
                     payload['tool_choice'] = tool_choice or "auto"
 
                 # Make the API call
-                response = requests.post(
+                request_start = time.monotonic()
+                response = my_llm_clients.get_session().post(
                     url="https://openrouter.ai/api/v1/chat/completions",
                     headers={
                         "Authorization": f"Bearer {key}",
@@ -345,6 +329,7 @@ def ai(
                     return '' # No retry for client errors
                 elif response.status_code >= 500:
                     my_log.log_openrouter_free(f'ai: Server error {response.status_code} on attempt {attempt + 1}. Retrying...')
+                    KEYS.report_failure(key)
                     time.sleep(5)
                     # Break inner loop and retry with a new key in the outer loop
                     break
@@ -353,6 +338,7 @@ def ai(
                     break
 
                 # --- Process successful response ---
+                KEYS.report_success(key, time.monotonic() - request_start)
                 response_json = response.json()
                 response_message = response_json['choices'][0]['message']
                 tool_calls = response_message.get('tool_calls')
@@ -395,6 +381,7 @@ def ai(
 
         except requests.exceptions.RequestException as e:
             my_log.log_openrouter_free(f'ai: Request failed on attempt {attempt + 1}: {e}')
+            KEYS.report_failure(key)
             if attempt < 2:
                 time.sleep(2)
 
@@ -723,7 +710,7 @@ def img2txt(
         if reasoning:
             payload['reasoning'] = reasoning
 
-        response = requests.post(
+        response = my_llm_clients.get_session().post(
             url="https://openrouter.ai/api/v1/chat/completions",
             headers={
                 "Authorization": f"Bearer {random.choice(cfg.OPEN_ROUTER_FREE_KEYS)}",
@@ -913,7 +900,7 @@ def _send_image_request(
             return None
 
         try:
-            response = requests.post(
+            response = my_llm_clients.get_session().post(
                 url="https://openrouter.ai/api/v1/chat/completions",
                 headers={
                     "Authorization": f"Bearer {key}",
@@ -4,18 +4,14 @@
 
 import time
 import traceback
-import threading
 import urllib.parse
 
 import cachetools.func
-from playwright.sync_api import sync_playwright
 
+import my_browser_pool
 import my_log
 
 
-LOCK = threading.Lock()
-
-
 def is_local_url(url: str) -> bool:
     try:
         parsed_url = urllib.parse.urlparse(url)
@@ -48,43 +44,35 @@ def gettext(url: str, timeout: int = 30) -> str:
         my_log.log_playwright(f'Blocked access to initial local URL: {url}')
         return "" # Блокируем сразу
 
-    global LOCK
-    with LOCK:
-        with sync_playwright() as p:
-            all_text = ''
-            try:
-                # Запускаем браузер в безголовом режиме
-                browser = p.chromium.launch(headless=True)
-                page = browser.new_page()
-
-
-                def handle_route(route):
-                    request_url = route.request.url
-                    if is_local_url(request_url):
-                        my_log.log_playwright(f'Blocked internal access to local URL: {request_url}')
-                        route.abort() # Блокируем этот запрос
-                    else:
-                        route.continue_() # Разрешаем запрос
-
-                # Перехватываем все запросы (**/*) и применяем нашу логику
-                page.route('**/*', handle_route)
-
-
-                page.goto(url)
-
-                # Ждем немного, чтобы страница загрузилась
-                start_time = time.time()
-                page.wait_for_load_state("networkidle", timeout=timeout * 1000)
-                timeout -= time.time() - start_time
-
-                # Пытаемся получить весь текст из тела страницы
-                all_text = page.inner_text('body', timeout=timeout * 1000)
-                page.close()
-            except Exception as error:
-                traceback_error = traceback.format_exc()
-                my_log.log_playwright(f'{error}\n{url} {timeout}\n{traceback_error}')
-            finally:
-                browser.close()
+    def _gettext(page) -> str:
+        def handle_route(route):
+            request_url = route.request.url
+            if is_local_url(request_url):
+                my_log.log_playwright(f'Blocked internal access to local URL: {request_url}')
+                route.abort() # Блокируем этот запрос
+            else:
+                route.continue_() # Разрешаем запрос
+
+        # Перехватываем все запросы (**/*) и применяем нашу логику
+        page.route('**/*', handle_route)
+
+        page.goto(url)
+
+        # Ждем немного, чтобы страница загрузилась
+        start_time = time.time()
+        page.wait_for_load_state("networkidle", timeout=timeout * 1000)
+        remaining = max(1, timeout - (time.time() - start_time))
+
+        # Пытаемся получить весь текст из тела страницы
+        return page.inner_text('body', timeout=remaining * 1000)
+
+    all_text = ''
+    try:
+        # браузер уже запущен в пуле, тут только новая страница
+        all_text = my_browser_pool.run(_gettext, timeout=timeout + 10)
+    except Exception as error:
+        traceback_error = traceback.format_exc()
+        my_log.log_playwright(f'{error}\n{url} {timeout}\n{traceback_error}')
 
     return all_text
 
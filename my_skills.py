@@ -29,7 +29,6 @@ from kerykeion.charts.charts_utils import convert_latitude_coordinate_to_string,
 from kerykeion.utilities import get_houses_list
 from datetime import datetime
 from PIL import Image
-from playwright.sync_api import sync_playwright
 from simpleeval import simple_eval
 from typing import Callable, List, Optional, Tuple, Union
 
@@ -38,13 +37,16 @@ from typing import Callable, List, Optional, Tuple, Union
 #from random import betavariate, choice, choices, expovariate, gammavariate, gauss, getrandbits, getstate, lognormvariate, normalvariate, paretovariate, randbytes, randint, randrange, sample, seed, setstate, shuffle, triangular, uniform, vonmisesvariate, weibullvariate
 
 import cfg
+import my_browser_pool
 import my_cohere
 import my_db
+import my_doc_index
 import my_google
 import my_gemini3
 import my_gemini_general
 import my_gemini_google
 import my_groq
+import my_hedge
 import my_log
 import my_md_tables_to_png
 import my_mistral
@@ -57,7 +59,6 @@ import utils
 
 
 ANIMATION_LOCK = threading.Lock()
-RENDERING_LOCK = threading.Lock()
 
 
 MAX_REQUEST = 25000
@@ -415,6 +416,11 @@ def query_user_file(query: str, user_id: str) -> str:
     else:
         saved_file = ''
 
+    # для большого файла только близкие к вопросу фрагменты, если индекс уже готов
+    passages = my_doc_index.query(user_id, saved_file_name, saved_file, query) if saved_file else ''
+    if passages:
+        saved_file = passages
+
     q = f'''Answer the user`s query using saved text and your own mind, answer plain text with fancy markdown formatting, do not use code block for answer.
 
 User query: {query}
@@ -427,15 +433,13 @@ Saved text: {saved_file}
     temperature = my_db.get_user_property(user_id, 'temperature') or 1
     role = my_db.get_user_property(user_id, 'role') or ''
 
-    result = my_gemini3.chat(q[:my_gemini_general.MAX_SUM_REQUEST], temperature=temperature, model = cfg.gemini_flash_light_model, system=role, do_not_update_history=True, empty_memory=True, chat_id=user_id)
-    if not result:
-        result = my_gemini3.chat(q[:my_gemini_general.MAX_SUM_REQUEST], temperature=temperature, model = cfg.gemini_flash_light_model_fallback, system=role, do_not_update_history=True, empty_memory=True, chat_id=user_id)
-    if not result:
-        result = my_cohere.ai(q[:my_cohere.MAX_SUM_REQUEST], system=role)
-    if not result:
-        result = my_mistral.ai(q[:my_mistral.MAX_SUM_REQUEST], system=role)
-    if not result:
-        result = my_groq.ai(q[:my_groq.MAX_SUM_REQUEST], temperature=temperature, max_tokens_ = 4000, system=role)
+    result, _ = my_hedge.run([
+        (cfg.gemini_flash_light_model, lambda: my_gemini3.chat(q[:my_gemini_general.MAX_SUM_REQUEST], temperature=temperature, model = cfg.gemini_flash_light_model, system=role, do_not_update_history=True, empty_memory=True, chat_id=user_id)),
+        (cfg.gemini_flash_light_model_fallback, lambda: my_gemini3.chat(q[:my_gemini_general.MAX_SUM_REQUEST], temperature=temperature, model = cfg.gemini_flash_light_model_fallback, system=role, do_not_update_history=True, empty_memory=True, chat_id=user_id)),
+        ('cohere', lambda: my_cohere.ai(q[:my_cohere.MAX_SUM_REQUEST], system=role)),
+        ('mistral', lambda: my_mistral.ai(q[:my_mistral.MAX_SUM_REQUEST], system=role)),
+        ('groq', lambda: my_groq.ai(q[:my_groq.MAX_SUM_REQUEST], temperature=temperature, max_tokens_ = 4000, system=role)),
+    ])
 
     if result:
         my_log.log_gemini_skills_query_file(result)
@@ -466,7 +470,9 @@ def query_user_logs(query: str, user_id: str) -> str:
 
         my_log.log_gemini_skills_query_logs(f'/query_user_log "{query}" "{user_id}"')
 
-        logs = my_log.get_user_logs(user_id)
+        # больше чем влезет в запрос все равно будет обрезано, читаем только хвост
+        # (лимит в символах, в utf-8 символ до 4 байт)
+        logs = my_log.get_user_logs(user_id, max_bytes=my_gemini_general.MAX_SUM_REQUEST * 4)
 
         q = f'''Answer the user`s query using saved text(chat log) and your own mind, answer plain text with fancy markdown formatting, do not use code block for answer.
 
@@ -478,15 +484,13 @@ Saved text: {logs}
         temperature = my_db.get_user_property(user_id, 'temperature') or 1
         role = my_db.get_user_property(user_id, 'role') or ''
 
-        result = my_gemini3.chat(q[-my_gemini_general.MAX_SUM_REQUEST:], temperature=temperature, model = cfg.gemini25_flash_model, system=role)
-        if not result:
-            result = my_gemini3.chat(q[-my_gemini_general.MAX_SUM_REQUEST:], temperature=temperature, model = cfg.gemini_flash_model, system=role)
-        if not result:
-            result = my_cohere.ai(q[-my_cohere.MAX_SUM_REQUEST:], system=role)
-        if not result:
-            result = my_mistral.ai(q[-my_mistral.MAX_SUM_REQUEST:], system=role)
-        if not result:
-            result = my_groq.ai(q[-my_groq.MAX_SUM_REQUEST:], temperature=temperature, max_tokens_ = 4000, system=role)
+        result, _ = my_hedge.run([
+            (cfg.gemini25_flash_model, lambda: my_gemini3.chat(q[-my_gemini_general.MAX_SUM_REQUEST:], temperature=temperature, model = cfg.gemini25_flash_model, system=role)),
+            (cfg.gemini_flash_model, lambda: my_gemini3.chat(q[-my_gemini_general.MAX_SUM_REQUEST:], temperature=temperature, model = cfg.gemini_flash_model, system=role)),
+            ('cohere', lambda: my_cohere.ai(q[-my_cohere.MAX_SUM_REQUEST:], system=role)),
+            ('mistral', lambda: my_mistral.ai(q[-my_mistral.MAX_SUM_REQUEST:], system=role)),
+            ('groq', lambda: my_groq.ai(q[-my_groq.MAX_SUM_REQUEST:], temperature=temperature, max_tokens_ = 4000, system=role)),
+        ])
 
         if result:
             my_log.log_gemini_skills_query_logs(result)
@@ -546,17 +550,14 @@ def render_html_to_mp4_bytes(
         frame_times: List[float] = []
         stopper = _HashStopper(10)
 
-        start = time.time()
         base_interval = max(1.0 / max(1, min(fps, 30)), 0.02)
         interval = base_interval
-        last_t = start
+        start = last_t = time.time()
 
-        with sync_playwright() as p:
-            browser = p.chromium.launch(
-                headless=True,
-                args=['--disable-dev-shm-usage', '--disable-extensions']
-            )
-            page = browser.new_page(viewport={'width': viewport_width, 'height': viewport_height})
+        def _record(page):
+            nonlocal start, last_t, interval
+            # время в очереди пула не должно съедать запись
+            start = last_t = time.time()
 
             if cut_external_assets:
                 page.route('/**/*', lambda route: route.abort() if route.request.resource_type in ('image', 'font') else route.continue_())
@@ -613,6 +614,8 @@ def render_html_to_mp4_bytes(
             last_t = time.time()
 
             while True:
+                # вызывающий уже не ждет (таймаут), освобождаем браузер
+                my_browser_pool.check_deadline()
                 now = time.time()
                 if now - start >= duration_seconds:
                     break
@@ -645,7 +648,9 @@ def render_html_to_mp4_bytes(
                 if len(frames) > 12 and stopper.push(shot):
                     break
 
-            browser.close()
+        # браузер уже запущен в пуле my_browser_pool, тут только новая страница
+        my_browser_pool.run(_record, timeout=duration_seconds + 60,
+                            viewport={'width': viewport_width, 'height': viewport_height})
 
         if not frames:
             return None
@@ -835,46 +840,45 @@ def save_html_to_image(filename: str, html: str, viewport_width: int, viewport_h
         str: 'OK' or 'FAILED'
     """
     html = utils.html.unescape(html)
-    with RENDERING_LOCK:
-        try:
-            my_log.log_gemini_skills_html(f'"{filename} {viewport_width}x{viewport_height}"\n\n"{html}"')
-
-            chat_id = my_skills_general.restore_id(chat_id)
-            if chat_id == '[unknown]':
-                return "FAIL, unknown chat id"
+    try:
+        my_log.log_gemini_skills_html(f'"{filename} {viewport_width}x{viewport_height}"\n\n"{html}"')
 
-            # Ensure filename has .png extension and is safe
-            if not filename.lower().endswith('.png'):
-                filename += '.png'
-            filename = utils.safe_fname(filename)
+        chat_id = my_skills_general.restore_id(chat_id)
+        if chat_id == '[unknown]':
+            return "FAIL, unknown chat id"
 
-            # save html to png file
-            try:
-                png_bytes = my_md_tables_to_png.html_to_image_bytes_playwright(html, width=viewport_width, height=viewport_height)
-            except Exception as e:
-                msg = f'FAILED: {str(e)}'
-                my_log.log_gemini_skills_html(msg)
-                return msg
+        # Ensure filename has .png extension and is safe
+        if not filename.lower().endswith('.png'):
+            filename += '.png'
+        filename = utils.safe_fname(filename)
 
-            if png_bytes and isinstance(png_bytes, bytes):
-                item = {
-                    'type': 'image/png file',
-                    'filename': filename,
-                    'data': png_bytes,
-                }
-                with my_skills_storage.STORAGE_LOCK:
-                    if chat_id in my_skills_storage.STORAGE:
-                        if item not in my_skills_storage.STORAGE[chat_id]:
-                            my_skills_storage.STORAGE[chat_id].append(item)
-                    else:
-                        my_skills_storage.STORAGE[chat_id] = [item,]
-                return "OK"
+        # save html to png file
+        try:
+            png_bytes = my_md_tables_to_png.html_to_image_bytes_playwright(html, width=viewport_width, height=viewport_height)
         except Exception as e:
-            traceback_error = traceback.format_exc()
-            my_log.log_gemini_skills_html(f'save_html_to_image: Unexpected error: {e}\n\n{traceback_error}\n\n{html}\n\n{filename} {viewport_width}x{viewport_height}\n\n{chat_id}')
-            return f"FAIL: An unexpected error occurred: {e}"
+            msg = f'FAILED: {str(e)}'
+            my_log.log_gemini_skills_html(msg)
+            return msg
 
-        return 'FAILED'
+        if png_bytes and isinstance(png_bytes, bytes):
+            item = {
+                'type': 'image/png file',
+                'filename': filename,
+                'data': png_bytes,
+            }
+            with my_skills_storage.STORAGE_LOCK:
+                if chat_id in my_skills_storage.STORAGE:
+                    if item not in my_skills_storage.STORAGE[chat_id]:
+                        my_skills_storage.STORAGE[chat_id].append(item)
+                else:
+                    my_skills_storage.STORAGE[chat_id] = [item,]
+            return "OK"
+    except Exception as e:
+        traceback_error = traceback.format_exc()
+        my_log.log_gemini_skills_html(f'save_html_to_image: Unexpected error: {e}\n\n{traceback_error}\n\n{html}\n\n{filename} {viewport_width}x{viewport_height}\n\n{chat_id}')
+        return f"FAIL: An unexpected error occurred: {e}"
+
+    return 'FAILED'
 
 
 @utils.log_if_slow(30)
@@ -4,7 +4,6 @@
 import datetime
 import io
 import matplotlib
-import time
 from typing import List, Tuple, Dict, Optional
 
 matplotlib.use('Agg') #  Отключаем вывод графиков на экран
@@ -93,36 +92,15 @@ def get_model_usage_for_days(num_days: int) -> List[Tuple[str, Dict[str, int]]]:
     """
 
     end_date = datetime.date.today() - datetime.timedelta(days=1)
+    start_date = end_date - datetime.timedelta(days=num_days - 1)
     usage_data: List[Tuple[str, Dict[str, int]]] = []
 
+    # одним запросом из сводной таблицы stat_model_day
+    usage_by_day = my_db.get_model_usage_by_days(start_date.strftime("%Y-%m-%d"), end_date.strftime("%Y-%m-%d"))
+
     for i in range(num_days - 1, -1, -1):
-        current_date = end_date - datetime.timedelta(days=i)
-        date_str = current_date.strftime("%Y-%m-%d")
-        start_timestamp = time.mktime(current_date.timetuple())
-        end_timestamp = start_timestamp + 24 * 60 * 60
-
-        model_usage: Dict[str, int] = {} # Initialize model_usage here
-
-        with my_db.LOCK:
-            try:
-                # Existing model usage query (msg_counter table)
-                my_db.CUR.execute('''
-                    SELECT model_used, COUNT(*) FROM msg_counter
-                    WHERE access_time >= ? AND access_time < ?
-                    GROUP BY model_used
-                ''', (start_timestamp, end_timestamp))
-                results = my_db.CUR.fetchall()
-
-                for row in results:
-                    model = row[0]
-                    usage_count = row[1]
-                    model_usage[model] = usage_count
-
-                usage_data.append((date_str, model_usage))
-
-            except Exception as error:
-                my_log.log2(f'my_db:get_model_usage_for_days {error}')
-                return []
+        date_str = (end_date - datetime.timedelta(days=i)).strftime("%Y-%m-%d")
+        usage_data.append((date_str, usage_by_day.get(date_str, {})))
 
     return usage_data
 
@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+# Пакетный перевод строк интерфейса на много языков.
+# Много строк в одном запросе (JSON массив туда и обратно), языки переводятся параллельно,
+# у каждого провайдера свой лимит одновременных запросов и пауза между ними.
+# Результат пишется в базу одной транзакцией через my_db.update_translations.
+
+
+import concurrent.futures
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+import my_cerebras
+import my_db
+import my_gemini3
+import my_groq
+import my_log
+import my_trans_cache
+
+
+# сколько строк и символов в одном запросе
+BATCH_SIZE = 40
+BATCH_MAX_CHARS = 6000
+# сколько языков переводить одновременно
+MAX_PARALLEL_LANGS = 6
+
+
+class ProviderLimiter:
+    '''Не больше max_concurrent запросов одновременно и не чаще чем раз в min_interval секунд'''
+    def __init__(self, max_concurrent: int, min_interval: float):
+        self.semaphore = threading.Semaphore(max_concurrent)
+        self.min_interval = min_interval
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def __enter__(self):
+        self.semaphore.acquire()
+        with self.lock:
+            now = time.time()
+            wait = self.next_time - now
+            self.next_time = max(now, self.next_time) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.semaphore.release()
+
+
+# провайдеры по порядку, то что не перевел первый пробует следующий
+# (name, translate_batch(items, to_lang) -> list, limiter)
+PROVIDERS: List[Tuple[str, Callable, ProviderLimiter]] = [
+    ('gemini', my_gemini3.translate_batch, ProviderLimiter(4, 1)),
+    ('groq', my_groq.translate_batch, ProviderLimiter(2, 2)),
+    ('cerebras', my_cerebras.translate_batch, ProviderLimiter(2, 2)),
+]
+
+
+def split_batches(items: List[Tuple[str, str]]) -> List[List[Tuple[str, str]]]:
+    '''Разбить (text, help) на пачки не больше BATCH_SIZE строк и BATCH_MAX_CHARS символов'''
+    batches = []
+    batch = []
+    size = 0
+    for item in items:
+        item_size = len(item[0]) + len(item[1] or '')
+        if batch and (len(batch) >= BATCH_SIZE or size + item_size > BATCH_MAX_CHARS):
+            batches.append(batch)
+            batch = []
+            size = 0
+        batch.append(item)
+        size += item_size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def translate_batch(items: List[Tuple[str, str]], lang: str) -> List[str]:
+    '''Перевести пачку, непереведенное одним провайдером отдается следующему'''
+    result = [''] * len(items)
+    todo = list(range(len(items)))
+    for name, func, limiter in PROVIDERS:
+        if not todo:
+            break
+        try:
+            with limiter:
+                translated = func([items[i] for i in todo], lang)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log_translate(f'my_trans_batch:translate_batch: {name} {lang} {error}\n\n{traceback_error}')
+            continue
+        left = []
+        for i, t in zip(todo, translated):
+            if t:
+                result[i] = t
+            else:
+                left.append(i)
+        todo = left
+    return result
+
+
+def translate_lang(items: List[Tuple[str, str]], lang: str) -> List[Tuple[str, str, str, str]]:
+    '''Перевести все (text, help) на язык lang, вернуть строки для my_db.update_translations'''
+    rows = []
+    for batch in split_batches(items):
+        translated = translate_batch(batch, lang)
+        for (text, help), t in zip(batch, translated):
+            if t:
+                rows.append((text, lang, help, t))
+                my_log.log_translate(f'{lang}\n\n{text}\n\n{t}')
+            else:
+                my_log.log_translate(f'Failed to translate: {text} to {lang}')
+    return rows
+
+
+def translate_missing(originals: List[Tuple[str, str]], langs: List[str]) -> Dict[str, int]:
+    '''
+    Перевести на все языки langs строки (original, help) у которых еще нет перевода.
+
+    Returns:
+        {lang: сколько строк переведено}
+    '''
+    jobs = {}
+    for lang in langs:
+        cached = my_trans_cache.CACHE.get(lang, {})
+        missing = [(text, help) for text, help in originals if (text, help) not in cached]
+        if missing:
+            jobs[lang] = missing
+
+    rows = []
+    stats = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_PARALLEL_LANGS) as executor:
+        futures = {executor.submit(translate_lang, items, lang): lang for lang, items in jobs.items()}
+        for future in concurrent.futures.as_completed(futures):
+            lang = futures[future]
+            try:
+                lang_rows = future.result()
+            except Exception as error:
+                traceback_error = traceback.format_exc()
+                my_log.log2(f'my_trans_batch:translate_missing: {lang} {error}\n\n{traceback_error}')
+                continue
+            rows.extend(lang_rows)
+            stats[lang] = len(lang_rows)
+
+    if rows:
+        my_db.update_translations(rows)
+        my_trans_cache.remember(rows)
+
+    return stats
+
+
+if __name__ == '__main__':
+    pass
+    my_db.init(backup=False)
+    my_trans_cache.load()
+    print(translate_batch([('Hello', ''), ('Settings', 'its a gui button')], 'de'))
+    my_db.close()
@@ -0,0 +1,230 @@
+#!/usr/bin/env python3
+# Кеш переводов интерфейса для tb.tr()
+# 1. словарь в памяти {lang: {(original, help): translation}}, загружается из базы при старте
+# 2. таблица translations в базе
+# 3. перевод ИИ в фоне, пока перевода нет юзер видит оригинал.
+#    Промахи на один язык собираются в пачку и переводятся одним запросом (my_trans_batch),
+#    по одной через всю цепочку ИИ переводятся только строки которые пачка не осилила
+
+
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List, Tuple
+
+from cachetools import LRUCache
+
+import cfg
+import my_db
+import my_log
+
+
+# {lang: {(original, help): translation}}
+CACHE: Dict[str, Dict[Tuple[str, str], str]] = {}
+# переводы которые не сохраняются в базе (save_cache=False), {(text, lang, help): translation}
+VOLATILE = LRUCache(maxsize=10000)
+LOCK = threading.Lock()
+
+# переводить промахи в фоне (True) или сразу в потоке юзера (False)
+BACKGROUND = cfg.TR_BACKGROUND if hasattr(cfg, 'TR_BACKGROUND') else True
+
+# функция перевода (text, lang, help) -> str, задается в init(), обычно цепочка ИИ из tb.py
+TRANSLATE_FUNC: Callable = None
+# пакетный перевод ([(text, help), ...], lang) -> [str, ...], задается в init(), обычно my_trans_batch.translate_batch
+BATCH_FUNC: Callable = None
+# сколько строк на один язык собирать в пачку и сколько ждать следующие строки, секунд
+TR_BATCH_SIZE = cfg.TR_BATCH_SIZE if hasattr(cfg, 'TR_BATCH_SIZE') else 40
+TR_BATCH_WAIT = cfg.TR_BATCH_WAIT if hasattr(cfg, 'TR_BATCH_WAIT') else 1.0
+
+# очередь фоновых переводов и то что уже в ней, что бы не ставить одно и то же дважды
+QUEUE = queue.Queue()
+PENDING = set()
+WORKER_STARTED = False
+
+# метрики
+BATCHES = 0
+BATCHED = 0
+SINGLE = 0
+
+
+def load():
+    '''Загрузить все переводы из базы в память'''
+    global CACHE
+    start = time.time()
+    rows = my_db.get_all_translations()
+    cache = {}
+    for original, lang, help, translation in rows:
+        if translation:
+            cache.setdefault(lang, {})[(original, help)] = translation
+    with LOCK:
+        CACHE = cache
+    my_log.log2(f'my_trans_cache:load: {len(rows)} translations, {len(cache)} languages, {time.time() - start:.2f}s')
+
+
+def init(translate_func: Callable, batch_func: Callable = None):
+    '''Загрузить кеш и запустить фоновый переводчик'''
+    global TRANSLATE_FUNC, BATCH_FUNC, WORKER_STARTED
+    TRANSLATE_FUNC = translate_func
+    BATCH_FUNC = batch_func
+    load()
+    with LOCK:
+        if WORKER_STARTED:
+            return
+        WORKER_STARTED = True
+    threading.Thread(target=worker, name='my_trans_cache', daemon=True).start()
+
+
+def get(text: str, lang: str, help: str) -> str:
+    '''Перевод из памяти или из базы, '' если его нет'''
+    translated = CACHE.get(lang, {}).get((text, help))
+    if translated:
+        return translated
+
+    with LOCK:
+        translated = VOLATILE.get((text, lang, help))
+    if translated:
+        return translated
+
+    translated = my_db.get_translation(text, lang, help)
+    if translated:
+        with LOCK:
+            CACHE.setdefault(lang, {})[(text, help)] = translated
+    return translated
+
+
+def put(text: str, lang: str, help: str, translation: str, save: bool = True):
+    '''Запомнить перевод, save=True - в базе и в постоянном кеше, иначе только в VOLATILE'''
+    with LOCK:
+        if save:
+            CACHE.setdefault(lang, {})[(text, help)] = translation
+        else:
+            VOLATILE[(text, lang, help)] = translation
+    if save:
+        my_db.update_translation(text, lang, help, translation)
+
+
+def remember(rows: list):
+    '''Запомнить в памяти переводы уже записанные в базу, rows - [(text, lang, help, translation), ...]'''
+    with LOCK:
+        for text, lang, help, translation in rows:
+            CACHE.setdefault(lang, {})[(text, help)] = translation
+
+
+def request(text: str, lang: str, help: str, save: bool = True) -> bool:
+    '''Поставить перевод в фоновую очередь, False если он уже там'''
+    key = (text, lang, help)
+    with LOCK:
+        if key in PENDING:
+            return False
+        PENDING.add(key)
+    QUEUE.put((text, lang, help, save))
+    return True
+
+
+def translate_now(text: str, lang: str, help: str, save: bool = True) -> str:
+    '''Перевести сразу через TRANSLATE_FUNC и запомнить, '' если не получилось'''
+    translated = TRANSLATE_FUNC(text, lang, help) if TRANSLATE_FUNC else ''
+    if translated and isinstance(translated, str):
+        put(text, lang, help, translated, save)
+        return translated
+    if translated:
+        my_log.log2(f'my_trans_cache:translate_now: переводчик вернул что то вместо строки {type(translated)}\n\n{str(translated)}')
+    return ''
+
+
+def _collect() -> List[Tuple[str, str, str, bool]]:
+    '''Дождаться промаха и добрать к нему из очереди до TR_BATCH_SIZE строк на тот же язык'''
+    batch = [QUEUE.get()]
+    lang, save = batch[0][1], batch[0][3]
+    other = []
+    deadline = time.time() + TR_BATCH_WAIT
+    while len(batch) < TR_BATCH_SIZE:
+        try:
+            item = QUEUE.get(timeout=max(0, deadline - time.time()))
+        except queue.Empty:
+            break
+        if item[1] == lang and item[3] == save:
+            batch.append(item)
+        else:
+            other.append(item)
+    # другие языки пойдут следующими пачками
+    for item in other:
+        QUEUE.put(item)
+    return batch
+
+
+def _translate(batch: List[Tuple[str, str, str, bool]]):
+    '''Перевести пачку одного языка, то что пачка не перевела - по одной через TRANSLATE_FUNC'''
+    global BATCHES, BATCHED, SINGLE
+    lang, save = batch[0][1], batch[0][3]
+    # могли перевести пока стояли в очереди
+    todo = [(text, help) for text, _, help, _ in batch if not CACHE.get(lang, {}).get((text, help))]
+    if not todo:
+        return
+
+    translated = [''] * len(todo)
+    if BATCH_FUNC and len(todo) > 1:
+        try:
+            translated = list(BATCH_FUNC(todo, lang))
+            translated += [''] * (len(todo) - len(translated))
+            BATCHES += 1
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_trans_cache:translate: {lang} {error}\n\n{traceback_error}')
+
+    rows = []
+    for (text, help), t in zip(todo, translated):
+        if t and isinstance(t, str):
+            rows.append((text, lang, help, t))
+            continue
+        SINGLE += 1
+        try:
+            if translate_now(text, lang, help, save):
+                continue
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_trans_cache:translate: {error}\n\n{traceback_error}')
+        # не повторять неудачный перевод, как и в tb.tr
+        put(text, lang, help, text, save=False)
+
+    if rows:
+        BATCHED += len(rows)
+        if save:
+            my_db.update_translations(rows)
+            remember(rows)
+        else:
+            with LOCK:
+                for text, lang, help, t in rows:
+                    VOLATILE[(text, lang, help)] = t
+
+
+def worker():
+    '''Фоновый переводчик промахов'''
+    while True:
+        batch = _collect()
+        try:
+            _translate(batch)
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'my_trans_cache:worker: {error}\n\n{traceback_error}')
+            for text, lang, help, _ in batch:
+                put(text, lang, help, text, save=False)
+        finally:
+            with LOCK:
+                for text, lang, help, _ in batch:
+                    PENDING.discard((text, lang, help))
+
+
+def get_stats() -> str:
+    with LOCK:
+        return (f'languages: {len(CACHE)}, strings: {sum(len(x) for x in CACHE.values())}, queued: {len(PENDING)}, '
+                f'batches: {BATCHES}, batched: {BATCHED}, one by one: {SINGLE}')
+
+
+if __name__ == '__main__':
+    pass
+    my_db.init(backup=False)
+    load()
+    print(get_stats())
+    my_db.close()
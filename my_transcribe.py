@@ -28,6 +28,7 @@ import cfg
 import my_gemini3
 import my_gemini_general
 import my_groq
+import my_llm_clients
 import my_log
 import my_ytb
 import utils
@@ -210,7 +211,7 @@ def genai_clear(key: str = '') -> None:
             return
 
         # Instantiate the client to avoid race conditions
-        client = genai.Client(api_key=api_key)
+        client = my_llm_clients.genai_client(api_key)
 
         # List and delete files. Converting to list() is safer.
         files_to_delete = list(client.files.list())
@@ -305,7 +306,7 @@ def transcribe_genai(
 
         try:
             key = my_gemini_general.get_next_key()
-            client = genai.Client(api_key=key, http_options={'timeout': int(remaining_time * 1000)})
+            client = my_llm_clients.genai_client(key, remaining_time)
 
             uploaded_file = client.files.upload(file=audio_file)
 
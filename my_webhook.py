@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+# Прием апдейтов телеграма через webhook, вместо bot.infinity_polling.
+# При polling один цикл long poll забирает апдейты и отдает их диспетчеру telebot.
+# Тут телеграм сам присылает апдейты на http адрес (WEBHOOK_URL, за nginx/прокси с https),
+# обработчик запроса только проверяет секрет, отсекает повторы по update_id и кладет апдейт
+# в очередь, а WEBHOOK_WORKERS потоков отдают апдейты в bot.process_new_updates (дальше как обычно
+# обработчики уходят в пулы my_executor). Апдейты одного чата всегда попадают в один поток,
+# поэтому их порядок сохраняется, а разные чаты обрабатываются параллельно.
+# Если очередь переполнена то телеграм получает 503 и пришлет апдейт еще раз.
+#
+# WEBHOOK_RECORD - файл куда записывать все принятые апдейты (json по строке),
+# их можно прогнать заново без телеграма для замера скорости приема:
+#   python my_webhook.py replay updates.jsonl
+
+
+import collections
+import json
+import queue
+import threading
+import time
+import traceback
+from typing import Callable, Dict, List
+
+import telebot
+from flask import Flask, request
+
+import cfg
+import my_api_server
+import my_log
+import my_log_writer
+
+
+# публичный https адрес который телеграм будет вызывать (полный, с путем), пусто - работать через polling
+WEBHOOK_URL = cfg.WEBHOOK_URL if hasattr(cfg, 'WEBHOOK_URL') else ''
+# где слушать локально, прокси должен пересылать WEBHOOK_URL сюда
+WEBHOOK_LISTEN = cfg.WEBHOOK_LISTEN if hasattr(cfg, 'WEBHOOK_LISTEN') else '127.0.0.1'
+WEBHOOK_PORT = cfg.WEBHOOK_PORT if hasattr(cfg, 'WEBHOOK_PORT') else 58797
+WEBHOOK_PATH = cfg.WEBHOOK_PATH if hasattr(cfg, 'WEBHOOK_PATH') else '/telegram'
+# телеграм присылает его в заголовке X-Telegram-Bot-Api-Secret-Token
+WEBHOOK_SECRET = cfg.WEBHOOK_SECRET if hasattr(cfg, 'WEBHOOK_SECRET') else ''
+# сколько потоков раздают апдейты обработчикам
+WEBHOOK_WORKERS = cfg.WEBHOOK_WORKERS if hasattr(cfg, 'WEBHOOK_WORKERS') else 8
+# сколько апдейтов держать в очереди (на все потоки вместе)
+WEBHOOK_QUEUE = cfg.WEBHOOK_QUEUE if hasattr(cfg, 'WEBHOOK_QUEUE') else 10000
+# файл для записи принятых апдейтов, пусто - не записывать
+WEBHOOK_RECORD = cfg.WEBHOOK_RECORD if hasattr(cfg, 'WEBHOOK_RECORD') else ''
+
+# сколько последних update_id помнить для отсева повторов
+SEEN_SIZE = 100000
+# сколько апдейтов отдавать в process_new_updates за раз
+BATCH_SIZE = 100
+
+
+def _shard_key(data: Dict) -> int:
+    '''id чата (или юзера) апдейта, что бы апдейты одного чата шли в один поток'''
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        # message, edited_message, channel_post... или callback_query с его message
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+    return 0
+
+
+class Dispatcher:
+    '''
+    Очередь апдейтов с отсевом повторов и пулом потоков.
+
+    process(updates) - обработка пачки апдейтов telebot.types.Update, обычно bot.process_new_updates
+    '''
+    def __init__(self, process: Callable[[List[telebot.types.Update]], None], workers: int = None, max_queue: int = None):
+        self.process = process
+        self.workers = max(1, workers or WEBHOOK_WORKERS)
+        per_worker = max(1, (max_queue or WEBHOOK_QUEUE) // self.workers)
+        self.queues = [queue.Queue(maxsize=per_worker) for _ in range(self.workers)]
+        self.threads = []
+
+        self.lock = threading.Lock()
+        self.seen = set()
+        self.seen_order = collections.deque()
+
+        # метрики
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.batches = 0
+        self.errors = 0
+
+    def start(self):
+        for n, q in enumerate(self.queues):
+            thread = threading.Thread(target=self._worker, args=(q,), name=f'my_webhook {n}', daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def feed(self, data: Dict) -> bool:
+        '''
+        Принять апдейт (json от телеграма в виде dict).
+        Returns:
+            False если очередь переполнена и апдейт надо прислать еще раз, повторы и мусор - True
+        '''
+        update_id = data.get('update_id')
+        if update_id is None:
+            return True
+        # разбираем тут а не в потоке, что бы битый апдейт не попал в очередь
+        update = telebot.types.Update.de_json(data)
+        with self.lock:
+            self.received += 1
+            if update_id in self.seen:
+                self.duplicates += 1
+                return True
+            try:
+                self.queues[hash(_shard_key(data)) % self.workers].put_nowait(update)
+            except queue.Full:
+                self.rejected += 1
+                return False
+            # запоминаем только принятые, иначе повтор от телеграма после 503 отсеется
+            self.seen.add(update_id)
+            self.seen_order.append(update_id)
+            if len(self.seen_order) > SEEN_SIZE:
+                self.seen.discard(self.seen_order.popleft())
+        return True
+
+    def _worker(self, q: queue.Queue):
+        while True:
+            update = q.get()
+            if update is None:
+                break
+            batch = [update]
+            stop = False
+            while len(batch) < BATCH_SIZE:
+                try:
+                    update = q.get_nowait()
+                except queue.Empty:
+                    break
+                if update is None:
+                    stop = True
+                    break
+                batch.append(update)
+            try:
+                self.process(batch)
+            except Exception as error:
+                traceback_error = traceback.format_exc()
+                my_log.log2(f'my_webhook:worker: {error}\n\n{traceback_error}')
+                with self.lock:
+                    self.errors += 1
+            with self.lock:
+                self.processed += len(batch)
+                self.batches += 1
+            if stop:
+                break
+
+    def stop(self, timeout: float = 10):
+        '''Дообработать очередь и остановить потоки'''
+        for q in self.queues:
+            q.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def qsize(self) -> int:
+        return sum(q.qsize() for q in self.queues)
+
+    def get_stats(self) -> str:
+        '''Текстовая сводка для /stats'''
+        with self.lock:
+            return (f'received: {self.received}, duplicates: {self.duplicates}, queue: {self.qsize()}, '
+                    f'rejected: {self.rejected}, processed: {self.processed} in {self.batches} batches, errors: {self.errors}')
+
+
+DISPATCHER: Dispatcher = None
+APP = Flask(__name__)
+# http сервер приема и флаг остановки, для stop()
+SERVER = None
+STOPPED = threading.Event()
+
+
+@APP.route(WEBHOOK_PATH, methods=['POST'])
+def receive():
+    '''Апдейт от телеграма'''
+    if WEBHOOK_SECRET and request.headers.get('X-Telegram-Bot-Api-Secret-Token') != WEBHOOK_SECRET:
+        return '', 403
+    data = request.get_json(silent=True, force=True)
+    if not isinstance(data, dict):
+        return '', 400
+    if WEBHOOK_RECORD:
+        my_log_writer.write(WEBHOOK_RECORD, json.dumps(data, ensure_ascii=False) + '\n')
+    if not DISPATCHER.feed(data):
+        return '', 503
+    return '', 200
+
+
+def run(bot: telebot.TeleBot, drop_pending_updates: bool = False):
+    '''
+    Зарегистрировать webhook в телеграме и принимать апдейты, блокирует до stop() (вместо bot.infinity_polling).
+    '''
+    global DISPATCHER, SERVER
+    STOPPED.clear()
+    DISPATCHER = Dispatcher(bot.process_new_updates)
+    DISPATCHER.start()
+    bot.remove_webhook()
+    bot.set_webhook(
+        url=WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET or None,
+        drop_pending_updates=drop_pending_updates,
+        max_connections=100,
+    )
+    try:
+        SERVER = my_api_server.create_server(WEBHOOK_LISTEN, WEBHOOK_PORT, app=APP)
+        thread = threading.Thread(target=SERVER.run, name='my_webhook server', daemon=True)
+        thread.start()
+        while thread.is_alive() and not STOPPED.wait(1):
+            pass
+    finally:
+        stop()
+        # webhook не снимаем, пока бот перезапускается телеграм копит апдейты у себя
+        DISPATCHER.stop()
+
+
+def stop():
+    '''Закрыть http сервер, run() вернет управление (например /restart)'''
+    global SERVER
+    STOPPED.set()
+    server, SERVER = SERVER, None
+    if server is not None:
+        try:
+            server.close()
+        except Exception as error:
+            my_log.log2(f'my_webhook:stop: {error}')
+
+
+def get_stats() -> str:
+    '''Текстовая сводка для /stats'''
+    return DISPATCHER.get_stats() if DISPATCHER else 'polling'
+
+
+def replay(path: str, process: Callable[[List[telebot.types.Update]], None] = None, workers: int = None) -> str:
+    '''
+    Прогнать записанные апдейты (WEBHOOK_RECORD) через Dispatcher без телеграма.
+    process - обработка пачки, по умолчанию ничего не делать (замер только приема и раздачи).
+    Returns:
+        сводка со скоростью
+    '''
+    updates = []
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                updates.append(json.loads(line))
+
+    dispatcher = Dispatcher(process or (lambda batch: None), workers=workers, max_queue=max(WEBHOOK_QUEUE, len(updates)))
+    dispatcher.start()
+    start = time.time()
+    for data in updates:
+        while not dispatcher.feed(data):
+            time.sleep(0.001)
+    fed = time.time() - start
+    dispatcher.stop(timeout=600)
+    total = time.time() - start
+    return (f'{len(updates)} updates, fed in {fed:.3f}s ({len(updates) / max(fed, 1e-9):.0f}/s), '
+            f'processed in {total:.3f}s ({dispatcher.processed / max(total, 1e-9):.0f}/s), {dispatcher.get_stats()}')
+
+
+if __name__ == '__main__':
+    pass
+
+    import sys
+
+    if len(sys.argv) > 2 and sys.argv[1] == 'replay':
+        print(replay(sys.argv[2], workers=int(sys.argv[3]) if len(sys.argv) > 3 else None))
+    else:
+        print('usage: python my_webhook.py replay updates.jsonl [workers]')
@@ -1,11 +1,9 @@
 #!/usr/bin/env python3
 
 
-import base64
 import concurrent.futures
 import io
 import importlib
-import hashlib
 import os
 import pickle
 import random
@@ -15,7 +13,6 @@ import sys
 import traceback
 import threading
 import time
-from flask import Flask, request, jsonify
 from decimal import Decimal, getcontext
 from multiprocessing.pool import ThreadPool
 from typing import Any, Dict, List, Optional, Union, Tuple
@@ -30,10 +27,13 @@ from sqlitedict import SqliteDict
 import cfg
 import md2tgmd
 import my_alert
+import my_api_server
+import my_browser_pool
 import my_init
 import my_genimg
 import my_cerebras
 import my_cerebras_tools
+import my_chat_action
 import my_cmd_callback
 import my_cmd_config
 import my_cmd_document
@@ -43,10 +43,14 @@ import my_cmd_photo
 import my_cmd_style
 import my_cmd_text
 import my_cmd_voice
+import my_coalesce
 import my_cohere
 import my_db
 import my_ddg
+import my_doc_index
 import my_doc_translate
+import my_executor
+import my_fifo
 import my_github
 import my_google
 # import my_gemini_embedding
@@ -56,7 +60,13 @@ import my_gemini_tts
 import my_gemini_genimg
 import my_gemini_google
 import my_groq
+import my_hedge
+import my_imgproc
+import my_key_scheduler
+import my_llm_clients
 import my_log
+import my_log_index
+import my_log_writer
 import my_md_tables_to_png
 import my_mistral
 import my_nebius
@@ -77,13 +87,17 @@ import my_sum
 import my_tavily
 import my_qrcode
 import my_trans
+import my_trans_batch
+import my_trans_cache
 import my_transcribe
 import my_tts
+import my_webhook
 import my_ytb
 import my_zip
 import utils
 import utils_llm
 from utils import async_run
+from my_executor import async_run_pool
 
 
 START_TIME = time.time()
@@ -97,10 +111,6 @@ if not os.path.exists('db'):
     os.mkdir('db')
 
 
-# API для доступа к функциям бота (бинг в основном)
-FLASK_APP = Flask(__name__)
-
-
 if hasattr(cfg, 'SKIP_PENDING') and cfg.SKIP_PENDING:
     bot = telebot.TeleBot(cfg.token, skip_pending=True)
 else:
@@ -181,15 +191,14 @@ CACHE_CHECK_PHONE = {}
 subscription_cache = {}
 
 # запоминаем прилетающие сообщения, если они слишком длинные и
-# были отправлены клиентом по кускам {id:[messages]}
-# ловим сообщение и ждем секунду не прилетит ли еще кусок
-MESSAGE_QUEUE = {}
+# были отправлены клиентом по кускам, склеиваем если за секунду не прилетел еще кусок
+MESSAGE_QUEUE = my_coalesce.Coalescer('text', pool='chat', max_size=my_coalesce.COALESCE_MAX_CHARS)
 # так же ловим пачки картинок(медиагруппы), телеграм их отправляет по одной
-MESSAGE_QUEUE_IMG = {}
+MESSAGE_QUEUE_IMG = my_coalesce.Coalescer('img', pool='image', max_size=my_coalesce.COALESCE_MAX_ITEMS)
 # так же ловим пачки картинок(медиагруппы)+текст, после пересылки картинки с инструкцией от юзера
 # они разделяются на 2 части, отдельно подпись от юзера и отдельно картинки
-MESSAGE_QUEUE_GRP = {}
-MESSAGE_QUEUE_AUDIO_GROUP = {}
+MESSAGE_QUEUE_GRP = my_coalesce.Coalescer('grp', pool='image', max_size=my_coalesce.COALESCE_MAX_ITEMS)
+MESSAGE_QUEUE_AUDIO_GROUP = my_coalesce.Coalescer('audio', pool='audio', max_size=my_coalesce.COALESCE_MAX_ITEMS)
 
 GEMIMI_TEMP_DEFAULT = 1
 
@@ -205,8 +214,6 @@ DEBUG_MD_TO_HTML = {}
 # {user_id: 'chatbot'(gemini, gemini15 etc)}
 WHO_ANSWERED = {}
 
-# кеш для переводов в оперативной памяти
-TRANS_CACHE = my_db.SmartCache()
 
 
 # key - time.time() float
@@ -218,9 +225,12 @@ TRANS_CACHE = my_db.SmartCache()
 #   m_ids as list of int,
 #   message_chat_id as int,
 #   message_message_id as int
-LOG_GROUP_MESSAGES = SqliteDict('db/log_group_messages.db', autocommit=True)
-LOG_GROUP_MESSAGES_LOCK = threading.Lock()
+LOG_GROUP_MESSAGES = my_fifo.PersistentFifo('db/log_group_queue.db', migrate_from='db/log_group_messages.db')
 LOG_GROUP_DAEMON_ENABLED = True
+# сколько записей очереди разбирать за раз
+LOG_GROUP_BATCH = 50
+# пауза после каждого сообщения в группу логов, телеграм разрешает около 20 сообщений в минуту в группу
+LOG_GROUP_SEND_INTERVAL = cfg.LOG_GROUP_SEND_INTERVAL if hasattr(cfg, 'LOG_GROUP_SEND_INTERVAL') else 3
 
 # {id:True} кто из юзеров не в этом словаре тому обновить клавиатуру
 # NEW_KEYBOARD = SqliteDict('db/new_keyboard_installed.db', autocommit=True)
@@ -256,47 +266,144 @@ class NoLock: # грязный хак что бы отключить замок
 
 
 class RequestCounter:
-    """Ограничитель числа запросов к боту
-    не дает делать больше 10 в минуту, банит на cfg.DDOS_BAN_TIME сек после превышения"""
-    def __init__(self):
-        self.counts = {}
+    """Ограничитель числа запросов к боту (token bucket)
+    у каждого юзера ведро на cfg.DDOS_MAX_PER_MINUTE жетонов, которое наполняется
+    равномерно за минуту, запрос стоит get_request_cost() жетонов,
+    если жетонов не хватило - бан на cfg.DDOS_BAN_TIME сек.
+    Проверка O(1), полные ведра и истекшие баны периодически удаляются"""
+    # как часто чистить память, сек
+    CLEANUP_INTERVAL = 300
 
-    def check_limit(self, user_id):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # {user_id: [tokens, last_time]}
+        self.buckets = {}
+        self.last_cleanup = time.time()
+        # метрики
+        self.allowed = 0
+        self.denied = 0
+        self.bans = 0
+        self.evicted = 0
+
+    def _capacity(self) -> float:
+        return float(cfg.DDOS_MAX_PER_MINUTE)
+
+    def _refill(self, bucket: list, now: float, capacity: float):
+        '''Добавить жетоны накопившиеся с прошлого обращения, вызывать под self.lock'''
+        bucket[0] = min(capacity, bucket[0] + (now - bucket[1]) * capacity / 60)
+        bucket[1] = now
+
+    def _cleanup(self, now: float, capacity: float):
+        '''Удалить полные ведра (юзер давно не писал) и истекшие баны, вызывать под self.lock'''
+        self.last_cleanup = now
+        rate = capacity / 60
+        idle = [k for k, (tokens, last) in self.buckets.items() if tokens + (now - last) * rate >= capacity]
+        for k in idle:
+            del self.buckets[k]
+        self.evicted += len(idle)
+        expired = [k for k, v in list(DDOS_BLOCKED_USERS.items()) if v <= now]
+        for k in expired:
+            DDOS_BLOCKED_USERS.pop(k, None)
+
+    def check_limit(self, user_id, cost: float = 1):
         """Возвращает True если лимит не превышен, False если превышен или юзер уже забанен"""
         current_time = time.time()
+        capacity = self._capacity()
+        # запрос дороже целого ведра все равно должен проходить когда ведро полное
+        cost = min(cost, capacity)
+
+        with self.lock:
+            if current_time - self.last_cleanup > self.CLEANUP_INTERVAL:
+                self._cleanup(current_time, capacity)
+
+            release_time = DDOS_BLOCKED_USERS.get(user_id)
+            if release_time:
+                if release_time > current_time:
+                    self.denied += 1
+                    return False
+                else:
+                    DDOS_BLOCKED_USERS.pop(user_id, None)
 
-        if user_id in DDOS_BLOCKED_USERS:
-            if DDOS_BLOCKED_USERS[user_id] > current_time:
-                return False
+            bucket = self.buckets.get(user_id)
+            if bucket is None:
+                bucket = self.buckets[user_id] = [capacity, current_time]
             else:
-                del DDOS_BLOCKED_USERS[user_id]
+                self._refill(bucket, current_time, capacity)
 
-        if user_id not in self.counts:
-            self.counts[user_id] = [current_time]
-            return True
-        else:
-            timestamps = self.counts[user_id]
-            # Удаляем старые временные метки, которые находятся за пределами 1 минуты
-            timestamps = [timestamp for timestamp in timestamps if timestamp >= current_time - 60]
-            if len(timestamps) < cfg.DDOS_MAX_PER_MINUTE:
-                timestamps.append(current_time)
-                self.counts[user_id] = timestamps
+            if bucket[0] >= cost:
+                bucket[0] -= cost
+                self.allowed += 1
                 return True
-            else:
-                DDOS_BLOCKED_USERS[user_id] = current_time + cfg.DDOS_BAN_TIME
-                my_log.log2(f'tb:request_counter:check_limit: user blocked {user_id}')
-                return False
+
+            DDOS_BLOCKED_USERS[user_id] = current_time + cfg.DDOS_BAN_TIME
+            # после бана начинает с полным ведром
+            del self.buckets[user_id]
+            self.denied += 1
+            self.bans += 1
+        my_log.log2(f'tb:request_counter:check_limit: user blocked {user_id}')
+        return False
+
+    def refund(self, user_id, cost: float = 1):
+        """Вернуть жетоны, например за части длинного сообщения которые склеиваются в одно"""
+        with self.lock:
+            bucket = self.buckets.get(user_id)
+            if bucket:
+                bucket[0] = min(self._capacity(), bucket[0] + cost)
+
+    def stats(self) -> str:
+        with self.lock:
+            now = time.time()
+            banned = sum(1 for v in list(DDOS_BLOCKED_USERS.values()) if v > now)
+            return (f'users tracked: {len(self.buckets)}, banned now: {banned}, '
+                    f'allowed: {self.allowed}, denied: {self.denied}, bans: {self.bans}, evicted: {self.evicted}')
 
 
 request_counter = RequestCounter()
 
-LOCK_FOR_SHOW_ACTION_LOCKS = threading.Lock()
-# {chat_id:lock}
-SHOW_ACTION_LOCKS = {}
 
-class ShowAction(threading.Thread):
-    """A thread that can be stopped. Continuously sends a notification of activity to the chat.
-    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated.
+# стоимость запроса в жетонах RequestCounter, по команде или типу сообщения, остальное стоит 1
+REQUEST_COSTS = {
+    'image': 5, 'img': 5, 'i': 5, 'imag': 5, 'imagine': 5, 'generate': 5, 'gen': 5,
+    'art': 5, 'picture': 5, 'pic': 5, 'gem': 5, 'flux': 5, 'bing': 5,
+    'voice': 2, 'audio': 2, 'video': 2, 'video_note': 2, 'document': 2, 'photo': 2,
+}
+if hasattr(cfg, 'DDOS_COSTS') and cfg.DDOS_COSTS:
+    REQUEST_COSTS.update(cfg.DDOS_COSTS)
+
+
+# альбомы (media_group_id) которые уже оплачены, {media_group_id: time}
+# альбом приходит пачкой сообщений по одному на картинку/файл, а платится как одно сообщение
+MEDIA_GROUPS_CHARGED = {}
+MEDIA_GROUPS_CHARGED_LOCK = threading.Lock()
+MEDIA_GROUPS_CHARGED_TTL = 60
+
+
+def get_request_cost(message: telebot.types.Message) -> float:
+    """Стоимость сообщения для RequestCounter"""
+    media_group_id = getattr(message, 'media_group_id', None)
+    if media_group_id:
+        now = time.time()
+        with MEDIA_GROUPS_CHARGED_LOCK:
+            if len(MEDIA_GROUPS_CHARGED) > 10000:
+                for k in [k for k, v in MEDIA_GROUPS_CHARGED.items() if now - v > MEDIA_GROUPS_CHARGED_TTL]:
+                    del MEDIA_GROUPS_CHARGED[k]
+            if now - MEDIA_GROUPS_CHARGED.get(media_group_id, 0) <= MEDIA_GROUPS_CHARGED_TTL:
+                return 0
+            MEDIA_GROUPS_CHARGED[media_group_id] = now
+
+    text = message.text or ''
+    if text.startswith('/'):
+        cmd = text[1:].split(maxsplit=1)[0] if len(text) > 1 else ''
+        cmd = cmd.split('@', maxsplit=1)[0].rstrip(':').lower()
+        if cmd in REQUEST_COSTS:
+            return REQUEST_COSTS[cmd]
+    return REQUEST_COSTS.get(message.content_type, 1)
+
+
+class ShowAction:
+    """Continuously shows a notification of activity in the chat while the block is running.
+    Telegram automatically extinguishes the notification after 5 seconds, so it must be repeated,
+    this is done by the shared scheduler thread in my_chat_action (one notification per chat).
 
     To use in the code, you need to do something like this:
     with ShowAction(message, 'typing'):
@@ -309,8 +416,8 @@ class ShowAction(threading.Thread):
             chat_id (_type_): id чата в котором будет отображаться уведомление
             action (_type_):  "typing", "upload_photo", "record_video", "upload_video", "record_audio", 
                               "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"
+            max_timeout (int): не дольше чем столько минут
         """
-        super().__init__()
         self.actions = [  "typing", "upload_photo", "record_video", "upload_video", "record_audio",
                          "upload_audio", "upload_document", "find_location", "record_video_note", "upload_video_note"]
         assert action in self.actions, f'Допустимые actions = {self.actions}'
@@ -321,9 +428,8 @@ class ShowAction(threading.Thread):
         self.lang = get_lang(self.full_chat_id, message)
         self.is_topic = True if message.is_topic_message else False
         self.action = action
-        self.is_running = True
-        self.timerseconds = 1
-        self.started_time = time.time()
+        self.is_running = False
+        self.handle = None
 
         # '' - отображение стандартным для телеграма стилем
         # 'message' - отображение в виде сообщения о том что бот что то пишет, сообщение удаляется автоматически
@@ -347,44 +453,24 @@ class ShowAction(threading.Thread):
                 disable_notification=True,
                 )
 
-    def run(self):
-        with LOCK_FOR_SHOW_ACTION_LOCKS:
-            if self.full_chat_id not in SHOW_ACTION_LOCKS:
-                SHOW_ACTION_LOCKS[self.full_chat_id] = threading.Lock()
-        with SHOW_ACTION_LOCKS[self.full_chat_id]:
-            while self.is_running:
-                if time.time() - self.started_time > 60 * self.max_timeout:
-                    self.stop()
-                    # my_log.log2(f'tb:1:show_action:stoped after 5min [{self.chat_id}] [{self.thread_id}] is topic: {self.is_topic} action: {self.action}')
-                    return
-                try:
-                    if not self.action_style:
-                        if self.is_topic:
-                            bot.send_chat_action(self.chat_id, self.action, message_thread_id = self.thread_id, timeout=30)
-                        else:
-                            bot.send_chat_action(self.chat_id, self.action, timeout=30)
-                except Exception as error:
-                    if 'A request to the Telegram API was unsuccessful. Error code: 429. Description: Too Many Requests' not in str(error):
-                        if 'Forbidden: bot was blocked by the user' in str(error):
-                            self.stop()
-                            return
-                        my_log.log2(f'tb:show_action:2:run: {str(error)} | {self.full_chat_id}')
-                n = 50
-                while n > 0:
-                    time.sleep(0.1)
-                    n = n - self.timerseconds
+    def start(self):
+        self.is_running = True
+        if not self.action_style:
+            self.handle = my_chat_action.add(self.chat_id, self.thread_id, self.action, self.is_topic, 60 * self.max_timeout)
 
     def stop(self):
-        self.timerseconds = 50
+        if not self.is_running:
+            return
         self.is_running = False
         try:
             if not self.action_style:
-                bot.send_chat_action(self.chat_id, 'cancel', message_thread_id = self.thread_id, timeout=30)
+                # гасим статус только если в этом чате больше никто ничего не делает
+                if my_chat_action.remove(self.chat_id, self.thread_id, self.handle):
+                    bot.send_chat_action(self.chat_id, 'cancel', message_thread_id = self.thread_id, timeout=30)
             elif self.action_style == 'message':
                 bot.delete_message(self.chat_id, self.action_message.message_id)
         except Exception as error:
             if 'Forbidden: bot was blocked by the user' in str(error):
-                self.stop()
                 return
             my_log.log2(f'tb:show_action:stop:3: {str(error)} | {self.full_chat_id}')
 
@@ -452,52 +538,43 @@ def tr(text: str, lang: str, help: str = '', save_cache: bool = True) -> str:
         if not help:
             help = 'its a gui message in telegram bot, keep it same format and average size to fit gui'
 
-        cache_key = (text, lang, help)
-        cache_key_hash = hashlib.md5(str(cache_key).encode()).hexdigest()
-        translated = TRANS_CACHE.get(cache_key_hash)
+        translated = my_trans_cache.get(text, lang, help)
         if translated:
             return translated
 
-        translated = my_db.get_translation(text, lang, help)
-        if translated:
-            TRANS_CACHE.set(cache_key_hash, translated)
-            return translated
-
-
-        translated = ''
+        # строки интерфейса переводятся в фоне, пока перевода нет юзер видит оригинал
+        if save_cache and my_trans_cache.BACKGROUND and my_trans_cache.WORKER_STARTED:
+            my_trans_cache.request(text, lang, help)
+            return text
 
+        translated = my_trans_cache.translate_now(text, lang, help, save=save_cache)
         if not translated:
-            translated = my_gemini3.translate(text, to_lang=lang, help=help, censored=True)
+            # не повторять неудачный перевод
+            my_trans_cache.put(text, lang, help, text, save=False)
+            return text
+        return translated
+    except Exception as unknown:
+        traceback_error = traceback.format_exc()
+        my_log.log2(f'tb:tr: {unknown}\n{traceback_error}')
+        return text
 
-        if not translated:
-            translated = my_groq.translate(text, to_lang=lang, help=help)
 
-        if not translated:
-            translated = my_cerebras.translate(text, to_lang=lang, help=help)
+def tr_translate(text: str, lang: str, help: str) -> str:
+    """Перевод строки цепочкой переводчиков, '' если никто не справился.
+    Используется кешем my_trans_cache для промахов.
+    """
+    translated = my_gemini3.translate(text, to_lang=lang, help=help, censored=True)
 
-        if not translated:
-            translated = my_trans.translate(text, lang)
+    if not translated:
+        translated = my_groq.translate(text, to_lang=lang, help=help)
 
+    if not translated:
+        translated = my_cerebras.translate(text, to_lang=lang, help=help)
 
-        if not translated:
-            translated = text
-            TRANS_CACHE.set(cache_key_hash, translated)
-            return text
+    if not translated:
+        translated = my_trans.translate(text, lang)
 
-        TRANS_CACHE.set(cache_key_hash, translated)
-        if save_cache:
-            my_db.update_translation(text, lang, help, translated)
-
-        if isinstance(translated, str):
-            return translated
-        else:
-            traceback_error = traceback.format_exc()
-            my_log.log2(f'tb:tr: переводчик вернул что то вместо строки {type(translated)}\n\n{str(translated)}\n\n{traceback_error}')
-            return text
-    except Exception as unknown:
-        traceback_error = traceback.format_exc()
-        my_log.log2(f'tb:tr: {unknown}\n{traceback_error}')
-        return text
+    return translated
 
 
 def add_to_bots_mem(query: str, resp: str, chat_id_full: str):
@@ -746,14 +823,15 @@ def extract_user_id(message: telebot.types.Message) -> int:
         return None
 
 
-def check_blocked_user(id_: str, from_user_id: int, check_trottle = True):
-    """Raises an exception if the user is blocked and should not be replied to"""
+def check_blocked_user(id_: str, from_user_id: int, check_trottle = True, cost: float = 1):
+    """Raises an exception if the user is blocked and should not be replied to
+    cost - сколько жетонов RequestCounter стоит этот запрос"""
     for x in cfg.admins:
         if id_ == f'[{x}] [0]':
             return
     user_id = id_.replace('[','').replace(']','').split()[0]
     if check_trottle:
-        if not request_counter.check_limit(user_id):
+        if not request_counter.check_limit(user_id, cost):
             # my_log.log2(f'tb:check_blocked_user: User {id_} is blocked for DDoS')
             raise Exception(f'user {user_id} in ddos stop list, ignoring')
 
@@ -844,6 +922,82 @@ def is_for_me(message: telebot.types.Message) -> bool:
         my_log.log2(f'tb:is_for_me:{unexpected_error}\n\n{traceback_error}')
 
 
+def _log_group_units(items: list) -> list:
+    """
+    Split a batch of LOG_GROUP_MESSAGES records into telegram sends.
+    Consecutive 'new' texts of one chat are glued into one message (up to 4000 chars),
+    records of different chats go to different topics so their relative order does not matter.
+
+    Returns:
+        list of (seqs, value) - queue keys covered by the send and the record to send
+    """
+    units = []
+    # последняя 'new' отправка каждого чата к которой еще можно приклеить текст
+    open_new = {}
+    for seq, value in items:
+        _type, _text, _chat_full_id = value[0], value[1], value[2]
+        if _type == 'new':
+            unit = open_new.get(_chat_full_id)
+            if unit is not None and len(unit[1][1]) + len(_text) + 1 <= 4000:
+                unit[0].append(seq)
+                unit[1][1] += '\n' + _text
+                continue
+            unit = ([seq], list(value))
+            units.append(unit)
+            open_new[_chat_full_id] = unit
+        else:
+            units.append(([seq], list(value)))
+            open_new.pop(_chat_full_id, None)
+    return units
+
+
+def _log_group_send(value: list) -> float:
+    """
+    Send or copy one record to the chat's forum topic in the logging group,
+    creating the topic if needed.
+
+    Returns:
+        how many seconds to wait before the next send
+    """
+    _type, _text, _chat_full_id, _chat_name, _m_ids, _message_chat_id, _message_message_id = value
+
+    if _chat_full_id in LOGS_GROUPS_DB:
+        th = LOGS_GROUPS_DB[_chat_full_id]
+    else:
+        try:
+            th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
+            LOGS_GROUPS_DB[_chat_full_id] = th
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'tb:log_group_daemon:create group topic: {error}\n{traceback_error}')
+            return LOG_GROUP_SEND_INTERVAL # drop message
+
+    def send(th: int):
+        if _type == 'new':
+            bot.send_message(cfg.LOGS_GROUP, _text, message_thread_id=th)
+        elif _m_ids:
+            bot.copy_messages(cfg.LOGS_GROUP, _message_chat_id, _m_ids, message_thread_id=th)
+        else:
+            bot.copy_message(cfg.LOGS_GROUP, _message_chat_id, _message_message_id, message_thread_id=th)
+
+    try:
+        send(th)
+    except Exception as error_0:
+        try:
+            if 'Bad Request: message thread not found' in str(error_0):
+                th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
+                LOGS_GROUPS_DB[_chat_full_id] = th
+                send(th)
+            else:
+                raise error_0
+        except Exception as error:
+            traceback_error = traceback.format_exc()
+            my_log.log2(f'tb:log_group_daemon:{_type} message: {error}\n{traceback_error}\n\n{_text}')
+
+    # каждое скопированное сообщение считается телеграмом отдельно
+    return LOG_GROUP_SEND_INTERVAL * (len(_m_ids) if _type == 'copy' and _m_ids else 1)
+
+
 @async_run
 def log_group_daemon():
     """
@@ -851,10 +1005,10 @@ def log_group_daemon():
     It sends new messages or copies existing messages to a designated logging group 
     based on their type and chat information. 
 
-    The function retrieves the oldest message from the queue, extracts its details, 
-    and then attempts to send or copy it to the appropriate forum topic within the 
-    logging group. It handles potential errors during topic creation and message 
-    sending/copying, logging any exceptions encountered. 
+    The function takes a batch of the oldest records from the queue, glues consecutive
+    'new' texts of the same chat into one message, and sends or copies them to the
+    appropriate forum topic within the logging group, pausing between sends to stay
+    within telegram group limits. Sent records are removed from the queue.
 
     The daemon continues processing messages until the LOG_GROUP_DAEMON_ENABLED flag 
     is set to False.
@@ -864,81 +1018,22 @@ def log_group_daemon():
             return
 
         global LOG_GROUP_DAEMON_ENABLED
-        group = 10
+        time.sleep(10)
         while LOG_GROUP_DAEMON_ENABLED:
             try:
-                time.sleep(3 + group) # telegram limit 1 message per second for groups
-                group = 0
-                with LOG_GROUP_MESSAGES_LOCK:
-                    try:
-                        min_key = min(LOG_GROUP_MESSAGES.keys())
-                    except ValueError:
-                        continue # no messages in queue
-                    value = LOG_GROUP_MESSAGES[min_key]
-                    _type = value[0]
-                    _text = value[1]
-                    _chat_full_id = value[2]
-                    _chat_name = value[3]
-                    _m_ids = value[4]
-                    _message_chat_id = value[5]
-                    _message_message_id = value[6]
-
-                    if _chat_full_id in LOGS_GROUPS_DB:
-                        th = LOGS_GROUPS_DB[_chat_full_id]
-                    else:
-                        try:
-                            th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
-                            LOGS_GROUPS_DB[_chat_full_id] = th
-                        except Exception as error:
-                            traceback_error = traceback.format_exc()
-                            my_log.log2(f'tb:log_group_daemon:create group topic: {error}\n{traceback_error}')
-                            del LOG_GROUP_MESSAGES[min_key] # drop message
-                            continue
-
-                    if _type == 'new':
-                        try:
-                            bot.send_message(cfg.LOGS_GROUP, _text, message_thread_id=th)
-                        except Exception as error2_0:
-                            try:
-                                if 'Bad Request: message thread not found' in str(error2_0):
-                                    th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
-                                    LOGS_GROUPS_DB[_chat_full_id] = th
-                                    bot.send_message(cfg.LOGS_GROUP, _text, message_thread_id=th)
-                            except Exception as error2:
-                                traceback_error = traceback.format_exc()
-                                my_log.log2(f'tb:log_group_daemon:send message: {error2}\n{traceback_error}\n\n{_text}')
-
-                    elif _type == 'copy':
-                        if _m_ids:
-                            try:
-                                group = len(_m_ids)*3
-                                bot.copy_messages(cfg.LOGS_GROUP, _message_chat_id, _m_ids, message_thread_id=th)
-                            except Exception as error3_0:
-                                try:
-                                    if 'Bad Request: message thread not found' in str(error3_0):
-                                        th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
-                                        LOGS_GROUPS_DB[_chat_full_id] = th
-                                        bot.copy_messages(cfg.LOGS_GROUP, _message_chat_id, _m_ids, message_thread_id=th)
-                                except Exception as error3:
-                                    traceback_error = traceback.format_exc()
-                                    my_log.log2(f'tb:log_group_daemon:copy message: {error3}\n{traceback_error}\n\n{_text}')
-                        else:
-                            try:
-                                bot.copy_message(cfg.LOGS_GROUP, _message_chat_id, _message_message_id, message_thread_id=th)
-                            except Exception as error4_0:
-                                try:
-                                    if 'Bad Request: message thread not found' in str(error4_0):
-                                        th = bot.create_forum_topic(cfg.LOGS_GROUP, _chat_full_id + ' ' + _chat_name).message_thread_id
-                                        LOGS_GROUPS_DB[_chat_full_id] = th
-                                        bot.copy_message(cfg.LOGS_GROUP, _message_chat_id, _message_message_id, message_thread_id=th)
-                                except Exception as error4:
-                                    traceback_error = traceback.format_exc()
-                                    my_log.log2(f'tb:log_group_daemon:copy message2: {error4}\n{traceback_error}\n\n{_text}')
-
-                    del LOG_GROUP_MESSAGES[min_key]
+                if not LOG_GROUP_MESSAGES.wait(1):
+                    continue # no messages in queue
+                items = LOG_GROUP_MESSAGES.peek(LOG_GROUP_BATCH)
+                for seqs, value in _log_group_units(items):
+                    if not LOG_GROUP_DAEMON_ENABLED:
+                        break
+                    pause = _log_group_send(value)
+                    LOG_GROUP_MESSAGES.delete(seqs)
+                    time.sleep(pause) # telegram limit for groups
             except Exception as unknown_error:
                 traceback_error = traceback.format_exc()
                 my_log.log2(f'tb:log_group_daemon: {unknown_error}\n{traceback_error}')
+                time.sleep(LOG_GROUP_SEND_INTERVAL)
     except Exception as unexpected_error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:log_group_daemon:{unexpected_error}\n\n{traceback_error}')
@@ -964,13 +1059,11 @@ def log_message_add(_type: str,
         _message_message_id (int): Unique ID of the message.
     """
     try:
-        with LOG_GROUP_MESSAGES_LOCK:
-            if _chat_full_id in DDOS_BLOCKED_USERS:
-                return
-            current_time = time.perf_counter_ns()
-            value = (_type, _text, _chat_full_id, _chat_name, _m_ids, _message_chat_id, _message_message_id)
-            if value not in LOG_GROUP_MESSAGES.values():
-                LOG_GROUP_MESSAGES[current_time] = value
+        if _chat_full_id in DDOS_BLOCKED_USERS:
+            return
+        value = (_type, _text, _chat_full_id, _chat_name, _m_ids, _message_chat_id, _message_message_id)
+        # дубликаты отсекает сама очередь
+        LOG_GROUP_MESSAGES.put(value, _chat_full_id)
     except Exception as unexpected_error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:log_message_add:{unexpected_error}\n\n{traceback_error}')
@@ -1279,14 +1372,14 @@ def authorized(message: telebot.types.Message) -> bool:
             if is_reply or is_private or bot_name_used:
                 # check for blocking and throttling
                 try:
-                    check_blocked_user(chat_id_full, message.from_user.id)
+                    check_blocked_user(chat_id_full, message.from_user.id, cost=get_request_cost(message))
                 except:
                     my_log.log_auth(f'tb:authorized:6: User {chat_id_full} is blocked. Text: {text} Caption: {caption}')
                     return False
         else:
             try:
                 if is_reply or is_private or bot_name_used:
-                    check_blocked_user(chat_id_full, message.from_user.id)
+                    check_blocked_user(chat_id_full, message.from_user.id, cost=get_request_cost(message))
             except:
                 my_log.log_auth(f'tb:authorized:7: User {chat_id_full} is blocked. Text: {text} Caption: {caption}')
                 return False
@@ -1384,6 +1477,18 @@ def bot_reply_tr(
         my_log.log2(f'tb:bot_reply_tr:{unexpected_error}\n\n{traceback_error}')
 
 
+def executor_reject(category: str, args: tuple, kwargs: dict):
+    """Ответ юзеру когда его апдейт не влез в очередь пула my_executor"""
+    if not args:
+        return
+    message = args[0]
+    # CallbackQuery -> его сообщение
+    if not hasattr(message, 'chat') and hasattr(message, 'message'):
+        message = message.message
+    if hasattr(message, 'chat'):
+        bot_reply_tr(message, 'Too many requests, please wait a bit and try again.', not_log=True)
+
+
 def bot_reply(
     message: telebot.types.Message,
     msg: str,
@@ -1960,7 +2065,7 @@ def get_keyboard(kbd: str, message: telebot.types.Message, flag: str = '') -> te
 
 
 @bot.callback_query_handler(func=authorized_callback)
-@async_run
+@async_run_pool('chat')
 def callback_inline_thread(call: telebot.types.CallbackQuery):
     """Обработчик клавиатуры"""
     my_cmd_callback.callback_inline_thread(
@@ -2132,7 +2237,7 @@ def transcribe_file(data: bytes, file_name: str, message: telebot.types.Message)
 
 
 @bot.message_handler(content_types=['voice', 'video', 'video_note', 'audio'], func=authorized)
-@async_run
+@async_run_pool('audio')
 def handle_voice(message: telebot.types.Message):
     """
     Обрабатывает одиночные и сгруппированные аудио/видео сообщения.
@@ -2170,7 +2275,7 @@ def handle_voice(message: telebot.types.Message):
 
 
 @bot.message_handler(content_types = ['location',], func=authorized)
-@async_run
+@async_run_pool('chat')
 def handle_location(message: telebot.types.Message):
     """Если юзер прислал геолокацию"""
     try:
@@ -2192,7 +2297,7 @@ def handle_location(message: telebot.types.Message):
 
 
 @bot.message_handler(content_types = ['contact',], func=authorized)
-@async_run
+@async_run_pool('chat')
 def handle_contact(message: telebot.types.Message):
     """Если юзер прислал контакст"""
     try:
@@ -2456,7 +2561,7 @@ AllowedIPs = {AllowedIPs}
 
 
 @bot.message_handler(content_types = ['document',], func=authorized)
-@async_run
+@async_run_pool('documents')
 def handle_document(message: telebot.types.Message):
     """Обработчик документов"""
     my_cmd_document.handle_document(
@@ -2497,8 +2602,8 @@ def handle_document(message: telebot.types.Message):
     )
 
 
-def download_image_from_message(message: telebot.types.Message) -> bytes:
-    '''Download image from message'''
+def download_image_from_message(message: telebot.types.Message, convert: bool = True) -> bytes:
+    '''Download image from message, convert=False - без уменьшения и пережатия в jpg'''
     try:
         if message.photo:
             photo = message.photo[-1]
@@ -2559,8 +2664,10 @@ def download_image_from_message(message: telebot.types.Message) -> bytes:
         # уменьшить до 2000 пикселей и пережать в jpg 60% если еще не меньше 2000 и jpg
 
         # return utils.heic2jpg(image)
+        if not convert:
+            return image
         # уменьшаем картинку до 2000 пикселей и переделываем в жпг
-        return utils.resize_and_convert_to_jpg(image, 2000, 60)
+        return my_imgproc.process('resize_and_convert_to_jpg', image, 2000, 60)
     except Exception as error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:download_image_from_message2: {error} {traceback_error}')
@@ -2570,9 +2677,11 @@ def download_image_from_message(message: telebot.types.Message) -> bytes:
 def download_image_from_messages(MESSAGES: list) -> list:
     '''Download images from message list'''
     try:
+        # в потоках только скачивание, пережатие всех картинок одной пачкой в процессах my_imgproc
         with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
-            images = list(executor.map(download_image_from_message, MESSAGES))
-        return images
+            images = list(executor.map(lambda x: download_image_from_message(x, convert=False), MESSAGES))
+        converted = iter(my_imgproc.process_batch('resize_and_convert_to_jpg', [x for x in images if x], 2000, 60, default=b''))
+        return [next(converted) if x else x for x in images]
     except Exception as unexpected_error:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:download_image_from_messages:{unexpected_error}\n\n{traceback_error}')
@@ -2580,7 +2689,7 @@ def download_image_from_messages(MESSAGES: list) -> list:
 
 
 @bot.message_handler(commands=['config', 'settings', 'setting', 'options'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def config(message: telebot.types.Message):
     """Меню настроек"""
     try:
@@ -2597,7 +2706,7 @@ def config(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['gmodels','gmodel','gm'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def gmodel(message: telebot.types.Message):
     """Показывает модели доступные в gemini"""
     try:
@@ -2656,7 +2765,7 @@ def gmodel(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['vacuum', 'vacuum_db', 'vacuumdb', 'clean', 'clean_db', 'cleandb', 'cleanup'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def vacuum_db(message: telebot.types.Message):
     """Чистка базы (блокирует бота на какое то время)"""
     try:
@@ -2671,8 +2780,39 @@ def vacuum_db(message: telebot.types.Message):
         my_log.log2(f'tb:vacuum_db: {unknown}\n{traceback_error}')
 
 
+@bot.message_handler(commands=['migrate_blobs'], func=authorized_admin)
+@async_run_pool('admin')
+def migrate_blobs(message: telebot.types.Message):
+    """Пережать старые lzma блобы в базе текущим кодеком
+    /migrate_blobs - только пережать
+    /migrate_blobs train - сначала обучить общий словарь zstd на диалогах
+    /migrate_blobs bench - показать сравнение кодеков на реальных диалогах
+    """
+    try:
+        with ShowAction(message):
+            chat_id_full = get_topic_id(message)
+            COMMAND_MODE[chat_id_full] = ''
+            arg = message.text.split(maxsplit=1)[1].strip().lower() if ' ' in message.text else ''
+
+            if arg == 'bench':
+                result = my_db.benchmark_blobs()
+                bot_reply(message, f'<pre>{utils.html.escape(result)}</pre>', parse_mode='HTML')
+                return
+
+            if arg == 'train':
+                dict_id = my_db.train_blob_dict()
+                bot_reply(message, f'zstd dictionary: {dict_id}')
+
+            bot_reply_tr(message, 'Converting database blobs. Please wait...')
+            result = my_db.migrate_blobs()
+            bot_reply(message, result)
+    except Exception as unknown:
+        traceback_error = traceback.format_exc()
+        my_log.log2(f'tb:migrate_blobs: {unknown}\n{traceback_error}')
+
+
 @bot.message_handler(commands=['transcribe',], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def transcribe(message: telebot.types.Message):
     """
     Бот может транскрибировать аудиозапись, переделать ее в субтитры.
@@ -2692,7 +2832,7 @@ def transcribe(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['model','Model'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def model(message: telebot.types.Message):
     """Юзеры могут менять модель для openrouter.ai"""
     try:
@@ -2720,7 +2860,7 @@ def model(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['maxhistlines',], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def maxhistlines(message: telebot.types.Message):
     """Юзеры могут менять maxhistlines для openrouter.ai"""
     try:
@@ -2749,7 +2889,7 @@ def maxhistlines(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['maxhistchars',], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def maxhistchars(message: telebot.types.Message):
     """Юзеры могут менять maxhistchars для openrouter.ai"""
     try:
@@ -2778,7 +2918,7 @@ def maxhistchars(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['maxtokens',], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def maxtokens(message: telebot.types.Message):
     """Юзеры могут менять maxtokens для openrouter.ai"""
     try:
@@ -2807,7 +2947,7 @@ def maxtokens(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['model_price'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def model_price(message: telebot.types.Message):
     """Пользователи могут устанавливать значения in_price и out_price,
        а также необязательный параметр currency."""
@@ -2862,7 +3002,7 @@ def model_price(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['list_models'])
-@async_run
+@async_run_pool('chat')
 def list_models_command(message: telebot.types.Message):
     """
     Handles the /list_models command, displaying available models to the user.
@@ -2898,7 +3038,7 @@ def list_models_command(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['set_timeout', 'timeout'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def set_timeout(message: telebot.types.Message):
     """Юзеры могут менять timeout для openrouter.ai"""
     try:
@@ -2924,7 +3064,7 @@ def set_timeout(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['reasoningeffort',], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def reasoningeffort(message: telebot.types.Message):
     """Юзеры могут менять reasoning effort для openrouter.ai"""
     try:
@@ -2960,7 +3100,7 @@ def reasoningeffort(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['tool_use', 'tools'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def tool_use(message: telebot.types.Message) -> None:
     """
     Sets the tool usage level for the user. Arguments are English-only.
@@ -3026,7 +3166,7 @@ def tool_use(message: telebot.types.Message) -> None:
 
 
 @bot.message_handler(commands=['openrouter', 'bothub'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def openrouter(message: telebot.types.Message) -> None:
     """
     Manages user settings for OpenRouter.ai and other compatible services.
@@ -3162,7 +3302,7 @@ Example for a Russian translation:
 
 
 @bot.message_handler(commands=['tgui'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def translation_gui(message: telebot.types.Message):
     """Исправление перевода сообщений от бота
 
@@ -3202,11 +3342,7 @@ def translation_gui(message: telebot.types.Message):
                         new_translation = my_groq.translate(original, to_lang = lang, help = help)
                         my_db.add_msg(chat_id_full, my_groq.DEFAULT_MODEL)
                     if new_translation:
-                        my_db.update_translation(original, lang, help, new_translation)
-
-                        cache_key = (original, lang, help)
-                        cache_key_hash = hashlib.md5(str(cache_key).encode()).hexdigest()
-                        TRANS_CACHE.set(cache_key_hash, new_translation)
+                        my_trans_cache.put(original, lang, help, new_translation)
 
                         translated_counter += 1
                         bot_reply(message, f'New translation:\n\n{new_translation}', disable_web_page_preview=True)
@@ -3219,7 +3355,7 @@ def translation_gui(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['create_all_translations'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def create_all_translations(message: telebot.types.Message):
     """Команда для создания переводов на все языки"""
     try:
@@ -3235,26 +3371,20 @@ def create_all_translations(message: telebot.types.Message):
 def create_translations_for_all_languages():
     """
     Создает переводы на все языки для уникальных оригиналов.
+    Переводятся только недостающие, пачками, языки параллельно (my_trans_batch).
     """
     # Получаем уникальные оригиналы и их подсказки из базы данных
     try:
         unique_originals: List[Tuple[str, str]] = my_db.get_unique_originals()
-
-        for original, help_text in unique_originals:
-            # Переводим на все поддерживаемые языки
-            for target_lang in my_init.top_20_used_languages:
-                try:
-                    translated = tr(original, target_lang, help=help_text, save_cache=True)
-                    my_log.log_translate(f'{target_lang}\n\n{original}\n\n{translated}')
-                except Exception as error:
-                    my_log.log_translate(f'Failed to translate: {original} to {target_lang}. Error: {str(error)}')
+        stats = my_trans_batch.translate_missing(unique_originals, my_init.top_20_used_languages)
+        my_log.log_translate(f'tb:create_translations_for_all_languages: {stats}')
     except Exception as unknown:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:create_translations_for_all_languages: {unknown}\n{traceback_error}')
 
 
 @bot.message_handler(commands=['keys', 'key', 'Keys', 'Key'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def users_keys_collector(message: telebot.types.Message):
     """Юзеры могут добавить свои бесплатные ключи для джемини в общий котёл"""
     try:
@@ -3344,14 +3474,12 @@ def users_keys_collector(message: telebot.types.Message):
                 bot_reply_tr(message, 'Added API key for github successfully!')
 
             if keys_groq:
-                my_groq.USER_KEYS[chat_id_full] = keys_groq[0]
-                my_groq.ALL_KEYS.append(keys_groq[0])
+                my_groq.add_user_key(chat_id_full, keys_groq[0])
                 my_log.log_keys(f'Added new API key for Groq: {chat_id_full} {keys_groq}')
                 bot_reply_tr(message, 'Added API key for Groq successfully!')
 
             if keys_cerebras:
-                my_cerebras.USER_KEYS[chat_id_full] = keys_cerebras[0]
-                my_cerebras.ALL_KEYS.append(keys_cerebras[0])
+                my_cerebras.add_user_key(chat_id_full, keys_cerebras[0])
                 my_log.log_keys(f'Added new API key for Cerebras: {chat_id_full} {keys_cerebras}')
                 bot_reply_tr(message, 'Added API key for Cerebras successfully!')
 
@@ -3362,7 +3490,6 @@ def users_keys_collector(message: telebot.types.Message):
                     for key in keys:
                         if key not in my_gemini_general.ALL_KEYS and key not in cfg.gemini_keys:
                             if my_gemini3.test_new_key(key, chat_id_full):
-                                my_gemini_general.ALL_KEYS.append(key)
                                 new_keys.append(key)
                                 added_flag = True
                                 my_log.log_keys(f'Added new api key for Gemini: {chat_id_full} {key}')
@@ -3374,7 +3501,8 @@ def users_keys_collector(message: telebot.types.Message):
                                 msg = tr('Failed to add new API key for Gemini:', lang) + f' {key}'
                                 bot_reply(message, msg)
                 if added_flag:
-                    my_gemini_general.USER_KEYS[chat_id_full] = new_keys
+                    with my_gemini_general.USER_KEYS_LOCK:
+                        my_gemini_general.add_user_key(chat_id_full, new_keys)
                     bot_reply_tr(message, 'Added keys successfully!')
                     return
 
@@ -3437,7 +3565,7 @@ def users_keys_collector(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['addkey', 'addkeys'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def addkeys(message: telebot.types.Message):
     try:
         args = message.text.split(maxsplit=2)
@@ -3445,23 +3573,20 @@ def addkeys(message: telebot.types.Message):
         uid = f'[{uid}] [0]'
         key = args[2].strip()
         bot_reply(message, f'{uid} {key}')
-        if key not in my_gemini_general.ALL_KEYS:
-            my_gemini_general.ALL_KEYS.append(key)
-            my_gemini_general.USER_KEYS[uid] = [key,]
-            bot_reply_tr(message, 'Added keys successfully!')
-        else:
-            for uid_ in [x for x in my_gemini_general.USER_KEYS.keys()]:
-                if uid_ in my_gemini_general.USER_KEYS:
-                    if my_gemini_general.USER_KEYS[uid_] == [key,]:
+        with my_gemini_general.USER_KEYS_LOCK:
+            if key in my_gemini_general.ALL_KEYS:
+                for uid_ in my_gemini_general.KEYS.owners.get(key, set()).copy():
+                    if my_gemini_general.USER_KEYS.get(uid_) == [key,]:
                         del my_gemini_general.USER_KEYS[uid_]
-            my_gemini_general.USER_KEYS[uid] = [key,]
-            bot_reply_tr(message, 'Added keys successfully!')
+                        my_gemini_general.KEYS.remove_owner(key, uid_)
+            my_gemini_general.add_user_key(uid, [key,])
+        bot_reply_tr(message, 'Added keys successfully!')
     except Exception as error:
         bot_reply_tr(message, 'Usage: /addkeys <user_id as int> <key>')
 
 
 @bot.message_handler(commands=['donate', 'star', 'stars'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def donate(message: telebot.types.Message):
     try:
         chat_id_full = get_topic_id(message)
@@ -3478,7 +3603,7 @@ def donate(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['sdonate', 'sstar', 'sstars'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def sdonate(message: telebot.types.Message):
     '''админ может добавить звезды пользователю
     использование - sdonate <id> <количество>'''
@@ -3503,7 +3628,7 @@ def sdonate(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['drop_subscription'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def drop_subscription(message: telebot.types.Message):
     '''
     админ может удалить запись об активной подписке
@@ -3614,7 +3739,7 @@ def send_all_files_from_storage(message: telebot.types.Message, chat_id_full: st
 
 
 @bot.message_handler(commands=['calc', 'math'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def calc_gemini(message: telebot.types.Message):
     """
     Calculate math expression with google gemini code execution tool
@@ -3660,7 +3785,7 @@ def calc_gemini(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['ytb'], func=authorized_owner)
-@async_run
+@async_run_pool('audio')
 def download_ytb_audio(message: telebot.types.Message):
     """
     Shows info about a YouTube video and presents download options.
@@ -3727,7 +3852,7 @@ def download_ytb_audio(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['memo', 'memos'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def memo_handler(message: telebot.types.Message):
     """
     Попросить бота запомнить что то.
@@ -3806,7 +3931,7 @@ Usage : /memo &lt;text&gt; or &lt;number to delete&gt; - попросить бо
 
 
 @bot.message_handler(commands=['memo_admin'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def memo_admin_handler(message: telebot.types.Message):
     """
     Allows admins to manage memos for other users.
@@ -3917,7 +4042,7 @@ def change_mode(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['set_stt_mode', 'stt'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def set_stt_mode(message: telebot.types.Message):
     """
     Allows admins to set or view the Speech-to-Text (STT) engine for a specific user.
@@ -3985,7 +4110,7 @@ def set_stt_mode(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['set_chat_mode'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def set_chat_mode(message: telebot.types.Message):
     """mandatory switch user from one chatbot to another"""
     try:
@@ -4022,7 +4147,7 @@ def set_chat_mode(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['disable_chat_mode'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def disable_chat_mode(message: telebot.types.Message):
     """mandatory switch all users from one chatbot to another"""
     try:
@@ -4048,7 +4173,7 @@ def disable_chat_mode(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['disable_stt_mode'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def disable_stt_mode(message: telebot.types.Message):
     """
     Принудительно переключает движок Speech-to-Text (STT) для всех пользователей
@@ -4107,7 +4232,7 @@ def disable_stt_mode(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['restore_chat_mode'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def restore_chat_mode(message: telebot.types.Message):
     """
     Восстанавливает предыдущие режимы чата для всех пользователей, у которых они были сохранены.
@@ -4181,7 +4306,7 @@ def change_last_bot_answer(chat_id_full: str, text: str, message: telebot.types.
 
 
 @bot.message_handler(commands=['force',], func=authorized_log)
-@async_run
+@async_run_pool('chat')
 def force_cmd(message: telebot.types.Message):
     """Update last bot answer"""
     try:
@@ -4205,7 +4330,7 @@ def force_cmd(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['undo', 'u', 'U', 'Undo'], func=authorized_log)
-@async_run
+@async_run_pool('chat')
 def undo_cmd(message: telebot.types.Message, show_message: bool = True):
     """Clear chat history last message (bot's memory)"""
     try:
@@ -4300,7 +4425,7 @@ def reset_(message: telebot.types.Message, say: bool = True, chat_id_full: str =
 
 
 @bot.message_handler(commands=['reset', 'clear', 'new'], func=authorized_log)
-@async_run
+@async_run_pool('chat')
 def reset(message: telebot.types.Message):
     """Clear chat history (bot's memory)"""
     try:
@@ -4323,7 +4448,7 @@ def reset(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['remove_keyboard'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def remove_keyboard(message: telebot.types.Message):
     try:
         chat_id_full = get_topic_id(message)
@@ -4364,7 +4489,7 @@ def change_style2(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['save'], func=authorized_owner)
-@async_run
+@async_run_pool('documents')
 def save_history(message: telebot.types.Message):
     """
     Сохранить переписку в формате .docx и .odt
@@ -4439,7 +4564,7 @@ def save_history(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['mem'], func=authorized_owner)
-@async_run
+@async_run_pool('documents')
 def send_debug_history(message: telebot.types.Message):
     """
     Отправляет текущую историю сообщений пользователю.
@@ -4512,7 +4637,7 @@ def send_debug_history(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['load'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def load_memory_handler(message: telebot.types.Message):
     """
     Загружает "память" (историю чата) другого пользователя в текущий чат.
@@ -4626,14 +4751,18 @@ def restart(message):
         if isinstance(message, telebot.types.Message):
             bot_reply_tr(message, 'Restarting bot, please wait')
         my_log.log2('tb:restart: !!!RESTART!!!')
-        bot.stop_polling()
+        if my_webhook.WEBHOOK_URL:
+            # в режиме webhook main ждет в my_webhook.run, а не в polling
+            my_webhook.stop()
+        else:
+            bot.stop_polling()
     except Exception as unknown:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:restart: {unknown}\n{traceback_error}')
 
 
 @bot.message_handler(commands=['leave'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def leave_thread(message: telebot.types.Message):
     """выйти из чата"""
     try:
@@ -4664,7 +4793,7 @@ def leave_thread(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['revoke'], func=authorized_admin) 
-@async_run
+@async_run_pool('admin')
 def revoke(message: telebot.types.Message):
     """разбанить чат(ы)"""
     try:
@@ -4690,7 +4819,7 @@ def revoke(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['temperature', 'temp'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def set_new_temperature(message: telebot.types.Message):
     """Changes the temperature for Gemini
     /temperature <0...2>
@@ -4749,7 +4878,7 @@ def set_new_temperature(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['atemp'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def atemp_command(message: telebot.types.Message):
     """
     Admin command to set or view a new temperature for a specific user.
@@ -4830,7 +4959,7 @@ def change_user_language(message):
 
 
 @bot.message_handler(commands=['lang', 'language'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def language(message: telebot.types.Message):
     """change locale"""
     try:
@@ -4863,7 +4992,7 @@ def language(message: telebot.types.Message):
 
 
 # @bot.message_handler(commands=['tts'], func=authorized)
-@async_run
+@async_run_pool('audio')
 def tts(message: telebot.types.Message, caption = None):
     """ /tts [ru|en|uk|...] [+-XX%] <текст>
         /tts <URL>
@@ -5013,7 +5142,7 @@ def tts(message: telebot.types.Message, caption = None):
 
 
 @bot.message_handler(commands=['google','Google'], func=authorized)
-@async_run
+@async_run_pool('chat')
 def google(message: telebot.types.Message):
     """ищет в гугле перед ответом"""
     try:
@@ -5131,7 +5260,7 @@ def check_vip_user_gemini(chat_id_full: str) -> bool:
 
 
 @bot.message_handler(commands=['downgrade', ], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def downgrade_handler(message: telebot.types.Message):
     '''ищет юзеров у которых уже есть больше 1000 сообщений и при этом нет ключей и звёзд,
     если у таких юзеров выбран чат режим gemini pro то меняет его на gemini
@@ -5154,7 +5283,7 @@ def downgrade_handler(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['gem', 'Gem', 'GEM', 'GEN', 'Gen', 'gen'], func=authorized)
-@async_run
+@async_run_pool('image')
 def image_gemini_gen(message: telebot.types.Message):
     """
     Generates 1-4 images using Gemini 2.5 in parallel, with a fallback to Gemini 2.0.
@@ -5288,7 +5417,7 @@ def image_gemini_gen(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['flux'], func=authorized)
-@async_run
+@async_run_pool('image')
 def image_flux_gen(message: telebot.types.Message):
     """Generates an image using the Flux Nebius model ('black-forest-labs/flux-dev').
     /flux <prompt>
@@ -5392,7 +5521,7 @@ def image_flux_gen(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['bing', 'Bing'], func=authorized)
-@async_run
+@async_run_pool('image')
 def image_bing_gen(message: telebot.types.Message):
     try:
         chat_id_full = get_topic_id(message)
@@ -5409,7 +5538,7 @@ def image_bing_gen(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['gpt', 'Gpt', 'GPT'], func=authorized)
-@async_run
+@async_run_pool('image')
 def image_bing_gen_gpt(message: telebot.types.Message):
     try:
         chat_id_full = get_topic_id(message)
@@ -5512,7 +5641,7 @@ def send_images_to_pic_group(
     ],
     func=authorized
 )
-@async_run
+@async_run_pool('image')
 def image_gen(message: telebot.types.Message):
     """Generates a picture from a description"""
     my_cmd_img.image_gen(
@@ -5549,7 +5678,7 @@ def image_gen(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['stats', 'stat'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def stats(message: telebot.types.Message):
     """Функция, показывающая статистику использования бота."""
     try:
@@ -5592,6 +5721,25 @@ def stats(message: telebot.types.Message):
             msg += f'\nGithub keys: {len(my_github.ALL_KEYS)}'
             msg += f'\nCerebras keys: {len(my_cerebras.ALL_KEYS)}'
             msg += f'\n\n Uptime: {get_uptime()}'
+            msg += f'\n\nWorker pools:\n{my_executor.get_stats()}'
+            msg += f'\n\nGUI translations: {my_trans_cache.get_stats()}'
+            msg += f'\n\nRate limiter: {request_counter.stats()}'
+            msg += f'\n\nChat actions: {my_chat_action.get_stats()}'
+            msg += f'\n\nLLM clients: {my_llm_clients.get_stats()}'
+            msg += f'\n\nAPI keys:\n{my_key_scheduler.get_stats()}'
+            msg += f'\n\nHedged fallbacks: {my_hedge.get_stats()}'
+            msg += f'\n\nMessage coalescing: {my_coalesce.get_stats(MESSAGE_QUEUE, MESSAGE_QUEUE_IMG, MESSAGE_QUEUE_GRP, MESSAGE_QUEUE_AUDIO_GROUP)}'
+            msg += f'\n\nLog writer: {my_log_writer.get_stats()}'
+            msg += f'\n\nLog index: {my_log_index.get_stats()}'
+            msg += f'\n\nSaved file index: {my_doc_index.get_stats()}'
+            msg += f'\n\nBrowser pool: {my_browser_pool.get_stats()}'
+            msg += f'\n\nImage processing: {my_imgproc.get_stats()}'
+            msg += f'\n\nDocument translation: {my_doc_translate.get_stats()}'
+            msg += f'\n\nLog group queue: {LOG_GROUP_MESSAGES.get_stats()}'
+            msg += f'\n\nImage generation: {my_genimg.get_stats()}'
+            if hasattr(cfg, 'BING_API') and cfg.BING_API:
+                msg += f'\n\nHTTP API: {my_api_server.get_stats()}'
+            msg += f'\n\nUpdates: {my_webhook.get_stats()}'
 
             usage_plots_image = my_stat.draw_user_activity(90)
             stat_data = my_stat.get_model_usage_for_days(90)
@@ -5640,7 +5788,7 @@ def stats(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['shell', 'cmd'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def shell_command(message: telebot.types.Message):
     """Выполняет шел комманды"""
     try:
@@ -5676,7 +5824,7 @@ def shell_command(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['block'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def block_command_handler(message: telebot.types.Message):
     """Handles the /block command to manage user blocking."""
     try:
@@ -5771,7 +5919,7 @@ def list_blocked_users(message: telebot.types.Message, level: int):
 
 
 @bot.message_handler(commands=['msg', 'm', 'message', 'mes'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def message_to_user(message: telebot.types.Message):
     """отправка сообщения от админа юзеру"""
     try:
@@ -5838,7 +5986,7 @@ def message_to_user(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['alert'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def alert(message: telebot.types.Message):
     """Сообщение всем кого бот знает."""
     try:
@@ -5873,7 +6021,7 @@ def alert(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['ask2', 'а2'], func=authorized)
-@async_run
+@async_run_pool('documents')
 def ask_file2(message: telebot.types.Message):
     '''ответ по сохраненному файлу, вариант с чистым промптом'''
     try:
@@ -5885,7 +6033,7 @@ def ask_file2(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['ask', 'а'], func=authorized)
-@async_run
+@async_run_pool('documents')
 def ask_file(message: telebot.types.Message):
     '''ответ по сохраненному файлу, админ может запросить файл другого пользователя'''
     try:
@@ -6006,7 +6154,7 @@ def ping(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['sum', 'Sum'], func=authorized)
-@async_run
+@async_run_pool('documents')
 def summ_text(message: telebot.types.Message):
     '''
     Пересказ текстов, видеороликов, ссылок
@@ -6104,7 +6252,7 @@ def summ_text(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['sum2'], func=authorized)
-@async_run
+@async_run_pool('documents')
 def summ2_text(message: telebot.types.Message):
     # убирает запрос из кеша если он там есть и делает запрос снова
     try:
@@ -6129,7 +6277,7 @@ def summ2_text(message: telebot.types.Message):
 
 
 #@bot.message_handler(commands=['trans', 'tr', 't'], func=authorized)
-@async_run
+@async_run_pool('chat')
 def trans(message: telebot.types.Message):
     '''
     Перевод текста
@@ -6191,7 +6339,7 @@ def trans(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['name'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def send_name(message: telebot.types.Message):
     """Меняем имя если оно подходящее, содержит только русские и английские буквы и не
     слишком длинное"""
@@ -6226,7 +6374,7 @@ def send_name(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['start'], func = authorized_log)
-@async_run
+@async_run_pool('chat')
 def send_welcome_start(message: telebot.types.Message):
     # Отправляем приветственное сообщение
     try:
@@ -6294,7 +6442,7 @@ def send_welcome_start(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['help'], func = authorized_log)
-@async_run
+@async_run_pool('chat')
 def send_welcome_help(message: telebot.types.Message):
     # Отправляем приветственное сообщение
     try:
@@ -6323,7 +6471,7 @@ def send_welcome_help(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['help2'], func = authorized_log)
-@async_run
+@async_run_pool('chat')
 def send_welcome_help2(message: telebot.types.Message):
     '''
     Дополнительное объяснение по ключам и опенроутеру
@@ -6350,7 +6498,7 @@ def send_welcome_help2(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['report'], func = authorized_log)
-@async_run
+@async_run_pool('chat')
 def report_cmd_handler(message: telebot.types.Message):
     try:
         chat_id_full = get_topic_id(message)
@@ -6375,7 +6523,7 @@ def report_cmd_handler(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['purge'], func = authorized_owner)
-@async_run
+@async_run_pool('chat')
 def purge_cmd_handler(message: telebot.types.Message):
     """удаляет логи юзера"""
     try:
@@ -6395,11 +6543,7 @@ def purge_cmd_handler(message: telebot.types.Message):
         if my_log.purge(message.chat.id):
             lang = get_lang(chat_id_full, message)
 
-            with LOG_GROUP_MESSAGES_LOCK:
-                for k in [x for x in LOG_GROUP_MESSAGES.keys()]:
-                    data = LOG_GROUP_MESSAGES[k]
-                    if data[2] == chat_id_full:
-                        del LOG_GROUP_MESSAGES[k]
+            LOG_GROUP_MESSAGES.remove_by_key(chat_id_full)
 
             # my_gemini3.reset(chat_id_full, model = my_db.get_user_property(chat_id_full, 'chat_mode'))
             my_gemini3.reset(chat_id_full)
@@ -6411,6 +6555,7 @@ def purge_cmd_handler(message: telebot.types.Message):
             my_ddg.reset(chat_id_full)
             if my_doc_translate.TRANSLATE_CACHE:
                 my_doc_translate.TRANSLATE_CACHE.remove_by_owner(chat_id_full)
+            my_doc_index.remove(chat_id_full)
 
             my_skills_storage.STORAGE.pop(chat_id_full, None)
 
@@ -6461,7 +6606,7 @@ def purge_cmd_handler(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['id'], func=authorized_log)
-@async_run
+@async_run_pool('chat')
 def id_cmd_handler(message: telebot.types.Message):
     """показывает id юзера и группы в которой сообщение отправлено"""
     try:
@@ -6672,7 +6817,7 @@ def id_cmd_handler(message: telebot.types.Message):
 
 # эту команду вероятно не следует выносить в отдельный модуль, что бы она сама себя не могла перезагрузить
 @bot.message_handler(commands=['reload'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def reload_module(message: telebot.types.Message):
     '''command for reload imported module on the fly'''
     chat_id_full = get_topic_id(message)
@@ -6766,6 +6911,10 @@ def reload_module(message: telebot.types.Message):
                         db_backup = cfg.DB_BACKUP if hasattr(cfg, 'DB_BACKUP') else True
                         db_vacuum = cfg.DB_VACUUM if hasattr(cfg, 'DB_VACUUM') else False
                         my_db.init(db_backup, db_vacuum)
+                    elif current_module_name == 'my_executor':
+                        my_executor.REJECT_CALLBACK = executor_reject
+                    elif current_module_name == 'my_chat_action':
+                        my_chat_action.init(bot)
 
                     results.append(f'{tr("Модуль успешно перезагружен:", lang)} {current_module_name}')
 
@@ -6784,7 +6933,7 @@ def reload_module(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['enable'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def enable_chat(message: telebot.types.Message):
     """что бы бот работал в чате надо его активировать там"""
     try:
@@ -6809,7 +6958,7 @@ def enable_chat(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['disable'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def disable_chat(message: telebot.types.Message):
     """что бы бот не работал в чате надо его деактивировать там"""
     try:
@@ -6826,7 +6975,7 @@ def disable_chat(message: telebot.types.Message):
 
 
 @bot.message_handler(commands=['histsize', 'memsize'], func=authorized_owner)
-@async_run
+@async_run_pool('chat')
 def set_history_size(message: telebot.types.Message) -> None:
     """
     Sets the number of last request/response pairs to keep in history for the user.
@@ -6892,7 +7041,7 @@ def set_history_size(message: telebot.types.Message) -> None:
 
 
 @bot.message_handler(commands=['init'], func=authorized_admin)
-@async_run
+@async_run_pool('admin')
 def set_default_commands(message: telebot.types.Message):
     """
     Reads a file containing a list of commands and their descriptions,
@@ -8055,8 +8204,8 @@ def send_voice(
 
 
 @bot.message_handler(content_types = ['photo', "text"], func=authorized)
-@async_run
-def handle_photo_and_text(message: telebot.types.Message):
+@async_run_pool('image')
+def handle_photo_and_text(message: telebot.types.Message, batch: List[telebot.types.Message] = None):
     """
     Обработчик текстовых сообщени и картинок, нужен что бы ловить пересланные картинки с подписью,
     телеграм разделяет их на 2 сообщения, отдельно подпись которую делает юзер к пересылаемой картинке
@@ -8068,6 +8217,8 @@ def handle_photo_and_text(message: telebot.types.Message):
     Если сообщений несколько и они разного типа то приоритет должен быть у картинок, текст надо
     добавлять им в caption, причем caption должен быть только у одной картинки
     (надо пробежаться по ним и убрать у всех кроме одного а у одного сделать склейку)
+
+    batch - пачка склеенная MESSAGE_QUEUE_GRP, при первом вызове None
     """
     try:
         chat_id_full = get_topic_id(message)
@@ -8076,28 +8227,15 @@ def handle_photo_and_text(message: telebot.types.Message):
         # зачем тут сбрасывать? из за этого текстовый обработчик не получает команды
         # COMMAND_MODE[chat_id_full] = ''
 
-        # catch groups of messages
-        if chat_id_full not in MESSAGE_QUEUE_GRP:
-            MESSAGE_QUEUE_GRP[chat_id_full] = [message,]
-            last_state = MESSAGE_QUEUE_GRP[chat_id_full]
-            n = 10
-            while n > 0:
-                n -= 1
-                time.sleep(0.1)
-                new_state = MESSAGE_QUEUE_GRP[chat_id_full]
-                if last_state != new_state:
-                    last_state = new_state
-                    n = 10
-        else:
-            MESSAGE_QUEUE_GRP[chat_id_full].append(message)
+        # catch groups of messages, обработка продолжится когда придет вся пачка
+        if batch is None:
+            # пачка и так выполняется в пуле image, поэтому без декоратора
+            MESSAGE_QUEUE_GRP.submit(chat_id_full, message,
+                                     lambda parts: handle_photo_and_text.__wrapped__(parts[0], batch=parts),
+                                     user_key=my_executor.get_user_key(message))
             return
 
-
-        if len(MESSAGE_QUEUE_GRP[chat_id_full]) > 1:
-            MESSAGES = MESSAGE_QUEUE_GRP[chat_id_full]
-        else:
-            MESSAGES = [message,]
-        del MESSAGE_QUEUE_GRP[chat_id_full]
+        MESSAGES = batch
 
 
         is_image = False
@@ -8314,7 +8452,7 @@ def edit_image_detect(text: str, lang: str, chat_id_full: str, message: telebot.
 
 
 @bot.message_handler(content_types = ['photo', 'sticker', 'animation'], func=authorized)
-@async_run
+@async_run_pool('image')
 def handle_photo(message: telebot.types.Message):
     """Обработчик фотографий. Сюда же попадают новости которые создаются как фотография
     + много текста в подписи, и пересланные сообщения в том числе"""
@@ -8349,6 +8487,7 @@ def handle_photo(message: telebot.types.Message):
         send_all_files_from_storage=send_all_files_from_storage,
         ShowAction=ShowAction,
         download_image_from_message=download_image_from_message,
+        download_image_from_messages=download_image_from_messages,
         img2img=img2img,
 
         # Command handler functions
@@ -8359,8 +8498,7 @@ def handle_photo(message: telebot.types.Message):
 
 @bot.message_handler(func=authorized)
 def echo_all(message: telebot.types.Message, custom_prompt: str = '') -> None:
-    thread = threading.Thread(target=do_task, args=(message, custom_prompt ))
-    thread.start()
+    my_executor.submit('chat', do_task, message, custom_prompt)
 def do_task(message, custom_prompt = ''):
     """default handler"""
     my_cmd_text.do_task(
@@ -8541,109 +8679,22 @@ def one_time_shot():
         my_log.log2(f'tb:one_time_shot: {error}\n{traceback_error}')
 
 
-## rest api #######################################################################
-
-@FLASK_APP.route('/bing', methods=['POST'])
-def bing_api_post() -> Dict[str, Any]:
-    """
-    API endpoint for generating images using Bing.
-
-    :return: A JSON response containing a list of URLs or an error message.
-    """
-    try:
-        # Get JSON data from the request
-        data: Dict[str, Any] = request.get_json()
-
-        # Extract the prompt from the JSON data
-        prompt: str = data.get('prompt', '')
-
-        if not prompt:
-            return jsonify({"error": "Prompt is required"}), 400
-
-        # Generate images using Bing API
-        image_urls: List[str] = my_genimg.gen_images_bing_only(prompt)
-        # image_urls: List[str] = ['url1', 'url2', 'url3', 'url4']
-
-        if not image_urls:
-            return jsonify({"error": "No images generated"}), 404
-
-        return jsonify({"urls": image_urls}), 200
-    except Exception as e:
-        my_log.log_bing_api(f'tb:bing_api_post: {e}')
-        return jsonify({"error": str(e)}), 500
-
-
-@FLASK_APP.route('/images', methods=['POST'])
-def images_api_post() -> Dict[str, Any]:
-    """
-    API endpoint for generating images using all providers.
-
-    :return: A JSON response containing a list of URLs (str) or base64 encoded image data (str) or an error message.
-    """
-    try:
-        # Get JSON data from the request
-        data: Dict[str, Any] = request.get_json()
-
-        # Extract the prompt from the JSON data
-        prompt: str = data.get('prompt', '')
-
-        if not prompt:
-            return jsonify({"error": "Prompt is required"}), 400
-
-        # Generate images using available APIs, the result can be a list of strings (URLs) or bytes (image data)
-        image_results: List[Union[str, bytes]] = my_genimg.gen_images(prompt, user_id='api_images')
-        # image_results: List[Union[str, bytes]] = ['url1', b'image_data_1', 'url2', b'image_data_2']
-
-        if not image_results:
-            prompt = prompt.strip()
-            # remove trailing !
-            prompt = re.sub(r'^!+', '', prompt).strip()
-            # Get English prompt and negative prompt using the function
-            reprompt, negative_prompt, preffered_aspect_ratio = my_genimg.get_reprompt(prompt)
-            if not reprompt.startswith('MODERATION'):
-                image_results = my_genimg.flux_nebius_gen1(reprompt, negative_prompt, model = 'black-forest-labs/flux-dev')
-
-        if not image_results:
-            return jsonify({"error": "No images generated"}), 404
-
-        # Process the results to convert bytes to base64 encoded strings
-        processed_results: List[str] = []
-        for item in image_results:
-            if isinstance(item, bytes):
-                # Encode bytes to base64 string
-                processed_results.append(base64.b64encode(item).decode('utf-8'))
-            else:
-                # Assume it's a string (URL) and add it directly
-                processed_results.append(item)
-
-        return jsonify({"results": processed_results}), 200
-
-    except Exception as e:
-        my_log.log_bing_api(f'tb:images_api_post: {e}')
-        return jsonify({"error": str(e)}), 500
-
-
-@async_run
-def run_flask(addr: str ='127.0.0.1', port: int = 58796):
-    try:
-        FLASK_APP.run(debug=True, use_reloader=False, host=addr, port = port)
-    except Exception as error:
-        my_log.log_bing_api(f'tb:run_flask: {error}')
-
-
-## rest api #######################################################################
-
-
 def main():
     """
     Runs the main function, which sets default commands and starts polling the bot.
     """
     try:
+        # процессы для картинок создаются через fork, делаем это до запуска баз и демонов
+        my_imgproc.start()
 
         db_backup = cfg.DB_BACKUP if hasattr(cfg, 'DB_BACKUP') else True
         db_vacuum = cfg.DB_VACUUM if hasattr(cfg, 'DB_VACUUM') else False
         my_db.init(db_backup, db_vacuum)
 
+        my_executor.REJECT_CALLBACK = executor_reject
+        my_trans_cache.init(tr_translate, my_trans_batch.translate_batch)
+        my_chat_action.init(bot)
+
         load_msgs()
         scan_and_cache_module_timestamps() # Scan for reloadable modules on startup
 
@@ -8662,8 +8713,8 @@ def main():
         log_group_daemon()
 
         if hasattr(cfg, 'BING_API') and cfg.BING_API:
-            run_flask(addr='127.0.0.1', port=58796)
-            # run_flask(addr='0.0.0.0', port=58796)
+            my_api_server.start(addr='127.0.0.1', port=58796)
+            # my_api_server.start(addr='0.0.0.0', port=58796)
 
         time.sleep(1)
 
@@ -8679,12 +8730,20 @@ def main():
         # my_cohere.test_chat()
 
 
-        bot.infinity_polling(timeout=90, long_polling_timeout=90)
+        if my_webhook.WEBHOOK_URL:
+            my_webhook.run(bot, drop_pending_updates=bool(hasattr(cfg, 'SKIP_PENDING') and cfg.SKIP_PENDING))
+        else:
+            bot.infinity_polling(timeout=90, long_polling_timeout=90)
 
         global LOG_GROUP_DAEMON_ENABLED
         LOG_GROUP_DAEMON_ENABLED = False
         time.sleep(10)
         my_db.close()
+        my_llm_clients.close()
+        my_key_scheduler.save_all()
+        my_browser_pool.shutdown()
+        my_imgproc.shutdown()
+        my_log_writer.shutdown()
     except Exception as unknown:
         traceback_error = traceback.format_exc()
         my_log.log2(f'tb:main: {unknown}\n{traceback_error}')
@@ -2473,6 +2473,10 @@ def resize_and_convert_to_jpg(image_data: Union[bytes, str], max_size: int = 200
         # Проверяем, был ли исходник уже JPG и достаточно мал
         if img.format == 'JPEG' and img.size[0] <= max_size and img.size[1] <= max_size:
             original_format_was_jpeg_and_small_enough = True
+        elif img.format == 'JPEG':
+            # большой jpeg сразу декодируем уменьшенным в 2/4/8 раз (draft), но не меньше max_size
+            scale = max_size / max(img.size)
+            img.draft('RGB', (math.ceil(img.size[0] * scale), math.ceil(img.size[1] * scale)))
 
     except PIL.Image.UnidentifiedImageError:
         # Если my_log не определен, закомментируй эту строку
@@ -1,3 +1,8 @@
+import json
+
+import json_repair
+
+
 def split_thoughts(text: str) -> tuple[str, str]:
     """
     Splits the thoughts of the LLM model and the answer from the text.
@@ -168,3 +173,73 @@ e
 """
     result = text_to_mem_dict(test_text)
     print(result)
+
+
+def build_batch_translate_prompt(items: list, to_lang: str, from_lang: str = '') -> str:
+    '''
+    Промпт для перевода пачки строк за один запрос.
+
+    Args:
+        items: список пар (text, help), help - подсказка переводчику для этой строки.
+        to_lang: язык перевода.
+        from_lang: язык оригинала, пусто - автоопределение.
+
+    Returns:
+        Текст запроса, ответ ожидается в виде {"translations": [{"id": int, "translation": str}, ...]}
+    '''
+    data = []
+    for i, (text, help) in enumerate(items):
+        item = {'id': i, 'text': text}
+        if help:
+            item['hint'] = help
+        data.append(item)
+
+    return f'''Translate every "text" of the JSON array below from language [{from_lang or 'autodetect'}] to language [{to_lang}].
+"hint" is a note that can help you to translate this item better, do not translate it.
+Keep formatting, markdown, html tags, placeholders and emojis as is.
+
+Using this JSON schema:
+  result = {{"translations": [{{"id": int, "translation": str}}]}}
+Return a `result` with exactly one translation for every id.
+
+ITEMS:
+
+{json.dumps(data, ensure_ascii=False, indent=1)}
+'''
+
+
+def parse_batch_translation(response: str, count: int) -> list:
+    '''
+    Разобрать ответ на build_batch_translate_prompt.
+
+    Returns:
+        Список длиной count, на месте непереведенных строк ''.
+    '''
+    result = [''] * count
+    if not response or not isinstance(response, str):
+        return result
+
+    try:
+        data = json_repair.loads(response)
+    except Exception:
+        return result
+
+    if isinstance(data, dict):
+        data = data.get('translations') or data.get('result') or []
+        # {"result": {"translations": [...]}}
+        if isinstance(data, dict):
+            data = data.get('translations') or []
+    if not isinstance(data, list):
+        return result
+
+    for item in data:
+        if not isinstance(item, dict):
+            continue
+        try:
+            i = int(item.get('id'))
+        except (TypeError, ValueError):
+            continue
+        translation = item.get('translation')
+        if 0 <= i < count and isinstance(translation, str):
+            result[i] = translation
+    return result